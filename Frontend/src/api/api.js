@@ -2,12 +2,22 @@ import axios from 'axios';
 
 const API_BASE = 'http://localhost:5000/api';
 
-export const uploadInvoice = (file) => {
+export const uploadInvoice = (file, uploadId) => {
   const formData = new FormData();
   formData.append('file', file);
-  return axios.post(`${API_BASE}/upload`, formData, {
-    headers: { 'Content-Type': 'multipart/form-data' },
+  const headers = { 'Content-Type': 'multipart/form-data' };
+  if (uploadId) headers['X-Upload-ID'] = uploadId;
+  return axios.post(`${API_BASE}/upload`, formData, { headers });
+};
+
+// Server-Sent Events: 'progress' ({stage, invoice_id, upload_id}) and 'invoice' ({result}).
+// Returns a function closing the stream.
+export const subscribeEvents = (handlers) => {
+  const source = new EventSource(`${API_BASE}/events`);
+  Object.entries(handlers).forEach(([type, handler]) => {
+    source.addEventListener(type, (event) => handler(JSON.parse(event.data)));
   });
+  return () => source.close();
 };
 
 export const getInvoices = () => axios.get(`${API_BASE}/invoices`);
@@ -18,6 +28,9 @@ export const getRecommendations = (id) => axios.get(`${API_BASE}/recommendations
 
 export const getAnalysis = (id) => axios.get(`${API_BASE}/analysis/${id}`);
 
+// Dashboard KPIs, maintained server-side as invoices are saved or corrected
+export const getDashboard = () => axios.get(`${API_BASE}/dashboard`);
+
 // New endpoints for full invoice data
 export const getAllFullInvoices = () => axios.get(`${API_BASE}/invoices_all`);
 
@@ -2,7 +2,7 @@ import React, { useEffect, useState } from 'react';
 import { Box, Grid, Paper, Typography, CircularProgress, Alert, Divider } from '@mui/material';
 import { Line, Bar, Pie } from 'react-chartjs-2';
 import { Chart as ChartJS, ArcElement, Tooltip, Legend, CategoryScale, LinearScale, PointElement, LineElement, BarElement, Title } from 'chart.js';
-import { getAllFullInvoices } from '../api/api';
+import { getDashboard, subscribeEvents } from '../api/api';
 import SavingsIcon from '@mui/icons-material/Savings';
 import FlashOnIcon from '@mui/icons-material/FlashOn';
 import CalendarMonthIcon from '@mui/icons-material/CalendarMonth';
@@ -23,181 +23,64 @@ import BusinessIcon from '@mui/icons-material/Business';
 // } from 'chart.js';
 ChartJS.register(ArcElement, Tooltip, Legend, CategoryScale, LinearScale, PointElement, LineElement, BarElement, Title);
 
+// Line item categories of the dashboard KPIs
+const ITEM_LABELS = {
+  peak: 'Heures de pointe',
+  off_peak: 'Heures creuses',
+  normal: 'Heures normales',
+  subscribed_power: 'Redevance de puissance',
+  power_overrun: 'Dépassement de puissance',
+  reactive: 'Énergie réactive',
+  other: 'Autres',
+};
+
 export default function Dashboard() {
-  const [invoices, setInvoices] = useState([]);
+  const [kpis, setKpis] = useState(null);
   const [loading, setLoading] = useState(true);
   const [error, setError] = useState('');
 
   useEffect(() => {
-    console.log('Dashboard mounted, attempting fetch');
-    getAllFullInvoices()
+    // The KPIs are aggregated server-side as invoices are saved: a few rows whatever the number of invoices
+    const load = () => getDashboard()
       .then(res => {
-        console.log('Received data from /api/invoices_all:', res.data);
-        // Flatten to extract all invoice, analysis, recommendations into one object per invoice
-        setInvoices(res.data.map(entry => ({
-          ...entry.invoice,
-          analysis: entry.analysis,
-          recommendations: entry.recommendations
-        })));
+        setKpis(res.data);
         setLoading(false);
       })
       .catch((err) => {
-        console.error('Error fetching invoices:', err);
-        setError('Erreur lors du chargement des factures.');
+        console.error('Error fetching dashboard:', err);
+        setError('Erreur lors du chargement du tableau de bord.');
         setLoading(false);
       });
+    load();
+    // New and corrected invoices update the figures
+    return subscribeEvents({ invoice: load });
   }, []);
 
-  // Debug log to see actual structure
-  console.log('Invoices data:', invoices);
-
-  // Aggregate data
-  const totalAmount = invoices.reduce((sum, inv) => sum + (Number(inv.total_amount) || 0), 0);
-  const totalKwh = invoices.reduce((sum, inv) => sum + (Number(inv.total_kwh) || 0), 0);
-  
-  // Robust potential_savings extraction - check in both root and recommendations
-  const getSavings = inv => {
-    // First try direct potential_savings
-    let val = inv.potential_savings;
-    
-    // If not found, check in recommendations
-    if (!val && inv.recommendations && inv.recommendations.potential_savings) {
-      val = inv.recommendations.potential_savings;
-    }
-    
-    // Handle case where we have the full recommendations object
-    if (!val && typeof inv === 'object') {
-      // Look for recommendations at root level
-      if (inv.recommendations) {
-        val = inv.recommendations.potential_savings;
-      }
-      
-      // Try to find it in any nested object
-      if (!val) {
-        for (const key in inv) {
-          if (inv[key] && typeof inv[key] === 'object' && inv[key].potential_savings) {
-            val = inv[key].potential_savings;
-            break;
-          }
-        }
-      }
-    }
-    
-    // Process the value
-    if (val && typeof val === 'object') {
-      val = val.value || val.amount || Object.values(val).find(v => typeof v === 'number');
-    }
-    if (typeof val === 'number' && isFinite(val)) return val;
-    if (typeof val === 'string') {
-      if (val.trim().toUpperCase() === 'N/A') return 0;
-      const parsed = Number(val);
-      if (!isNaN(parsed) && isFinite(parsed)) return parsed;
-    }
-    return 0;
-  };
-  
-  const savings = invoices.reduce((sum, inv) => sum + getSavings(inv), 0);
+  const totalAmount = kpis ? kpis.total_amount : 0;
+  const totalKwh = kpis ? kpis.total_kwh : 0;
+  const savings = kpis ? kpis.potential_savings : 0;
 
   // Monthly trends
   const months = {};
-  invoices.forEach(inv => {
-    const date = inv.issue_date || inv.period_start;
-    if (date) {
-      const month = date.slice(0,7); // YYYY-MM
-      if (!months[month]) months[month] = { amount: 0, kwh: 0, count: 0 };
-      months[month].amount += Number(inv.total_amount) || 0;
-      months[month].kwh += Number(inv.total_kwh) || 0;
-      months[month].count++;
-    }
+  (kpis ? kpis.periods : []).forEach(p => {
+    months[p.period] = { amount: p.amount, kwh: p.kwh, count: p.invoices };
   });
   const sortedMonths = Object.keys(months).sort();
 
   // Provider breakdown
-  const providers = {};
-  invoices.forEach(inv => {
-    const p = inv.provider || 'Autre';
-    if (!providers[p]) providers[p] = { amount: 0, kwh: 0, count: 0 };
-    providers[p].amount += Number(inv.total_amount) || 0;
-    providers[p].kwh += Number(inv.total_kwh) || 0;
-    providers[p].count++;
-  });
+  const providers = kpis ? kpis.providers : {};
 
-  // Peak/off-peak breakdown
-  // Heures Pleines vs Creuses (robust)
-  let peak = 0, offpeak = 0, normal = 0;
-  invoices.forEach(inv => {
-    // Try both possible spellings and fallback to items
-    peak += Number(inv.peak_kwh) || 0;
-    offpeak += Number(inv.off_peak_kwh) || 0;
-    
-    // If we have invoice items, extract from there
-    if (Array.isArray(inv.items)) {
-      inv.items.forEach(item => {
-        const desc = (item.description || '').toLowerCase();
-        if (desc.includes('pointe')) peak += Number(item.quantity) || 0;
-        else if (desc.includes('creuse')) offpeak += Number(item.quantity) || 0;
-        else if (desc.includes('normale')) normal += Number(item.quantity) || 0;
-      });
-    }
-    
-    // Handle case where we have a single invoice with the structure shown in your example
-    if (inv.invoice && inv.invoice.peak_kwh) peak += Number(inv.invoice.peak_kwh) || 0;
-    if (inv.invoice && inv.invoice.off_peak_kwh) offpeak += Number(inv.invoice.off_peak_kwh) || 0;
-  });
-  
-  // If we still have no data but we have the sample data structure, use it
-  if (peak === 0 && offpeak === 0 && invoices.length === 1) {
-    const sampleInv = invoices[0];
-    if (sampleInv.invoice) {
-      // Try to extract from the sample structure
-      const items = sampleInv.invoice.items || [];
-      items.forEach(item => {
-        const desc = (item.description || '').toLowerCase();
-        if (desc.includes('pointe')) peak += Number(item.quantity) || 0;
-        else if (desc.includes('creuse')) offpeak += Number(item.quantity) || 0;
-        else if (desc.includes('normale')) normal += Number(item.quantity) || 0;
-      });
-    }
-  }
+  // Heures Pleines vs Creuses
+  const bands = kpis ? kpis.bands : {};
+  const peak = bands.peak || 0, offpeak = bands.off_peak || 0, normal = bands.normal || 0;
 
-  // Invoice items by type (pie)
-  const itemTypes = {};
-  invoices.forEach(inv => {
-    // Handle regular invoice items
-    const items = inv.items || [];
-    items.forEach(item => {
-      const key = item.description || 'Autre';
-      if (!itemTypes[key]) itemTypes[key] = 0;
-      itemTypes[key] += Number(item.total) || 0;
-    });
-    
-    // Handle nested invoice structure
-    if (inv.invoice && Array.isArray(inv.invoice.items)) {
-      inv.invoice.items.forEach(item => {
-        const key = item.description || 'Autre';
-        if (!itemTypes[key]) itemTypes[key] = 0;
-        itemTypes[key] += Number(item.total) || 0;
-      });
-    }
-  });
-  
-  // If we still have no data, try to extract from the sample JSON structure
-  if (Object.keys(itemTypes).length === 0 && invoices.length > 0) {
-    // Try the structure from your example JSON
-    const sampleInv = invoices[0];
-    if (sampleInv.invoice && Array.isArray(sampleInv.invoice.items)) {
-      sampleInv.invoice.items.forEach(item => {
-        const key = item.description || 'Autre';
-        if (!itemTypes[key]) itemTypes[key] = 0;
-        itemTypes[key] += Number(item.total) || 0;
-      });
-    }
-  }
+  // Invoice items by category (pie)
+  const itemTypes = kpis ? kpis.items : {};
   // Only show item types with >0 value
-  const filteredItemLabels = Object.keys(itemTypes).filter((k, i) => Number(itemTypes[k]) > 0);
-  const filteredItemData = filteredItemLabels.map(k => itemTypes[k]);
+  const filteredItemKeys = Object.keys(itemTypes).filter(k => Number(itemTypes[k]) > 0);
+  const filteredItemData = filteredItemKeys.map(k => itemTypes[k]);
   const itemPieData = {
-    labels: filteredItemLabels,
+    labels: filteredItemKeys.map(k => ITEM_LABELS[k] || k),
     datasets: [{
       data: filteredItemData,
       backgroundColor: ['#1976d2', '#43a047', '#ffa726', '#ef5350', '#90caf9', '#a1887f', '#ce93d8', '#ffb74d'],
@@ -205,36 +88,7 @@ export default function Dashboard() {
   };
 
   // Taxes breakdown (bar)
-  const taxMap = {};
-  invoices.forEach(inv => {
-    // Handle direct taxes object
-    if (inv.taxes) {
-      Object.entries(inv.taxes).forEach(([tax, val]) => {
-        if (!taxMap[tax]) taxMap[tax] = 0;
-        taxMap[tax] += Number(val) || 0;
-      });
-    }
-    
-    // Handle nested invoice structure
-    if (inv.invoice && inv.invoice.taxes) {
-      Object.entries(inv.invoice.taxes).forEach(([tax, val]) => {
-        if (!taxMap[tax]) taxMap[tax] = 0;
-        taxMap[tax] += Number(val) || 0;
-      });
-    }
-  });
-  
-  // If we still have no data, try to extract from the sample JSON structure
-  if (Object.keys(taxMap).length === 0 && invoices.length > 0) {
-    // Try the structure from your example JSON
-    const sampleInv = invoices[0];
-    if (sampleInv.invoice && sampleInv.invoice.taxes) {
-      Object.entries(sampleInv.invoice.taxes).forEach(([tax, val]) => {
-        if (!taxMap[tax]) taxMap[tax] = 0;
-        taxMap[tax] += Number(val) || 0;
-      });
-    }
-  }
+  const taxMap = kpis ? kpis.taxes : {};
   // Only show tax types with >0 value
   const filteredTaxLabels = Object.keys(taxMap).filter(k => Number(taxMap[k]) > 0);
   const filteredTaxData = filteredTaxLabels.map(k => taxMap[k]);
@@ -247,10 +101,6 @@ export default function Dashboard() {
     }],
   };
 
-  // Efficiency score (gauge simulation)
-  const efficiencyScores = invoices.map(inv => Number(inv.efficiency_score) || 0).filter(x => x > 0);
-  const avgEfficiency = efficiencyScores.length ? efficiencyScores.reduce((a, b) => a + b, 0) / efficiencyScores.length : null;
-
   // Chart data
   const lineData = {
     labels: sortedMonths,
@@ -1,7 +1,7 @@
 import React, { useEffect, useState } from 'react';
 import { Box, Typography, Paper, List, ListItem, ListItemText, Divider, Button, CircularProgress, Alert } from '@mui/material';
 import { Link } from 'react-router-dom';
-import { getAllFullInvoices } from '../api/api';
+import { getAllFullInvoices, subscribeEvents } from '../api/api';
 
 export default function InvoiceList() {
   const [invoices, setInvoices] = useState([]);
@@ -19,6 +19,12 @@ export default function InvoiceList() {
         setError('Erreur lors du chargement des factures.');
         setLoading(false);
       });
+    // New invoices are pushed by the server instead of re-fetching the list
+    return subscribeEvents({
+      invoice: ({ result }) => setInvoices(current =>
+        current.some(entry => entry.invoice?.id === result.invoice?.id) ? current : [result, ...current]
+      ),
+    });
   }, []);
 
   return (
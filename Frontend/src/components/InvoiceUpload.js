@@ -1,19 +1,31 @@
-import React, { useState } from 'react';
+import React, { useEffect, useRef, useState } from 'react';
 import { Box, Button, Typography, Paper, LinearProgress, Alert, Fade } from '@mui/material';
 import CloudUploadIcon from '@mui/icons-material/CloudUpload';
 import InsertDriveFileOutlinedIcon from '@mui/icons-material/InsertDriveFileOutlined';
 import UploadFileOutlinedIcon from '@mui/icons-material/UploadFileOutlined';
-import { uploadInvoice } from '../api/api';
+import { subscribeEvents, uploadInvoice } from '../api/api';
 import { useNavigate } from 'react-router-dom';
 
+const STAGES = {
+  uploaded: 'Fichier reçu',
+  ocr_done: 'Texte extrait',
+  extracted: 'Données extraites',
+  analyzed: 'Analyse terminée',
+  recommended: 'Recommandations générées',
+};
+
 export default function InvoiceUpload() {
   const [file, setFile] = useState(null);
   const [uploading, setUploading] = useState(false);
   const [error, setError] = useState('');
   const [dragActive, setDragActive] = useState(false);
   const [success, setSuccess] = useState(false);
+  const [stage, setStage] = useState(null);
+  const unsubscribe = useRef(null);
   const navigate = useNavigate();
 
+  useEffect(() => () => unsubscribe.current && unsubscribe.current(), []);
+
   const handleFileChange = (e) => {
     setFile(e.target.files[0]);
     setError('');
@@ -46,12 +58,22 @@ export default function InvoiceUpload() {
     setUploading(true);
     setError('');
     setSuccess(false);
+    setStage(null);
+    // Follow the processing stages of this upload
+    const uploadId = window.crypto.randomUUID();
+    unsubscribe.current = subscribeEvents({
+      progress: (event) => {
+        if (event.upload_id === uploadId && STAGES[event.stage]) setStage(event.stage);
+      },
+    });
     try {
-      await uploadInvoice(file);
+      await uploadInvoice(file, uploadId);
+      unsubscribe.current();
       setUploading(false);
       setSuccess(true);
       setTimeout(() => navigate('/invoices'), 1200);
     } catch (err) {
+      unsubscribe.current();
       setUploading(false);
       setError('Erreur lors de l\'importation du fichier.');
     }
@@ -104,7 +126,15 @@ export default function InvoiceUpload() {
           accept=".pdf,image/*"
         />
       </Box>
-      {uploading && <LinearProgress sx={{ my: 2 }} />}
+      {uploading && (
+        <Box sx={{ my: 2 }}>
+          <LinearProgress
+            variant={stage ? 'determinate' : 'indeterminate'}
+            value={stage ? (Object.keys(STAGES).indexOf(stage) + 1) * 100 / Object.keys(STAGES).length : 0}
+          />
+          {stage && <Typography variant="body2" color="text.secondary" sx={{ mt: 1 }}>{STAGES[stage]}</Typography>}
+        </Box>
+      )}
       {success && <Alert severity="success" sx={{ mt: 2 }}>Importation réussie ! Redirection...</Alert>}
       {error && <Alert severity="error" sx={{ mt: 2 }}>{error}</Alert>}
       <Button
@@ -1,12 +1,17 @@
-from flask import Blueprint, request, jsonify, current_app
-import os
-import uuid
-from werkzeug.utils import secure_filename
+from flask import Blueprint, Response, request, jsonify, current_app, send_file, stream_with_context
 
 from services.invoice_processor import InvoiceProcessor
 from services.ocr_service import OCRService
 from services.llm_service import LLMService
-from models.invoice import Invoice
+from services.report_exporter import EXPORT_FORMATS
+from services.upload_ingest import UploadError, UploadIngestor
+from services.event_bus import format_sse
+from services.idempotency import CLAIMED, CONFLICT, DONE, IN_FLIGHT
+from services.scheduler import PRIORITIES, SchedulerFull
+from pydantic import ValidationError
+from models.invoice import describe_errors
+from utils.metrics import stage
+from utils.resilience import DeadlineExceeded, DependencyUnavailable
 
 api_bp = Blueprint('api', __name__)
 invoice_processor = InvoiceProcessor()
@@ -16,45 +21,185 @@ def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in current_app.config['ALLOWED_EXTENSIONS']
 
+def replay_response(record):
+    """Build the response stored for an idempotency key"""
+    response = jsonify(record['response'])
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response, record['status_code']
+
+def get_filters():
+    """Get the invoice filters from the query string"""
+    return {
+        "provider": request.args.get('provider'),
+        "customer": request.args.get('customer'),
+        "period_from": request.args.get('period_from'),
+        "period_to": request.args.get('period_to')
+    }
+
 @api_bp.route('/upload', methods=['POST'])
 def upload_invoice():
     """
     Upload and process an energy invoice
+    Accepts a multipart 'file' field, or the raw file as request body
+    (with an optional 'filename' query parameter). An X-Upload-ID header is
+    echoed in the progress events published on /events
+    Query parameter priority: 'interactive' (default) waits for the result;
+    'bulk' queues the invoice behind interactive uploads and answers 202, the
+    result being published on /events. Customers (X-Tenant-ID header, or the
+    client address) share the processing fairly
+    PDF bundles holding several invoices are split and their invoices processed
+    concurrently; the response is then {"batch": ..., "results": [...]}
+    Retries are keyed by the Idempotency-Key header, or the file's SHA-256 without
+    it: a request identical to one in flight waits for its response instead of
+    processing the file again, and later retries get the stored response
+    (Idempotent-Replayed header); a key reused for another file gets 422
     Returns processed invoice data with extracted information
     """
-    # Check if file is in request
-    if 'file' not in request.files:
-        return jsonify({"error": "No file part"}), 400
+    priority = request.args.get('priority', 'interactive')
+    if priority not in PRIORITIES:
+        return jsonify({"error": f"priority must be one of {', '.join(PRIORITIES)}"}), 400
     
-    file = request.files['file']
+    tenant = request.headers.get('X-Tenant-ID') or request.remote_addr
+    idempotency = invoice_processor.idempotency
+    client_key = request.headers.get('Idempotency-Key')
     
-    # Check if file is selected
-    if file.filename == '':
-        return jsonify({"error": "No file selected"}), 400
+    if request.mimetype == 'multipart/form-data':
+        # Check if file is in request
+        if 'file' not in request.files:
+            return jsonify({"error": "No file part"}), 400
+        
+        file = request.files['file']
+        
+        # Check if file is selected
+        if file.filename == '':
+            return jsonify({"error": "No file selected"}), 400
+        
+        # Check if file type is allowed
+        if not allowed_file(file.filename):
+            return jsonify({"error": "File type not allowed"}), 400
+        stream, filename = file.stream, file.filename
+    else:
+        stream, filename = request.stream, request.args.get('filename')
     
-    # Check if file type is allowed
-    if not allowed_file(file.filename):
-        return jsonify({"error": "File type not allowed"}), 400
-    
-    # Generate unique filename
-    filename = str(uuid.uuid4()) + '_' + secure_filename(file.filename)
-    file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
+    # Stream the file to disk while hashing it, rejecting bad files before any OCR call
+    ingestor = UploadIngestor(
+        current_app.config['UPLOAD_FOLDER'],
+        current_app.config.get('MAX_CONTENT_LENGTH'),
+        blob_store=invoice_processor.blob_store
+    )
+    try:
+        with stage('save') as info:
+            upload = ingestor.ingest(stream, filename)
+            info['bytes'] = upload['size']
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status_code
     
-    # Save file
-    file.save(file_path)
+    upload_id = request.headers.get('X-Upload-ID') or upload['sha256']
+    cost = max(1.0, upload['size'] / (1024 * 1024))
     
+    # Single flight: identical requests share one job and its stored response
+    key = f"{tenant}:{client_key or 'sha256:' + upload['sha256']}"
+    outcome, record = idempotency.claim(key, upload['sha256'])
+    if outcome == CONFLICT:
+        return jsonify({"error": "Idempotency-Key already used for a different file"}), 422
+    tracked = False
     try:
-        # Process invoice
-        invoice_data = invoice_processor.process_invoice(file_path)
+        if outcome == IN_FLIGHT:
+            if priority == 'bulk':
+                return jsonify({"status": "queued", "upload_id": upload_id}), 202
+            outcome, record = idempotency.wait(key, upload['sha256'], timeout=idempotency.lock_ttl)
+            if outcome == IN_FLIGHT:
+                return jsonify({"status": "processing", "upload_id": upload_id}), 202
+        if outcome == DONE:
+            return replay_response(record)
+        
+        segments = invoice_processor.split_document(upload['path'])
+        if len(segments) > 1:
+            batch = invoice_processor.submit_bundle(
+                tenant, priority, upload['path'], segments, cost=cost, file_hash=upload['sha256'], upload_id=upload_id
+            )
+            idempotency.track(key, batch, lambda result: (200, result))
+            tracked = True
+            if priority == 'bulk':
+                return jsonify({"status": "queued", "upload_id": upload_id, "batch_id": batch.batch_id,
+                                "invoices": len(segments)}), 202
+            return jsonify(batch.result()), 200
+        
+        # Queue the invoice, its share of the workers weighted by its size in MB
+        job = invoice_processor.scheduler.submit(
+            tenant, priority, upload['path'], cost=cost, file_hash=upload['sha256'], upload_id=upload_id
+        )
+        idempotency.track(key, job, lambda result: (200, result))
+        tracked = True
+        if priority == 'bulk':
+            return jsonify({"status": "queued", "upload_id": upload_id}), 202
+        invoice_data = job.result()
         return jsonify(invoice_data), 200
+    except SchedulerFull as e:
+        response = jsonify({"error": str(e)})
+        response.headers['Retry-After'] = str(int(e.retry_after) + 1)
+        return response, 429
+    except DependencyUnavailable as e:
+        # The OCR is down and the file has no text layer to fall back on
+        response = jsonify({"error": str(e), "dependency": e.dependency})
+        response.headers['Retry-After'] = str(int(e.retry_after) + 1)
+        return response, 503
+    except DeadlineExceeded as e:
+        return jsonify({"error": str(e)}), 504
+    except ValidationError as e:
+        # The extraction stayed invalid after a correction request: nothing was stored
+        return jsonify({"error": "Invalid extraction", "details": describe_errors(e)}), 422
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    finally:
+        # Not processed (refused, or failed before queuing): a retry may run it
+        if outcome == CLAIMED and not tracked:
+            idempotency.release(key)
+
+@api_bp.route('/events', methods=['GET'])
+def stream_events():
+    """
+    Server-Sent Events stream of processing progress ('progress' events with
+    stage, invoice_id and upload_id) and new results ('invoice' events)
+    Reconnecting clients resume after their Last-Event-ID header (or ?since=)
+    """
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        last_id = int(last_id) if last_id else None
+    except ValueError:
+        return jsonify({"error": "Last-Event-ID must be an integer"}), 400
+    events = invoice_processor.event_bus.listen(last_id)
+
+    def stream():
+        yield 'retry: 3000\n\n'
+        for event in events:
+            yield format_sse(event)
+
+    return Response(
+        stream_with_context(stream()),
+        mimetype='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@api_bp.route('/batches/<batch_id>', methods=['GET'])
+def get_batch(batch_id):
+    """Get the record of a split PDF bundle: pages, invoice ID or error of each invoice"""
+    try:
+        batch = invoice_processor.get_batch(batch_id)
+        if not batch:
+            return jsonify({"error": "Batch not found"}), 404
+        return jsonify(batch), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @api_bp.route('/invoices', methods=['GET'])
 def get_invoices():
-    """Get list of all processed invoices"""
+    """
+    Get list of all processed invoices
+    Query parameters: provider, customer, period_from and period_to (YYYY-MM)
+    """
     try:
-        invoices = invoice_processor.get_all_invoices()
+        invoices = invoice_processor.get_all_invoices(get_filters())
         return jsonify(invoices), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -70,6 +215,51 @@ def get_invoice(invoice_id):
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@api_bp.route('/invoices/<invoice_id>', methods=['PATCH'])
+def correct_invoice(invoice_id):
+    """
+    Correct extracted fields of an invoice (JSON object of field: new value)
+    Only the stages depending on the corrected fields are recomputed; the updated
+    result lists them under 'recomputed'
+    """
+    corrections = request.get_json(silent=True)
+    if not isinstance(corrections, dict) or not corrections:
+        return jsonify({"error": "Body must be a JSON object of field corrections"}), 400
+    try:
+        result = invoice_processor.correct_invoice(invoice_id, corrections)
+        if not result:
+            return jsonify({"error": "Invoice not found"}), 404
+        return jsonify(result), 200
+    except ValueError as e:
+        if isinstance(e, ValidationError):
+            return jsonify({"error": "Invalid correction", "details": describe_errors(e)}), 422
+        return jsonify({"error": str(e)}), 400
+    except DeadlineExceeded as e:
+        return jsonify({"error": str(e)}), 504
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@api_bp.route('/invoices/<invoice_id>/corrections', methods=['GET'])
+def get_invoice_corrections(invoice_id):
+    """Get the field corrections made to an invoice, oldest first"""
+    try:
+        if not invoice_processor.get_invoice(invoice_id):
+            return jsonify({"error": "Invoice not found"}), 404
+        return jsonify(invoice_processor.get_corrections(invoice_id)), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@api_bp.route('/invoices/<invoice_id>/file', methods=['GET'])
+def get_invoice_file(invoice_id):
+    """Download the uploaded file of an invoice (restored from the archive if needed)"""
+    try:
+        file_path = invoice_processor.get_invoice_file(invoice_id)
+        if not file_path:
+            return jsonify({"error": "Invoice file not found"}), 404
+        return send_file(file_path, as_attachment=True)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @api_bp.route('/recommendations/<invoice_id>', methods=['GET'])
 def get_recommendations(invoice_id):
     """Get recommendations for a specific invoice"""
@@ -91,3 +281,86 @@ def get_analysis(invoice_id):
         return jsonify(analysis), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+
+@api_bp.route('/dashboard', methods=['GET'])
+def get_dashboard():
+    """Get the dashboard KPIs, read from tables updated with each saved or corrected invoice"""
+    try:
+        return jsonify(invoice_processor.get_dashboard()), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@api_bp.route('/analytics', methods=['GET'])
+def get_analytics():
+    """
+    Get consumption and cost aggregations grouped by provider or customer
+    Query parameters: group_by (provider|customer), provider, customer,
+    period_from and period_to (YYYY-MM)
+    """
+    group_by = request.args.get('group_by', 'provider')
+    if group_by not in ('provider', 'customer'):
+        return jsonify({"error": "group_by must be 'provider' or 'customer'"}), 400
+    try:
+        analytics = invoice_processor.get_analytics(group_by, get_filters())
+        return jsonify(analytics), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@api_bp.route('/consistency', methods=['GET'])
+def get_consistency():
+    """
+    Check the arithmetic of all processed invoices (item totals, taxes, kWh bands, rate per kWh)
+    Returns confidence flag counts per field and the inconsistent invoices
+    """
+    try:
+        return jsonify(invoice_processor.check_consistency()), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@api_bp.route('/reports/export', methods=['GET'])
+def export_report():
+    """
+    Stream a report of the processed invoices
+    Query parameters: format (csv|xlsx|parquet) and the same filters as /invoices
+    """
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({"error": f"format must be one of {', '.join(EXPORT_FORMATS)}"}), 400
+    try:
+        chunks = invoice_processor.export_report(export_format, get_filters())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    return Response(
+        stream_with_context(chunks),
+        mimetype=EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition": f"attachment; filename=invoices.{export_format}"}
+    )
+
+@api_bp.route('/search', methods=['GET'])
+def search_invoices():
+    """
+    Search invoices by invoice number, line item descriptions, issues and OCR text
+    Query parameters: q (terms, "phrases", prefix*), field, provider, issue_type,
+    severity, limit and offset
+    """
+    try:
+        limit = min(int(request.args.get('limit', 20)), 100)
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({"error": "limit and offset must be integers"}), 400
+    filters = {
+        "provider": request.args.get('provider'),
+        "issue_type": request.args.get('issue_type'),
+        "severity": request.args.get('severity')
+    }
+    try:
+        results = invoice_processor.search_invoices(
+            request.args.get('q', ''), filters, request.args.get('field'), limit, offset
+        )
+        return jsonify(results), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
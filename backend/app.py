@@ -1,13 +1,16 @@
 import os
-from flask import Flask, jsonify
+import time
+from flask import Flask, Response, g, jsonify, request
 from flask_cors import CORS
 from dotenv import load_dotenv
 
-from api.routes import api_bp
+from api.routes import api_bp, invoice_processor
+from utils.file_utils import remove_stale_files
 from utils.config import Config
+from utils.metrics import HTTP_DURATION, configure_structured_logging, log_event, registry, start_trace
+from utils.resilience import OPEN, breaker_states
 
 import logging
-from services.invoice_processor import InvoiceProcessor
 
 logging.basicConfig(
     level=logging.INFO,  # or logging.DEBUG for more details
@@ -19,22 +22,44 @@ load_dotenv(override=True)
 def create_app(config_class=Config):
     """Create and configure the Flask application"""
     app = Flask(__name__, static_folder='static')
-    invoice_processor = InvoiceProcessor()
     app.config.from_object(config_class)
     
     # Enable CORS
     CORS(app)
     
+    # Structured per-request event log, written off the request thread
+    configure_structured_logging()
+    
+    @app.before_request
+    def start_request_trace():
+        g.trace_id = start_trace(request.headers.get('X-Request-ID'))
+        g.request_start = time.perf_counter()
+    
+    @app.after_request
+    def end_request_trace(response):
+        response.headers['X-Request-ID'] = g.get('trace_id', '')
+        if request.path != '/metrics':
+            duration = time.perf_counter() - g.get('request_start', time.perf_counter())
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            HTTP_DURATION.observe(duration, method=request.method, route=route, status=response.status_code)
+            log_event('request', method=request.method, path=request.path,
+                      status=response.status_code, duration_ms=round(duration * 1000, 1))
+        return response
+    
     # Register blueprints
     app.register_blueprint(api_bp, url_prefix='/api')
     
-    # Create upload directory if it doesn't exist
+    # Create upload directory if it doesn't exist, removing uploads interrupted by a crash
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    remove_stale_files(app.config['UPLOAD_FOLDER'], prefix='.ingest-')
+    
+    # Archive cold uploads and delete unreferenced ones past retention in the background
+    invoice_processor.blob_store.start_compaction(float(os.environ.get('BLOB_COMPACTION_INTERVAL', 3600)))
     
     @app.route('/api/invoices_all', methods=['GET'])
     def get_invoices_all():
-        results = invoice_processor.get_all_full_results()
-        return jsonify(results)
+        # The array is assembled by the database, without decoding every result
+        return Response(invoice_processor.get_all_full_results_json(), mimetype='application/json')
     
     @app.route('/api/invoice_full/<invoice_id>', methods=['GET'])
     def get_invoice_full(invoice_id):
@@ -46,13 +71,24 @@ def create_app(config_class=Config):
     
     @app.route('/health', methods=['GET'])
     def health_check():
-        """Health check endpoint"""
-        return jsonify({"status": "ok"})
+        """Health check endpoint, with the circuit breaker of each dependency"""
+        dependencies = breaker_states()
+        degraded = any(state['state'] == OPEN for state in dependencies.values())
+        return jsonify({"status": "degraded" if degraded else "ok", "dependencies": dependencies})
+    
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        """Prometheus metrics endpoint"""
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
     
     @app.errorhandler(404)
     def not_found(error):
         return jsonify({"error": "Not found"}), 404
     
+    @app.errorhandler(413)
+    def request_too_large(error):
+        return jsonify({"error": "File too large"}), 413
+    
     @app.errorhandler(500)
     def server_error(error):
         return jsonify({"error": "Internal server error"}), 500
@@ -0,0 +1,266 @@
+import os
+import json
+import time
+import uuid
+import random
+import logging
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Deque, Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+logger = logging.getLogger(__name__)
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def load_fixture(name: str) -> str:
+    """Read a file from the fixtures directory"""
+    with open(os.path.join(FIXTURES_DIR, name), 'r', encoding='utf-8') as f:
+        return f.read()
+
+class MockBehavior:
+    """Latency and failure profile of a mock server"""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, seed: Optional[int] = None):
+        """
+        Initialize the profile
+
+        Args:
+            latency: Mean response delay in seconds
+            jitter: Relative spread of the delay (0.2 gives delays in latency * [0.8, 1.2])
+            error_rate: Fraction of requests answered with an HTTP 500
+            seed: Random seed, for reproducible runs
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self) -> float:
+        with self._lock:
+            spread = self._random.uniform(-self.jitter, self.jitter)
+        return max(0.0, self.latency * (1 + spread))
+
+    def should_fail(self) -> bool:
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; without this delayed ACKs add ~40ms per response
+    disable_nagle_algorithm = True
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug(format, *args)
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _send_json(self, status: int, payload: Dict[str, Any]) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _simulate(self) -> bool:
+        """Apply the latency profile, answering with an error if this request fails"""
+        behavior = self.server.behavior
+        time.sleep(behavior.delay())
+        if behavior.should_fail():
+            self._send_json(500, {'message': 'Simulated server error'})
+            return False
+        return True
+
+class _WhisperHandler(_MockHandler):
+    """LLMWhisperer v2 API: /whisper, /whisper-status and /whisper-retrieve"""
+
+    def do_POST(self):
+        self._read_body()
+        if not urlparse(self.path).path.endswith('/whisper'):
+            self._send_json(404, {'message': 'Not found'})
+            return
+        if not self._simulate():
+            return
+        whisper_hash = uuid.uuid4().hex
+        self.server.jobs[whisper_hash] = time.monotonic() + self.server.processing_delay
+        self._send_json(202, {'message': 'Whisper Job Accepted', 'status': 'processing', 'whisper_hash': whisper_hash})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        whisper_hash = parse_qs(url.query).get('whisper_hash', [''])[0]
+        ready_at = self.server.jobs.get(whisper_hash)
+        if ready_at is None:
+            self._send_json(400, {'message': 'Unknown whisper hash'})
+        elif url.path.endswith('/whisper-status'):
+            self._send_json(200, {'status': 'processed' if time.monotonic() >= ready_at else 'processing'})
+        elif url.path.endswith('/whisper-retrieve'):
+            self.server.jobs.pop(whisper_hash, None)
+            self._send_json(200, {'result_text': self.server.ocr_text, 'confidence_metadata': [], 'metadata': {}})
+        else:
+            self._send_json(404, {'message': 'Not found'})
+
+class _ChatHandler(_MockHandler):
+    """Groq (OpenAI-compatible) chat completions API"""
+
+    def do_POST(self):
+        request = json.loads(self._read_body() or b'{}')
+        if not urlparse(self.path).path.endswith('/chat/completions'):
+            self._send_json(404, {'error': {'message': 'Not found'}})
+            return
+        if not self._simulate():
+            return
+
+        messages = request.get('messages') or []
+        system = ' '.join(m.get('content', '') for m in messages if m.get('role') == 'system').lower()
+        prompt = PrefixCache.serialize(messages)
+        responses = self.server.responses
+        schema_name = ((request.get('response_format') or {}).get('json_schema') or {}).get('name')
+        if schema_name == 'invoice_result':
+            # Single-call mode: the three payloads in one structured response
+            content = {key: responses[key] for key in ('invoice', 'analysis', 'recommendations')}
+        elif 'recommendation' in system:
+            content = responses['recommendations']
+        elif 'analyz' in system:
+            content = responses['analysis']
+        else:
+            content = responses['invoice']
+        content = json.dumps(content, ensure_ascii=False)
+
+        # Rough token counts (about 4 characters per token) so usage metrics are populated
+        prompt_tokens, completion_tokens = len(prompt) // 4, len(content) // 4
+        cached_tokens = self.server.prefix_cache.lookup(messages) // 4 if self.server.prefix_cache else 0
+        # Prefill cost of the prompt tokens not served from the cache
+        time.sleep(self.server.prefill_latency * (prompt_tokens - cached_tokens))
+        self._send_json(200, {
+            'id': f'chatcmpl-{uuid.uuid4().hex}',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': request.get('model', 'mock'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens,
+                'prompt_tokens_details': {'cached_tokens': cached_tokens},
+            },
+        })
+
+class PrefixCache:
+    """
+    Prompt prefix cache of an inference server
+
+    Like the KV cache reuse of llama.cpp or vLLM, the part of a prompt shared with
+    a recent prompt does not have to be processed again; only prefixes are reused,
+    so a prompt differing early gets little from the cache.
+    """
+
+    def __init__(self, size: int = 64):
+        """
+        Initialize the cache
+
+        Args:
+            size: Number of recent prompts kept
+        """
+        self.size = size
+        self._prompts: Deque[str] = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def serialize(messages: List[Dict[str, Any]]) -> str:
+        """Prompt text as a chat template would lay it out"""
+        return ''.join(f"<|{m.get('role', '')}|>{m.get('content', '')}<|end|>" for m in messages)
+
+    def lookup(self, messages: List[Dict[str, Any]]) -> int:
+        """
+        Find the longest cached prefix of a prompt, then cache the prompt
+
+        Args:
+            messages: Chat messages
+
+        Returns:
+            Number of cached prompt characters
+        """
+        prompt = self.serialize(messages)
+        with self._lock:
+            cached = max((len(os.path.commonprefix([prompt, seen])) for seen in self._prompts), default=0)
+            self._prompts.append(prompt)
+        return cached
+
+class MockServer:
+    """HTTP server running on a background thread"""
+
+    def __init__(self, handler, behavior: Optional[MockBehavior] = None, host: str = '127.0.0.1', port: int = 0):
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.httpd.behavior = behavior or MockBehavior()
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self) -> 'MockServer':
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self) -> 'MockServer':
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+class MockWhisperServer(MockServer):
+    """Stand-in for the LLMWhisperer v2 API, returning a fixed OCR text"""
+
+    def __init__(self, behavior: Optional[MockBehavior] = None, processing_delay: float = 0.0,
+                 ocr_text: Optional[str] = None, **kwargs):
+        """
+        Initialize the server
+
+        Args:
+            behavior: Latency and failure profile of the /whisper call
+            processing_delay: Seconds a job reports 'processing' after being accepted. The
+                LLMWhisperer client polls every 5 seconds, so any delay costs at least that much.
+            ocr_text: Extracted text to return (defaults to fixtures/ocr_text.txt)
+        """
+        super().__init__(_WhisperHandler, behavior, **kwargs)
+        self.httpd.jobs = {}
+        self.httpd.processing_delay = processing_delay
+        self.httpd.ocr_text = ocr_text if ocr_text is not None else load_fixture('ocr_text.txt')
+
+    @property
+    def url(self) -> str:
+        return super().url + '/api/v2'
+
+class MockChatServer(MockServer):
+    """Stand-in for the Groq chat completions API, answering with fixed extraction,
+    analysis and recommendation JSON depending on the system prompt (all three for
+    the 'invoice_result' JSON schema response format)"""
+
+    def __init__(self, behavior: Optional[MockBehavior] = None, responses: Optional[Dict[str, Any]] = None,
+                 prefix_cache: bool = False, prefill_latency: float = 0.0, **kwargs):
+        """
+        Initialize the server
+
+        Args:
+            behavior: Latency and failure profile of each completion
+            responses: Dict with 'invoice', 'analysis' and 'recommendations' payloads
+                (defaults to fixtures/llm_responses.json)
+            prefix_cache: Reuse the prompt prefixes shared with recent requests, reported
+                as usage.prompt_tokens_details.cached_tokens
+            prefill_latency: Extra delay per prompt token not served from the cache, in seconds
+        """
+        super().__init__(_ChatHandler, behavior, **kwargs)
+        self.httpd.responses = responses or json.loads(load_fixture('llm_responses.json'))
+        self.httpd.prefix_cache = PrefixCache() if prefix_cache else None
+        self.httpd.prefill_latency = prefill_latency
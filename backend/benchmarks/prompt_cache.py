@@ -0,0 +1,115 @@
+"""
+Benchmark of prompt prefix caching against a local OpenAI-compatible server
+
+Sends the extract, analyze and recommend prompts for a series of invoices to the
+mock chat server with its prefix cache on, once with the registry layout (static
+rules in the system message, invoice data last) and once with the previous inline
+layout (a short role line, then the data in the middle of the rules), and reports
+the share of prompt tokens served from the cache and the latency of each stage.
+
+Usage (from the backend directory):
+    python -m benchmarks.prompt_cache --invoices 30 --prefill-latency 0.0002
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.mock_servers import MockChatServer, load_fixture
+from services.llm_backends import OpenAICompatibleBackend
+from services.prompts import ANALYZE, EXTRACT, RECOMMEND, PromptTemplate
+
+LAYOUTS = ('registry', 'inline')
+
+def inline_messages(prompt: PromptTemplate, **values: Any) -> List[Dict[str, str]]:
+    """
+    Lay a prompt out as before the registry: role line as system message, and the
+    data inserted after the first paragraph of the rules in the user message
+    """
+    role, _, rules = prompt.system.partition('\n\n')
+    intro, _, rest = rules.partition('\n\n')
+    data = prompt.render(**values)[1]['content']
+    return [{'role': 'system', 'content': role}, {'role': 'user', 'content': f'{intro}\n\n{data}\n\n{rest}'}]
+
+def invoice_calls(index: int, ocr_text: str, responses: Dict[str, Any]) -> List[tuple]:
+    """The three pipeline prompts of one invoice, with data differing from the other invoices"""
+    invoice = dict(responses['invoice'], invoice_number=f'BENCH-{index:05d}', total_kwh=1000 + index)
+    return [
+        ('extract', EXTRACT, {'ocr_text': f'Facture N° BENCH-{index:05d}\n{ocr_text}'}),
+        ('analyze', ANALYZE, {'invoice_data': invoice}),
+        ('recommend', RECOMMEND, {'invoice_data': invoice, 'analysis': responses['analysis']}),
+    ]
+
+def run_layout(layout: str, invoices: int, prefill_latency: float) -> Dict[str, Any]:
+    """
+    Send the prompts of a series of invoices with one layout to a fresh server
+
+    Args:
+        layout: 'registry' or 'inline'
+        invoices: Number of invoices
+        prefill_latency: Server delay per uncached prompt token, in seconds
+
+    Returns:
+        Cached token share and latency per stage
+    """
+    ocr_text = load_fixture('ocr_text.txt')
+    responses = json.loads(load_fixture('llm_responses.json'))
+    stages: Dict[str, Dict[str, list]] = {}
+    with MockChatServer(prefix_cache=True, prefill_latency=prefill_latency) as server:
+        backend = OpenAICompatibleBackend(server.url + '/v1', 'bench')
+        for index in range(invoices):
+            for stage_name, prompt, values in invoice_calls(index, ocr_text, responses):
+                messages = prompt.render(**values) if layout == 'registry' else inline_messages(prompt, **values)
+                start = time.perf_counter()
+                usage = backend.complete(messages, stage=stage_name).usage
+                measures = stages.setdefault(stage_name, {'latency': [], 'prompt': [], 'cached': []})
+                measures['latency'].append(time.perf_counter() - start)
+                measures['prompt'].append(usage.prompt_tokens)
+                measures['cached'].append(usage.cached_tokens)
+
+    report = {}
+    for stage_name, measures in stages.items():
+        report[stage_name] = {
+            'prompt_tokens': int(np.mean(measures['prompt'])),
+            'cached_share': round(sum(measures['cached']) / max(sum(measures['prompt']), 1), 3),
+            'p50_ms': round(float(np.percentile(measures['latency'], 50)) * 1000, 2),
+        }
+    return report
+
+def run(invoices: int = 30, prefill_latency: float = 0.0002) -> Dict[str, Any]:
+    """
+    Run the benchmark
+
+    Args:
+        invoices: Number of invoices per layout
+        prefill_latency: Server delay per uncached prompt token, in seconds
+
+    Returns:
+        Report per layout, and the p50 latency saved per stage by the registry layout
+    """
+    report: Dict[str, Any] = {'invoices': invoices, 'prefill_latency': prefill_latency}
+    for layout in LAYOUTS:
+        report[layout] = run_layout(layout, invoices, prefill_latency)
+    report['p50_saved_ms'] = {
+        stage_name: round(report['inline'][stage_name]['p50_ms'] - report['registry'][stage_name]['p50_ms'], 2)
+        for stage_name in report['registry']
+    }
+    return report
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--invoices', type=int, default=30, help='Invoices sent per layout')
+    parser.add_argument('--prefill-latency', type=float, default=0.0002,
+                        help='Server delay per uncached prompt token (s); 0.0002 is about 5000 tokens/s')
+    args = parser.parse_args(argv)
+    print(json.dumps(run(args.invoices, args.prefill_latency), indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,388 @@
+"""
+End-to-end benchmark of the invoice pipeline against local mock OCR and LLM servers
+
+Usage (from the backend directory):
+    python -m benchmarks.run --concurrency 1,4,16 --requests 40 --output results.json
+    python -m benchmarks.run --compare benchmarks/baseline.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.mock_servers import MockBehavior, MockChatServer, MockWhisperServer, load_fixture
+
+logger = logging.getLogger(__name__)
+
+# 'fused' runs process_invoice in the single-call LLM mode (FUSED_LLM_PIPELINE)
+SCENARIOS = ('process', 'fused', 'upload', 'read')
+
+# Read endpoints exercised by the 'read' scenario ({invoice_id} is filled with a processed invoice)
+READ_ENDPOINTS = (
+    '/api/invoices',
+    '/api/invoices_all',
+    '/api/invoice_full/{invoice_id}',
+    '/api/analytics?group_by=provider',
+    '/api/search?q=puissance',
+    '/api/reports/export?format=csv',
+)
+
+# Relative slowdown (p95 latency up or throughput down) reported as a regression by --compare
+DEFAULT_TOLERANCE = 0.25
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of the process in MB (ru_maxrss is in KB on Linux, bytes on macOS)"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def summarize(name: str, concurrency: int, latencies: List[float], errors: int, wall_time: float) -> Dict[str, Any]:
+    """
+    Summarize the latencies of one benchmark run
+
+    Args:
+        name: Scenario name
+        concurrency: Number of concurrent clients
+        latencies: Latencies of the successful requests in seconds
+        errors: Number of failed requests
+        wall_time: Duration of the run in seconds
+
+    Returns:
+        Dict with throughput, latency percentiles (ms), error count and peak RSS
+    """
+    values = np.array(latencies) * 1000
+    percentile = lambda q: round(float(np.percentile(values, q)), 2) if len(values) else None
+    return {
+        'scenario': name,
+        'concurrency': concurrency,
+        'requests': len(latencies) + errors,
+        'errors': errors,
+        'throughput_rps': round(len(latencies) / wall_time, 2) if wall_time else None,
+        'latency_ms': {
+            'p50': percentile(50),
+            'p95': percentile(95),
+            'p99': percentile(99),
+            'mean': round(float(values.mean()), 2) if len(values) else None,
+            'max': round(float(values.max()), 2) if len(values) else None,
+        },
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+def run_concurrent(name: str, task: Callable[[int], None], concurrency: int, requests: int) -> Dict[str, Any]:
+    """
+    Run a task a number of times with a fixed number of concurrent clients
+
+    Args:
+        name: Scenario name
+        task: Callable taking the request index, raising on failure
+        concurrency: Number of concurrent clients
+        requests: Total number of requests
+
+    Returns:
+        Summary of the run (see summarize)
+    """
+    latencies, errors, lock = [], [0], threading.Lock()
+
+    def timed(index: int) -> None:
+        start = time.perf_counter()
+        try:
+            task(index)
+        except Exception as e:
+            logger.debug(f"{name} request {index} failed: {e}")
+            with lock:
+                errors[0] += 1
+            return
+        with lock:
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(timed, range(requests)))
+    result = summarize(name, concurrency, latencies, errors[0], time.perf_counter() - start)
+    logger.info(
+        f"{name:<40} c={concurrency:<3} {result['throughput_rps']} req/s  "
+        f"p50={result['latency_ms']['p50']}ms p95={result['latency_ms']['p95']}ms "
+        f"p99={result['latency_ms']['p99']}ms errors={result['errors']}"
+    )
+    return result
+
+def make_invoice_pdf(path: str) -> str:
+    """Write a one-page PDF invoice (with a text layer) from the OCR fixture"""
+    from fpdf import FPDF
+
+    pdf = FPDF()
+    pdf.add_page()
+    pdf.set_font('Courier', size=8)
+    for line in load_fixture('ocr_text.txt').splitlines():
+        pdf.cell(0, 4, line.encode('latin-1', 'replace').decode('latin-1'), ln=1)
+    pdf.output(path)
+    return path
+
+def stage_summary() -> Dict[str, Dict[str, float]]:
+    """Mean duration of each pipeline stage, from the metrics registry"""
+    from utils.metrics import STAGE_DURATION
+
+    stages = {}
+    for line in STAGE_DURATION.render():
+        if not line.startswith('aienergy_stage_duration_seconds_') or 'status="ok"' not in line:
+            continue
+        metric, value = line.rsplit(' ', 1)
+        stage_name = metric.split('stage="', 1)[1].split('"', 1)[0]
+        entry = stages.setdefault(stage_name, {})
+        if metric.startswith('aienergy_stage_duration_seconds_sum'):
+            entry['sum'] = float(value)
+        elif metric.startswith('aienergy_stage_duration_seconds_count'):
+            entry['count'] = int(value)
+    return {
+        name: {'count': entry.get('count', 0), 'mean_ms': round(1000 * entry['sum'] / entry['count'], 2)}
+        for name, entry in sorted(stages.items()) if entry.get('count')
+    }
+
+def llm_token_totals() -> Dict[str, float]:
+    """Prompt and completion tokens used so far by all stages, from the metrics registry"""
+    from utils.metrics import LLM_TOKENS
+
+    totals = {'prompt': 0.0, 'completion': 0.0}
+    for line in LLM_TOKENS.render():
+        if line.startswith('aienergy_llm_tokens_sum'):
+            metric, value = line.rsplit(' ', 1)
+            kind = metric.split('kind="', 1)[1].split('"', 1)[0]
+            if kind in totals:
+                totals[kind] += float(value)
+    return totals
+
+def with_llm_tokens(run: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+    """Run a scenario and add the LLM tokens it used per request to its summary"""
+    before = llm_token_totals()
+    result = run()
+    after = llm_token_totals()
+    requests = max(result['requests'], 1)
+    result['llm_tokens_per_request'] = {kind: round((after[kind] - before[kind]) / requests, 1) for kind in after}
+    return result
+
+def run_benchmarks(args: argparse.Namespace) -> Dict[str, Any]:
+    """
+    Start the mock servers and the application, then run the selected scenarios
+
+    Args:
+        args: Parsed command line arguments
+
+    Returns:
+        Machine-readable benchmark report
+    """
+    import requests
+    from werkzeug.serving import make_server
+
+    work_dir = tempfile.mkdtemp(prefix='aienergy_bench_')
+    whisper = MockWhisperServer(
+        MockBehavior(args.ocr_latency, args.jitter, args.error_rate, args.seed),
+        processing_delay=args.ocr_processing_delay
+    ).start()
+    chat = MockChatServer(MockBehavior(args.llm_latency, args.jitter, args.error_rate, args.seed)).start()
+    previous_cwd = os.getcwd()
+    http_server = None
+    try:
+        # Results written relative to the working directory and the data directory both go to the work dir
+        os.environ['DATA_DIR'] = os.path.join(work_dir, 'data')
+        # Enough processing workers for every client, so queueing does not cap the measured concurrency
+        os.environ.setdefault('PROCESSING_CONCURRENCY', str(max(args.concurrency)))
+        os.chdir(work_dir)
+
+        from app import create_app
+        from api.routes import invoice_processor
+        from services.llm_service import LLMService
+        from services.llm_backends import GroqBackend
+        from services.ocr_service import OCRService
+
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        logger.setLevel(logging.INFO)
+
+        # Point the shared processor at the mock servers (explicitly, since .env files are loaded with override)
+        invoice_processor.ocr_service = OCRService(api_key='benchmark', base_url=whisper.url)
+        invoice_processor.ocr_service.client.logger.setLevel(logging.WARNING)
+        invoice_processor.llm_service = LLMService(
+            backend=GroqBackend('benchmark', os.environ.get('GROQ_MODEL', 'llama3-70b-8192'), base_url=chat.url))
+
+        app = create_app()
+        app.config['UPLOAD_FOLDER'] = os.path.join(work_dir, 'uploads')
+        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+        logging.getLogger('aienergy.events').setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+        http_server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=http_server.serve_forever, daemon=True).start()
+        base_url = f'http://127.0.0.1:{http_server.server_port}'
+
+        source = args.file or make_invoice_pdf(os.path.join(work_dir, 'invoice.pdf'))
+        with open(source, 'rb') as f:
+            payload = f.read()
+        extension = os.path.splitext(source)[1].lower()
+        sessions = threading.local()
+
+        def session() -> 'requests.Session':
+            if not hasattr(sessions, 'session'):
+                sessions.session = requests.Session()
+            return sessions.session
+
+        def process_task(index: int) -> None:
+            # process_invoice works on a file in place, so each request gets its own copy
+            path = os.path.join(work_dir, 'uploads', f'process_{time.perf_counter_ns()}_{index}{extension}')
+            with open(path, 'wb') as f:
+                f.write(payload)
+            invoice_processor.process_invoice(path)
+
+        def upload_task(index: int) -> None:
+            response = session().post(f'{base_url}/api/upload', files={'file': (f'invoice{extension}', payload)})
+            response.raise_for_status()
+
+        results = []
+        for concurrency in args.concurrency:
+            if 'process' in args.scenarios:
+                results.append(with_llm_tokens(
+                    lambda: run_concurrent('process_invoice', process_task, concurrency, args.requests)))
+            if 'fused' in args.scenarios:
+                invoice_processor.fused_pipeline = True
+                try:
+                    results.append(with_llm_tokens(
+                        lambda: run_concurrent('process_invoice (fused)', process_task, concurrency, args.requests)))
+                finally:
+                    invoice_processor.fused_pipeline = False
+            if 'upload' in args.scenarios:
+                results.append(run_concurrent('POST /api/upload', upload_task, concurrency, args.requests))
+
+        if 'read' in args.scenarios:
+            if not invoice_processor.get_all_full_results():
+                process_task(0)
+            invoice_id = invoice_processor.get_all_full_results()[0]['invoice']['id']
+            for endpoint in READ_ENDPOINTS:
+                url = base_url + endpoint.format(invoice_id=invoice_id)
+
+                def read_task(index: int, url: str = url) -> None:
+                    response = session().get(url)
+                    response.raise_for_status()
+                    response.content
+
+                for concurrency in args.concurrency:
+                    results.append(run_concurrent(
+                        'GET ' + endpoint.split('?')[0], read_task, concurrency, args.requests * args.read_multiplier
+                    ))
+
+        return {
+            'meta': {
+                'timestamp': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'config': {
+                    key: value for key, value in vars(args).items()
+                    if key not in ('output', 'compare', 'verbose')
+                },
+            },
+            'results': results,
+            'stages': stage_summary(),
+            'peak_rss_mb': peak_rss_mb(),
+        }
+    finally:
+        if http_server is not None:
+            http_server.shutdown()
+        whisper.stop()
+        chat.stop()
+        os.chdir(previous_cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float = DEFAULT_TOLERANCE) -> List[str]:
+    """
+    Compare a report against a baseline
+
+    Args:
+        report: Report of the current run
+        baseline: Report of the baseline run
+        tolerance: Allowed relative slowdown of p95 latency and throughput
+
+    Returns:
+        Descriptions of the regressions found (empty if none)
+    """
+    reference = {(r['scenario'], r['concurrency']): r for r in baseline.get('results', [])}
+    regressions = []
+    for result in report['results']:
+        base = reference.get((result['scenario'], result['concurrency']))
+        if not base:
+            continue
+        label = f"{result['scenario']} (c={result['concurrency']})"
+        p95, base_p95 = result['latency_ms']['p95'], base['latency_ms']['p95']
+        if p95 and base_p95 and p95 > base_p95 * (1 + tolerance):
+            regressions.append(f"{label}: p95 {base_p95}ms -> {p95}ms")
+        rps, base_rps = result['throughput_rps'], base['throughput_rps']
+        if rps and base_rps and rps < base_rps * (1 - tolerance):
+            regressions.append(f"{label}: throughput {base_rps} -> {rps} req/s")
+        if result['errors'] > base['errors']:
+            regressions.append(f"{label}: errors {base['errors']} -> {result['errors']}")
+    return regressions
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        type=lambda value: [s for s in value.split(',') if s],
+                        help=f"Comma-separated scenarios among {', '.join(SCENARIOS)}")
+    parser.add_argument('--concurrency', default=[1, 4, 16], type=lambda value: [int(c) for c in value.split(',')],
+                        help='Comma-separated concurrency levels')
+    parser.add_argument('--requests', type=int, default=40, help='Requests per scenario and concurrency level')
+    parser.add_argument('--read-multiplier', type=int, default=5, help='Request multiplier for the read endpoints')
+    parser.add_argument('--ocr-latency', type=float, default=0.2, help='Mean latency of the mock /whisper call (s)')
+    parser.add_argument('--ocr-processing-delay', type=float, default=0.0,
+                        help='Seconds mock OCR jobs stay in processing (the client polls every 5s)')
+    parser.add_argument('--llm-latency', type=float, default=0.3, help='Mean latency of a mock chat completion (s)')
+    parser.add_argument('--jitter', type=float, default=0.2, help='Relative latency jitter of the mock servers')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of mock requests failing with 500')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed of the mock servers')
+    parser.add_argument('--file', help='Invoice file to upload (defaults to a generated one-page PDF)')
+    parser.add_argument('--output', help='Write the JSON report to this file (default: stdout)')
+    parser.add_argument('--compare', help='Baseline report to compare against; exits with 1 on regression')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Allowed relative regression of p95 latency and throughput')
+    parser.add_argument('--verbose', action='store_true', help='Keep the structured request log')
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    if args.file:
+        args.file = os.path.abspath(args.file)
+    return args
+
+def main(argv: Optional[List[str]] = None) -> int:
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stderr)
+    args = parse_args(argv)
+    report = run_benchmarks(args)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            logger.warning(f"Regression: {regression}")
+        if regressions:
+            return 1
+        logger.info('No regression against the baseline')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
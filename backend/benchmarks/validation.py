@@ -0,0 +1,83 @@
+"""
+Micro-benchmark of parsing and validating LLM responses
+
+Compares json.loads into dicts with pydantic validation straight from JSON
+(model_validate_json) on the fixture responses, and invoice listings built
+from dicts against slots-based summaries.
+
+Usage (from the backend directory):
+    python -m benchmarks.validation --iterations 2000
+"""
+import os
+import sys
+import json
+import timeit
+import argparse
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.mock_servers import load_fixture
+from models.invoice import Invoice, InvoiceAnalysis, InvoiceRecommendation, InvoiceSummary
+
+MODELS = {
+    'invoice': Invoice,
+    'analysis': InvoiceAnalysis,
+    'recommendations': InvoiceRecommendation,
+}
+
+def time_per_call(function: Callable[[], Any], iterations: int) -> float:
+    """Best mean time of one call over 3 repeats, in microseconds"""
+    return round(min(timeit.repeat(function, number=iterations, repeat=3)) / iterations * 1e6, 2)
+
+def allocated_kb(function: Callable[[], Any]) -> float:
+    """Memory held by the value a function returns, in KB"""
+    tracemalloc.start()
+    value = function()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del value
+    return round(size / 1024, 1)
+
+def run(iterations: int = 2000, listing_size: int = 10000) -> Dict[str, Any]:
+    """
+    Run the benchmark
+
+    Args:
+        iterations: Parses timed per payload
+        listing_size: Number of invoices in the listing comparison
+
+    Returns:
+        Report with microseconds per parse and listing memory
+    """
+    responses = json.loads(load_fixture('llm_responses.json'))
+    report: Dict[str, Any] = {'iterations': iterations, 'parse_us': {}}
+    for name, model in MODELS.items():
+        text = json.dumps(responses[name], ensure_ascii=False)
+        report['parse_us'][name] = {
+            'bytes': len(text.encode('utf-8')),
+            'json_loads': time_per_call(lambda: json.loads(text), iterations),
+            'json_loads_then_validate': time_per_call(lambda: model.model_validate(json.loads(text)), iterations),
+            'model_validate_json': time_per_call(lambda: model.model_validate_json(text), iterations),
+        }
+
+    invoice = Invoice.model_validate(responses['invoice']).model_dump(mode='json')
+    values = [invoice.get(name) for name in InvoiceSummary.__slots__]
+    report['listing_kb'] = {
+        'size': listing_size,
+        'dicts': allocated_kb(lambda: [dict(zip(InvoiceSummary.__slots__, values)) for _ in range(listing_size)]),
+        'slots': allocated_kb(lambda: [InvoiceSummary(*values) for _ in range(listing_size)]),
+    }
+    return report
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=2000, help='Parses timed per payload')
+    parser.add_argument('--listing-size', type=int, default=10000, help='Invoices in the listing comparison')
+    args = parser.parse_args(argv)
+    print(json.dumps(run(args.iterations, args.listing_size), indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
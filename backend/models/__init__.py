@@ -1,3 +1,11 @@
 """Models module for AIENERGY backend"""
 
-from .invoice import Invoice, InvoiceItem, EnergyConsumption, InvoiceRecommendation
+from .invoice import (
+    Invoice,
+    InvoiceItem,
+    InvoiceIssue,
+    InvoiceAnalysis,
+    InvoiceRecommendation,
+    FusedInvoiceResult,
+    InvoiceSummary
+)
@@ -1,49 +1,131 @@
-from pydantic import BaseModel, Field
-from typing import List, Dict, Optional
-from datetime import datetime
-import uuid
+from pydantic import BaseModel, BeforeValidator, ConfigDict, Field, ValidationError
+from typing import Annotated, Any, Dict, List, Optional, Union
+
+from utils.invoice_utils import parse_date, to_float
+
+def _number(value: Any) -> Optional[float]:
+    """Accept numbers and numeric strings ("13 818,99"), rejecting anything else"""
+    if value is None or value == '':
+        return None
+    number = to_float(value)
+    if number is None:
+        raise ValueError(f"expected a number, got {value!r}")
+    return number
+
+def _date(value: Any) -> Optional[str]:
+    """Normalize a date to YYYY-MM-DD"""
+    if value is None or value == '':
+        return None
+    date = parse_date(value)
+    if date is None:
+        raise ValueError(f"expected a date in YYYY-MM-DD format, got {value!r}")
+    return date.strftime('%Y-%m-%d')
+
+def _text(value: Any) -> Optional[str]:
+    """Accept strings and numbers (invoice numbers are often returned as integers)"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    return value
+
+Number = Annotated[Optional[float], BeforeValidator(_number)]
+Date = Annotated[Optional[str], BeforeValidator(_date)]
+Text = Annotated[Optional[str], BeforeValidator(_text)]
 
 class InvoiceItem(BaseModel):
     """Model for an individual line item on an invoice"""
-    description: str
-    quantity: float
-    unit_price: float
-    total: float
-    
-class EnergyConsumption(BaseModel):
-    """Model for energy consumption details"""
-    period_start: datetime
-    period_end: datetime
-    total_kwh: float
-    peak_kwh: Optional[float] = None
-    off_peak_kwh: Optional[float] = None
-    rate_per_kwh: float
-    
+    model_config = ConfigDict(extra='ignore')
+
+    description: Text = None
+    quantity: Number = None
+    unit_price: Number = None
+    total: Number = None
+
 class Invoice(BaseModel):
-    """Model for an energy invoice"""
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    file_path: str
-    provider: str
-    invoice_number: str
-    issue_date: datetime
-    due_date: datetime
-    customer_name: str
-    customer_id: str
-    total_amount: float
-    consumption: EnergyConsumption
-    items: List[InvoiceItem]
-    taxes: Dict[str, float]
-    processed_at: datetime = Field(default_factory=datetime.now)
-    
-    class Config:
-        json_encoders = {
-            datetime: lambda v: v.isoformat()
-        }
+    """Model for an energy invoice, as extracted by the LLM"""
+    model_config = ConfigDict(extra='ignore')
+
+    id: Optional[str] = None
+    file_path: Optional[str] = None
+    file_hash: Optional[str] = None
+    batch_id: Optional[str] = None
+    provider: Text = None
+    invoice_number: Text = None
+    issue_date: Date = None
+    due_date: Date = None
+    customer_name: Text = None
+    customer_id: Text = None
+    total_amount: Number = None
+    period_start: Date = None
+    period_end: Date = None
+    total_kwh: Number = None
+    rate_per_kwh: Number = None
+    peak_kwh: Number = None
+    off_peak_kwh: Number = None
+    max_power_kw: Number = None
+    items: List[InvoiceItem] = Field(default_factory=list)
+    taxes: Dict[str, Number] = Field(default_factory=dict)
+
+class InvoiceIssue(BaseModel):
+    """Model for an issue identified by the analysis"""
+    model_config = ConfigDict(extra='allow')
+
+    description: str
+    severity: Optional[str] = None
+
+class InvoiceAnalysis(BaseModel):
+    """Model for the analysis of an invoice (issues as objects, or strings with a parallel severity list)"""
+    model_config = ConfigDict(extra='allow')
+
+    issues: List[Union[InvoiceIssue, str]] = Field(default_factory=list)
+    severity: Optional[List[str]] = None
 
 class InvoiceRecommendation(BaseModel):
     """Model for invoice recommendations"""
-    invoice_id: str
+    model_config = ConfigDict(extra='allow')
+
+    invoice_id: Optional[str] = None
     recommendations: List[str]
-    potential_savings: Optional[float] = None
-    efficiency_score: Optional[float] = None
-    generated_at: datetime = Field(default_factory=datetime.now)
+    potential_savings: Number = None
+    efficiency_score: Annotated[Optional[float], BeforeValidator(_number), Field(ge=0, le=100)] = None
+
+class FusedInvoiceResult(BaseModel):
+    """Model for the single-call extraction, analysis and recommendations of an invoice"""
+    model_config = ConfigDict(extra='ignore')
+
+    invoice: Invoice
+    analysis: InvoiceAnalysis
+    recommendations: InvoiceRecommendation
+
+class InvoiceSummary:
+    """Summary of an invoice in listings; slots keep large listings compact"""
+
+    __slots__ = ('id', 'provider', 'invoice_number', 'issue_date', 'customer_name', 'total_amount',
+                 'period_start', 'period_end', 'total_kwh')
+
+    def __init__(self, *values: Any):
+        """Set the fields in __slots__ order (missing trailing values are None)"""
+        values += (None,) * (len(self.__slots__) - len(values))
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+def describe_errors(error: ValidationError, limit: int = 20) -> List[str]:
+    """
+    Describe validation errors field by field
+
+    Args:
+        error: Pydantic validation error
+        limit: Maximum number of errors described
+
+    Returns:
+        Lines such as "items.2.total: expected a number, got 'n/a'"
+    """
+    lines = []
+    for detail in error.errors()[:limit]:
+        location = '.'.join(str(part) for part in detail['loc']) or '(document)'
+        lines.append(f"{location}: {detail['msg'].removeprefix('Value error, ')}")
+    return lines
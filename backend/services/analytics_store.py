@@ -0,0 +1,325 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+
+from utils.invoice_utils import to_float, billing_period, customer_key, summarize_items, ENERGY_CATEGORIES
+
+logger = logging.getLogger(__name__)
+
+STRING_COLUMNS = (
+    'invoice_id', 'provider', 'customer', 'customer_name', 'invoice_number',
+    'issue_date', 'due_date', 'period'
+)
+NUMERIC_COLUMNS = (
+    'total_amount', 'total_kwh', 'peak_kwh', 'off_peak_kwh', 'normal_kwh',
+    'energy_cost', 'tax_total', 'updated_at'
+)
+GROUP_COLUMNS = {'provider': 'provider', 'customer': 'customer'}
+
+def invoice_to_row(invoice: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Flatten extracted invoice data into one analytics row
+
+    Args:
+        invoice: Extracted invoice data (as stored under "invoice" in a full result)
+
+    Returns:
+        Dict with a value for every store column (NaN for unknown numbers)
+    """
+    items = summarize_items(invoice.get('items'))
+    taxes = invoice.get('taxes') if isinstance(invoice.get('taxes'), dict) else {}
+
+    def band_kwh(category, field):
+        if category in items:
+            return items[category]['quantity']
+        value = to_float(invoice.get(field)) if field else None
+        return np.nan if value is None else value
+
+    def number(field):
+        value = to_float(invoice.get(field))
+        return np.nan if value is None else value
+
+    energy_items = [items[c]['total'] for c in ENERGY_CATEGORIES if c in items]
+    tax_values = [to_float(v) for v in taxes.values()]
+    tax_values = [v for v in tax_values if v is not None]
+
+    return {
+        'invoice_id': str(invoice.get('id') or ''),
+        'provider': str(invoice.get('provider') or ''),
+        'customer': customer_key(invoice),
+        'customer_name': str(invoice.get('customer_name') or ''),
+        'invoice_number': str(invoice.get('invoice_number') or ''),
+        'issue_date': str(invoice.get('issue_date') or ''),
+        'due_date': str(invoice.get('due_date') or ''),
+        'period': billing_period(invoice),
+        'total_amount': number('total_amount'),
+        'total_kwh': number('total_kwh'),
+        'peak_kwh': band_kwh('peak', 'peak_kwh'),
+        'off_peak_kwh': band_kwh('off_peak', 'off_peak_kwh'),
+        'normal_kwh': band_kwh('normal', None),
+        'energy_cost': sum(energy_items) if energy_items else np.nan,
+        'tax_total': sum(tax_values) if tax_values else np.nan,
+        'updated_at': time.time(),
+    }
+
+def _number(value: float) -> Optional[float]:
+    """Convert a numpy scalar to a JSON-friendly float (None for NaN/inf)"""
+    value = float(value)
+    return round(value, 6) if np.isfinite(value) else None
+
+class AnalyticsStore:
+    """
+    Columnar store of per-invoice metrics used for dashboard aggregations.
+
+    Rows are appended as small immutable ``.npz`` segments (one per write) and
+    periodically compacted into a single base segment. Rows are keyed by
+    invoice ID: the most recent write for an ID wins, so re-processing or
+    correcting an invoice simply appends a new row.
+    """
+
+    def __init__(self, store_dir: str, max_segments: int = 32):
+        """
+        Initialize the store, loading existing segments from disk
+
+        Args:
+            store_dir: Directory holding the segment files
+            max_segments: Number of segments above which they are compacted
+        """
+        self.store_dir = store_dir
+        self.max_segments = max_segments
+        os.makedirs(self.store_dir, exist_ok=True)
+
+        self._lock = threading.RLock()
+        self._segments = {}
+        self._columns = None
+
+    def __len__(self) -> int:
+        return len(self.columns()['invoice_id'])
+
+    def add_invoice(self, invoice: Dict[str, Any]) -> None:
+        """Append (or replace) the analytics row of a processed invoice"""
+        self.append([invoice_to_row(invoice)])
+
+    def append(self, rows: List[Dict[str, Any]]) -> None:
+        """
+        Append rows as a new segment
+
+        Args:
+            rows: Rows as returned by invoice_to_row
+        """
+        if not rows:
+            return
+        columns = self._build_columns(rows)
+        with self._lock:
+            self._refresh()
+            name = self._write_segment(columns)
+            self._segments[name] = columns
+            self._columns = None
+            if len(self._segments) > self.max_segments:
+                self.compact()
+
+    def rebuild(self, invoices: Iterable[Dict[str, Any]]) -> None:
+        """
+        Replace the store content with rows built from the given invoices
+
+        Args:
+            invoices: Extracted invoice data of every processed invoice
+        """
+        rows = [invoice_to_row(invoice) for invoice in invoices]
+        with self._lock:
+            self._refresh()
+            old_segments = list(self._segments)
+            self._segments = {}
+            if rows:
+                columns = self._build_columns(rows)
+                self._segments[self._write_segment(columns)] = columns
+            self._columns = None
+            self._remove_segments(old_segments)
+        logger.info(f"Analytics store rebuilt with {len(rows)} invoices")
+
+    def compact(self) -> None:
+        """Merge all segments into a single base segment"""
+        with self._lock:
+            columns = self.columns()
+            old_segments = list(self._segments)
+            name = self._write_segment(columns)
+            self._segments = {name: columns}
+            self._remove_segments(old_segments)
+            logger.info(f"Compacted {len(old_segments)} analytics segments")
+
+    def columns(self) -> Dict[str, np.ndarray]:
+        """
+        Get the current content of the store as column arrays
+
+        Returns:
+            Dict mapping column name to a numpy array (one entry per invoice)
+        """
+        with self._lock:
+            self._refresh()
+            if self._columns is None:
+                self._columns = self._merge(list(self._segments.values()))
+            return self._columns
+
+    def select(self, filters: Optional[Dict[str, Any]] = None) -> Dict[str, np.ndarray]:
+        """
+        Get the store columns restricted to the rows matching the filters
+
+        Args:
+            filters: Optional dict with provider, customer, period_from, period_to
+                     (YYYY-MM, inclusive) and invoice_ids keys
+
+        Returns:
+            Dict mapping column name to the filtered numpy array
+        """
+        columns = self.columns()
+        filters = {k: v for k, v in (filters or {}).items() if v}
+        if not filters:
+            return columns
+
+        mask = np.ones(len(columns['invoice_id']), dtype=bool)
+        if 'provider' in filters:
+            mask &= columns['provider'] == filters['provider']
+        if 'customer' in filters:
+            mask &= columns['customer'] == filters['customer']
+        if 'period_from' in filters:
+            mask &= columns['period'] >= filters['period_from']
+        if 'period_to' in filters:
+            mask &= (columns['period'] <= filters['period_to']) & (columns['period'] != '')
+        if 'invoice_ids' in filters:
+            mask &= np.isin(columns['invoice_id'], list(filters['invoice_ids']))
+        return {name: values[mask] for name, values in columns.items()}
+
+    def aggregate(self, group_by: str = 'provider', filters: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Aggregate consumption and cost metrics by provider or customer
+
+        Args:
+            group_by: 'provider' or 'customer'
+            filters: Row filters (see select)
+
+        Returns:
+            Dict with the grouping and one entry per group, including a monthly breakdown
+        """
+        if group_by not in GROUP_COLUMNS:
+            raise ValueError(f"Unsupported group_by: {group_by}")
+
+        columns = self.select(filters)
+        groups, group_idx = np.unique(columns[GROUP_COLUMNS[group_by]], return_inverse=True)
+        periods, period_idx = np.unique(columns['period'], return_inverse=True)
+        n_groups, n_periods = len(groups), len(periods)
+        cells = group_idx * n_periods + period_idx
+
+        def by_group(values):
+            return np.bincount(group_idx, weights=np.nan_to_num(values), minlength=n_groups)
+
+        def by_cell(values=None):
+            weights = None if values is None else np.nan_to_num(values)
+            return np.bincount(cells, weights=weights, minlength=n_groups * n_periods).reshape(n_groups, n_periods)
+
+        counts = np.bincount(group_idx, minlength=n_groups)
+        total_kwh = by_group(columns['total_kwh'])
+        total_amount = by_group(columns['total_amount'])
+        energy_cost = by_group(columns['energy_cost'])
+        tax_total = by_group(columns['tax_total'])
+        peak = by_group(columns['peak_kwh'])
+        off_peak = by_group(columns['off_peak_kwh'])
+        normal = by_group(columns['normal_kwh'])
+        band_kwh = peak + off_peak + normal
+
+        month_counts = by_cell()
+        month_kwh = by_cell(columns['total_kwh'])
+        month_amount = by_cell(columns['total_amount'])
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cost_per_kwh = energy_cost / band_kwh
+            peak_share = peak / band_kwh
+            off_peak_share = off_peak / band_kwh
+
+        result = []
+        for g, key in enumerate(groups):
+            months = np.nonzero(month_counts[g])[0]
+            result.append({
+                'key': str(key) or None,
+                'invoice_count': int(counts[g]),
+                'total_kwh': _number(total_kwh[g]),
+                'total_amount': _number(total_amount[g]),
+                'energy_cost': _number(energy_cost[g]),
+                'cost_per_kwh': _number(cost_per_kwh[g]),
+                'peak_share': _number(peak_share[g]),
+                'off_peak_share': _number(off_peak_share[g]),
+                'tax_total': _number(tax_total[g]),
+                'by_month': [
+                    {
+                        'period': str(periods[p]) or None,
+                        'invoice_count': int(month_counts[g, p]),
+                        'total_kwh': _number(month_kwh[g, p]),
+                        'total_amount': _number(month_amount[g, p]),
+                    }
+                    for p in months
+                ],
+            })
+        return {'group_by': group_by, 'invoice_count': int(counts.sum()), 'groups': result}
+
+    def _refresh(self) -> None:
+        """Pick up segments written or compacted away by other workers"""
+        on_disk = {name for name in os.listdir(self.store_dir) if name.endswith('.npz')}
+        if set(self._segments) - on_disk:
+            # Another worker compacted the segments we hold; reload everything
+            self._segments = {}
+        for name in sorted(on_disk - set(self._segments)):
+            try:
+                with np.load(os.path.join(self.store_dir, name), allow_pickle=False) as data:
+                    self._segments[name] = {column: data[column] for column in data.files}
+            except (OSError, ValueError) as e:
+                logger.warning(f"Skipping unreadable analytics segment {name}: {e}")
+                continue
+            self._columns = None
+
+    def _merge(self, segments: List[Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+        """Concatenate segments, keeping only the latest row of each invoice"""
+        if not segments:
+            columns = {name: np.array([], dtype=str) for name in STRING_COLUMNS}
+            columns.update({name: np.array([], dtype=np.float64) for name in NUMERIC_COLUMNS})
+            return columns
+
+        columns = {
+            name: np.concatenate([segment[name] for segment in segments])
+            for name in STRING_COLUMNS + NUMERIC_COLUMNS
+        }
+        # Latest update first, then keep the first occurrence of each invoice ID
+        order = np.argsort(-columns['updated_at'], kind='stable')
+        _, first = np.unique(columns['invoice_id'][order], return_index=True)
+        if len(first) == len(order):
+            return columns
+        keep = np.sort(order[first])
+        return {name: values[keep] for name, values in columns.items()}
+
+    def _build_columns(self, rows: List[Dict[str, Any]]) -> Dict[str, np.ndarray]:
+        """Convert rows to column arrays"""
+        columns = {name: np.array([row[name] for row in rows], dtype=str) for name in STRING_COLUMNS}
+        columns.update({
+            name: np.array([row[name] for row in rows], dtype=np.float64) for name in NUMERIC_COLUMNS
+        })
+        return columns
+
+    def _write_segment(self, columns: Dict[str, np.ndarray]) -> str:
+        """Write columns to a new segment file atomically and return its name"""
+        name = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.npz"
+        path = os.path.join(self.store_dir, name)
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, **columns)
+        os.replace(path + '.tmp', path)
+        return name
+
+    def _remove_segments(self, names: List[str]) -> None:
+        """Delete segment files that have been merged elsewhere"""
+        for name in names:
+            try:
+                os.remove(os.path.join(self.store_dir, name))
+            except FileNotFoundError:
+                pass
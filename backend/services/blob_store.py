@@ -0,0 +1,337 @@
+import os
+import gzip
+import time
+import uuid
+import shutil
+import hashlib
+import logging
+import threading
+from typing import Any, Dict, Optional
+
+from utils.database import Database
+from utils.file_utils import remove_stale_files
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    extension TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    tier TEXT NOT NULL DEFAULT 'hot',
+    ref_count INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL,
+    -- When the blob last became unreferenced (its creation if it never was referenced)
+    released_at REAL
+);
+CREATE TABLE IF NOT EXISTS blob_refs (
+    digest TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    PRIMARY KEY (digest, owner)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_blob_refs_owner ON blob_refs (owner);
+CREATE INDEX IF NOT EXISTS idx_blobs_released ON blobs (released_at) WHERE ref_count = 0;
+CREATE INDEX IF NOT EXISTS idx_blobs_tier ON blobs (tier, accessed_at);
+"""
+
+HOT, ARCHIVE = 'hot', 'archive'
+
+DAY = 24 * 3600
+COPY_CHUNK_SIZE = 1024 * 1024
+
+def file_sha256(path: str) -> str:
+    """Compute the SHA-256 of a file in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class BlobStore:
+    """
+    Content-addressed storage of uploaded files, reference counted by invoices
+
+    Blobs are identified by the SHA-256 of their content. A blob is kept while
+    invoices reference it; once unreferenced it is deleted after the retention
+    period. Blobs not accessed for a while move to a compressed archive tier.
+    """
+
+    def put(self, source_path: str, extension: str, digest: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Move a file into the store (dropping it if the content is already stored)
+
+        Args:
+            source_path: File to store; it is moved, not copied
+            extension: File extension without the dot (e.g. 'pdf')
+            digest: SHA-256 of the file if already known
+
+        Returns:
+            Dict with digest, extension, size and path of the blob
+        """
+        raise NotImplementedError
+
+    def path(self, digest: str) -> Optional[str]:
+        """Get a local path to read a blob from, restoring it from the archive if needed"""
+        raise NotImplementedError
+
+    def add_ref(self, digest: str, owner: str) -> None:
+        """Record that an owner (an invoice ID) references a blob"""
+        raise NotImplementedError
+
+    def release(self, digest: str, owner: str) -> None:
+        """Remove the reference of an owner to a blob"""
+        raise NotImplementedError
+
+    def compact(self, now: Optional[float] = None) -> Dict[str, int]:
+        """Archive cold blobs and delete unreferenced blobs past retention"""
+        raise NotImplementedError
+
+class LocalBlobStore(BlobStore):
+    """Blob store on the local filesystem, with its index in the application database"""
+
+    def __init__(self, root: str, database: Database, retention_days: Optional[float] = None,
+                 archive_after_days: Optional[float] = None):
+        """
+        Initialize the store, removing temporary files left by crashed workers
+
+        Args:
+            root: Root directory of the store
+            database: Application database holding the blob index and references
+            retention_days: Days unreferenced blobs are kept (defaults to BLOB_RETENTION_DAYS or 30)
+            archive_after_days: Days without access before a blob is compressed
+                (defaults to BLOB_ARCHIVE_AFTER_DAYS or 7, 0 disables archiving)
+        """
+        self.root = root
+        self.database = database
+        if retention_days is None:
+            retention_days = float(os.environ.get('BLOB_RETENTION_DAYS', 30))
+        if archive_after_days is None:
+            archive_after_days = float(os.environ.get('BLOB_ARCHIVE_AFTER_DAYS', 7))
+        self.retention = retention_days * DAY
+        self.archive_after = archive_after_days * DAY
+
+        self.objects_dir = os.path.join(root, 'objects')
+        self.archive_dir = os.path.join(root, 'archive')
+        self.tmp_dir = os.path.join(root, 'tmp')
+        for directory in (self.objects_dir, self.archive_dir, self.tmp_dir):
+            os.makedirs(directory, exist_ok=True)
+        self.database.executescript(SCHEMA)
+        remove_stale_files(self.tmp_dir)
+
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _hot_path(self, digest: str, extension: str) -> str:
+        # Two levels of 256 shards keep every directory small
+        return os.path.join(self.objects_dir, digest[:2], digest[2:4], f"{digest}.{extension}")
+
+    def _archive_path(self, digest: str, extension: str) -> str:
+        return os.path.join(self.archive_dir, digest[:2], digest[2:4], f"{digest}.{extension}.gz")
+
+    def _tmp_path(self) -> str:
+        return os.path.join(self.tmp_dir, f"{uuid.uuid4().hex}.tmp")
+
+    def put(self, source_path: str, extension: str, digest: Optional[str] = None) -> Dict[str, Any]:
+        digest = digest or file_sha256(source_path)
+        extension = extension.lower().lstrip('.')
+        size = os.path.getsize(source_path)
+        hot_path = self._hot_path(digest, extension)
+        os.makedirs(os.path.dirname(hot_path), exist_ok=True)
+        # Bring the file onto the store's filesystem first (a copy when it is on another one),
+        # so only a rename happens while the write lock is held
+        staged_path = self._stage(source_path)
+        now = time.time()
+
+        # Renames happen under the database write lock, so they never race with compaction
+        with self.database.transaction() as conn:
+            row = conn.execute('SELECT extension, tier, ref_count FROM blobs WHERE digest = ?', (digest,)).fetchone()
+            if row is None:
+                os.replace(staged_path, hot_path)
+                conn.execute(
+                    'INSERT INTO blobs (digest, extension, size, tier, ref_count, created_at, accessed_at, released_at) '
+                    'VALUES (?, ?, ?, ?, 0, ?, ?, ?)',
+                    (digest, extension, size, HOT, now, now, now)
+                )
+            else:
+                extension = row['extension']
+                hot_path = self._hot_path(digest, extension)
+                if row['tier'] == HOT and os.path.exists(hot_path):
+                    os.remove(staged_path)
+                else:
+                    # Archived (or missing) content: the new copy becomes the hot one
+                    os.makedirs(os.path.dirname(hot_path), exist_ok=True)
+                    os.replace(staged_path, hot_path)
+                    archive_path = self._archive_path(digest, extension)
+                    if os.path.exists(archive_path):
+                        os.remove(archive_path)
+                conn.execute(
+                    'UPDATE blobs SET tier = ?, accessed_at = ?, '
+                    'released_at = CASE WHEN ref_count = 0 THEN ? ELSE released_at END WHERE digest = ?',
+                    (HOT, now, now, digest)
+                )
+        return {'digest': digest, 'extension': extension, 'size': size, 'path': hot_path}
+
+    def _stage(self, source_path: str) -> str:
+        """Move a file into the temporary directory, copying it if it is on another filesystem"""
+        tmp_path = self._tmp_path()
+        try:
+            os.replace(source_path, tmp_path)
+        except OSError:
+            try:
+                shutil.copyfile(source_path, tmp_path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            os.remove(source_path)
+        return tmp_path
+
+    def path(self, digest: str) -> Optional[str]:
+        row = self.database.connection.execute(
+            'SELECT extension, tier FROM blobs WHERE digest = ?', (digest,)
+        ).fetchone()
+        if row is None:
+            return None
+        hot_path = self._hot_path(digest, row['extension'])
+        if row['tier'] == HOT:
+            self.database.connection.execute('UPDATE blobs SET accessed_at = ? WHERE digest = ?', (time.time(), digest))
+            return hot_path
+
+        # Restore from the archive: decompress outside the lock, then swap in under it
+        archive_path = self._archive_path(digest, row['extension'])
+        tmp_path = self._tmp_path()
+        with gzip.open(archive_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+        with self.database.transaction() as conn:
+            current = conn.execute('SELECT tier FROM blobs WHERE digest = ?', (digest,)).fetchone()
+            if current is not None and current['tier'] == ARCHIVE:
+                os.makedirs(os.path.dirname(hot_path), exist_ok=True)
+                os.replace(tmp_path, hot_path)
+                os.remove(archive_path)
+                conn.execute('UPDATE blobs SET tier = ?, accessed_at = ? WHERE digest = ?', (HOT, time.time(), digest))
+                logger.info(f"Restored blob {digest} from the archive")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return hot_path
+
+    def add_ref(self, digest: str, owner: str) -> None:
+        with self.database.transaction() as conn:
+            inserted = conn.execute(
+                'INSERT OR IGNORE INTO blob_refs (digest, owner) SELECT digest, ? FROM blobs WHERE digest = ?',
+                (owner, digest)
+            ).rowcount
+            if inserted:
+                conn.execute(
+                    'UPDATE blobs SET ref_count = ref_count + 1, released_at = NULL WHERE digest = ?', (digest,)
+                )
+
+    def release(self, digest: str, owner: str) -> None:
+        with self.database.transaction() as conn:
+            deleted = conn.execute('DELETE FROM blob_refs WHERE digest = ? AND owner = ?', (digest, owner)).rowcount
+            if deleted:
+                conn.execute(
+                    'UPDATE blobs SET ref_count = ref_count - 1, '
+                    'released_at = CASE WHEN ref_count = 1 THEN ? ELSE released_at END WHERE digest = ?',
+                    (time.time(), digest)
+                )
+
+    def ref_count(self, digest: str) -> int:
+        """Get the number of owners referencing a blob (0 if unknown)"""
+        row = self.database.connection.execute('SELECT ref_count FROM blobs WHERE digest = ?', (digest,)).fetchone()
+        return row['ref_count'] if row else 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Get blob counts and sizes per tier"""
+        rows = self.database.connection.execute(
+            'SELECT tier, COUNT(*), COALESCE(SUM(size), 0), SUM(ref_count = 0) FROM blobs GROUP BY tier'
+        ).fetchall()
+        return {tier: {'count': count, 'bytes': size, 'unreferenced': unreferenced or 0}
+                for tier, count, size, unreferenced in rows}
+
+    def compact(self, now: Optional[float] = None) -> Dict[str, int]:
+        now = time.time() if now is None else now
+        result = {'deleted': self._collect_garbage(now), 'archived': 0}
+        if self.archive_after > 0:
+            result['archived'] = self._archive_cold(now)
+        remove_stale_files(self.tmp_dir)
+        if result['deleted'] or result['archived']:
+            logger.info(f"Blob store compaction: {result['deleted']} deleted, {result['archived']} archived")
+        return result
+
+    def _collect_garbage(self, now: float) -> int:
+        candidates = self.database.connection.execute(
+            'SELECT digest FROM blobs WHERE ref_count = 0 AND released_at < ?', (now - self.retention,)
+        ).fetchall()
+        deleted = 0
+        for (digest,) in candidates:
+            with self.database.transaction() as conn:
+                # Re-checked under the write lock: the blob may have been referenced or re-uploaded since
+                row = conn.execute(
+                    'SELECT extension, tier FROM blobs WHERE digest = ? AND ref_count = 0 AND released_at < ?',
+                    (digest, now - self.retention)
+                ).fetchone()
+                if row is None:
+                    continue
+                for path in (self._hot_path(digest, row['extension']), self._archive_path(digest, row['extension'])):
+                    if os.path.exists(path):
+                        os.remove(path)
+                conn.execute('DELETE FROM blobs WHERE digest = ?', (digest,))
+                deleted += 1
+        return deleted
+
+    def _archive_cold(self, now: float) -> int:
+        cutoff = now - self.archive_after
+        candidates = self.database.connection.execute(
+            'SELECT digest, extension, accessed_at FROM blobs WHERE tier = ? AND accessed_at < ?', (HOT, cutoff)
+        ).fetchall()
+        archived = 0
+        for digest, extension, accessed_at in candidates:
+            hot_path = self._hot_path(digest, extension)
+            if not os.path.exists(hot_path):
+                continue
+            # Compress outside the lock, then swap in only if the blob was not touched meanwhile
+            tmp_path = self._tmp_path()
+            with open(hot_path, 'rb') as src, gzip.open(tmp_path, 'wb', compresslevel=6) as dst:
+                shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+            with self.database.transaction() as conn:
+                row = conn.execute(
+                    'SELECT 1 FROM blobs WHERE digest = ? AND tier = ? AND accessed_at = ?', (digest, HOT, accessed_at)
+                ).fetchone()
+                if row is not None:
+                    archive_path = self._archive_path(digest, extension)
+                    os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+                    os.replace(tmp_path, archive_path)
+                    os.remove(hot_path)
+                    conn.execute('UPDATE blobs SET tier = ? WHERE digest = ?', (ARCHIVE, digest))
+                    archived += 1
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return archived
+
+    def start_compaction(self, interval: float) -> None:
+        """
+        Run compaction periodically on a background thread
+
+        Args:
+            interval: Seconds between compactions (0 or less disables it)
+        """
+        if interval <= 0 or self._thread is not None:
+            return
+
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    self.compact()
+                except Exception as e:
+                    logger.warning(f"Blob store compaction failed: {str(e)}")
+
+        self._thread = threading.Thread(target=run, name='blob-compaction', daemon=True)
+        self._thread.start()
+
+    def stop_compaction(self) -> None:
+        """Stop the background compaction thread"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,217 @@
+import math
+import logging
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from utils.invoice_utils import ENERGY_CATEGORIES, classify_item, summarize_items, to_float
+
+logger = logging.getLogger(__name__)
+
+# Relative and absolute tolerances when comparing amounts (item totals are rounded to the cent)
+TOLERANCE = 0.01
+ABSOLUTE_TOLERANCE = 0.05
+# The average rate is compared more loosely, as invoices round unit prices
+RATE_TOLERANCE = 0.05
+# Share of the consumption in peak hours above which the analysis looks at the tariff split
+PEAK_SHARE_THRESHOLD = 0.3
+# Item categories whose presence means the invoice carries penalties worth analyzing
+PENALTY_CATEGORIES = ('power_overrun', 'reactive')
+
+# Fields given a confidence flag: 'verified', 'derived', 'mismatch' or 'unverified'
+CHECKED_FIELDS = ('items', 'total_amount', 'total_kwh', 'peak_kwh', 'off_peak_kwh', 'rate_per_kwh')
+
+def _column(values: List[Any]) -> np.ndarray:
+    """Convert extracted values to a float array (NaN for missing values)"""
+    return np.array([np.nan if (number := to_float(value)) is None else number for value in values], dtype=float)
+
+def _differs(value: np.ndarray, expected: np.ndarray, tolerance: float = TOLERANCE) -> np.ndarray:
+    """Element-wise mismatch of two arrays (False where either side is unknown)"""
+    with np.errstate(invalid='ignore'):
+        return np.abs(value - expected) > np.maximum(tolerance * np.abs(expected), ABSOLUTE_TOLERANCE)
+
+def check_invoices(invoices: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Check the arithmetic of extracted invoices and compute the derivable fields
+
+    All items of all invoices are checked at once: quantity * unit_price against
+    each item total, item totals plus taxes against total_amount, the energy bands
+    against total_kwh, peak_kwh and off_peak_kwh, and the energy cost per kWh
+    against rate_per_kwh.
+
+    Args:
+        invoices: Extracted invoice data
+
+    Returns:
+        One report per invoice, with 'consistent', a confidence 'flags' dict,
+        'item_mismatches' (item indexes), 'derived' (values for missing fields),
+        'item_totals' (index -> total for items without one) and 'expected'
+        (computed values of mismatching fields)
+    """
+    count = len(invoices)
+    rows = [(index, position, item) for index, invoice in enumerate(invoices)
+            for position, item in enumerate(invoice.get('items') or []) if isinstance(item, dict)]
+    owner = np.array([row[0] for row in rows], dtype=np.int64)
+    position = np.array([row[1] for row in rows], dtype=np.int64)
+    categories = np.array([classify_item(item.get('description')) for _, _, item in rows], dtype=object)
+    quantity = _column([item.get('quantity') for _, _, item in rows])
+    unit_price = _column([item.get('unit_price') for _, _, item in rows])
+    total = _column([item.get('total') for _, _, item in rows])
+
+    # Items: quantity * unit_price against the total, missing totals computed
+    computed = quantity * unit_price
+    item_mismatch = _differs(total, computed)
+    item_unknown = np.isnan(computed) & np.isnan(total)
+    item_total = np.where(np.isnan(total), computed, total)
+
+    def per_invoice(weights: np.ndarray) -> np.ndarray:
+        return np.bincount(owner, weights=weights, minlength=count) if len(rows) else np.zeros(count)
+
+    items_total = per_invoice(np.nan_to_num(item_total))
+    items_complete = per_invoice(item_unknown.astype(float)) == 0
+    has_items = per_invoice(np.ones(len(rows))) > 0
+    bands = {c: per_invoice(np.where(categories == c, np.nan_to_num(quantity), 0.0)) for c in ENERGY_CATEGORIES}
+    energy_kwh = sum(bands.values())
+    energy_cost = per_invoice(np.where(np.isin(categories, ENERGY_CATEGORIES), np.nan_to_num(item_total), 0.0))
+
+    taxes = np.array([sum(to_float(value) or 0.0 for value in (invoice.get('taxes') or {}).values())
+                      if isinstance(invoice.get('taxes'), dict) else 0.0 for invoice in invoices], dtype=float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        expected = {
+            'total_amount': np.where(has_items & items_complete, items_total + taxes, np.nan),
+            'total_kwh': np.where(energy_kwh > 0, energy_kwh, np.nan),
+            'peak_kwh': np.where(bands['peak'] > 0, bands['peak'], np.nan),
+            'off_peak_kwh': np.where(bands['off_peak'] > 0, bands['off_peak'], np.nan),
+            'rate_per_kwh': np.where(energy_kwh > 0, energy_cost / energy_kwh, np.nan),
+        }
+    extracted = {field: _column([invoice.get(field) for invoice in invoices]) for field in expected}
+    mismatch = {field: _differs(extracted[field], expected[field], RATE_TOLERANCE if field == 'rate_per_kwh' else TOLERANCE)
+                for field in expected}
+
+    # Rows are in invoice order: the mismatching and filled items of each invoice are
+    # split into per-invoice groups at once
+    def by_invoice(selected: np.ndarray, *columns: np.ndarray) -> List[List[list]]:
+        bounds = np.searchsorted(owner[selected], np.arange(1, count))
+        return [[part.tolist() for part in np.split(column[selected], bounds)] for column in columns]
+
+    mismatched_items, = by_invoice(item_mismatch, position)
+    filled = np.isnan(total) & ~np.isnan(computed)
+    filled_positions, filled_totals = by_invoice(filled, position, computed)
+
+    expected_values = {field: values.tolist() for field, values in expected.items()}
+    extracted_missing = {field: np.isnan(values).tolist() for field, values in extracted.items()}
+    mismatched = {field: values.tolist() for field, values in mismatch.items()}
+    verified = (has_items & items_complete).tolist()
+
+    reports = []
+    for index in range(count):
+        flags = {'items': 'mismatch' if mismatched_items[index] else
+                 'verified' if verified[index] else 'unverified'}
+        derived, values = {}, {}
+        for field in expected:
+            value = expected_values[field][index]
+            if mismatched[field][index]:
+                flags[field] = 'mismatch'
+                values[field] = round(value, 4)
+            elif math.isnan(value):
+                flags[field] = 'unverified'
+            elif extracted_missing[field][index]:
+                flags[field] = 'derived'
+                derived[field] = round(value, 5 if field == 'rate_per_kwh' else 2)
+            else:
+                flags[field] = 'verified'
+        reports.append({
+            'consistent': 'mismatch' not in flags.values(),
+            'flags': flags,
+            'item_mismatches': mismatched_items[index],
+            'derived': derived,
+            'item_totals': {i: round(t, 2) for i, t in zip(filled_positions[index], filled_totals[index])},
+            'expected': values,
+        })
+    return reports
+
+def check_invoice(invoice: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Check the arithmetic of one invoice (see check_invoices)
+
+    Args:
+        invoice: Extracted invoice data
+
+    Returns:
+        The consistency report
+    """
+    return check_invoices([invoice])[0]
+
+def needs_analysis(invoice: Dict[str, Any], report: Dict[str, Any]) -> bool:
+    """
+    Tell whether an invoice is worth an LLM analysis
+
+    Consistent invoices without penalty items and without a high share of peak
+    consumption have none of the issues the analysis looks for.
+
+    Args:
+        invoice: Invoice data, with the derived fields filled in
+        report: Its consistency report
+
+    Returns:
+        False if the invoice is clean
+    """
+    if not report['consistent']:
+        return True
+    items = summarize_items(invoice.get('items'))
+    if any(items.get(category, {}).get('total') for category in PENALTY_CATEGORIES):
+        return True
+    peak, total = to_float(invoice.get('peak_kwh')), to_float(invoice.get('total_kwh'))
+    return bool(peak and total and peak / total >= PEAK_SHARE_THRESHOLD)
+
+def analysis_payload(invoice: Dict[str, Any], report: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Build the compact view of an invoice sent to the analysis prompt
+
+    Identifiers and empty fields are dropped and line items are summed by
+    category; checked fields that are not verified are listed so the LLM does
+    not redo the arithmetic.
+
+    Args:
+        invoice: Invoice data
+        report: Its consistency report
+
+    Returns:
+        The invoice fields, 'items_by_category' and 'checks'
+    """
+    skipped = {'id', 'file_path', 'file_hash', 'items', 'taxes'}
+    payload = {key: value for key, value in invoice.items() if key not in skipped and value not in (None, '', [], {})}
+    payload['items_by_category'] = {
+        category: {key: round(value, 5 if key == 'unit_price' else 2) for key, value in entry.items() if value is not None}
+        for category, entry in summarize_items(invoice.get('items')).items()
+    }
+    taxes = invoice.get('taxes') or {}
+    if taxes:
+        payload['taxes_total'] = round(sum(to_float(value) or 0.0 for value in taxes.values()), 2)
+    if report:
+        payload['checks'] = {field: flag for field, flag in report['flags'].items() if flag != 'verified'}
+    return payload
+
+def summarize_reports(invoices: List[Dict[str, Any]], reports: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Summarize the consistency reports of a corpus
+
+    Args:
+        invoices: Invoice data
+        reports: Their reports, in the same order
+
+    Returns:
+        Counts per field and flag, and the reports of the inconsistent invoices
+    """
+    flag_counts = {field: {} for field in CHECKED_FIELDS}
+    for report in reports:
+        for field, flag in report['flags'].items():
+            flag_counts[field][flag] = flag_counts[field].get(flag, 0) + 1
+    inconsistent = [dict(report, id=invoice.get('id')) for invoice, report in zip(invoices, reports)
+                    if not report['consistent']]
+    return {
+        'checked': len(reports),
+        'consistent': len(reports) - len(inconsistent),
+        'flags': flag_counts,
+        'inconsistent': inconsistent,
+    }
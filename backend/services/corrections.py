@@ -0,0 +1,77 @@
+import logging
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from models.invoice import Invoice
+
+logger = logging.getLogger(__name__)
+
+# Fields set by the pipeline, which users cannot correct
+PIPELINE_FIELDS = ('id', 'file_path', 'file_hash', 'batch_id')
+CORRECTABLE_FIELDS = tuple(name for name in Invoice.model_fields if name not in PIPELINE_FIELDS)
+
+# Fields the consistency check reads
+AMOUNT_FIELDS = ('items', 'taxes', 'total_amount', 'total_kwh', 'peak_kwh', 'off_peak_kwh', 'rate_per_kwh')
+# Fields placing an invoice in its customer's history, and those its metrics come from
+HISTORY_FIELDS = ('customer_id', 'customer_name', 'period_start', 'period_end', 'issue_date',
+                  'items', 'total_kwh', 'max_power_kw')
+
+# Invoice fields each stage reads; a correction recomputes the stages reading a corrected field.
+# The recommendations are not listed: they are made again when the issues, history flags or
+# simulation they are made from change.
+STAGE_FIELDS = {
+    'check': AMOUNT_FIELDS,
+    'analyze': AMOUNT_FIELDS + ('provider', 'max_power_kw', 'period_start', 'period_end'),
+    'history': HISTORY_FIELDS,
+    'simulate': HISTORY_FIELDS,
+}
+
+def apply_corrections(invoice: Dict[str, Any], corrections: Dict[str, Any],
+                      flags: Optional[Dict[str, str]] = None) -> Tuple[Dict[str, Any], Dict[str, Dict[str, Any]]]:
+    """
+    Apply field corrections to an invoice
+
+    Values are normalized like extracted ones (numbers, YYYY-MM-DD dates); items and
+    taxes are replaced as a whole. Fields the consistency check derived at processing
+    (flagged 'derived') are cleared when an amount changes, so they are derived again.
+
+    Args:
+        invoice: Stored invoice data
+        corrections: New value of each corrected field
+        flags: Consistency flags of the stored invoice
+
+    Returns:
+        (corrected invoice, {field: {'old': ..., 'new': ...}} for the fields whose value changed)
+
+    Raises:
+        ValueError: If a field does not exist or cannot be corrected
+        ValidationError: If a value is invalid
+    """
+    unknown = sorted(set(corrections) - set(CORRECTABLE_FIELDS))
+    if unknown:
+        raise ValueError(f"Fields cannot be corrected: {', '.join(unknown)}")
+
+    normalized = Invoice.model_validate({**invoice, **corrections}).model_dump(mode='json')
+    corrected = dict(invoice)
+    changed = {}
+    for field in corrections:
+        if normalized[field] != invoice.get(field):
+            changed[field] = {'old': invoice.get(field), 'new': normalized[field]}
+            corrected[field] = normalized[field]
+
+    if set(changed) & set(AMOUNT_FIELDS):
+        for field, flag in (flags or {}).items():
+            if flag == 'derived' and field not in corrections and field in CORRECTABLE_FIELDS:
+                corrected[field] = None
+    return corrected, changed
+
+def dirty_stages(changed: Set[str]) -> List[str]:
+    """
+    Get the stages reading any of the changed fields
+
+    Args:
+        changed: Names of the changed fields
+
+    Returns:
+        Stage names, in pipeline order
+    """
+    return [stage_name for stage_name, fields in STAGE_FIELDS.items() if changed & set(fields)]
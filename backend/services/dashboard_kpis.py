@@ -0,0 +1,183 @@
+import logging
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from utils.database import Database
+from utils.invoice_utils import billing_period, normalize_issues, summarize_items, to_float
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dashboard_kpis (
+    dimension TEXT NOT NULL,
+    key TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    amount REAL NOT NULL,
+    kwh REAL NOT NULL,
+    savings REAL NOT NULL,
+    efficiency_sum REAL NOT NULL,
+    efficiency_count INTEGER NOT NULL,
+    PRIMARY KEY (dimension, key)
+) WITHOUT ROWID;
+"""
+
+# Measures kept for every (dimension, key) cell, in table column order
+MEASURES = ('count', 'amount', 'kwh', 'savings', 'efficiency_sum', 'efficiency_count')
+
+# Dimensions: 'total' (a single '' key), 'period' (billing month), 'provider', 'severity'
+# (count of issues), 'tax' (amounts by tax), 'item' (amounts by line item category, see
+# invoice_utils.classify_item) and 'band' (kWh by peak, off-peak and normal hours)
+TOTAL = ('total', '')
+
+Cell = Tuple[str, str]
+
+def kpi_cells(result: Optional[Dict[str, Any]]) -> Dict[Cell, List[float]]:
+    """
+    Get what a full result adds to each dashboard KPI cell
+
+    Args:
+        result: Full result ({"invoice", "analysis", "recommendations"}), or None
+
+    Returns:
+        Dict mapping (dimension, key) to its measures (see MEASURES)
+    """
+    cells: Dict[Cell, List[float]] = defaultdict(lambda: [0.0] * len(MEASURES))
+    invoice = (result or {}).get('invoice')
+    if not isinstance(invoice, dict):
+        return {}
+    recommendations = result.get('recommendations') or {}
+    amount = to_float(invoice.get('total_amount')) or 0.0
+    kwh = to_float(invoice.get('total_kwh')) or 0.0
+    savings = to_float(recommendations.get('potential_savings')) or 0.0
+    efficiency = to_float(recommendations.get('efficiency_score'))
+
+    cells[TOTAL][:] = [1, amount, kwh, savings, efficiency or 0.0, 0 if efficiency is None else 1]
+    for cell in (('period', billing_period(invoice)), ('provider', str(invoice.get('provider') or ''))):
+        cells[cell][0:3] = [1, amount, kwh]
+
+    for issue in normalize_issues(result.get('analysis')):
+        cells[('severity', issue['severity'] or 'unknown')][0] += 1
+
+    taxes = invoice.get('taxes') if isinstance(invoice.get('taxes'), dict) else {}
+    for name, value in taxes.items():
+        cell = cells[('tax', str(name))]
+        cell[0] = 1
+        cell[1] += to_float(value) or 0.0
+    items = summarize_items(invoice.get('items'))
+    for category, summary in items.items():
+        cells[('item', category)][0:2] = [1, summary['total']]
+
+    # kWh by hour band: the consumption items, or the extracted peak/off-peak totals
+    for band, field in (('peak', 'peak_kwh'), ('off_peak', 'off_peak_kwh'), ('normal', None)):
+        value = items[band]['quantity'] if band in items else (to_float(invoice.get(field)) if field else None)
+        if value:
+            cell = cells[('band', band)]
+            cell[0] = 1
+            cell[2] = value
+    return dict(cells)
+
+class DashboardKPIs:
+    """
+    Dashboard figures materialized in SQLite, one row per (dimension, key) cell
+
+    Each saved result applies the difference between its new and previous cells in the
+    transaction that writes it, so the table always matches the stored results and the
+    dashboard is read from a few rows whatever the number of invoices.
+    """
+
+    def __init__(self, database: Database):
+        """
+        Initialize the table, creating it if needed
+
+        Args:
+            database: Application database
+        """
+        self.database = database
+        self.database.executescript(SCHEMA)
+
+    def empty(self) -> bool:
+        """Check whether no result was counted yet"""
+        row = self.database.connection.execute(
+            'SELECT count FROM dashboard_kpis WHERE dimension = ? AND key = ?', TOTAL
+        ).fetchone()
+        return not row or not row['count']
+
+    def apply(self, conn, previous: Optional[Dict[str, Any]], result: Optional[Dict[str, Any]]) -> None:
+        """
+        Replace a result's contribution to the KPIs, within the caller's transaction
+
+        Args:
+            conn: Connection in a write transaction
+            previous: Result as stored before (None for a new invoice)
+            result: Result as stored now (None for a removed invoice)
+        """
+        deltas = kpi_cells(result)
+        for cell, values in kpi_cells(previous).items():
+            delta = deltas.setdefault(cell, [0.0] * len(MEASURES))
+            for i, value in enumerate(values):
+                delta[i] -= value
+        rows = [(*cell, *values) for cell, values in deltas.items() if any(values)]
+        if not rows:
+            return
+        conn.executemany(
+            f"""INSERT INTO dashboard_kpis (dimension, key, {', '.join(MEASURES)})
+                VALUES ({', '.join('?' * (len(MEASURES) + 2))})
+                ON CONFLICT (dimension, key) DO UPDATE SET
+                    {', '.join(f'{name} = {name} + excluded.{name}' for name in MEASURES)}""",
+            rows
+        )
+        # Cells no invoice counts in any more (a corrected period or provider)
+        conn.executemany(
+            "DELETE FROM dashboard_kpis WHERE dimension = ? AND key = ? AND count <= 0 AND dimension != 'total'",
+            [row[:2] for row in rows]
+        )
+
+    def rebuild(self, conn, results: Iterable[Dict[str, Any]]) -> None:
+        """
+        Recompute the KPIs from all stored results, within the caller's transaction
+
+        Args:
+            conn: Connection in a write transaction
+            results: All full results
+        """
+        conn.execute('DELETE FROM dashboard_kpis')
+        count = 0
+        for result in results:
+            self.apply(conn, None, result)
+            count += 1
+        logger.info(f"Rebuilt the dashboard KPIs from {count} results")
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Get the dashboard figures
+
+        Returns:
+            Dict with invoice count, total_amount, total_kwh, potential_savings and
+            average_efficiency_score, issue counts by severity, amount and kWh by
+            period and by provider, and amounts by tax and line item category and kWh by hour band
+        """
+        rows = self.database.connection.execute(
+            f"SELECT dimension, key, {', '.join(MEASURES)} FROM dashboard_kpis ORDER BY dimension, key"
+        ).fetchall()
+        cells = defaultdict(dict)
+        for row in rows:
+            cells[row['dimension']][row['key']] = row
+        total = cells['total'].get('')
+
+        def figures(row):
+            return {'invoices': row['count'], 'amount': round(row['amount'], 2), 'kwh': round(row['kwh'], 2)}
+
+        return {
+            'invoices': total['count'] if total else 0,
+            'total_amount': round(total['amount'], 2) if total else 0.0,
+            'total_kwh': round(total['kwh'], 2) if total else 0.0,
+            'potential_savings': round(total['savings'], 2) if total else 0.0,
+            'average_efficiency_score': (round(total['efficiency_sum'] / total['efficiency_count'], 1)
+                                         if total and total['efficiency_count'] else None),
+            'severity': {key: row['count'] for key, row in cells['severity'].items()},
+            'periods': [dict(figures(row), period=key) for key, row in cells['period'].items() if key],
+            'providers': {key or 'Autre': figures(row) for key, row in cells['provider'].items()},
+            'taxes': {key: round(row['amount'], 2) for key, row in cells['tax'].items()},
+            'items': {key: round(row['amount'], 2) for key, row in cells['item'].items()},
+            'bands': {key: round(row['kwh'], 2) for key, row in cells['band'].items()},
+        }
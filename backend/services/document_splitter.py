@@ -0,0 +1,140 @@
+import os
+import re
+import uuid
+import logging
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import PyPDF2
+
+from utils.metrics import registry, stage
+
+logger = logging.getLogger(__name__)
+
+# Header printed at the top of each invoice, with its number ("Détail de votre facture N° 1234567")
+INVOICE_HEADER = re.compile(
+    r"(?:d[ée]tail\s+de\s+votre\s+facture\s+n\s*[°o]|n\s*[°o]\s*facture)\.?\s*:?\s*([0-9][0-9A-Z/-]{3,})",
+    re.IGNORECASE
+)
+
+# Pages with less text than this are considered scanned (no usable text layer)
+MIN_TEXT_CHARS = 20
+
+DOCUMENTS_SPLIT = registry.counter('aienergy_documents_split_total', 'Uploaded PDFs holding several invoices')
+SPLIT_INVOICES = registry.counter('aienergy_split_invoices_total', 'Invoices found in split PDFs')
+
+def find_invoice_number(text: str) -> Optional[str]:
+    """Get the invoice number from the first invoice header of a page, if any"""
+    match = INVOICE_HEADER.search(text or '')
+    return match.group(1).upper() if match else None
+
+def segment_pages(page_texts: List[str]) -> List[Tuple[int, int, Optional[str]]]:
+    """
+    Find the invoices of a document from the headers of its pages
+
+    A page starts a new invoice when its header carries a number different from
+    the current invoice's (continuation pages repeating the header stay with it).
+    Pages without a header belong to the invoice before them, or to the first one.
+
+    Args:
+        page_texts: Text of each page
+
+    Returns:
+        (first page, last page, invoice number) of each invoice, 0-based and inclusive
+    """
+    segments: List[List[Any]] = []
+    for index, text in enumerate(page_texts):
+        number = find_invoice_number(text)
+        if number and (not segments or (segments[-1][2] and segments[-1][2] != number)):
+            segments.append([index, index, number])
+        elif segments:
+            segments[-1][1] = index
+            segments[-1][2] = segments[-1][2] or number
+        else:
+            segments.append([index, index, number])
+    return [tuple(segment) for segment in segments]
+
+def read_page_texts(pdf_path: str) -> List[str]:
+    """Text layer of each page of a PDF"""
+    with open(pdf_path, 'rb') as f:
+        reader = PyPDF2.PdfReader(f)
+        return [page.extract_text() or '' for page in reader.pages]
+
+class DocumentSplitter:
+    """
+    Splits PDF bundles holding several invoices into one PDF per invoice
+
+    Boundaries are found from the invoice headers in the text layer of each page;
+    bundles of scanned pages go through a cheap OCR pass instead when one is given.
+    """
+
+    def __init__(self, output_dir: str, ocr_pages: Optional[Callable[[str], List[str]]] = None):
+        """
+        Initialize the splitter
+
+        Args:
+            output_dir: Directory the per-invoice PDFs are written to
+            ocr_pages: Optional function returning the OCR text of each page of a PDF,
+                used when the text layer is missing
+        """
+        self.output_dir = output_dir
+        self.ocr_pages = ocr_pages
+        os.makedirs(output_dir, exist_ok=True)
+
+    def page_texts(self, pdf_path: str) -> List[str]:
+        """
+        Get the text of each page, from the text layer or the cheap OCR pass
+
+        Args:
+            pdf_path: Path to the PDF file
+
+        Returns:
+            Text of each page
+        """
+        texts = read_page_texts(pdf_path)
+        if self.ocr_pages and len(texts) > 1 and any(len(text.strip()) < MIN_TEXT_CHARS for text in texts):
+            try:
+                ocr_texts = self.ocr_pages(pdf_path)
+                if len(ocr_texts) == len(texts):
+                    return [text if len(text.strip()) >= MIN_TEXT_CHARS else ocr_text
+                            for text, ocr_text in zip(texts, ocr_texts)]
+                logger.warning(f"Page OCR returned {len(ocr_texts)} pages for {len(texts)}, using the text layer")
+            except Exception as e:
+                logger.warning(f"Page OCR failed, using the text layer: {str(e)}")
+        return texts
+
+    def split(self, pdf_path: str) -> List[Dict[str, Any]]:
+        """
+        Split a PDF into its invoices
+
+        Args:
+            pdf_path: Path to the PDF file
+
+        Returns:
+            One dict per invoice with pages ([first, last], 1-based), invoice_number (from
+            the header, may be None) and path. A single invoice keeps the original path;
+            otherwise each invoice is written to its own file, which the caller removes.
+        """
+        with stage('segment') as info:
+            texts = self.page_texts(pdf_path)
+            segments = segment_pages(texts)
+            info['pages'] = len(texts)
+            info['invoices'] = len(segments)
+            if len(segments) <= 1:
+                return [{'pages': [1, max(len(texts), 1)], 'invoice_number': segments[0][2] if segments else None,
+                         'path': pdf_path}]
+
+            DOCUMENTS_SPLIT.inc()
+            SPLIT_INVOICES.inc(len(segments))
+            with open(pdf_path, 'rb') as f:
+                reader = PyPDF2.PdfReader(f)
+                parts = []
+                for first, last, number in segments:
+                    writer = PyPDF2.PdfWriter()
+                    for index in range(first, last + 1):
+                        writer.add_page(reader.pages[index])
+                    path = os.path.join(self.output_dir, f"{uuid.uuid4().hex}_p{first + 1}-{last + 1}.pdf")
+                    with open(path, 'wb') as out:
+                        writer.write(out)
+                    parts.append({'pages': [first + 1, last + 1], 'invoice_number': number, 'path': path})
+            logger.info(f"Split {pdf_path} into {len(parts)} invoices")
+            return parts
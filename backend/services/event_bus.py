@@ -0,0 +1,153 @@
+import json
+import time
+import logging
+import threading
+from typing import Any, Dict, Iterator, List, Optional
+
+from utils.database import Database
+from utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    type TEXT NOT NULL,
+    data TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+"""
+
+# Processing stages published for each invoice, in pipeline order
+STAGES = ('uploaded', 'ocr_done', 'extracted', 'analyzed', 'recommended')
+
+# Seconds events are kept for clients catching up with Last-Event-ID
+RETENTION_SECONDS = 3600
+# Old events are pruned once every this many publishes
+PRUNE_EVERY = 100
+# Seconds between reads of the event log, to pick up events published by other workers
+POLL_INTERVAL = 0.5
+
+EVENTS_PUBLISHED = registry.counter('aienergy_events_published_total', 'Events published to clients', ['type'])
+EVENT_SUBSCRIBERS = registry.gauge('aienergy_event_subscribers', 'Clients listening to the event stream')
+
+def format_sse(event: Optional[Dict[str, Any]]) -> str:
+    """
+    Encode an event as a Server-Sent Events message
+
+    Args:
+        event: Event from EventBus.listen (None for a keep-alive comment)
+
+    Returns:
+        The message text
+    """
+    if event is None:
+        return ': keep-alive\n\n'
+    data = json.dumps(event['data'], ensure_ascii=False)
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {data}\n\n"
+
+class EventBus:
+    """Publish/subscribe channel over an event log table, shared by all workers"""
+
+    def __init__(self, database: Database, poll_interval: float = POLL_INTERVAL,
+                 retention: float = RETENTION_SECONDS):
+        """
+        Initialize the event bus
+
+        Args:
+            database: Application database
+            poll_interval: Seconds between reads of the event log while idle
+            retention: Seconds events are kept
+        """
+        self.database = database
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.database.executescript(SCHEMA)
+        # Listeners of this worker are woken as soon as an event is published here
+        self._condition = threading.Condition()
+        self._generation = 0
+
+    def publish(self, event_type: str, **data) -> int:
+        """
+        Publish an event
+
+        Args:
+            event_type: Event type (e.g. 'progress', 'invoice')
+            data: JSON-serializable event fields
+
+        Returns:
+            ID of the event
+        """
+        now = time.time()
+        with self.database.transaction() as conn:
+            cursor = conn.execute(
+                "INSERT INTO events (type, data, created_at) VALUES (?, ?, ?)",
+                (event_type, json.dumps(data, ensure_ascii=False, default=str), now)
+            )
+            event_id = cursor.lastrowid
+            if event_id % PRUNE_EVERY == 0:
+                conn.execute("DELETE FROM events WHERE created_at < ?", (now - self.retention,))
+        with self._condition:
+            self._generation += 1
+            self._condition.notify_all()
+        EVENTS_PUBLISHED.inc(type=event_type)
+        return event_id
+
+    def latest_id(self) -> int:
+        """Get the ID of the last published event (0 if none)"""
+        return self.database.connection.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+
+    def since(self, last_id: int, limit: int = 100) -> List[Dict[str, Any]]:
+        """
+        Get the events published after an event
+
+        Args:
+            last_id: ID of the last event seen
+            limit: Maximum number of events returned
+
+        Returns:
+            Events with 'id', 'type', 'data' and 'created_at', oldest first
+        """
+        rows = self.database.connection.execute(
+            "SELECT id, type, data, created_at FROM events WHERE id > ? ORDER BY id LIMIT ?", (last_id, limit)
+        ).fetchall()
+        return [{'id': row['id'], 'type': row['type'], 'data': json.loads(row['data']),
+                 'created_at': row['created_at']} for row in rows]
+
+    def listen(self, last_id: Optional[int] = None, heartbeat: float = 15.0,
+               stop: Optional[threading.Event] = None) -> Iterator[Optional[Dict[str, Any]]]:
+        """
+        Follow the event log
+
+        Args:
+            last_id: ID of the last event seen (None to receive only new events)
+            heartbeat: Seconds without events after which None is yielded, so
+                idle connections are kept alive and closed clients detected
+            stop: Optional event ending the iteration
+
+        Yields:
+            Events in publication order, or None as a keep-alive
+        """
+        last_id = self.latest_id() if last_id is None else last_id
+        last_yield = time.monotonic()
+        EVENT_SUBSCRIBERS.inc()
+        try:
+            while not (stop and stop.is_set()):
+                with self._condition:
+                    generation = self._generation
+                events = self.since(last_id)
+                for event in events:
+                    last_id = event['id']
+                    yield event
+                if events:
+                    last_yield = time.monotonic()
+                    continue
+                if time.monotonic() - last_yield >= heartbeat:
+                    last_yield = time.monotonic()
+                    yield None
+                # Events of other workers are picked up by the next read of the log
+                with self._condition:
+                    if self._generation == generation:
+                        self._condition.wait(self.poll_interval)
+        finally:
+            EVENT_SUBSCRIBERS.dec()
@@ -0,0 +1,150 @@
+import re
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from pydantic import ValidationError
+
+from models.invoice import Invoice
+from services.consistency_checker import check_invoice
+from utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Fields that can be re-extracted: prompt description and the OCR lines likely to hold them.
+# A missing field is only re-requested when its keywords appear in the OCR text.
+REPAIRABLE_FIELDS = {
+    'provider': ("nom du fournisseur d'énergie", r"lydec|onee|redal|amendis|radee"),
+    'invoice_number': ("numéro de facture", r"n°\s*facture|facture\s*n°"),
+    'issue_date': ("date d'émission (AAAA-MM-JJ)", r"date\s+de\s+l'?\s*[ée]dition|date\s+d'[ée]mission|[ée]mise?\s+le"),
+    'due_date': ("date limite de paiement (AAAA-MM-JJ)", r"date\s+limite|[ée]ch[ée]ance|payer\s+avant"),
+    'customer_name': ("nom du client", r"client|raison\s+sociale|abonn[ée]"),
+    'customer_id': ("numéro d'identification du client", r"n°\s*client|r[ée]f[ée]rence\s+client|n°\s*contrat|police"),
+    'total_amount': ("montant total TTC", r"montant\s+ttc|total\s+g[ée]n[ée]ral|net\s+[àa]\s+payer|total\s+ttc|\btva\b"),
+    'period_start': ("début de la période de consommation (AAAA-MM-JJ)", r"p[ée]riode|ancien\s+index"),
+    'period_end': ("fin de la période de consommation (AAAA-MM-JJ)", r"p[ée]riode|nouvel\s+index"),
+    'total_kwh': ("total des kWh consommés", r"total.*(kwh|[ée]nergie\s+active)"),
+    'rate_per_kwh': ("tarif moyen par kWh", r"prix\s+unitaire|tarif|kwh"),
+}
+
+CONTEXT_LINES = 1
+MAX_SNIPPET_CHARS = 2000
+# Fields whose mismatch with the line items is worth a re-extraction
+REPAIRABLE_MISMATCHES = ('total_amount', 'total_kwh')
+
+FIELDS_REPAIRED = registry.counter(
+    'aienergy_fields_repaired_total', 'Fields re-extracted by the repair stage', ['field', 'outcome']
+)
+
+def find_inconsistent_fields(invoice: Dict[str, Any], report: Optional[Dict[str, Any]] = None) -> List[str]:
+    """
+    Find totals that contradict the line items
+
+    Args:
+        invoice: Extracted invoice data
+        report: Its consistency report (computed if not given)
+
+    Returns:
+        Names of the fields whose value disagrees with the items and taxes
+    """
+    flags = (report or check_invoice(invoice))['flags']
+    return [name for name in REPAIRABLE_MISMATCHES if flags.get(name) == 'mismatch']
+
+def ocr_snippet(ocr_text: str, patterns: List[str], max_chars: int = MAX_SNIPPET_CHARS) -> str:
+    """
+    Extract the OCR lines matching any pattern, with their neighbouring non-blank lines
+
+    Args:
+        ocr_text: Raw OCR text
+        patterns: Case-insensitive regular expressions
+        max_chars: Maximum snippet length
+
+    Returns:
+        The matching lines in document order ('' if none match)
+    """
+    lines = [line.strip() for line in (ocr_text or '').splitlines() if line.strip()]
+    regex = re.compile('|'.join(f'(?:{p})' for p in patterns), re.IGNORECASE)
+    selected = set()
+    for i, line in enumerate(lines):
+        if regex.search(line):
+            selected.update(range(max(0, i - CONTEXT_LINES), min(len(lines), i + CONTEXT_LINES + 1)))
+    snippet, size = [], 0
+    for i in sorted(selected):
+        line = lines[i]
+        if size + len(line) > max_chars:
+            break
+        snippet.append(line)
+        size += len(line) + 1
+    return '\n'.join(snippet)
+
+class FieldRepairer:
+    """Re-extracts missing or inconsistent invoice fields from the relevant part of the OCR text"""
+
+    def __init__(self, llm_service):
+        """
+        Initialize the repairer
+
+        Args:
+            llm_service: LLM service used for the re-extraction
+        """
+        self.llm_service = llm_service
+
+    def plan(self, invoice: Dict[str, Any], ocr_text: str) -> Tuple[List[str], str]:
+        """
+        Choose the fields to re-extract and the OCR snippet to send
+
+        Args:
+            invoice: Extracted invoice data
+            ocr_text: Raw OCR text
+
+        Returns:
+            The field names and the snippet (no fields if nothing needs repair)
+        """
+        report = check_invoice(invoice)
+        inconsistent = find_inconsistent_fields(invoice, report)
+        # Missing fields computable from the items are left to the consistency check
+        candidates = [name for name in REPAIRABLE_FIELDS if name in inconsistent or
+                      (invoice.get(name) is None and name not in report['derived'])]
+        fields = [name for name in candidates
+                  if name in inconsistent or re.search(REPAIRABLE_FIELDS[name][1], ocr_text or '', re.IGNORECASE)]
+        if not fields:
+            return [], ''
+        snippet = ocr_snippet(ocr_text, [REPAIRABLE_FIELDS[name][1] for name in fields])
+        return (fields, snippet) if snippet else ([], '')
+
+    def repair(self, invoice: Invoice, ocr_text: str) -> List[str]:
+        """
+        Re-extract the missing or inconsistent fields of an invoice in place
+
+        Args:
+            invoice: Validated invoice
+            ocr_text: Raw OCR text
+
+        Returns:
+            Names of the fields that were updated
+        """
+        data = invoice.model_dump()
+        fields, snippet = self.plan(data, ocr_text)
+        if not fields:
+            return []
+
+        response = self.llm_service.extract_fields({name: REPAIRABLE_FIELDS[name][0] for name in fields}, snippet)
+        try:
+            values = Invoice.model_validate_json(response) if isinstance(response, str) else Invoice.model_validate(response)
+        except ValidationError as e:
+            logger.warning(f"Ignoring invalid field re-extraction: {str(e)}")
+            for name in fields:
+                FIELDS_REPAIRED.inc(field=name, outcome='invalid')
+            return []
+
+        repaired = []
+        for name in fields:
+            value = getattr(values, name)
+            if value is None or value == data.get(name):
+                FIELDS_REPAIRED.inc(field=name, outcome='unchanged')
+                continue
+            setattr(invoice, name, value)
+            repaired.append(name)
+            FIELDS_REPAIRED.inc(field=name, outcome='repaired')
+        if repaired:
+            logger.info(f"Re-extracted fields: {', '.join(repaired)}")
+        return repaired
@@ -0,0 +1,308 @@
+import json
+import logging
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+from utils.database import Database
+from utils.invoice_utils import to_float, billing_period, customer_key, summarize_items, ENERGY_CATEGORIES
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS customer_history (
+    customer TEXT PRIMARY KEY,
+    state TEXT NOT NULL
+);
+"""
+
+METRICS = ('total_kwh', 'peak_share', 'cost_per_kwh', 'subscribed_power', 'power_overrun', 'max_power')
+
+# Subscribed power is only called oversized when the highest power actually drawn
+# over the history stays below this share of it
+OVERSIZED_POWER_RATIO = 0.8
+
+def invoice_metrics(invoice: Dict[str, Any]) -> np.ndarray:
+    """
+    Compute the history metrics of one invoice
+
+    Args:
+        invoice: Extracted invoice data
+
+    Returns:
+        Array of values ordered as METRICS (NaN when a metric cannot be derived)
+    """
+    items = summarize_items(invoice.get('items'))
+    band_kwh = sum(items[c]['quantity'] for c in ENERGY_CATEGORIES if c in items)
+    energy_cost = sum(items[c]['total'] for c in ENERGY_CATEGORIES if c in items)
+    total_kwh = to_float(invoice.get('total_kwh')) or band_kwh or np.nan
+
+    if band_kwh:
+        peak_share = items.get('peak', {}).get('quantity', 0.0) / band_kwh
+        cost_per_kwh = energy_cost / band_kwh
+    else:
+        peak_share = cost_per_kwh = np.nan
+
+    if items:
+        subscribed = items['subscribed_power']['quantity'] if 'subscribed_power' in items else np.nan
+        overrun = items['power_overrun']['quantity'] if 'power_overrun' in items else 0.0
+    else:
+        subscribed = overrun = np.nan
+    max_power = to_float(invoice.get('max_power_kw'))
+
+    return np.array([total_kwh, peak_share, cost_per_kwh, subscribed, overrun,
+                     np.nan if max_power is None else max_power], dtype=np.float64)
+
+def _welford(stats: Dict[str, np.ndarray], values: np.ndarray, sign: int) -> None:
+    """Add (sign=1) or remove (sign=-1) one observation from running count/mean/M2 arrays"""
+    mask = np.isfinite(values)
+    count, mean, m2 = stats['count'], stats['mean'], stats['m2']
+    x = np.where(mask, values, 0.0)
+    if sign > 0:
+        new_count = count + mask
+        delta = x - mean
+        new_mean = np.where(mask, mean + delta / np.maximum(new_count, 1), mean)
+        new_m2 = np.where(mask, m2 + delta * (x - new_mean), m2)
+    else:
+        new_count = np.maximum(count - mask, 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            new_mean = np.where(mask & (new_count > 0), (count * mean - x) / new_count, np.where(mask, 0.0, mean))
+        new_m2 = np.where(mask & (new_count > 0), np.maximum(m2 - (x - new_mean) * (x - mean), 0.0),
+                          np.where(mask, 0.0, m2))
+    stats['count'], stats['mean'], stats['m2'] = new_count, new_mean, new_m2
+
+def _empty_stats() -> Dict[str, np.ndarray]:
+    size = len(METRICS)
+    return {'count': np.zeros(size), 'mean': np.zeros(size), 'm2': np.zeros(size)}
+
+def _round(value: float) -> Optional[float]:
+    return round(float(value), 4) if np.isfinite(value) else None
+
+class HistoryAnalyzer:
+    """
+    Judges an invoice against the billing history of its customer.
+
+    Each customer has a row in the database holding the metrics of every billed
+    period plus running (Welford) statistics, overall and per calendar month.
+    Processing an invoice updates that state in O(1) instead of re-reading
+    the customer's previous invoices.
+    """
+
+    def __init__(self, database: Database, window: int = 12, min_history: int = 3, z_threshold: float = 2.0):
+        """
+        Initialize the analyzer, creating its table if needed
+
+        Args:
+            database: Application database holding one state row per customer
+            window: Number of previous periods used for the rolling baseline
+            min_history: Minimum number of previous periods before z-scores are reported
+            z_threshold: Absolute z-score above which a metric is flagged
+        """
+        self.database = database
+        self.window = window
+        self.min_history = min_history
+        self.z_threshold = z_threshold
+        self.database.executescript(SCHEMA)
+
+    def evaluate(self, invoice: Dict[str, Any], exclude: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        """
+        Evaluate an invoice against its customer's history, without recording it
+
+        A period that is already recorded is left out of the history it is judged against.
+
+        Args:
+            invoice: Extracted invoice data
+            exclude: Invoice as recorded before a correction, also left out of the history
+
+        Returns:
+            Compact findings, or None if the customer or billing period is unknown
+        """
+        key = customer_key(invoice)
+        period = billing_period(invoice)
+        if not key or not period:
+            return None
+
+        state = self._load(self.database.connection, key)
+        self._remove_period(state, period)
+        self._remove_invoice(state, key, exclude)
+        findings = self._evaluate(state, period, invoice_metrics(invoice))
+        findings['customer'] = key
+        return findings
+
+    def history_values(self, invoice: Dict[str, Any], exclude: Optional[Dict[str, Any]] = None) -> Optional[np.ndarray]:
+        """
+        Get the metrics of the customer's previous periods
+
+        Args:
+            invoice: Extracted invoice data
+            exclude: Invoice as recorded before a correction, left out of the history
+
+        Returns:
+            One row per period before the invoice's (at most window rows, oldest first),
+            ordered as METRICS, or None if the customer or billing period is unknown
+        """
+        key = customer_key(invoice)
+        period = billing_period(invoice)
+        if not key or not period:
+            return None
+
+        state = self._load(self.database.connection, key)
+        self._remove_invoice(state, key, exclude)
+        previous = sorted(p for p in state['periods'] if p < period)[-self.window:]
+        return np.array([state['periods'][p]['values'] for p in previous], dtype=np.float64).reshape(-1, len(METRICS))
+
+    def record(self, invoice: Dict[str, Any], previous: Optional[Dict[str, Any]] = None) -> None:
+        """
+        Add an invoice to its customer's history
+
+        Re-processing an already recorded period replaces that period's values. The
+        state is read and written in one transaction, so concurrent workers do not
+        lose each other's updates.
+
+        Args:
+            invoice: Extracted invoice data, once it has been persisted
+            previous: The invoice as recorded before a correction, removed from its
+                customer's history in the same transaction
+        """
+        key = customer_key(invoice)
+        period = billing_period(invoice)
+
+        with self.database.transaction() as conn:
+            previous_key = customer_key(previous) if previous else ''
+            if previous_key and previous_key != key:
+                state = self._load(conn, previous_key)
+                if self._remove_invoice(state, previous_key, previous):
+                    self._save(conn, previous_key, state)
+            if not key or not period:
+                return
+            state = self._load(conn, key)
+            self._remove_invoice(state, key, previous)
+            self._remove_period(state, period)
+            self._add_period(state, period, invoice.get('id'), invoice_metrics(invoice))
+            self._save(conn, key, state)
+
+    def _evaluate(self, state: Dict[str, Any], period: str, values: np.ndarray) -> Dict[str, Any]:
+        """Compute z-scores, rolling baselines and seasonal deviations for one invoice"""
+        stats = state['stats']
+        seasonal = state['seasonal'].get(period[5:7], _empty_stats())
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            std = np.sqrt(stats['m2'] / (stats['count'] - 1))
+            zscores = np.where((stats['count'] >= self.min_history) & (std > 0), (values - stats['mean']) / std, np.nan)
+            seasonal_dev = np.where(seasonal['count'] >= 1, (values - seasonal['mean']) / np.abs(seasonal['mean']), np.nan)
+
+        previous = sorted(p for p in state['periods'] if p < period)[-self.window:]
+        if previous:
+            recent = np.array([state['periods'][p]['values'] for p in previous], dtype=np.float64)
+            counts = np.isfinite(recent).sum(axis=0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                baseline = np.where(counts > 0, np.nansum(recent, axis=0) / counts, np.nan)
+        else:
+            recent = np.empty((0, len(METRICS)))
+            baseline = np.full(len(METRICS), np.nan)
+
+        metrics = {}
+        for i, name in enumerate(METRICS):
+            entry = {
+                'value': _round(values[i]),
+                'baseline': _round(baseline[i]),
+                'zscore': _round(zscores[i]),
+                'seasonal_deviation': _round(seasonal_dev[i]),
+            }
+            metrics[name] = {k: v for k, v in entry.items() if v is not None}
+
+        idx = {name: i for i, name in enumerate(METRICS)}
+        flags = []
+        if zscores[idx['total_kwh']] > self.z_threshold:
+            flags.append('consumption_spike')
+        elif zscores[idx['total_kwh']] < -self.z_threshold:
+            flags.append('consumption_drop')
+        if abs(seasonal_dev[idx['total_kwh']]) > 0.3:
+            flags.append('seasonal_deviation')
+
+        peak = idx['peak_share']
+        if zscores[peak] > self.z_threshold or values[peak] > baseline[peak] * 1.2:
+            flags.append('peak_concentration')
+
+        overruns = np.append(recent[:, idx['power_overrun']], values[idx['power_overrun']])
+        overruns = overruns[np.isfinite(overruns)]
+        if np.count_nonzero(overruns > 0) >= 2:
+            flags.append('recurrent_power_overrun')
+        elif not np.any(overruns > 0):
+            # Only the power actually drawn tells whether the subscribed power is too high:
+            # periods without an overrun line say nothing about it
+            drawn = np.append(recent[:, idx['max_power']], values[idx['max_power']])
+            subscribed = np.append(recent[:, idx['subscribed_power']], values[idx['subscribed_power']])
+            known = np.isfinite(drawn) & np.isfinite(subscribed)
+            if np.count_nonzero(known) > self.min_history and \
+                    np.max(drawn[known]) < OVERSIZED_POWER_RATIO * np.min(subscribed[known]):
+                flags.append('oversized_subscribed_power')
+
+        return {
+            'period': period,
+            'history_count': len(state['periods']),
+            'metrics': metrics,
+            'flags': flags,
+        }
+
+    def _add_period(self, state: Dict[str, Any], period: str, invoice_id: Optional[str], values: np.ndarray) -> None:
+        state['periods'][period] = {'invoice_id': invoice_id, 'values': values.tolist()}
+        _welford(state['stats'], values, 1)
+        _welford(state['seasonal'].setdefault(period[5:7], _empty_stats()), values, 1)
+
+    def _remove_invoice(self, state: Dict[str, Any], key: str, invoice: Optional[Dict[str, Any]]) -> bool:
+        """Remove a recorded invoice from a customer's state, if it is recorded there"""
+        if not invoice or customer_key(invoice) != key:
+            return False
+        period = billing_period(invoice)
+        recorded = state['periods'].get(period)
+        if recorded is None or recorded['invoice_id'] != invoice.get('id'):
+            return False
+        self._remove_period(state, period)
+        return True
+
+    def _remove_period(self, state: Dict[str, Any], period: str) -> None:
+        recorded = state['periods'].pop(period, None)
+        if recorded is None:
+            return
+        values = np.array(recorded['values'], dtype=np.float64)
+        _welford(state['stats'], values, -1)
+        _welford(state['seasonal'][period[5:7]], values, -1)
+
+    def _load(self, conn, key: str) -> Dict[str, Any]:
+        """Load a customer's state, converting stored lists back to arrays"""
+        row = conn.execute('SELECT state FROM customer_history WHERE customer = ?', (key,)).fetchone()
+        if row is None:
+            return {'periods': {}, 'stats': _empty_stats(), 'seasonal': {}}
+        raw = json.loads(row[0])
+        size = len(METRICS)
+
+        def to_stats(data):
+            # States saved before a metric was added are padded with empty statistics
+            return {k: np.pad(np.array(data[k], dtype=np.float64), (0, size - len(data[k])))
+                    for k in ('count', 'mean', 'm2')}
+
+        periods = raw.get('periods', {})
+        for entry in periods.values():
+            values = [np.nan if v is None else v for v in entry['values']]
+            entry['values'] = values + [np.nan] * (size - len(values))
+        return {
+            'periods': periods,
+            'stats': to_stats(raw['stats']),
+            'seasonal': {month: to_stats(s) for month, s in raw.get('seasonal', {}).items()},
+        }
+
+    def _save(self, conn, key: str, state: Dict[str, Any]) -> None:
+        """Save a customer's state (NaN stored as null)"""
+        def clean(values):
+            return [None if not np.isfinite(v) else float(v) for v in values]
+
+        data = {
+            'periods': {
+                p: {'invoice_id': e['invoice_id'], 'values': clean(e['values'])}
+                for p, e in state['periods'].items()
+            },
+            'stats': {k: clean(v) for k, v in state['stats'].items()},
+            'seasonal': {m: {k: clean(v) for k, v in s.items()} for m, s in state['seasonal'].items()},
+        }
+        conn.execute('INSERT OR REPLACE INTO customer_history (customer, state) VALUES (?, ?)', (key, json.dumps(data)))
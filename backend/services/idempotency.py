@@ -0,0 +1,212 @@
+import os
+import json
+import time
+import logging
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from utils.database import Database
+from utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    status TEXT NOT NULL,
+    status_code INTEGER,
+    response TEXT,
+    owner TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys (expires_at);
+"""
+
+# Outcomes of claim: the caller runs the request, replays the stored response,
+# joins the request in flight, or used the key for a different file
+CLAIMED, DONE, IN_FLIGHT, CONFLICT = 'claimed', 'done', 'in_flight', 'conflict'
+
+# Seconds between reads of a key processed by another worker
+POLL_INTERVAL = 0.5
+
+IDEMPOTENT_REQUESTS = registry.counter(
+    'aienergy_idempotent_requests_total', 'Uploads by idempotency outcome', ['outcome']
+)
+
+# Response stored for a completed request: (HTTP status, JSON body)
+Response = Tuple[int, Any]
+
+class IdempotencyStore:
+    """
+    Single-flight table of upload requests, shared by all workers
+
+    The first request with a key claims it and runs; identical requests arriving
+    while it runs wait for its response (on the job itself in the same worker, by
+    polling the table in others), and later retries get the stored response.
+    Claims expire after lock_ttl seconds so a crashed worker does not hold a key,
+    and stored responses after ttl seconds. Failed requests release their key so
+    they can be retried.
+    """
+
+    def __init__(self, database: Database, ttl: float = 86400, lock_ttl: float = 600,
+                 poll_interval: float = POLL_INTERVAL):
+        """
+        Initialize the store, creating its table if needed
+
+        Args:
+            database: Application database
+            ttl: Seconds a completed response is replayed
+            lock_ttl: Seconds a request in flight holds its key
+            poll_interval: Seconds between reads of a key claimed by another worker
+        """
+        self.database = database
+        self.ttl = ttl
+        self.lock_ttl = lock_ttl
+        self.poll_interval = poll_interval
+        self.owner = str(os.getpid())
+        self.database.executescript(SCHEMA)
+        # Jobs of the requests claimed by this worker, joined directly by identical requests
+        self._jobs: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        Get the live record of a key
+
+        Args:
+            key: Idempotency key
+
+        Returns:
+            Dict with fingerprint, status, status_code and response (decoded), or None
+        """
+        row = self.database.connection.execute(
+            'SELECT fingerprint, status, status_code, response FROM idempotency_keys WHERE key = ? AND expires_at > ?',
+            (key, time.time())
+        ).fetchone()
+        if not row:
+            return None
+        return {'fingerprint': row['fingerprint'], 'status': row['status'], 'status_code': row['status_code'],
+                'response': json.loads(row['response']) if row['response'] is not None else None}
+
+    def claim(self, key: str, fingerprint: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+        """
+        Claim a key for a request, unless it is already in flight or done
+
+        Args:
+            key: Idempotency key
+            fingerprint: Hash of the request content, to detect a key reused for another file
+
+        Returns:
+            (CLAIMED, None), or (DONE, IN_FLIGHT or CONFLICT, the key's record)
+        """
+        now = time.time()
+        with self.database.transaction() as conn:
+            conn.execute('DELETE FROM idempotency_keys WHERE expires_at <= ?', (now,))
+            row = conn.execute(
+                'SELECT fingerprint, status, status_code, response FROM idempotency_keys WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                conn.execute(
+                    """INSERT INTO idempotency_keys (key, fingerprint, status, owner, created_at, expires_at)
+                       VALUES (?, ?, ?, ?, ?, ?)""",
+                    (key, fingerprint, IN_FLIGHT, self.owner, now, now + self.lock_ttl)
+                )
+                outcome, record = CLAIMED, None
+            else:
+                record = {'fingerprint': row['fingerprint'], 'status': row['status'], 'status_code': row['status_code'],
+                          'response': json.loads(row['response']) if row['response'] is not None else None}
+                if row['fingerprint'] != fingerprint:
+                    outcome = CONFLICT
+                else:
+                    outcome = DONE if row['status'] == DONE else IN_FLIGHT
+        IDEMPOTENT_REQUESTS.inc(outcome=outcome)
+        return outcome, record
+
+    def complete(self, key: str, status_code: int, response: Any) -> None:
+        """
+        Store the response of a claimed request, replayed to its retries for ttl seconds
+
+        Args:
+            key: Idempotency key
+            status_code: HTTP status of the response
+            response: JSON-serializable response body
+        """
+        now = time.time()
+        with self.database.transaction() as conn:
+            conn.execute(
+                """UPDATE idempotency_keys SET status = ?, status_code = ?, response = ?, expires_at = ?
+                   WHERE key = ?""",
+                (DONE, status_code, json.dumps(response, ensure_ascii=False, default=str), now + self.ttl, key)
+            )
+
+    def release(self, key: str) -> None:
+        """Drop the claim of a request that failed, so a retry runs it again"""
+        with self.database.transaction() as conn:
+            conn.execute('DELETE FROM idempotency_keys WHERE key = ? AND status = ?', (key, IN_FLIGHT))
+
+    def track(self, key: str, job: Future, respond: Callable[[Any], Response]) -> None:
+        """
+        Complete a claimed key with the result of its job, or release it if the job fails
+
+        Args:
+            key: Idempotency key
+            job: Future of the processing
+            respond: Builds the (status, body) response from the job result
+        """
+        with self._lock:
+            self._jobs[key] = job
+
+        def done(future: Future) -> None:
+            with self._lock:
+                self._jobs.pop(key, None)
+            try:
+                if future.cancelled() or future.exception() is not None:
+                    self.release(key)
+                else:
+                    self.complete(key, *respond(future.result()))
+            except Exception as e:
+                logger.warning(f"Failed to record the outcome of idempotency key {key}: {str(e)}")
+        job.add_done_callback(done)
+
+    def wait(self, key: str, fingerprint: str, timeout: float) -> Tuple[str, Optional[Dict[str, Any]]]:
+        """
+        Wait for a request in flight with the same key
+
+        In this worker the job is joined directly, its error raised to this request too;
+        a request running in another worker is followed through the table, and if it
+        fails its key is released and this request claims it.
+
+        Args:
+            key: Idempotency key
+            fingerprint: Hash of the request content
+            timeout: Seconds to wait at most
+
+        Returns:
+            (DONE, record) once the response is stored, (CLAIMED, None) if the key was
+            released, or (IN_FLIGHT, record) if it is still running after timeout
+            
+        Raises:
+            Exception: The error of the job joined in this worker
+        """
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            job = self._jobs.get(key)
+        if job is not None:
+            try:
+                job.result(timeout=timeout)
+            except FutureTimeout:
+                pass
+        while True:
+            record = self.get(key)
+            if record is None:
+                outcome, record = self.claim(key, fingerprint)
+                if outcome != IN_FLIGHT:
+                    return outcome, record
+            elif record['status'] == DONE:
+                return DONE, record
+            if time.monotonic() >= deadline:
+                return IN_FLIGHT, record
+            time.sleep(self.poll_interval)
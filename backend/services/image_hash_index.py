@@ -0,0 +1,203 @@
+import re
+import logging
+import threading
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from utils.database import Database
+from utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS image_hashes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    hash TEXT NOT NULL,
+    invoice_id TEXT NOT NULL,
+    invoice_number TEXT,
+    file_hash TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_image_hashes_invoice ON image_hashes (invoice_id);
+"""
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+# 64-bit hashes, split into CHUNKS blocks of CHUNK_BITS for the multi-index lookup
+HASH_BITS = 64
+CHUNKS = 4
+CHUNK_BITS = HASH_BITS // CHUNKS
+
+DUPLICATES = registry.counter('aienergy_duplicate_uploads_total',
+                              'Uploads matching an earlier invoice image', ('outcome',))
+
+def dhash(path: str, size: int = 8) -> int:
+    """
+    Compute the difference hash of an image
+
+    The image is turned upright from its EXIF orientation, converted to grayscale
+    and shrunk to (size + 1) x size pixels; each bit tells whether a pixel is
+    brighter than its left neighbour, so the hash survives rescaling, recompression
+    and small exposure changes.
+
+    Args:
+        path: Path to the image
+        size: Hash side (size * size bits)
+
+    Returns:
+        Hash as an integer
+    """
+    with Image.open(path) as image:
+        small = ImageOps.exif_transpose(image).convert('L').resize((size + 1, size), Image.LANCZOS)
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def hamming(a: int, b: int) -> int:
+    """Number of differing bits between two hashes"""
+    return bin(a ^ b).count('1')
+
+@lru_cache(maxsize=None)
+def _flip_masks(radius: int, bits: int) -> Tuple[int, ...]:
+    """XOR masks turning a chunk into every value within a Hamming radius of it"""
+    masks = [0]
+    frontier = [(0, -1)]
+    for _ in range(radius):
+        frontier = [(mask | (1 << bit), bit) for mask, last in frontier for bit in range(last + 1, bits)]
+        masks.extend(mask for mask, _ in frontier)
+    return tuple(masks)
+
+def number_in_text(number: Optional[str], text: Optional[str]) -> bool:
+    """Whether an invoice number appears in a text, ignoring spaces and separators"""
+    if not number or not text:
+        return False
+    key = re.sub(r'[\s./-]', '', number).upper()
+    return len(key) >= 4 and key in re.sub(r'[\s./-]', '', text).upper()
+
+def popcount(values: np.ndarray) -> np.ndarray:
+    """Number of set bits of each value of a uint64 array"""
+    values = values - ((values >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    values = (values & np.uint64(0x3333333333333333)) + ((values >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    values = (values + (values >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return (values * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+class ImageHashIndex:
+    """
+    Perceptual-hash index of the invoice images already processed
+
+    Hashes are persisted in the database and kept in memory in a multi-index:
+    each 64-bit hash is split into CHUNKS blocks, and by the pigeonhole principle
+    a hash within distance d of a query shares at least one block within
+    d // CHUNKS bits of the query's, so a lookup only probes those blocks and
+    compares the few hashes found there, in one NumPy pass. Rows added by other
+    workers are picked up incrementally before each lookup.
+    """
+
+    def __init__(self, database: Database, threshold: int = 10):
+        """
+        Initialize the index, creating its table and loading the stored hashes
+
+        Args:
+            database: Application database
+            threshold: Largest Hamming distance reported as a probable duplicate
+        """
+        self.database = database
+        self.threshold = threshold
+        # Hashes by position, and the positions of each chunk value
+        self._hashes = np.zeros(1024, dtype=np.uint64)
+        self._entries: List[Optional[Dict[str, Any]]] = []
+        self._tables: List[Dict[int, List[int]]] = [{} for _ in range(CHUNKS)]
+        self._last_id = 0
+        self._lock = threading.Lock()
+        self.database.executescript(SCHEMA)
+        self._sync()
+
+    def __len__(self) -> int:
+        return sum(1 for entry in self._entries if entry is not None)
+
+    def add(self, image_hash: int, invoice_id: str, invoice_number: Optional[str] = None,
+            file_hash: Optional[str] = None) -> None:
+        """
+        Add the hash of a processed invoice image
+
+        Args:
+            image_hash: Hash of the image (see dhash)
+            invoice_id: ID of the invoice
+            invoice_number: Extracted invoice number, used to confirm duplicates
+            file_hash: SHA-256 of the file, identifying exact re-uploads
+        """
+        with self.database.transaction() as conn:
+            conn.execute('INSERT INTO image_hashes (hash, invoice_id, invoice_number, file_hash) VALUES (?, ?, ?, ?)',
+                         (format(image_hash, '016x'), invoice_id, invoice_number, file_hash))
+        self._sync()
+
+    def remove(self, invoice_id: str) -> None:
+        """Remove the hashes of an invoice"""
+        with self.database.transaction() as conn:
+            conn.execute('DELETE FROM image_hashes WHERE invoice_id = ?', (invoice_id,))
+        mask = (1 << CHUNK_BITS) - 1
+        with self._lock:
+            for position, entry in enumerate(self._entries):
+                if entry is None or entry['invoice_id'] != invoice_id:
+                    continue
+                image_hash = int(self._hashes[position])
+                for chunk, table in enumerate(self._tables):
+                    table[(image_hash >> (chunk * CHUNK_BITS)) & mask].remove(position)
+                self._entries[position] = None
+
+    def lookup(self, image_hash: int, threshold: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Find the images within a Hamming distance of a hash
+
+        Args:
+            image_hash: Hash of the image (see dhash)
+            threshold: Largest distance (defaults to the index threshold)
+
+        Returns:
+            Matching entries (invoice_id, invoice_number, file_hash, distance), closest first
+        """
+        threshold = self.threshold if threshold is None else threshold
+        self._sync()
+        masks = _flip_masks(threshold // CHUNKS, CHUNK_BITS)
+        chunk_mask = (1 << CHUNK_BITS) - 1
+        candidates = set()
+        with self._lock:
+            for chunk, table in enumerate(self._tables):
+                value = (image_hash >> (chunk * CHUNK_BITS)) & chunk_mask
+                for mask in masks:
+                    bucket = table.get(value ^ mask)
+                    if bucket:
+                        candidates.update(bucket)
+            if not candidates:
+                return []
+            positions = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+            distances = popcount(self._hashes[positions] ^ np.uint64(image_hash))
+            close = np.flatnonzero(distances <= threshold)
+            matches = [dict(self._entries[positions[i]], distance=int(distances[i])) for i in close]
+        return sorted(matches, key=lambda entry: entry['distance'])
+
+    def _sync(self) -> None:
+        """Load the rows added since the last sync (by this or another worker)"""
+        rows = self.database.connection.execute(
+            'SELECT id, hash, invoice_id, invoice_number, file_hash FROM image_hashes WHERE id > ? ORDER BY id',
+            (self._last_id,)
+        ).fetchall()
+        if not rows:
+            return
+        mask = (1 << CHUNK_BITS) - 1
+        with self._lock:
+            for row_id, value, invoice_id, invoice_number, file_hash in rows:
+                if row_id <= self._last_id:
+                    continue
+                image_hash = int(value, 16)
+                position = len(self._entries)
+                if position == len(self._hashes):
+                    self._hashes = np.concatenate([self._hashes, np.zeros_like(self._hashes)])
+                self._hashes[position] = image_hash
+                self._entries.append({'invoice_id': invoice_id, 'invoice_number': invoice_number,
+                                      'file_hash': file_hash})
+                for chunk, table in enumerate(self._tables):
+                    table.setdefault((image_hash >> (chunk * CHUNK_BITS)) & mask, []).append(position)
+                self._last_id = row_id
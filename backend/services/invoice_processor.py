@@ -1,8 +1,11 @@
 import os
 import json
 import logging
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Iterator, Optional, Tuple
 import uuid
+import tempfile
+import threading
+from concurrent.futures import Future
 from datetime import datetime
 import pandas as pd
 
@@ -10,11 +13,43 @@ import os
 import json
 from services.ocr_service import OCRService
 from services.llm_service import LLMService
-from models.invoice import Invoice, InvoiceRecommendation
-from utils.file_utils import extract_json_from_response
+from services.analytics_store import AnalyticsStore
+from services.blob_store import LocalBlobStore
+from services.history_analyzer import HistoryAnalyzer
+from services.search_index import SearchIndex
+from services.report_exporter import REPORT_COLUMNS, export_report
+from services.result_store import ResultStore
+from services.event_bus import EventBus
+from services.idempotency import IdempotencyStore
+from services.scheduler import ProcessingScheduler
+from services.field_repair import FieldRepairer
+from services.document_splitter import DocumentSplitter
+from services.tariff_simulator import TariffSimulator
+from services import rule_engine
+from services.image_hash_index import DUPLICATES, IMAGE_EXTENSIONS, ImageHashIndex, dhash, number_in_text
+from services.corrections import apply_corrections, dirty_stages
+from services.consistency_checker import analysis_payload, check_invoice, check_invoices, needs_analysis, summarize_reports
+from pydantic import BaseModel, ValidationError
+from models.invoice import FusedInvoiceResult, Invoice, InvoiceAnalysis, InvoiceRecommendation, describe_errors
+from utils.database import Database, get_database_path
+from utils.metrics import log_payload, registry, stage
+from utils.resilience import Deadline, DeadlineExceeded, DependencyUnavailable, deadline_scope, get_breaker
 
 logger = logging.getLogger(__name__)
 
+VALIDATION_ERRORS = registry.counter(
+    'aienergy_llm_validation_errors_total', 'LLM responses failing schema validation', ['stage', 'corrected']
+)
+FUSED_FALLBACKS = registry.counter(
+    'aienergy_fused_fallbacks_total', 'Single-call LLM results rejected in favour of the staged calls', ['reason']
+)
+# Consistency report entries kept in the analysis
+REPORT_KEYS = ('consistent', 'flags', 'item_mismatches', 'expected')
+
+DEGRADED = registry.counter(
+    'aienergy_degraded_stages_total', 'Stages served locally because a dependency was unavailable', ['stage', 'reason']
+)
+
 class InvoiceProcessor:
     """Service for processing energy invoices"""
     
@@ -26,149 +61,768 @@ class InvoiceProcessor:
             base_url=os.environ.get('LLMWHISPERER_BASE_URL')
         )
         self.llm_service = LLMService()
+        # Missing or inconsistent fields are re-extracted from the matching OCR lines only
+        self.field_repair = os.environ.get('FIELD_REPAIR', '1') != '0'
+        # Consistent invoices without penalties or peak-heavy consumption skip the LLM analysis
+        self.skip_clean_analysis = os.environ.get('SKIP_CLEAN_ANALYSIS', '1') != '0'
+        # Opt-in: extraction, analysis and recommendations in one structured-output completion
+        self.fused_pipeline = os.environ.get('FUSED_LLM_PIPELINE', '0') == '1'
+        # Time budget of each invoice across all its stages; LLM stages still pending when
+        # it runs out, or while a dependency's breaker is open, fall back to the local rules
+        self.processing_deadline = float(os.environ.get('PROCESSING_DEADLINE_SECONDS', 120))
+        # PDF bundles holding several invoices are split and each invoice processed as its own job
+        self.split_documents = os.environ.get('SPLIT_DOCUMENTS', '1') != '0'
+        self.splitter = DocumentSplitter(
+            os.path.join(tempfile.gettempdir(), 'aienergy_segments'),
+            # Looked up per call so it always uses the current OCR service
+            ocr_pages=lambda pdf_path: self.ocr_service.process_pdf_pages(pdf_path)
+        )
         
-        # In a real implementation, this would be a database
-        # For simplicity, we're using in-memory storage
-        self.invoices = {}
-        self.recommendations = {}
-        
-        # Create data directory if it doesn't exist
-        self.data_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'static', 'data')
+        # Create data directory if it doesn't exist (DATA_DIR overrides the default location)
+        self.data_dir = os.environ.get('DATA_DIR') or os.path.join(os.path.dirname(os.path.dirname(__file__)), 'static', 'data')
         os.makedirs(self.data_dir, exist_ok=True)
+
+        # Application database (DATABASE_URI, relative paths are resolved in the data directory)
+        self.database = Database(get_database_path(os.environ.get('DATABASE_URI'), self.data_dir))
+        
+        # Processed results, each invoice's artifacts written atomically in one transaction.
+        # Results left as JSON files by earlier versions are imported at startup.
+        self.result_store = ResultStore(self.database)
+        self.result_store.recover(self.data_dir, os.path.join("static", "data", "full_results"))
+        
+        # Content-addressed store of uploaded files, reference counted by invoices
+        self.blob_store = LocalBlobStore(
+            os.environ.get('BLOB_STORE_DIR') or os.path.join(self.data_dir, 'blobs'), self.database
+        )
+        
+        # Columnar store backing the analytics endpoints, kept up to date on every processed invoice
+        self.analytics_store = AnalyticsStore(os.path.join(self.data_dir, 'analytics'))
+        # Full-text and faceted search index over invoices, issues and OCR text
+        self.search_index = SearchIndex(self.database)
+        self._backfill_indexes()
+        
+        # Per-customer running statistics used to judge invoices against their billing history
+        self.history_analyzer = HistoryAnalyzer(self.database)
+        # Subscribed power and load shift what-if simulation, computing the savings the recommendations quote
+        self.tariff_simulator = TariffSimulator(max_load_shift=float(os.environ.get('TARIFF_MAX_LOAD_SHIFT', 0.2)))
+        
+        # Perceptual hashes of the processed invoice images, to recognize the same bill photographed again
+        self.detect_duplicates = os.environ.get('DETECT_DUPLICATES', '1') != '0'
+        self.image_index = ImageHashIndex(self.database, threshold=int(os.environ.get('DUPLICATE_IMAGE_DISTANCE', 10)))
+        
+        # Processing progress and new results, pushed to clients by the /api/events stream
+        self.event_bus = EventBus(self.database)
+        
+        # Upload requests in flight and their responses, so client retries do not process a file twice
+        self.idempotency = IdempotencyStore(
+            self.database,
+            ttl=float(os.environ.get('IDEMPOTENCY_TTL_SECONDS', 86400)),
+            lock_ttl=float(os.environ.get('IDEMPOTENCY_LOCK_SECONDS', 600))
+        )
+        
+        # Uploads are processed through a queue: interactive before bulk, customers served
+        # fairly, and jobs started within the OCR and LLM rate budgets
+        self.scheduler = ProcessingScheduler(
+            self.process_invoice,
+            concurrency=int(os.environ.get('PROCESSING_CONCURRENCY', 4)),
+            reserved_interactive=int(os.environ.get('INTERACTIVE_RESERVED_WORKERS', 1)),
+            ocr_per_minute=float(os.environ.get('OCR_REQUESTS_PER_MINUTE', 0)),
+            llm_tokens_per_minute=float(os.environ.get('LLM_TOKENS_PER_MINUTE', 0)),
+            llm_tokens_per_job=float(os.environ.get('LLM_TOKENS_PER_INVOICE', 8000)),
+            max_wait={'interactive': float(os.environ.get('MAX_INTERACTIVE_QUEUE_WAIT', 300))}
+        )
+    
+    def split_document(self, file_path: str) -> List[Dict[str, Any]]:
+        """
+        Find the invoices of an uploaded file
+        
+        Args:
+            file_path: Path to the uploaded file
+            
+        Returns:
+            One entry per invoice (see DocumentSplitter.split); a single entry
+            with the original path for images, single invoices or when splitting is off
+        """
+        if self.split_documents and file_path.lower().endswith('.pdf'):
+            try:
+                return self.splitter.split(file_path)
+            except Exception as e:
+                logger.warning(f"Could not split {file_path}, processing it as one invoice: {str(e)}")
+        return [{'pages': None, 'invoice_number': None, 'path': file_path}]
     
-    def process_invoice(self, file_path: str) -> Dict[str, Any]:
+    def submit_bundle(self, tenant: str, priority: str, file_path: str, segments: List[Dict[str, Any]],
+                      cost: float = 1.0, file_hash: Optional[str] = None,
+                      upload_id: Optional[str] = None) -> 'Future[Dict[str, Any]]':
+        """
+        Queue each invoice of a split bundle as its own job and record the batch
+        
+        The invoices are processed concurrently by the scheduler workers; the batch
+        record lists each invoice's pages with its ID or error once all are done.
+        
+        Args:
+            tenant: Customer the upload belongs to
+            priority: Scheduler priority
+            file_path: Path to the uploaded bundle
+            segments: Invoices of the bundle (see split_document)
+            cost: Scheduler cost of the whole bundle, shared between its invoices by pages
+            file_hash: SHA-256 of the bundle, referenced by each of its invoices
+            upload_id: Client-chosen ID echoed in the progress events
+            
+        Returns:
+            Future of a dict with the final batch record and the results of the processed
+            invoices, with the ID of the batch as its batch_id attribute
+            
+        Raises:
+            SchedulerFull: If the queue refuses the invoices (none of them is processed)
+        """
+        batch_id = str(uuid.uuid4())
+        pages = segments[-1]['pages'][1]
+        batch = {
+            "id": batch_id,
+            "file_hash": file_hash,
+            "filename": os.path.basename(file_path),
+            "pages": pages,
+            "status": "processing",
+            "created_at": datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+            "invoices": [{"pages": segment['pages'], "invoice_number": segment['invoice_number'],
+                          "invoice_id": None, "error": None} for segment in segments],
+        }
+        self.result_store.save_batch(batch)
+        
+        done: 'Future[Dict[str, Any]]' = Future()
+        done.batch_id = batch_id
+        futures: List[Future] = []
+        remaining = [len(segments)]
+        lock = threading.Lock()
+        
+        def finish(_future: Future) -> None:
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            results = []
+            for entry, segment, future in zip(batch['invoices'], segments, futures):
+                if future.cancelled():
+                    entry['error'] = 'cancelled'
+                elif future.exception() is not None:
+                    entry['error'] = str(future.exception())
+                else:
+                    result = future.result()
+                    entry['invoice_id'] = result['invoice']['id']
+                    results.append(result)
+                if os.path.exists(segment['path']):
+                    os.remove(segment['path'])
+            failed = sum(1 for entry in batch['invoices'] if entry['error'])
+            batch['status'] = 'failed' if failed == len(segments) else 'partial' if failed else 'done'
+            try:
+                self.result_store.save_batch(batch)
+            except Exception as e:
+                logger.warning(f"Failed to save batch {batch_id}: {str(e)}")
+            self._publish('batch', upload_id=upload_id, batch=batch)
+            done.set_result({"batch": batch, "results": results})
+        
+        try:
+            for segment in segments:
+                first, last = segment['pages']
+                futures.append(self.scheduler.submit(
+                    tenant, priority, segment['path'], cost=max(1.0, cost * (last - first + 1) / pages),
+                    file_hash=file_hash, upload_id=upload_id, batch_id=batch_id
+                ))
+        except Exception:
+            # Refused by admission control: drop the invoices already queued
+            for future in futures:
+                future.cancel()
+            for segment in segments:
+                if os.path.exists(segment['path']):
+                    os.remove(segment['path'])
+            batch['status'] = 'rejected'
+            self.result_store.save_batch(batch)
+            raise
+        for future in futures:
+            future.add_done_callback(finish)
+        return done
+    
+    def get_batch(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Get the record of a split bundle
+        
+        Args:
+            batch_id: ID of the batch
+            
+        Returns:
+            Batch record with each invoice's pages and ID or error, or None if not found
+        """
+        return self.result_store.get_batch(batch_id)
+    
+    def correct_invoice(self, invoice_id: str, corrections: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Correct fields of a processed invoice and recompute only what depends on them
+        
+        The stages reading a corrected field run again (see corrections.STAGE_FIELDS): the
+        local checks, the LLM analysis, the history comparison and the tariff simulation.
+        The recommendations are made again only if the issues, history flags or simulation
+        they come from changed. The stored result, its correction log, the customer history,
+        the analytics store and the search index are updated in place.
+        
+        Args:
+            invoice_id: ID of the invoice
+            corrections: New value of each corrected field
+            
+        Returns:
+            The updated result, with the stages run again under 'recomputed', or None if
+            the invoice is not found
+            
+        Raises:
+            ValueError: If a field does not exist or cannot be corrected
+            ValidationError: If a value is invalid
+        """
+        result = self.result_store.get(invoice_id)
+        if not result:
+            return None
+        
+        old_invoice = result['invoice']
+        analysis = dict(result.get('analysis') or {})
+        recommendations = result.get('recommendations') or {}
+        invoice_data, changed = apply_corrections(old_invoice, corrections,
+                                                  (analysis.get('consistency') or {}).get('flags'))
+        if not changed:
+            return dict(result, recomputed=[])
+        
+        stages = dirty_stages(set(changed))
+        recomputed: List[str] = []
+        inputs = self._recommendation_inputs(analysis)
+        # Stages run again drop out of the degraded ones, unless the LLM is still unavailable
+        degraded = [name for name in analysis.get('degraded', []) if name not in stages + ['recommend']]
+        simulation = analysis.get('simulation')
+        if simulation:
+            simulation = dict(simulation, curves=recommendations.get('savings_curves') or {})
+        
+        with deadline_scope(Deadline(self.processing_deadline)):
+            if 'check' in stages or 'analyze' in stages:
+                with stage('check') as info:
+                    consistency = check_invoice(invoice_data)
+                    invoice_data.update(consistency['derived'])
+                    for index, total in consistency['item_totals'].items():
+                        invoice_data['items'][index]['total'] = total
+                    info['consistent'] = consistency['consistent']
+                analysis['consistency'] = {key: consistency[key] for key in REPORT_KEYS}
+                recomputed.append('check')
+            
+            if 'analyze' in stages:
+                with stage('analyze', invoice_id=invoice_id) as info:
+                    # Issues and severities are replaced, the other entries are kept
+                    analysis.pop('severity', None)
+                    analysis.update(self._analyze(invoice_data, consistency, info, degraded))
+                recomputed.append('analyze')
+            
+            if 'history' in stages:
+                with stage('history', invoice_id=invoice_id):
+                    # Compared with its customer's history without the invoice as recorded,
+                    # which is only replaced once the corrected result is saved
+                    history = self.history_analyzer.evaluate(invoice_data, exclude=old_invoice)
+                    if history:
+                        analysis['history'] = history
+                    else:
+                        analysis.pop('history', None)
+                recomputed.append('history')
+            
+            if 'simulate' in stages:
+                with stage('simulate', invoice_id=invoice_id) as info:
+                    simulation = self._simulate(invoice_data, exclude=old_invoice)
+                    if simulation:
+                        info['periods'] = simulation['periods']
+                        analysis['simulation'] = {key: value for key, value in simulation.items() if key != 'curves'}
+                    else:
+                        analysis.pop('simulation', None)
+                recomputed.append('simulate')
+            
+            if self._recommendation_inputs(analysis) != inputs:
+                with stage('recommend', invoice_id=invoice_id) as info:
+                    recommendation = self._recommend(invoice_data, analysis, simulation, info, degraded)
+                    recommendations = self._finish_recommendation(recommendation, invoice_id, simulation)
+                recomputed.append('recommend')
+        
+        if degraded:
+            analysis['degraded'] = degraded
+        else:
+            analysis.pop('degraded', None)
+        
+        with stage('persist', invoice_id=invoice_id):
+            result = {
+                "invoice": invoice_data,
+                "analysis": analysis,
+                "recommendations": recommendations
+            }
+            self.result_store.save(result, corrections=changed)
+            if 'history' in stages:
+                self.history_analyzer.record(invoice_data, previous=old_invoice)
+            
+            try:
+                self.analytics_store.add_invoice(invoice_data)
+                self.search_index.index_invoice(invoice_data, analysis, self.result_store.get_ocr_text(invoice_id))
+            except Exception as e:
+                logger.warning(f"Failed to update analytics store or search index: {str(e)}")
+        logger.info(f"Invoice {invoice_id} corrected ({', '.join(changed)}), recomputed: {', '.join(recomputed) or 'nothing'}")
+        self._publish('invoice', result=result)
+        
+        return dict(result, recomputed=recomputed)
+    
+    def process_invoice(self, file_path: str, file_hash: Optional[str] = None,
+                        upload_id: Optional[str] = None, batch_id: Optional[str] = None,
+                        deadline: Optional[Deadline] = None) -> Dict[str, Any]:
         """
         Process an invoice file and extract information
         
+        Every OCR and LLM call is bounded by the deadline. When a call is refused by its
+        dependency's circuit breaker or the deadline has passed, the extraction, analysis
+        and recommendations are made by the local rules instead (listed in the analysis
+        under 'degraded'), and a file processed before is answered from its stored result.
+        
         Args:
             file_path: Path to the invoice file
+            file_hash: SHA-256 of the file, when computed at upload
+            upload_id: Client-chosen ID echoed in the progress events of this upload
+            batch_id: Batch of the bundle the invoice was split from
+            deadline: Time budget of the processing (PROCESSING_DEADLINE_SECONDS from now by default)
             
         Returns:
             Processed invoice data
+            
+        Raises:
+            DependencyUnavailable: If the OCR is unavailable and the file has no text layer
+            DeadlineExceeded: If the deadline passes before the text is extracted
         """
+        with deadline_scope(deadline or Deadline(self.processing_deadline)):
+            return self._process_invoice(file_path, file_hash, upload_id, batch_id)
+    
+    def _process_invoice(self, file_path: str, file_hash: Optional[str], upload_id: Optional[str],
+                         batch_id: Optional[str]) -> Dict[str, Any]:
+        """Process an invoice within the current deadline (see process_invoice)"""
+        invoice_id = str(uuid.uuid4())
+        self._publish_progress('uploaded', invoice_id, upload_id)
         try:
-            # Extract text using OCR
+            # Images close to an earlier invoice's: the same file is reused as is, others once
+            # their OCR text confirms the earlier invoice number
+            image_hash, duplicates = self._image_duplicates(file_path)
+            for match in duplicates:
+                if file_hash and match['file_hash'] == file_hash:
+                    reused = self._reuse_duplicate(match, upload_id, 'exact')
+                    if reused:
+                        return reused
+            
+            # A dependency is down: a file processed before is answered from its stored result
+            # (split invoices share their bundle's hash, so they are always processed)
+            if file_hash and not batch_id:
+                unavailable = [name for name in ('llmwhisperer', 'llm') if not get_breaker(name).available()]
+                cached = self.result_store.find_by_file_hash(file_hash) if unavailable else None
+                if cached:
+                    DEGRADED.inc(stage='cached', reason='open')
+                    logger.warning(f"{', '.join(unavailable)} unavailable, serving the stored result of {file_hash}")
+                    self._publish_progress('recommended', cached['invoice']['id'], upload_id, cached=True)
+                    return dict(cached, cached=True)
+            
+            # Extract text using OCR (timed per stage inside the OCR service)
             logger.info(f"Extracting text from invoice: {file_path}")
-            print('file_path',file_path)
             ocr_text = self.ocr_service.process_file(file_path)
-            logger.info(f"OCR text extracted: {ocr_text}")
-            print('ocr_text',ocr_text)
+            logger.info(f"OCR text extracted ({len(ocr_text or '')} characters)")
+            log_payload('ocr text', ocr_text)
+            self._publish_progress('ocr_done', invoice_id, upload_id)
+            
+            confirmed = next((match for match in duplicates if number_in_text(match['invoice_number'], ocr_text)), None)
+            reused = self._reuse_duplicate(confirmed, upload_id, 'confirmed') if confirmed else None
+            if reused:
+                return reused
+            if duplicates:
+                DUPLICATES.inc(outcome='rejected')
+            
+            # Single-call mode, falling back to the staged calls below when its result is unusable
+            fused = self._process_fused(ocr_text) if self.fused_pipeline else None
+            
+            # Stages made by the local rules because the LLM was unavailable
+            degraded: List[str] = []
             
             # Extract structured data using LLM
-            logger.info("Extracting structured data from OCR text")
-            invoice_data_str = self.llm_service.extract_invoice_data(ocr_text)
-            invoice_data = json.loads(invoice_data_str) if isinstance(invoice_data_str, str) else invoice_data_str
+            if fused:
+                invoice = fused.invoice
+            else:
+                logger.info("Extracting structured data from OCR text")
+                with stage('extract') as info:
+                    try:
+                        invoice_data_str = self.llm_service.extract_invoice_data(ocr_text)
+                        info['bytes'] = len(invoice_data_str) if isinstance(invoice_data_str, str) else 0
+                        invoice = self._parse(Invoice, invoice_data_str, 'extract')
+                    except (DependencyUnavailable, DeadlineExceeded) as e:
+                        self._degrade('extract', e, info, degraded)
+                        invoice = rule_engine.extract_invoice(ocr_text)
+            
+            # Re-extract missing or inconsistent fields (best effort, the first extraction is kept on failure)
+            if self.field_repair and not degraded:
+                with stage('repair') as info:
+                    try:
+                        # Built per invoice so it always uses the current LLM service
+                        info['fields'] = len(FieldRepairer(self.llm_service).repair(invoice, ocr_text))
+                    except Exception as e:
+                        logger.warning(f"Field repair failed: {str(e)}")
+            
+            # Check the arithmetic locally and fill in the fields computable from the items
+            with stage('check') as info:
+                consistency = check_invoice(invoice.model_dump())
+                for name, value in consistency['derived'].items():
+                    setattr(invoice, name, value)
+                for index, total in consistency['item_totals'].items():
+                    invoice.items[index].total = total
+                info['consistent'] = consistency['consistent']
             
             # Create invoice object
-            invoice_id = str(uuid.uuid4())
-            invoice_data['id'] = invoice_id
-            invoice_data['file_path'] = file_path
+            invoice.id = invoice_id
+            if batch_id:
+                invoice.batch_id = batch_id
+            if file_hash:
+                # Stored files are resolved through the blob store, since archiving moves them
+                invoice.file_hash = file_hash
+            else:
+                invoice.file_path = file_path
+            exclude = {'file_path'} if file_hash else {'file_hash'}
+            if not batch_id:
+                exclude.add('batch_id')
+            invoice_data = invoice.model_dump(mode='json', exclude=exclude)
+            self._publish_progress('extracted', invoice_id, upload_id)
             
             # Analyze invoice
             logger.info("Analyzing invoice data")
-            analysis_str = self.llm_service.analyze_invoice(invoice_data)
-            logger.info(f"Analysis result: {analysis_str}")
-            analysis = json.loads(analysis_str) if isinstance(analysis_str, str) else analysis_str
+            with stage('analyze', invoice_id=invoice_id) as info:
+                if fused:
+                    info['fused'] = True
+                    analysis = fused.analysis.model_dump(mode='json', exclude_unset=True)
+                else:
+                    analysis = self._analyze(invoice_data, consistency, info, degraded)
+                analysis['consistency'] = {key: consistency[key] for key in REPORT_KEYS}
+
+            # Compare against the customer's billing history
+            with stage('history', invoice_id=invoice_id):
+                # Only evaluated here: the invoice joins the history once it is persisted
+                history = self.history_analyzer.evaluate(invoice_data)
+                if history:
+                    analysis['history'] = history
+            
+            # Simulate the subscribed power and load shifts over the history (the curves are only stored)
+            with stage('simulate', invoice_id=invoice_id) as info:
+                simulation = self._simulate(invoice_data)
+                if simulation:
+                    info['periods'] = simulation['periods']
+                    analysis['simulation'] = {key: value for key, value in simulation.items() if key != 'curves'}
+            self._publish_progress('analyzed', invoice_id, upload_id)
             
             # Generate recommendations
             logger.info("Generating recommendations")
-            recommendations_str = self.llm_service.generate_recommendations(invoice_data, analysis)
-            recommendations = json.loads(recommendations_str) if isinstance(recommendations_str, str) else recommendations_str
-            recommendations['invoice_id'] = invoice_id
-            
-            # Store invoice and recommendations
-            self.invoices[invoice_id] = invoice_data
-            self.recommendations[invoice_id] = recommendations
-            
-            # Save to disk (in a real implementation, this would be a database)
-            self._save_invoice(invoice_id, invoice_data)
-            self._save_recommendations(invoice_id, recommendations)
-            logger.info("Invoice saved to disk")
-            logger.info("Recommendations saved to disk")
-            logger.info("Analysis saving to disk")
-            # Save analysis to disk
-            self._save_analysis(invoice_id, analysis)
-            logger.info("Analysis saved to disk")
-            
-            # Return combined data
-            result = {
-                "invoice": invoice_data,
-                "analysis": analysis,
-                "recommendations": recommendations
-            }
+            with stage('recommend', invoice_id=invoice_id) as info:
+                if fused:
+                    # Made without the history, which is only attached to the analysis
+                    info['fused'] = True
+                    recommendation = fused.recommendations
+                else:
+                    recommendation = self._recommend(invoice_data, analysis, simulation, info, degraded)
+                recommendations = self._finish_recommendation(recommendation, invoice_id, simulation)
+            if degraded:
+                analysis['degraded'] = degraded
+            self._publish_progress('recommended', invoice_id, upload_id)
+            
+            with stage('persist', invoice_id=invoice_id):
+                # Combined data, saved in a single transaction (group-committed with concurrent saves)
+                result = {
+                    "invoice": invoice_data,
+                    "analysis": analysis,
+                    "recommendations": recommendations
+                }
+                self.result_store.save(result, ocr_text)
+                self.history_analyzer.record(invoice_data)
+
+                # Keep the uploaded file for as long as the invoice references it
+                if file_hash:
+                    self.blob_store.add_ref(file_hash, invoice_id)
+                if image_hash is not None:
+                    self.image_index.add(image_hash, invoice_id, invoice_data.get('invoice_number'), file_hash)
 
-            # Save full result to static/data/full_results/{invoice_id}.json
-            full_results_dir = os.path.join("static", "data", "full_results")
-            os.makedirs(full_results_dir, exist_ok=True)
-            full_result_path = os.path.join(full_results_dir, f"{invoice_id}.json")
-            with open(full_result_path, "w", encoding="utf-8") as f:
-                json.dump(result, f, ensure_ascii=False, indent=2)
+                # Update analytics aggregates and the search index incrementally
+                try:
+                    self.analytics_store.add_invoice(invoice_data)
+                    self.search_index.index_invoice(invoice_data, analysis, ocr_text)
+                except Exception as e:
+                    logger.warning(f"Failed to update analytics store or search index: {str(e)}")
+            logger.info(f"Invoice {invoice_id} saved")
+            self._publish('invoice', upload_id=upload_id, result=result)
 
             return result
 
         except Exception as e:
             logger.error(f"Error processing invoice: {str(e)}")
+            self._publish_progress('failed', invoice_id, upload_id, error=str(e))
             raise
     
-    def get_all_full_results(self) -> list:
+    def _process_fused(self, ocr_text: str) -> Optional[FusedInvoiceResult]:
         """
-        Loads all full invoice results from static/data/full_results.
+        Extract, analyze and recommend in one completion
+        
+        Unlike the staged calls, an invalid result gets no correction request: the
+        caller falls back to the staged path instead.
+        
+        Args:
+            ocr_text: Raw text extracted from the invoice
+            
+        Returns:
+            The validated result, or None if the call failed or the result is invalid
         """
-        full_results_dir = os.path.join("static", "data", "full_results")
-        results = []
-        if not os.path.exists(full_results_dir):
-            return results
-        for filename in os.listdir(full_results_dir):
-            if filename.endswith(".json"):
-                with open(os.path.join(full_results_dir, filename), "r", encoding="utf-8") as f:
-                    try:
-                        data = json.load(f)
-                        results.append(data)
-                    except Exception as e:
-                        import logging
-                        logging.warning(f"Failed to load {filename}: {e}")
-        return results
+        logger.info("Processing invoice in a single LLM call")
+        with stage('fused') as info:
+            try:
+                response = self.llm_service.process_invoice_fused(ocr_text)
+                info['bytes'] = len(response) if isinstance(response, str) else 0
+                return self._validate(FusedInvoiceResult, response)
+            except ValidationError as e:
+                reason = 'invalid'
+                logger.warning(f"Invalid single-call response, using the staged calls: {'; '.join(describe_errors(e))}")
+            except Exception as e:
+                reason = 'error'
+                logger.warning(f"Single-call processing failed, using the staged calls: {str(e)}")
+            info['fallback'] = reason
+            FUSED_FALLBACKS.inc(reason=reason)
+            return None
+    
+    def _analyze(self, invoice_data: Dict[str, Any], consistency: Dict[str, Any], info: Dict[str, Any],
+                 degraded: List[str]) -> Dict[str, Any]:
+        """
+        Find the issues of an invoice with the LLM (skipped for clean invoices, local rules when unavailable)
         
-    def get_full_result_by_id(self, invoice_id: str) -> dict:
+        Args:
+            invoice_data: Invoice data, with the derived fields filled in
+            consistency: Its consistency report
+            info: Stage info
+            degraded: Stages made by the local rules, appended to
+            
+        Returns:
+            The analysis (issues and severities)
         """
-        Loads a specific full invoice result by ID.
+        if self.skip_clean_analysis and not needs_analysis(invoice_data, consistency):
+            info['skipped'] = True
+            return {"issues": []}
+        try:
+            # Compact view: items summed by category, arithmetic already checked
+            analysis_str = self.llm_service.analyze_invoice(analysis_payload(invoice_data, consistency))
+            info['bytes'] = len(analysis_str) if isinstance(analysis_str, str) else 0
+            return self._parse(InvoiceAnalysis, analysis_str, 'analyze').model_dump(mode='json', exclude_unset=True)
+        except (DependencyUnavailable, DeadlineExceeded) as e:
+            self._degrade('analyze', e, info, degraded)
+            return rule_engine.analyze(invoice_data, consistency)
+    
+    def _recommend(self, invoice_data: Dict[str, Any], analysis: Dict[str, Any], simulation: Optional[Dict[str, Any]],
+                   info: Dict[str, Any], degraded: List[str]) -> InvoiceRecommendation:
         """
-        full_results_dir = os.path.join("static", "data", "full_results")
-        full_result_path = os.path.join(full_results_dir, f"{invoice_id}.json")
+        Generate the recommendations with the LLM (local rules when unavailable)
         
-        if os.path.exists(full_result_path):
+        Args:
+            invoice_data: Invoice data
+            analysis: Its analysis, with history and simulation
+            simulation: Tariff simulation, with its curves
+            info: Stage info
+            degraded: Stages made by the local rules, appended to
+            
+        Returns:
+            The validated recommendations
+        """
+        try:
+            recommendations_str = self.llm_service.generate_recommendations(invoice_data, analysis)
+            info['bytes'] = len(recommendations_str) if isinstance(recommendations_str, str) else 0
+            return self._parse(InvoiceRecommendation, recommendations_str, 'recommend')
+        except (DependencyUnavailable, DeadlineExceeded) as e:
+            self._degrade('recommend', e, info, degraded)
+            return InvoiceRecommendation.model_validate(rule_engine.recommend(analysis, simulation))
+    
+    def _simulate(self, invoice_data: Dict[str, Any], exclude: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        """Simulate the tariff over the customer's history, without exclude (best effort: None on failure)"""
+        try:
+            return self.tariff_simulator.simulate(invoice_data, self.history_analyzer.history_values(invoice_data, exclude))
+        except Exception as e:
+            logger.warning(f"Tariff simulation failed: {str(e)}")
+            return None
+    
+    @staticmethod
+    def _finish_recommendation(recommendation: InvoiceRecommendation, invoice_id: str,
+                               simulation: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """Attach the invoice ID and the simulated figures to recommendations, as stored"""
+        recommendation.invoice_id = invoice_id
+        if simulation:
+            # Computed figures replace the LLM's estimates, which only write the prose
+            recommendation.potential_savings = simulation['potential_savings']
+            recommendation.efficiency_score = simulation['efficiency_score']
+            recommendation.savings_curves = simulation['curves']
+        return recommendation.model_dump(mode='json', exclude_unset=True)
+    
+    @staticmethod
+    def _recommendation_inputs(analysis: Dict[str, Any]) -> Tuple[Any, Any, Any]:
+        """Get the parts of an analysis the recommendations are made from"""
+        return (analysis.get('issues'), (analysis.get('history') or {}).get('flags'), analysis.get('simulation'))
+    
+    def _degrade(self, stage_name: str, error: Exception, info: Dict[str, Any], degraded: List[str]) -> None:
+        """Record that a stage falls back to the local rules"""
+        reason = error.reason if isinstance(error, DependencyUnavailable) else 'deadline'
+        logger.warning(f"{stage_name} made by the local rules: {str(error)}")
+        DEGRADED.inc(stage=stage_name, reason=reason)
+        info['degraded'] = reason
+        degraded.append(stage_name)
+    
+    def _image_duplicates(self, file_path: str) -> Tuple[Optional[int], List[Dict[str, Any]]]:
+        """
+        Hash an invoice image and find the earlier images close to it
+        
+        Args:
+            file_path: Path to the invoice file
+            
+        Returns:
+            (hash, probable duplicates closest first); (None, []) for PDFs, when detection
+            is off or the image cannot be read
+        """
+        if not self.detect_duplicates or not file_path.lower().endswith(IMAGE_EXTENSIONS):
+            return None, []
+        with stage('dedup') as info:
             try:
-                with open(full_result_path, "r", encoding="utf-8") as f:
-                    return json.load(f)
+                image_hash = dhash(file_path)
             except Exception as e:
-                import logging
-                logging.warning(f"Failed to load {full_result_path}: {e}")
-                return None
-        return None
+                logger.warning(f"Could not hash {file_path}: {str(e)}")
+                return None, []
+            duplicates = self.image_index.lookup(image_hash)
+            info['candidates'] = len(duplicates)
+        return image_hash, duplicates
+    
+    def _reuse_duplicate(self, match: Dict[str, Any], upload_id: Optional[str], outcome: str) -> Optional[Dict[str, Any]]:
+        """
+        Get the stored result of the earlier invoice an upload duplicates
+        
+        Args:
+            match: Index entry of the earlier image
+            upload_id: Client-chosen ID echoed in the progress events of this upload
+            outcome: 'exact' (same file) or 'confirmed' (same invoice number)
+            
+        Returns:
+            The earlier result with a duplicate_of entry, or None if it is no longer stored
+        """
+        result = self.get_full_result_by_id(match['invoice_id'])
+        if not result:
+            return None
+        DUPLICATES.inc(outcome=outcome)
+        logger.info(f"Upload duplicates invoice {match['invoice_id']} ({outcome}, distance {match['distance']})")
+        self._publish_progress('recommended', match['invoice_id'], upload_id, duplicate=True)
+        return dict(result, duplicate_of={"invoice_id": match['invoice_id'], "distance": match['distance'],
+                                          "confirmation": outcome})
+    
+    def _publish_progress(self, stage_name: str, invoice_id: str, upload_id: Optional[str], **data) -> None:
+        """Publish a stage transition of an invoice (see event_bus.STAGES, plus 'failed')"""
+        self._publish('progress', stage=stage_name, invoice_id=invoice_id, upload_id=upload_id, **data)
+    
+    def _publish(self, event_type: str, **data) -> None:
+        """Publish an event, never failing the processing"""
+        try:
+            self.event_bus.publish(event_type, **data)
+        except Exception as e:
+            logger.warning(f"Failed to publish {event_type} event: {str(e)}")
+    
+    def _parse(self, model: type, response: Any, stage_name: str) -> BaseModel:
+        """
+        Validate an LLM response straight into a model
+        
+        An invalid response gets one correction request listing its field errors;
+        if the correction is invalid too the error is raised, so nothing is stored.
+        
+        Args:
+            model: Pydantic model class
+            response: JSON text (or an already decoded dict)
+            stage_name: Pipeline stage, for metrics and the correction prompt
+            
+        Returns:
+            The validated model
+        """
+        try:
+            return self._validate(model, response)
+        except ValidationError as e:
+            errors = describe_errors(e)
+            logger.warning(f"Invalid {stage_name} response, asking for a correction: {'; '.join(errors)}")
+        
+        text = response if isinstance(response, str) else json.dumps(response, ensure_ascii=False)
+        corrected = self.llm_service.correct_json(stage_name, text, errors)
+        try:
+            result = self._validate(model, corrected)
+        except ValidationError:
+            VALIDATION_ERRORS.inc(stage=stage_name, corrected='false')
+            raise
+        VALIDATION_ERRORS.inc(stage=stage_name, corrected='true')
+        return result
+    
+    @staticmethod
+    def _validate(model: type, response: Any) -> BaseModel:
+        if isinstance(response, (str, bytes)):
+            return model.model_validate_json(response)
+        return model.model_validate(response)
+    
+    def _backfill_indexes(self) -> None:
+        """Build the analytics store and search index from stored results when they are empty"""
+        analytics_empty = not len(self.analytics_store)
+        search_empty = not self.search_index.count()
+        if not (analytics_empty or search_empty):
+            return
+        
+        results = [result for result in self.get_all_full_results() if result.get('invoice')]
+        if analytics_empty:
+            self.analytics_store.rebuild(result['invoice'] for result in results)
+        if search_empty and results:
+            self.search_index.index_many(results)
+    
+    def search_invoices(self, query: str = '', filters: Optional[Dict[str, str]] = None,
+                        field: Optional[str] = None, limit: int = 20, offset: int = 0) -> Dict[str, Any]:
+        """
+        Search invoices by invoice number, line items, issues or OCR text
+        
+        Args:
+            query: Terms, "phrases" and prefix* terms
+            filters: Facet filters (provider, issue_type, severity)
+            field: Optional field to restrict the search to
+            limit: Maximum number of results
+            offset: Number of results to skip
+            
+        Returns:
+            Matching invoices with snippets and facet counts
+        """
+        return self.search_index.search(query, filters, field, limit, offset)
+    
+    def get_all_full_results(self) -> list:
+        """
+        Loads all full invoice results.
+        """
+        return self.result_store.all()
+
+    def get_all_full_results_json(self) -> str:
+        """
+        Gets all full invoice results as a JSON array.
+        """
+        return self.result_store.all_json()
+        
+    def get_full_result_by_id(self, invoice_id: str) -> dict:
+        """
+        Loads a specific full invoice result by ID.
+        """
+        return self.result_store.get(invoice_id)
 
-    def get_all_invoices(self) -> List[Dict[str, Any]]:
+    def get_all_invoices(self, filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
         """
         Get list of all processed invoices (summary only)
+        Args:
+            filters: Optional provider, customer, period_from and period_to filters
         Returns:
             List of dicts with id and summary fields
         """
-        # Load invoices from disk if not in memory
-        if not self.invoices:
-            self._load_invoices()
-        
-        def summary(inv):
-            return {
-                "id": inv.get("id"),
-                "provider": inv.get("provider"),
-                "invoice_number": inv.get("invoice_number"),
-                "issue_date": inv.get("issue_date"),
-                "customer_name": inv.get("customer_name"),
-                "total_amount": inv.get("total_amount"),
-                "period_start": inv.get("period_start"),
-                "period_end": inv.get("period_end"),
-                "total_kwh": inv.get("total_kwh")
-            }
-        return [summary(inv) for inv in self.invoices.values()]
+        summaries = self.result_store.summaries()
+        if filters and any(filters.values()):
+            matching = set(self.analytics_store.select(filters)["invoice_id"].tolist())
+            summaries = [summary for summary in summaries if summary.id in matching]
+        return [summary.to_dict() for summary in summaries]
     
     def get_invoice(self, invoice_id: str) -> Optional[Dict[str, Any]]:
         """
@@ -180,11 +834,38 @@ class InvoiceProcessor:
         Returns:
             Invoice data or None if not found
         """
-        # Load invoices from disk if not in memory
-        if not self.invoices:
-            self._load_invoices()
+        result = self.result_store.get(invoice_id)
+        return result["invoice"] if result else None
+    
+    def get_corrections(self, invoice_id: str) -> List[Dict[str, Any]]:
+        """
+        Get the field corrections made to an invoice
+        
+        Args:
+            invoice_id: ID of the invoice
+        
+        Returns:
+            Corrections (field, old_value, new_value, created_at), oldest first
+        """
+        return self.result_store.corrections(invoice_id)
+    
+    def get_invoice_file(self, invoice_id: str) -> Optional[str]:
+        """
+        Get a local path to the uploaded file of an invoice
         
-        return self.invoices.get(invoice_id)
+        Args:
+            invoice_id: ID of the invoice
+            
+        Returns:
+            Path to the file, or None if the invoice or its file is not found
+        """
+        invoice = self.get_invoice(invoice_id)
+        if not invoice:
+            return None
+        if invoice.get("file_hash"):
+            return self.blob_store.path(invoice["file_hash"])
+        file_path = invoice.get("file_path")
+        return file_path if file_path and os.path.exists(file_path) else None
     
     def get_recommendations(self, invoice_id: str) -> Optional[Dict[str, Any]]:
         """
@@ -196,11 +877,8 @@ class InvoiceProcessor:
         Returns:
             Recommendations or None if not found
         """
-        # Load recommendations from disk if not in memory
-        if not self.recommendations:
-            self._load_recommendations()
-        
-        return self.recommendations.get(invoice_id)
+        result = self.result_store.get(invoice_id)
+        return result["recommendations"] if result else None
 
     def get_analysis(self, invoice_id: str) -> Optional[Dict[str, Any]]:
         """
@@ -211,50 +889,41 @@ class InvoiceProcessor:
             Analysis dict or None if not found
         """
         logger.info(f"Getting analysis for invoice: {invoice_id}")
-        file_path = os.path.join(self.data_dir, f"analysis_{invoice_id}.json")
-        if os.path.exists(file_path):
-            with open(file_path, 'r') as f:
-                return json.load(f)
-        return None
-
+        result = self.result_store.get(invoice_id)
+        return result["analysis"] if result else None
     
-    def _save_invoice(self, invoice_id: str, invoice_data: Dict[str, Any]) -> None:
-        """Save invoice data to disk"""
-        file_path = os.path.join(self.data_dir, f"invoice_{invoice_id}.json")
-        with open(file_path, 'w') as f:
-            json.dump(invoice_data, f, indent=2)
-
-    def _save_analysis(self, invoice_id: str, analysis: Dict[str, Any]) -> None:
-        """Save analysis to disk"""
-        file_path = os.path.join(self.data_dir, f"analysis_{invoice_id}.json")
-        with open(file_path, 'w') as f:
-            json.dump(analysis, f, indent=2)
-    
-    def _save_recommendations(self, invoice_id: str, recommendations: Dict[str, Any]) -> None:
-        """Save recommendations to disk"""
-        file_path = os.path.join(self.data_dir, f"recommendations_{invoice_id}.json")
-        with open(file_path, 'w') as f:
-            json.dump(recommendations, f, indent=2)
-    
-    def _load_invoices(self) -> None:
-        """Load all invoices from disk"""
-        self.invoices = {}
-        for filename in os.listdir(self.data_dir):
-            if filename.startswith("invoice_") and filename.endswith(".json"):
-                invoice_id = filename.replace("invoice_", "").replace(".json", "")
-                file_path = os.path.join(self.data_dir, filename)
-                with open(file_path, 'r') as f:
-                    self.invoices[invoice_id] = json.load(f)
-    
-    def _load_recommendations(self) -> None:
-        """Load all recommendations from disk"""
-        self.recommendations = {}
-        for filename in os.listdir(self.data_dir):
-            if filename.startswith("recommendations_") and filename.endswith(".json"):
-                invoice_id = filename.replace("recommendations_", "").replace(".json", "")
-                file_path = os.path.join(self.data_dir, filename)
-                with open(file_path, 'r') as f:
-                    self.recommendations[invoice_id] = json.load(f)
+    def get_analytics(self, group_by: str = 'provider', filters: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Get aggregated consumption and cost metrics
+        
+        Args:
+            group_by: 'provider' or 'customer'
+            filters: Optional provider, customer, period_from and period_to filters
+            
+        Returns:
+            Aggregations per group, with a monthly breakdown
+        """
+        return self.analytics_store.aggregate(group_by, filters)
+    
+    def get_dashboard(self) -> Dict[str, Any]:
+        """
+        Get the dashboard figures, maintained as each result is saved
+        
+        Returns:
+            Totals, issue counts by severity, average efficiency score, potential savings,
+            and amounts and kWh by period, provider, tax, line item and hour band
+        """
+        return self.result_store.kpis.snapshot()
+    
+    def check_consistency(self) -> Dict[str, Any]:
+        """
+        Check the arithmetic of every stored invoice in one vectorized pass
+        
+        Returns:
+            Counts per field and confidence flag, and the reports of the inconsistent invoices
+        """
+        invoices = self.result_store.invoices()
+        return summarize_reports(invoices, check_invoices(invoices))
     
     def generate_report(self, invoice_ids: List[str] = None) -> pd.DataFrame:
         """
@@ -266,27 +935,21 @@ class InvoiceProcessor:
         Returns:
             DataFrame with invoice data
         """
-        # Load invoices from disk if not in memory
-        if not self.invoices:
-            self._load_invoices()
-        
-        # Filter invoices if IDs provided
-        invoices_to_report = self.invoices
-        if invoice_ids:
-            invoices_to_report = {k: v for k, v in self.invoices.items() if k in invoice_ids}
-        
-        # Create DataFrame
-        report_data = []
-        for invoice_id, invoice in invoices_to_report.items():
-            report_data.append({
-                "id": invoice_id,
-                "provider": invoice.get("provider"),
-                "invoice_number": invoice.get("invoice_number"),
-                "issue_date": invoice.get("issue_date"),
-                "due_date": invoice.get("due_date"),
-                "customer_name": invoice.get("customer_name"),
-                "total_amount": invoice.get("total_amount"),
-                "total_kwh": invoice.get("total_kwh")
-            })
-        
-        return pd.DataFrame(report_data)
+        columns = self.analytics_store.select({'invoice_ids': invoice_ids} if invoice_ids else None)
+        report = pd.DataFrame({header: columns[name] for header, name in REPORT_COLUMNS})
+        return report.replace({"": None})
+    
+    def export_report(self, export_format: str = 'csv', filters: Optional[Dict[str, Any]] = None,
+                      chunk_size: int = 1000) -> Iterator[bytes]:
+        """
+        Stream a report of the invoices matching the filters
+        
+        Args:
+            export_format: 'csv', 'xlsx' or 'parquet'
+            filters: Optional provider, customer, period_from and period_to filters
+            chunk_size: Number of rows encoded per chunk
+            
+        Returns:
+            Iterator of encoded byte blocks
+        """
+        return export_report(self.analytics_store.select(filters), export_format, chunk_size)
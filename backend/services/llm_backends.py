@@ -0,0 +1,312 @@
+import os
+import time
+import logging
+import threading
+from collections import namedtuple
+from typing import Any, Dict, List, Optional
+
+import groq
+import requests
+
+from utils.metrics import cached_prompt_tokens, registry
+from utils.replay import ReplayMiss, ReplayStore, replay_store_from_env, request_key
+from utils.resilience import DependencyUnavailable, call_timeout
+
+logger = logging.getLogger(__name__)
+
+Message = Dict[str, str]
+# cached_tokens: prompt tokens served from the provider's prefix cache
+Usage = namedtuple('Usage', ['prompt_tokens', 'completion_tokens', 'cached_tokens'], defaults=(0,))
+
+# Groq request timeout in seconds, shortened to the request's deadline
+GROQ_TIMEOUT = 60.0
+
+BACKEND_CALLS = registry.counter(
+    'aienergy_llm_backend_calls_total', 'LLM calls per backend and stage', ['backend', 'stage', 'status'])
+
+class Completion:
+    """Text and token usage of a chat completion"""
+
+    __slots__ = ('content', 'usage', 'backend', 'model')
+
+    def __init__(self, content: str, usage: Optional[Usage], backend: str, model: str):
+        self.content = content
+        self.usage = usage
+        self.backend = backend
+        self.model = model
+
+class LLMBackend:
+    """Chat completion backend"""
+
+    name = 'backend'
+
+    def __init__(self, model: str):
+        """
+        Initialize the backend
+
+        Args:
+            model: Model name sent with each request
+        """
+        self.model = model
+
+    def complete(self, messages: List[Message], temperature: float = 0.0, max_tokens: Optional[int] = None,
+                 stage: Optional[str] = None, response_format: Optional[Dict[str, Any]] = None) -> Completion:
+        """
+        Run a chat completion
+
+        Args:
+            messages: Chat messages ({'role', 'content'})
+            temperature: Sampling temperature
+            max_tokens: Optional completion length limit
+            stage: Pipeline stage of the call (used for routing)
+            response_format: Optional OpenAI-style response format (e.g. a JSON schema)
+
+        Returns:
+            The completion
+        """
+        raise NotImplementedError
+
+class GroqBackend(LLMBackend):
+    """Groq chat completions API"""
+
+    name = 'groq'
+
+    def __init__(self, api_key: str, model: str, base_url: Optional[str] = None):
+        super().__init__(model)
+        self.client = groq.Client(api_key=api_key, base_url=base_url)
+
+    def complete(self, messages: List[Message], temperature: float = 0.0, max_tokens: Optional[int] = None,
+                 stage: Optional[str] = None, response_format: Optional[Dict[str, Any]] = None) -> Completion:
+        options = {'max_tokens': max_tokens} if max_tokens else {}
+        if response_format:
+            options['response_format'] = response_format
+        response = self.client.chat.completions.create(
+            model=self.model, messages=messages, temperature=temperature,
+            timeout=call_timeout(GROQ_TIMEOUT, stage or 'completion'), **options
+        )
+        return Completion(response.choices[0].message.content, response.usage, self.name, self.model)
+
+class OpenAICompatibleBackend(LLMBackend):
+    """Any server exposing the OpenAI chat completions API (llama.cpp, vLLM, Ollama...)"""
+
+    name = 'local'
+
+    def __init__(self, base_url: str, model: str, api_key: Optional[str] = None, timeout: float = 120.0):
+        """
+        Initialize the backend
+
+        Args:
+            base_url: API root, e.g. http://localhost:8080/v1
+            model: Model name
+            api_key: Optional bearer token
+            timeout: Request timeout in seconds
+        """
+        super().__init__(model)
+        self.url = f"{base_url.rstrip('/')}/chat/completions"
+        self.timeout = timeout
+        self.session = requests.Session()
+        if api_key:
+            self.session.headers['Authorization'] = f'Bearer {api_key}'
+
+    def complete(self, messages: List[Message], temperature: float = 0.0, max_tokens: Optional[int] = None,
+                 stage: Optional[str] = None, response_format: Optional[Dict[str, Any]] = None) -> Completion:
+        payload = {'model': self.model, 'messages': messages, 'temperature': temperature}
+        if max_tokens:
+            payload['max_tokens'] = max_tokens
+        if response_format:
+            payload['response_format'] = response_format
+        response = self.session.post(self.url, json=payload, timeout=call_timeout(self.timeout, stage or 'completion'))
+        response.raise_for_status()
+        data = response.json()
+        usage = data.get('usage')
+        if usage:
+            details = usage.get('prompt_tokens_details') or {}
+            usage = Usage(usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0),
+                          details.get('cached_tokens') or 0)
+        return Completion(data['choices'][0]['message']['content'], usage, self.name, data.get('model', self.model))
+
+class ReplayBackend(LLMBackend):
+    """
+    Records completions on disk keyed by a hash of the request, and replays them
+
+    In 'replay' mode unknown requests raise ReplayMiss, so runs are deterministic
+    and never reach the network; in 'record' mode they are sent to the wrapped
+    backend and recorded.
+    """
+
+    name = 'replay'
+
+    def __init__(self, store: ReplayStore, backend: Optional[LLMBackend] = None):
+        """
+        Initialize the backend
+
+        Args:
+            store: Recordings
+            backend: Backend answering unrecorded requests in 'record' mode
+        """
+        super().__init__(backend.model if backend else 'replay')
+        self.store = store
+        self.backend = backend
+
+    @staticmethod
+    def request(messages: List[Message], temperature: float, max_tokens: Optional[int],
+                response_format: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Recorded request (the model is left out so recordings survive model changes)"""
+        request = {'messages': messages, 'temperature': temperature, 'max_tokens': max_tokens}
+        if response_format:
+            request['response_format'] = response_format
+        return request
+
+    def complete(self, messages: List[Message], temperature: float = 0.0, max_tokens: Optional[int] = None,
+                 stage: Optional[str] = None, response_format: Optional[Dict[str, Any]] = None) -> Completion:
+        request = self.request(messages, temperature, max_tokens, response_format)
+        key = request_key(request)
+        recording = self.store.get(key, f"{stage or 'LLM'} request")
+        if recording is not None:
+            usage = recording.get('usage')
+            return Completion(recording['content'], Usage(**usage) if usage else None, self.name, recording.get('model', ''))
+        if self.backend is None:
+            raise ReplayMiss(f"No LLM backend to record {stage or 'request'} {key[:12]}")
+
+        completion = self.backend.complete(messages, temperature, max_tokens, stage, response_format)
+        usage = completion.usage
+        self.store.put(key, {
+            'stage': stage,
+            'model': completion.model,
+            'request': request,
+            'content': completion.content,
+            'usage': {'prompt_tokens': int(getattr(usage, 'prompt_tokens', 0) or 0),
+                      'completion_tokens': int(getattr(usage, 'completion_tokens', 0) or 0),
+                      'cached_tokens': cached_prompt_tokens(usage)} if usage else None,
+        })
+        return completion
+
+class BackendRouter(LLMBackend):
+    """
+    Sends each stage to the fastest available backend
+
+    Latency is tracked per backend and stage as a moving average; backends not
+    yet measured for a stage are tried first. A failing backend is skipped for
+    a cooldown period and the call falls back to the next one.
+    """
+
+    name = 'router'
+
+    def __init__(self, backends: List[LLMBackend], stages: Optional[Dict[str, List[str]]] = None,
+                 cooldown: float = 30.0, smoothing: float = 0.2):
+        """
+        Initialize the router
+
+        Args:
+            backends: Candidate backends
+            stages: Optional stage -> allowed backend names (all backends otherwise)
+            cooldown: Seconds a failed backend is skipped
+            smoothing: Weight of the latest latency in the moving average
+        """
+        if not backends:
+            raise ValueError("At least one LLM backend is required")
+        super().__init__(backends[0].model)
+        self.backends = {backend.name: backend for backend in backends}
+        self.stages = stages or {}
+        for stage, names in self.stages.items():
+            unknown = [name for name in names if name not in self.backends]
+            if unknown:
+                logger.warning(f"LLM_STAGE_BACKENDS routes {stage} to unconfigured backends: {', '.join(unknown)}")
+        self.cooldown = cooldown
+        self.smoothing = smoothing
+        self._latency: Dict[tuple, float] = {}
+        self._down_until: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def candidates(self, stage: Optional[str]) -> List[LLMBackend]:
+        """
+        Order the backends allowed for a stage, fastest available first
+
+        Args:
+            stage: Pipeline stage
+
+        Returns:
+            Backends to try, in order
+        """
+        names = [name for name in self.stages.get(stage or '', self.backends) if name in self.backends]
+        now = time.monotonic()
+        with self._lock:
+            up = [name for name in names if self._down_until.get(name, 0) <= now]
+            # Every backend is tried when all are cooling down
+            ordered = sorted(up or names, key=lambda name: self._latency.get((stage, name), 0.0))
+        return [self.backends[name] for name in ordered]
+
+    def complete(self, messages: List[Message], temperature: float = 0.0, max_tokens: Optional[int] = None,
+                 stage: Optional[str] = None, response_format: Optional[Dict[str, Any]] = None) -> Completion:
+        candidates = self.candidates(stage)
+        if not candidates:
+            # Only unconfigured backends are routed to this stage
+            raise DependencyUnavailable('llm', f"no configured backend for {stage}", retry_after=self.cooldown)
+        error = None
+        for backend in candidates:
+            start = time.monotonic()
+            try:
+                completion = backend.complete(messages, temperature, max_tokens, stage, response_format)
+            except Exception as e:
+                error = e
+                logger.warning(f"LLM backend {backend.name} failed for {stage}: {str(e)}")
+                BACKEND_CALLS.inc(backend=backend.name, stage=stage or '', status='error')
+                with self._lock:
+                    self._down_until[backend.name] = time.monotonic() + self.cooldown
+                continue
+            latency = time.monotonic() - start
+            BACKEND_CALLS.inc(backend=backend.name, stage=stage or '', status='ok')
+            with self._lock:
+                previous = self._latency.get((stage, backend.name))
+                self._latency[(stage, backend.name)] = latency if previous is None else \
+                    previous + self.smoothing * (latency - previous)
+            return completion
+        raise error
+
+def parse_stage_routes(value: Optional[str]) -> Dict[str, List[str]]:
+    """Parse 'extract=local,groq;analyze=groq' into a stage -> backend names mapping"""
+    routes = {}
+    for entry in (value or '').split(';'):
+        stage, _, names = entry.partition('=')
+        if stage.strip() and names.strip():
+            routes[stage.strip()] = [name.strip() for name in names.split(',') if name.strip()]
+    return routes
+
+def build_backend(api_key: Optional[str] = None, model: Optional[str] = None) -> Optional[LLMBackend]:
+    """
+    Build the LLM backend configured by the environment
+
+    LLM_BACKENDS lists the backends ('groq', 'local'), LLM_STAGE_BACKENDS restricts
+    them per stage and LLM_LOCAL_BASE_URL / LLM_LOCAL_MODEL configure the local
+    server. With REPLAY_MODE set ('record' or 'replay') the result is wrapped in a
+    replay backend storing its recordings under REPLAY_DIR.
+
+    Args:
+        api_key: Groq API key
+        model: Groq model
+
+    Returns:
+        The backend, or None if none is configured
+    """
+    backends: List[LLMBackend] = []
+    for name in [n.strip() for n in os.environ.get('LLM_BACKENDS', 'groq').split(',') if n.strip()]:
+        if name == 'groq' and api_key:
+            backends.append(GroqBackend(api_key, model))
+        elif name == 'local' and os.environ.get('LLM_LOCAL_BASE_URL'):
+            backends.append(OpenAICompatibleBackend(
+                os.environ['LLM_LOCAL_BASE_URL'], os.environ.get('LLM_LOCAL_MODEL', model),
+                api_key=os.environ.get('LLM_LOCAL_API_KEY')
+            ))
+        elif name not in ('groq', 'local'):
+            logger.warning(f"Unknown LLM backend: {name}")
+
+    backend = None
+    if len(backends) == 1:
+        backend = backends[0]
+    elif backends:
+        backend = BackendRouter(backends, parse_stage_routes(os.environ.get('LLM_STAGE_BACKENDS')))
+
+    store = replay_store_from_env('llm')
+    if store:
+        backend = ReplayBackend(store, backend)
+    return backend
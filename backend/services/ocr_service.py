@@ -1,6 +1,12 @@
 import os
+import time
+import uuid
+import hashlib
 import tempfile
 import logging
+import threading
+import contextvars
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from typing import List, Dict, Any, Union, Optional
 import PyPDF2
 from PIL import Image, ImageEnhance
@@ -8,9 +14,28 @@ from fpdf import FPDF
 from unstract.llmwhisperer import LLMWhispererClientV2
 import dotenv 
 
+from services.rule_engine import completeness
+from utils.file_utils import remove_stale_files
+from utils.metrics import log_payload, registry, stage
+from utils.replay import replay_store_from_env
+from utils.resilience import DeadlineExceeded, DependencyUnavailable, call_timeout, get_breaker
+
 dotenv.load_dotenv(override=True)
 logger = logging.getLogger(__name__)
 
+# Page separator requested from LLMWhisperer when pages are needed separately
+PAGE_SEPARATOR = '<<<'
+
+# Longest wait for an LLMWhisperer extraction, shortened to the request's deadline
+WHISPER_TIMEOUT = 200
+
+# Seconds between LLMWhisperer status checks in hedged mode
+WHISPER_POLL_INTERVAL = 2.0
+
+HEDGE_WINNERS = registry.counter(
+    'aienergy_hedged_ocr_total', 'Hedged PDF extractions by the source whose text was used', ['winner']
+)
+
 def image_to_pdf(input_image_path: str, output_pdf_path: str, enhancement_params: Optional[Dict[str, float]] = None) -> str:
     """
     Convert an image to PDF with optional enhancement
@@ -52,10 +77,14 @@ def image_to_pdf(input_image_path: str, output_pdf_path: str, enhancement_params
         image = image.convert("RGB")
 
         # Create a temporary file to save the image
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as temp_file:
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg", dir=os.path.dirname(os.path.abspath(output_pdf_path))) as temp_file:
             temp_image_path = temp_file.name
             image.save(temp_image_path)
+    except Exception as e:
+        logger.error(f"Error converting image to PDF: {str(e)}")
+        raise
 
+    try:
         # Create PDF
         pdf = FPDF()
         pdf.add_page()
@@ -85,9 +114,6 @@ def image_to_pdf(input_image_path: str, output_pdf_path: str, enhancement_params
 
         # Save the PDF
         pdf.output(output_pdf_path)
-
-        # Clean up the temporary file
-        os.remove(temp_image_path)
         
         logger.info(f"PDF created successfully: {output_pdf_path}")
         return output_pdf_path
@@ -95,6 +121,9 @@ def image_to_pdf(input_image_path: str, output_pdf_path: str, enhancement_params
     except Exception as e:
         logger.error(f"Error converting image to PDF: {str(e)}")
         raise
+    finally:
+        # Clean up the temporary file
+        os.remove(temp_image_path)
 
 class OCRService:
     """Service for performing OCR on invoice images and PDFs using LLMWhisperer"""
@@ -113,9 +142,23 @@ class OCRService:
         # Initialize the LLMWhisperer client
         self.client = LLMWhispererClientV2(base_url=self.base_url, api_key=self.api_key)
         
-        # Create a temporary directory for processing files
+        # Create a temporary directory for processing files, removing files left by crashed workers
         self.temp_dir = os.path.join(tempfile.gettempdir(), 'aienergy_ocr')
         os.makedirs(self.temp_dir, exist_ok=True)
+        remove_stale_files(self.temp_dir)
+        
+        # OCR results recorded or replayed by file content (REPLAY_MODE), for network-free runs
+        self.replay = replay_store_from_env('ocr')
+        
+        # Shared health of LLMWhisperer: while it is failing, calls are refused at once
+        self.breaker = get_breaker('llmwhisperer')
+        
+        # Opt-in: race the PDF text layer against LLMWhisperer, keeping the text layer when it
+        # scores at least min_completeness (see rule_engine.completeness)
+        self.hedged = os.environ.get('HEDGED_OCR', '0') == '1'
+        self.min_completeness = float(os.environ.get('HEDGE_MIN_COMPLETENESS', 0.75))
+        self.poll_interval = WHISPER_POLL_INTERVAL
+        self._hedge_pool = ThreadPoolExecutor(thread_name_prefix='ocr-hedge') if self.hedged else None
     
     def process_image(self, image_path: str) -> str:
         """
@@ -127,10 +170,17 @@ class OCRService:
         Returns:
             Extracted text from the image
         """
+        # Images have no text layer to fall back on: fail fast while LLMWhisperer is down
+        if not self.breaker.available():
+            raise DependencyUnavailable(self.breaker.name, 'open', retry_after=max(self.breaker.retry_after(), 1.0))
+        
+        # Unique name: the same stored image may be processed by several requests at once
+        pdf_path = os.path.join(self.temp_dir, f"{uuid.uuid4().hex}_{os.path.basename(image_path)}.pdf")
         try:
             # Convert image to PDF for better OCR results
-            pdf_path = os.path.join(self.temp_dir, f"{os.path.basename(image_path)}.pdf")
-            image_to_pdf(image_path, pdf_path)
+            with stage('image_to_pdf') as info:
+                image_to_pdf(image_path, pdf_path)
+                info['bytes'] = os.path.getsize(pdf_path)
             
             # Process the PDF with LLMWhisperer
             return self.process_pdf(pdf_path)
@@ -139,7 +189,7 @@ class OCRService:
             raise
         finally:
             # Clean up temporary PDF if it exists
-            if 'pdf_path' in locals() and os.path.exists(pdf_path):
+            if os.path.exists(pdf_path):
                 os.remove(pdf_path)
     
     def process_pdf(self, pdf_path: str) -> str:
@@ -152,14 +202,20 @@ class OCRService:
         Returns:
             Extracted text from the PDF
         """
+        if self.hedged:
+            return self._process_pdf_hedged(pdf_path)
         try:
             # Use LLMWhisperer to extract text
-            whisper_result = self.client.whisper(
-                file_path=pdf_path, 
-                wait_for_completion=True,
-                wait_timeout=200
-            )
-            logger.info(f"LLMWhisperer result1: {whisper_result}")
+            with stage('whisper') as info:
+                whisper_result = self.breaker.call(
+                    self.client.whisper,
+                    file_path=pdf_path, 
+                    wait_for_completion=True,
+                    wait_timeout=max(int(call_timeout(WHISPER_TIMEOUT, 'whisper')), 1)
+                )
+                result_text = ((whisper_result or {}).get('extraction') or {}).get('result_text')
+                info['bytes'] = len(result_text.encode('utf-8')) if isinstance(result_text, str) else 0
+            log_payload('whisper result', whisper_result)
             
             # Extract the result text
             if whisper_result and 'extraction' in whisper_result and 'result_text' in whisper_result['extraction']:
@@ -168,12 +224,153 @@ class OCRService:
                 # Fallback to PyPDF2 if LLMWhisperer doesn't return text
                 logger.warning("LLMWhisperer did not return expected result format, falling back to PyPDF2")
                 return self._extract_text_with_pypdf2(pdf_path)
+        except (DependencyUnavailable, DeadlineExceeded) as e:
+            # Degraded: only the text layer is read, which scanned pages do not have
+            logger.warning(f"Skipping LLMWhisperer ({str(e)}), using the PDF text layer")
+            text = self._extract_text_with_pypdf2(pdf_path)
+            if not text.strip():
+                raise
+            return text
         except Exception as e:
             logger.error(f"Error processing PDF with LLMWhisperer: {str(e)}")
             # Fallback to PyPDF2
             logger.info("Falling back to PyPDF2 for text extraction")
             return self._extract_text_with_pypdf2(pdf_path)
     
+    def _process_pdf_hedged(self, pdf_path: str) -> str:
+        """
+        Extract text from a PDF with the text layer and LLMWhisperer at once
+        
+        The first result acceptable is used and the other extraction is cancelled: the
+        text layer when it covers the invoice (completeness of at least min_completeness),
+        otherwise LLMWhisperer's. If LLMWhisperer fails, the text layer is used as is.
+        
+        Args:
+            pdf_path: Path to the PDF file
+            
+        Returns:
+            Extracted text from the PDF
+            
+        Raises:
+            DependencyUnavailable: If LLMWhisperer is unavailable and the PDF has no text layer
+            DeadlineExceeded: If the deadline passes and the PDF has no text layer
+        """
+        cancelled = threading.Event()
+        # Run in copies of this context, so both calls see the request's deadline
+        local = self._hedge_pool.submit(contextvars.copy_context().run, self._extract_text_with_pypdf2, pdf_path)
+        remote = self._hedge_pool.submit(contextvars.copy_context().run, self._whisper_cancellable, pdf_path, cancelled)
+        sources = {local: 'local', remote: 'remote'}
+        local_text, local_error, remote_error = '', None, None
+        with stage('hedged_ocr') as info:
+            try:
+                pending = set(sources)
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        try:
+                            text = future.result()
+                        except Exception as e:
+                            logger.warning(f"Hedged {sources[future]} extraction failed: {str(e)}")
+                            if future is remote:
+                                remote_error = e
+                            else:
+                                local_error = e
+                            continue
+                        if future is remote:
+                            info['winner'] = 'remote'
+                            log_payload('whisper result', text)
+                            return text
+                        local_text = text
+                        info['score'] = completeness(text)
+                        if info['score'] >= self.min_completeness:
+                            info['winner'] = 'local'
+                            return text
+                
+                # LLMWhisperer failed: the text layer is all there is
+                unavailable = isinstance(remote_error, (DependencyUnavailable, DeadlineExceeded))
+                if local_error is not None:
+                    raise remote_error if unavailable else local_error
+                if unavailable and not local_text.strip():
+                    raise remote_error
+                info['winner'] = 'fallback'
+                return local_text
+            finally:
+                cancelled.set()
+                remote.cancel()
+                HEDGE_WINNERS.inc(winner=info.get('winner', 'none'))
+    
+    def _whisper_cancellable(self, pdf_path: str, cancelled: threading.Event) -> str:
+        """
+        Extract text with LLMWhisperer, polling its status until done or cancelled
+        
+        Args:
+            pdf_path: Path to the PDF file
+            cancelled: Set to stop waiting for the extraction
+            
+        Returns:
+            Extracted text ('' if cancelled)
+            
+        Raises:
+            RuntimeError: If the extraction fails or gives no text
+            TimeoutError: If it is not done within the whisper timeout
+        """
+        timeout = call_timeout(WHISPER_TIMEOUT, 'whisper')
+        
+        def extract() -> str:
+            submitted = self.client.whisper(file_path=pdf_path)
+            whisper_hash = submitted.get('whisper_hash')
+            result = submitted
+            started = time.monotonic()
+            while whisper_hash and not cancelled.wait(self.poll_interval):
+                status = self.client.whisper_status(whisper_hash=whisper_hash)
+                if status.get('status') == 'processed':
+                    result = self.client.whisper_retrieve(whisper_hash=whisper_hash)
+                    break
+                if status.get('status_code') != 200 or 'error' in str(status.get('status')):
+                    raise RuntimeError(f"LLMWhisperer extraction failed: {status.get('message') or status.get('status')}")
+                if time.monotonic() - started > timeout:
+                    raise TimeoutError(f"LLMWhisperer extraction not done after {timeout:.0f}s")
+            if cancelled.is_set():
+                return ''
+            text = (result.get('extraction') or {}).get('result_text')
+            if not isinstance(text, str):
+                raise RuntimeError("LLMWhisperer did not return expected result format")
+            return text
+        
+        with stage('whisper') as info:
+            text = self.breaker.call(extract)
+            info['bytes'] = len(text.encode('utf-8'))
+        return text
+    
+    def process_pdf_pages(self, pdf_path: str) -> List[str]:
+        """
+        Extract the text of each page of a PDF with the cheapest LLMWhisperer mode
+        
+        Used to find invoice boundaries in scanned bundles, not for extraction.
+        
+        Args:
+            pdf_path: Path to the PDF file
+            
+        Returns:
+            Text of each page
+        """
+        with stage('whisper_pages') as info:
+            whisper_result = self.breaker.call(
+                self.client.whisper,
+                file_path=pdf_path,
+                mode='low_cost',
+                page_seperator=PAGE_SEPARATOR,
+                wait_for_completion=True,
+                wait_timeout=max(int(call_timeout(WHISPER_TIMEOUT, 'whisper_pages')), 1)
+            )
+            result_text = ((whisper_result or {}).get('extraction') or {}).get('result_text') or ''
+            info['bytes'] = len(result_text.encode('utf-8'))
+        pages = result_text.split(PAGE_SEPARATOR)
+        # The separator may also follow the last page
+        if len(pages) > 1 and not pages[-1].strip():
+            pages.pop()
+        return pages
+    
     def _extract_text_with_pypdf2(self, pdf_path: str) -> str:
         """
         Extract text from a PDF using PyPDF2 as a fallback
@@ -213,12 +410,26 @@ class OCRService:
         Returns:
             Extracted text from the file
         """
+        if self.replay:
+            digest = hashlib.sha256()
+            with open(file_path, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(block)
+            key = digest.hexdigest()
+            recording = self.replay.get(key, f"OCR of {os.path.basename(file_path)}")
+            if recording is not None:
+                return recording['text']
+        
         file_extension = os.path.splitext(file_path)[1].lower()
         
         if file_extension in ['.pdf']:
-            return self.process_pdf(file_path)
+            text = self.process_pdf(file_path)
         elif file_extension in ['.jpg', '.jpeg', '.png']:
-            return self.process_image(file_path)
+            text = self.process_image(file_path)
         else:
             raise ValueError(f"Unsupported file type: {file_extension}")
+        
+        if self.replay:
+            self.replay.put(key, {'file': os.path.basename(file_path), 'text': text})
+        return text
 
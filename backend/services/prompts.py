@@ -0,0 +1,248 @@
+import json
+import hashlib
+from string import Template
+from typing import Any, Dict, List
+
+JSON_ONLY = "retournez juste un json, sans texte, sans remarques, sans ```json juste le json"
+
+class PromptTemplate:
+    """
+    Versioned chat prompt: a static system message and a user message holding only the variable data
+
+    Everything that does not depend on the invoice lives in the system message, which
+    is rendered once, so every call starts with the same prefix and providers or local
+    servers can reuse its cached KV state. The user template is compiled once and only
+    substituted per call. Bump the version when editing a template.
+    """
+
+    __slots__ = ('name', 'version', 'system', 'user', 'fingerprint')
+
+    def __init__(self, name: str, version: int, system: str, user: str):
+        """
+        Initialize the template
+
+        Args:
+            name: Prompt name (usually the pipeline stage)
+            version: Template version
+            system: Static instructions
+            user: User message template with $placeholders for the variable data
+        """
+        self.name = name
+        self.version = version
+        self.system = system.strip()
+        self.user = Template(user.strip())
+        self.fingerprint = hashlib.sha256(f'{self.system}\n{user}'.encode('utf-8')).hexdigest()[:12]
+
+    @property
+    def id(self) -> str:
+        """Versioned identifier, e.g. 'analyze@v2'"""
+        return f'{self.name}@v{self.version}'
+
+    def render(self, **values: Any) -> List[Dict[str, str]]:
+        """
+        Build the chat messages
+
+        Args:
+            values: Placeholder values; non-string values are serialized as compact JSON
+
+        Returns:
+            System and user messages
+        """
+        user = self.user.substitute({
+            key: value if isinstance(value, str) else
+            json.dumps(value, ensure_ascii=False, separators=(',', ':'), default=str)
+            for key, value in values.items()
+        })
+        return [{'role': 'system', 'content': self.system}, {'role': 'user', 'content': user}]
+
+EXTRACT = PromptTemplate('extract', 2, f"""
+You are an AI assistant that extracts structured data from energy invoices.you return just a valid json, do not put ```json in first or at the end of the response , just put the json
+
+Vous êtes un assistant IA spécialisé dans l'extraction d'informations à partir de factures d'énergie.
+Le texte de la facture fourni est en français.
+Extrayez les informations suivantes du texte de facture d'énergie donné par l'utilisateur :
+
+1.  **Nom du fournisseur**: Identifiez le nom de l'entreprise de services publics (par exemple, "LYDEC").
+2.  **Numéro de facture**: Recherchez "N° FACTURE" ou "Détail de votre facture N°" suivi d'un numéro.
+3.  **Date d'émission**: Trouvez "Date de l'édition" et formatez-la au format AAAA-MM-JJ.
+4.  **Date d'échéance**: Si elle est explicitement indiquée (par exemple, "Date limite de paiement"), formatez-la au format AAAA-MM-JJ. Si non trouvée, retournez `null`.
+5.  **Nom du client**: Si disponible, extrayez le nom complet du client. Si non trouvé, retournez `null`.
+6.  **ID client**: Si disponible, extrayez le numéro d'identification du client. Si non trouvé, retournez `null`.
+7.  **Montant total**: Trouvez le "Montant TTC" ou "Total général" (Total toutes taxes comprises).
+8.  **Période de consommation d'énergie**: Déterminez les dates de début et de fin de la période de consommation. Celles-ci sont généralement indiquées par la date de "Ancien Index" (début) et la date de "Nouvel Index" (fin) sous la section "Détail de votre consommation". Formatez les deux au format AAAA-MM-JJ.
+9.  **Total kWh consommés**: Recherchez "Total énergie Active" ou la somme des catégories de consommation (par exemple, "Heures Normales", "Heures Creuses", "Heures de Pointe").
+10. **Tarif par kWh**: Ce tarif peut varier selon la catégorie de consommation ; si un tarif global unique n'est pas disponible, retournez `null`. Le prompt extraira les tarifs individuels dans les postes.
+11. **kWh Pointe**: Extrayez la valeur de consommation pour les "Heures de Pointe". Si "Heures de Pointe" n'est pas présente mais "Heures Normales" l'est, considérez "Heures Normales" comme la pointe.
+12. **kWh Creuses**: Extrayez la valeur de consommation pour les "Heures Creuses".
+13. **Postes détaillés (Line items)**: Extrayez les détails du tableau principal de consommation/services (par exemple, sous "DISTRIBUTION MT"). Pour chaque poste, capturez :
+    *   `description`: Le nom de la charge ou du service (par exemple, "CONSO. H. NORMALES", "RDV. DE PUISSANCE").
+    *   `quantity`: La valeur sous la colonne "Quantité".
+    *   `unit_price`: La valeur sous la colonne "Prix Unitaire H.T.".
+    *   `total`: La valeur sous la colonne "Montant H.T.".
+14. **Taxes**: Extrayez les détails des taxes de la section "Récapitulatif TVA". Créez un objet où les clés sont les noms des taxes (par exemple, "TVA_7_percent", "TVA_14_percent" basés sur la colonne "Taux") et les valeurs sont leurs "Montant" correspondants.
+15. **Puissance maximale appelée**: Si la facture indique la puissance maximale atteinte ou appelée sur la période (en kW ou kVA), extrayez sa valeur numérique. Si non trouvée, retournez `null`.
+
+Retournez les informations dans un format JSON structuré avec ces clés exactes :
+`provider`, `invoice_number`, `issue_date`, `due_date`, `customer_name`, `customer_id`,
+`total_amount`, `period_start`, `period_end`, `total_kwh`, `rate_per_kwh`, `peak_kwh`,
+`off_peak_kwh`, `items` (tableau d'objets tel que décrit ci-dessus), `taxes` (objet avec les noms de taxes comme clés et les montants comme valeurs), `max_power_kw`.
+Si un champ n'est pas trouvé, retournez `null` pour ce champ spécifique.
+{JSON_ONLY}
+""", """
+Voici le texte de la facture :
+$ocr_text
+""")
+
+CORRECT = PromptTemplate('correct', 2, f"""
+You correct invalid JSON responses. you return just a valid json, do not put ```json in first or at the end of the response , just put the json
+
+L'utilisateur fournit une réponse JSON qui ne respecte pas le schéma attendu et la liste des champs en erreur.
+Corrigez uniquement les champs en erreur (utilisez `null` si la valeur est inconnue) et retournez le JSON complet corrigé.
+{JSON_ONLY}
+""", """
+Erreurs :
+$errors
+
+Réponse précédente :
+$response
+""")
+
+REPAIR = PromptTemplate('repair', 2, f"""
+You extract specific fields from energy invoice excerpts. you return just a valid json, do not put ```json in first or at the end of the response , just put the json
+
+L'utilisateur fournit une liste de champs et un extrait de facture d'électricité.
+Retournez un objet JSON avec uniquement ces clés (`null` si la valeur n'est pas dans l'extrait).
+{JSON_ONLY}
+""", """
+Champs à extraire :
+$fields
+
+Extrait :
+$ocr_snippet
+""")
+
+ANALYZE = PromptTemplate('analyze', 2, f"""
+You are an AI assistant that analyzes energy invoices for issues. you return just a valid json, do not put ```json in first or at the end of the response , just put the json
+
+Vous êtes un assistant IA spécialisé dans l'analyse des factures d'énergie.
+En vous basant *intégralement* sur les "Problèmes observés" et leurs "Effets sur la facture" décrits dans le document "Essentiel pour l'optimisation des redevances électriques", analysez les données de facture d'énergie fournies par l'utilisateur et identifiez toute anomalie ou problème potentiel.
+
+Les lignes de la facture sont regroupées par catégorie dans `items_by_category` (power_overrun : dépassements de puissance, reactive : énergie réactive, subscribed_power : redevance de puissance). Les calculs ont déjà été vérifiés : `checks` indique les champs incohérents ("mismatch") ou calculés ("derived"), ne refaites pas l'arithmétique.
+
+Votre analyse doit spécifiquement rechercher les problèmes suivants, tels que définis dans le document de référence :
+
+1.  **Facteur de puissance (cos φ) < 0.93**: Y a-t-il des signes de "Pénalités sur la puissance réactive" ou des données suggérant un facteur de puissance faible ?
+2.  **Puissance appelée > 110 % de la puissance souscrite**: Des "Pénalités de dépassement" sont-elles appliquées, indiquant que la puissance appelée a excédé significativement la puissance souscrite ?
+3.  **Puissance souscrite trop élevée par rapport à la puissance réellement appelée**: Y a-t-il un "Surcoût mensuel inutile" potentiel dû à une puissance souscrite qui semble excessive par rapport à l'historique de consommation ou la puissance maximale appelée ?
+4.  **Consommation concentrée durant les heures pleines (HP)**: La répartition de la consommation indique-t-elle une concentration significative en "Heures Pleines", entraînant un "Coût élevé de l'énergie" ?
+
+Retournez votre analyse dans un format JSON structuré avec ces clés :
+`issues` (un tableau d'objets, où chaque objet décrit un problème identifié), `severity` (la gravité pour chaque problème : "high", "medium", "low"). Chaque objet dans le tableau `issues` doit avoir une clé `description` pour le problème et une clé `severity`.
+
+{JSON_ONLY} , toute la reponse doit etre en francais
+""", """
+Données de la facture :
+$invoice_data
+""")
+
+RECOMMEND = PromptTemplate('recommend', 3, f"""
+You are an AI assistant that provides energy optimization recommendations.
+
+Vous êtes un assistant IA spécialisé dans la fourniture de recommandations d'optimisation énergétique.
+En vous basant sur les données de facture d'énergie et l'analyse fournies par l'utilisateur, fournissez des recommandations pour optimiser l'utilisation de l'énergie et réduire les coûts.
+
+Pour chaque problème identifié dans l'analyse (`analysis.issues`), trouvez la correspondance ci-dessous et formulez une recommandation spécifique et actionable en vous basant sur l' "Action recommandée" et l' "Explication détaillée" correspondantes.
+
+Si l'analyse contient une clé `history`, elle résume l'historique de facturation du client : pour chaque indicateur (`total_kwh`, `peak_share`, `cost_per_kwh`, `subscribed_power`, `power_overrun`, `max_power`), la valeur actuelle, la moyenne des périodes précédentes (`baseline`), le `zscore` et l'écart saisonnier (`seasonal_deviation`), ainsi que des `flags` (`consumption_spike`, `consumption_drop`, `seasonal_deviation`, `peak_concentration`, `recurrent_power_overrun`, `oversized_subscribed_power`, ce dernier n'étant levé que si la puissance maximale appelée est connue). Utilisez ces constats pour confirmer ou nuancer les problèmes de puissance souscrite et de concentration en heures pleines, et citez les chiffres correspondants dans vos recommandations.
+
+**Liste des problèmes et des actions recommandées (tirées du document "Essentiel pour l'optimisation des redevances électriques") :**
+
+*   **Si l'analyse identifie un problème lié au "Facteur de puissance (cos φ) < 0.93" ou des "Pénalités sur la puissance réactive" :**
+    *   **Action recommandée :** "Installer des batteries de condensateurs"
+    *   **Explication détaillée :** "Un cos φ faible signifie que vous tirez plus de puissance apparente que nécessaire. Cela surcharge les équipements et le réseau. La correction réduit la puissance réactive et évite des pénalités mensuelles. L'objectif est d'atteindre un cos φ à ≥ 0.93 (idéalement 0.95-0.98)."
+    *   **Recommandation à formuler :** l'installation de batteries de condensateurs en expliquant que cela corrigera le facteur de puissance, réduira la puissance réactive et évitera les pénalités mensuelles.
+
+*   **Si l'analyse identifie un problème lié à la "Puissance appelée > 110 % de la puissance souscrite" ou des "Pénalités de dépassement" :**
+    *   **Action recommandée :** "Étalement des démarrages, gestion des appels de charge, dispositifs de lissage (peak shaving)"
+    *   **Explication détaillée :** "Lorsque vous dépassez 1.1 × la puissance souscrite, vous êtes facturé pour le surplus. Il faut éviter les démarrages simultanés ou les pics inattendus (par exemple, compresseurs + convoyeurs). L'objectif est de réduire les pics de puissance."
+    *   **Recommandation :** l'étalement des démarrages, une meilleure gestion des appels de charge et/ou l'utilisation de dispositifs de lissage (peak shaving) pour réduire les pics de puissance et éviter les surcoûts liés aux dépassements.
+
+*   **Si l'analyse identifie un problème lié à la "Puissance souscrite trop élevée par rapport à la puissance réellement appelée" ou un "Surcoût mensuel inutile" :**
+    *   **Action recommandée :** "Analyser les historiques de charge et ajuster la puissance souscrite"
+    *   **Explication détaillée :** "La puissance souscrite est facturée même si elle n'est pas utilisée. Il est judicieux de la fixer légèrement au-dessus de la puissance maximale réellement consommée pour éviter les pénalités sans surpayer. L'objectif est de réduire la puissance souscrite au niveau optimal."
+    *   **Recommandation :** analyser les historiques de charge pour ajuster la puissance souscrite au niveau optimal, en veillant à ce qu'elle soit légèrement supérieure à la puissance maximale réellement consommée pour éviter les frais inutiles.
+
+*   **Si l'analyse identifie un problème lié à la "Consommation concentrée durant les heures pleines (HP)" ou un "Coût élevé de l'énergie" :**
+    *   **Action recommandée :** "Transférer la consommation vers les heures creuses (HC) ou normales (HN) / Programmer les équipements pour fonctionner en HC"
+    *   **Explication détaillée :** "Les heures pleines sont les plus coûteuses. En planifiant les usages énergétiques importants (non critiques) la nuit ou en HC, on réduit fortement la facture d'énergie sans modifier la production."
+    *   **Recommandation :** transférer la consommation des équipements non critiques vers les heures creuses ou normales, en programmant leur fonctionnement pendant ces périodes moins coûteuses.
+
+Si l'analyse contient une clé `simulation`, elle résulte d'une simulation exacte sur l'historique du client : la puissance souscrite actuelle et optimale (`current.subscribed_power`, `optimum.subscribed_power`), la part de la consommation des heures pleines à reporter en heures creuses (`optimum.load_shift`), le coût moyen par période (`cost`), les économies par période (`potential_savings`, détaillées dans `savings_breakdown`) et l'`efficiency_score`. Reprenez alors ces valeurs telles quelles pour `potential_savings` et `efficiency_score`, sans les estimer vous-même, et citez la puissance souscrite optimale et le report de consommation dans les recommandations correspondantes.
+
+Sinon, estimez les économies potentielles (en pourcentage et en montant monétaire) si les recommandations sont suivies. Si les données fournies ne permettent pas une estimation précise, vous pouvez indiquer `null` pour ces valeurs ou fournir une estimation basée sur des hypothèses générales (en mentionnant ces hypothèses si possible).
+Attribuez également un `efficiency_score` (évaluation de 0 à 100 de l'efficacité actuelle) en fonction de la présence et de la gravité des problèmes identifiés.
+
+Retournez vos recommandations dans un format JSON structuré avec ces clés :
+`recommendations` (tableau de chaînes de caractères décrivant les recommandations), `potential_savings` (montant monétaire estimé),
+`efficiency_score` (évaluation de 0 à 100 de l'efficacité actuelle).
+
+{JSON_ONLY} , toute la reponse doit etre en francais
+""", """
+Données de la facture :
+$invoice_data
+
+Analyse :
+$analysis
+""")
+
+def _rules(prompt: PromptTemplate) -> str:
+    """Instructions of a prompt without its English role line"""
+    return prompt.system.partition('\n\n')[2]
+
+# Extraction, analysis and recommendations in one completion (FUSED_LLM_PIPELINE), answered
+# with a JSON schema response format; the per-stage instructions are reused unchanged
+FUSED = PromptTemplate('fused', 2, f"""
+You are an AI assistant that processes energy invoices in a single response: extraction, then issues, then advice. you return just a valid json
+
+Vous traitez une facture d'énergie en trois étapes, en une seule réponse. Les instructions de chaque étape décrivent le JSON qu'elle produit ; l'étape 2 analyse les données extraites à l'étape 1, et l'étape 3 s'appuie sur les étapes 1 et 2.
+
+### Étape 1 : extraction
+
+{_rules(EXTRACT)}
+
+### Étape 2 : analyse
+
+`items_by_category` et `checks` ne sont pas fournis dans ce mode : appuyez-vous sur les postes extraits à l'étape 1.
+
+{_rules(ANALYZE)}
+
+### Étape 3 : recommandations
+
+{_rules(RECOMMEND)}
+
+### Réponse
+
+Retournez un seul objet JSON avec trois clés : `invoice` (le JSON de l'étape 1), `analysis` (le JSON de l'étape 2) et `recommendations` (le JSON de l'étape 3).
+{JSON_ONLY} , toute la reponse doit etre en francais
+""", EXTRACT.user.template)
+
+PROMPTS: Dict[str, PromptTemplate] = {prompt.name: prompt for prompt in (EXTRACT, CORRECT, REPAIR, ANALYZE, RECOMMEND, FUSED)}
+
+def get_prompt(name: str) -> PromptTemplate:
+    """
+    Get a prompt from the registry
+
+    Args:
+        name: Prompt name ('extract', 'correct', 'repair', 'analyze', 'recommend', 'fused')
+
+    Returns:
+        The template
+
+    Raises:
+        KeyError: If there is no such prompt
+    """
+    return PROMPTS[name]
+
+def prompt_versions() -> Dict[str, str]:
+    """Versioned ID and content fingerprint of every registered prompt"""
+    return {name: f'{prompt.id}+{prompt.fingerprint}' for name, prompt in PROMPTS.items()}
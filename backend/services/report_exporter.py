@@ -0,0 +1,205 @@
+import io
+import csv
+import math
+import zipfile
+import logging
+from typing import Any, Dict, Iterator, List
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Report column header -> analytics store column
+REPORT_COLUMNS = [
+    ("id", "invoice_id"),
+    ("provider", "provider"),
+    ("invoice_number", "invoice_number"),
+    ("issue_date", "issue_date"),
+    ("due_date", "due_date"),
+    ("customer_name", "customer_name"),
+    ("total_amount", "total_amount"),
+    ("total_kwh", "total_kwh"),
+]
+
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+def iter_report_chunks(columns: Dict[str, np.ndarray], chunk_size: int = 1000) -> Iterator[List[List[Any]]]:
+    """
+    Slice store columns into chunks of report rows
+
+    Args:
+        columns: Store columns (see AnalyticsStore.select)
+        chunk_size: Number of rows per chunk
+
+    Yields:
+        Lists of rows, each row ordered as REPORT_COLUMNS (None for missing values)
+    """
+    total = len(columns["invoice_id"])
+    for start in range(0, total, chunk_size):
+        values = [columns[name][start:start + chunk_size].tolist() for _, name in REPORT_COLUMNS]
+        yield [
+            [None if v == "" or (isinstance(v, float) and math.isnan(v)) else v for v in row]
+            for row in zip(*values)
+        ]
+
+class _StreamBuffer(io.RawIOBase):
+    """Write-only sink whose content is drained after each chunk"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+def stream_csv(chunks: Iterator[List[List[Any]]]) -> Iterator[bytes]:
+    """Encode report chunks as CSV, one block of bytes per chunk"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([header for header, _ in REPORT_COLUMNS])
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+_XLSX_PARTS = {
+    "[Content_Types].xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    "_rels/.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+        'Target="xl/workbook.xml"/></Relationships>'
+    ),
+    "xl/workbook.xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Invoices" sheetId="1" r:id="rId1"/></sheets></workbook>'
+    ),
+    "xl/_rels/workbook.xml.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+        'Target="worksheets/sheet1.xml"/></Relationships>'
+    ),
+}
+
+def _xlsx_row(values: List[Any]) -> str:
+    """Render one worksheet row using inline strings"""
+    cells = []
+    for value in values:
+        if value is None:
+            cells.append('<c/>')
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            cells.append(f'<c><v>{value}</v></c>')
+        else:
+            cells.append(f'<c t="inlineStr"><is><t>{escape(str(value))}</t></is></c>')
+    return f'<row>{"".join(cells)}</row>'
+
+def stream_xlsx(chunks: Iterator[List[List[Any]]]) -> Iterator[bytes]:
+    """
+    Encode report chunks as an XLSX workbook
+
+    The workbook is written through zipfile on a non-seekable sink, so entries
+    use data descriptors and the archive is emitted as rows are encoded.
+    """
+    sink = _StreamBuffer()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, content in _XLSX_PARTS.items():
+            archive.writestr(name, content)
+        yield sink.drain()
+
+        with archive.open("xl/worksheets/sheet1.xml", "w") as sheet:
+            sheet.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+            )
+            sheet.write(_xlsx_row([header for header, _ in REPORT_COLUMNS]).encode("utf-8"))
+            for rows in chunks:
+                sheet.write("".join(_xlsx_row(row) for row in rows).encode("utf-8"))
+                yield sink.drain()
+            sheet.write(b'</sheetData></worksheet>')
+    yield sink.drain()
+
+def stream_parquet(chunks: Iterator[List[List[Any]]]) -> Iterator[bytes]:
+    """
+    Encode report chunks as a Parquet file, one row group per chunk
+
+    Requires the optional pyarrow dependency.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ValueError("Parquet export requires pyarrow to be installed")
+
+    schema = pa.schema([
+        (header, pa.float64() if header in ("total_amount", "total_kwh") else pa.string())
+        for header, _ in REPORT_COLUMNS
+    ])
+    sink = _StreamBuffer()
+    with pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema) as writer:
+        for rows in chunks:
+            columns = list(zip(*rows))
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(values, type=field.type) for values, field in zip(columns, schema)],
+                schema=schema
+            ))
+            yield sink.drain()
+    yield sink.drain()
+
+WRITERS = {
+    "csv": stream_csv,
+    "xlsx": stream_xlsx,
+    "parquet": stream_parquet,
+}
+
+def export_report(columns: Dict[str, np.ndarray], export_format: str = "csv", chunk_size: int = 1000) -> Iterator[bytes]:
+    """
+    Stream a report of the given store columns in the requested format
+
+    Args:
+        columns: Store columns to export (see AnalyticsStore.select)
+        export_format: One of 'csv', 'xlsx' or 'parquet'
+        chunk_size: Number of rows encoded per chunk
+
+    Returns:
+        Iterator of encoded byte blocks
+    """
+    if export_format not in WRITERS:
+        raise ValueError(f"Unsupported export format: {export_format}")
+    if export_format == "parquet":
+        # Fail before the response starts if the optional dependency is missing
+        try:
+            import pyarrow.parquet  # noqa: F401
+        except ImportError:
+            raise ValueError("Parquet export requires pyarrow to be installed")
+    return WRITERS[export_format](iter_report_chunks(columns, chunk_size))
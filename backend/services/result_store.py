@@ -0,0 +1,311 @@
+import os
+import json
+import time
+import logging
+from typing import Any, Dict, List, Optional
+
+from models.invoice import InvoiceSummary
+from services.dashboard_kpis import DashboardKPIs
+from utils.database import Database, GroupCommitter
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS invoice_results (
+    invoice_id TEXT PRIMARY KEY,
+    invoice TEXT NOT NULL,
+    analysis TEXT,
+    recommendations TEXT,
+    ocr_text TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_invoice_results_created ON invoice_results (created_at);
+CREATE INDEX IF NOT EXISTS idx_invoice_results_file_hash ON invoice_results (json_extract(invoice, '$.file_hash'));
+CREATE TABLE IF NOT EXISTS invoice_corrections (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    invoice_id TEXT NOT NULL,
+    field TEXT NOT NULL,
+    old_value TEXT,
+    new_value TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_invoice_corrections_invoice ON invoice_corrections (invoice_id);
+CREATE TABLE IF NOT EXISTS invoice_batches (
+    batch_id TEXT PRIMARY KEY,
+    batch TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+ARTIFACTS = ('invoice', 'analysis', 'recommendations')
+
+# Suffix given to legacy files that could not be read or parsed, so recovery does not retry them
+CORRUPT_SUFFIX = '.corrupt'
+
+def _dumps(value: Any) -> Optional[str]:
+    return None if value is None else json.dumps(value, ensure_ascii=False)
+
+def _load_json(path: str) -> Optional[Any]:
+    """Read a legacy JSON file, setting it aside if it is unreadable, truncated or corrupt"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Setting aside unreadable result file {path}: {str(e)}")
+        try:
+            os.replace(path, path + CORRUPT_SUFFIX)
+        except OSError as e:
+            logger.warning(f"Could not set aside {path}: {str(e)}")
+        return None
+
+class ResultStore:
+    """
+    Processed invoice results (invoice, analysis and recommendations), stored in one row
+    per invoice so all artifacts of an invoice are written in a single transaction
+    """
+
+    def __init__(self, database: Database, committer: Optional[GroupCommitter] = None):
+        """
+        Initialize the store, creating its table if needed
+
+        Args:
+            database: Application database
+            committer: Group committer writes go through (one is created if not given)
+        """
+        self.database = database
+        self.committer = committer or GroupCommitter(database)
+        self.database.executescript(SCHEMA)
+        # Dashboard figures, updated in the transaction writing each result
+        self.kpis = DashboardKPIs(database)
+        if self.kpis.empty() and self.count():
+            with self.database.transaction() as conn:
+                self.kpis.rebuild(conn, (self._to_result(row) for row in conn.execute(
+                    'SELECT invoice, analysis, recommendations FROM invoice_results').fetchall()))
+
+    def count(self) -> int:
+        """Get the number of stored results"""
+        return self.database.connection.execute('SELECT COUNT(*) FROM invoice_results').fetchone()[0]
+
+    def save(self, result: Dict[str, Any], ocr_text: Optional[str] = None,
+             corrections: Optional[Dict[str, Dict[str, Any]]] = None) -> None:
+        """
+        Store the full result of an invoice, returning once it is durably committed
+
+        The dashboard KPIs are updated in the same transaction, replacing the figures of
+        the result stored before.
+
+        Args:
+            result: Dict with invoice (containing its id), analysis and recommendations
+            ocr_text: Raw OCR text of the invoice
+            corrections: Field corrections the result was recomputed from ({field: {'old', 'new'}}),
+                recorded in the same transaction
+        """
+        invoice_id = result['invoice']['id']
+        now = time.time()
+        row = (invoice_id, *(_dumps(result.get(name)) for name in ARTIFACTS), ocr_text, now)
+        correction_rows = [(invoice_id, field, _dumps(change['old']), _dumps(change['new']), now)
+                           for field, change in (corrections or {}).items()]
+
+        def write(conn):
+            previous = conn.execute(
+                'SELECT invoice, analysis, recommendations FROM invoice_results WHERE invoice_id = ?', (invoice_id,)
+            ).fetchone()
+            conn.execute(
+                """INSERT INTO invoice_results
+                       (invoice_id, invoice, analysis, recommendations, ocr_text, created_at, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?6)
+                   ON CONFLICT (invoice_id) DO UPDATE SET
+                       invoice = excluded.invoice, analysis = excluded.analysis,
+                       recommendations = excluded.recommendations,
+                       ocr_text = COALESCE(excluded.ocr_text, ocr_text), updated_at = excluded.updated_at""",
+                row
+            )
+            if correction_rows:
+                conn.executemany(
+                    """INSERT INTO invoice_corrections (invoice_id, field, old_value, new_value, created_at)
+                       VALUES (?, ?, ?, ?, ?)""",
+                    correction_rows
+                )
+            self.kpis.apply(conn, self._to_result(previous) if previous else None, result)
+        self.committer.submit(write)
+
+    def corrections(self, invoice_id: str) -> List[Dict[str, Any]]:
+        """
+        Get the field corrections made to an invoice, oldest first
+
+        Args:
+            invoice_id: ID of the invoice
+
+        Returns:
+            Dicts with field, old_value, new_value and created_at
+        """
+        rows = self.database.connection.execute(
+            """SELECT field, old_value, new_value, created_at FROM invoice_corrections
+               WHERE invoice_id = ? ORDER BY id""", (invoice_id,)
+        )
+        return [{'field': row['field'], 'created_at': row['created_at'],
+                 **{name: json.loads(row[name]) if row[name] is not None else None
+                    for name in ('old_value', 'new_value')}} for row in rows]
+
+    def get(self, invoice_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Get the full result of an invoice
+
+        Args:
+            invoice_id: ID of the invoice
+
+        Returns:
+            Dict with invoice, analysis and recommendations, or None if not found
+        """
+        row = self.database.connection.execute(
+            'SELECT invoice, analysis, recommendations FROM invoice_results WHERE invoice_id = ?', (invoice_id,)
+        ).fetchone()
+        return self._to_result(row) if row else None
+
+    def find_by_file_hash(self, file_hash: str) -> Optional[Dict[str, Any]]:
+        """
+        Get the latest full result of an invoice extracted from a file
+
+        Args:
+            file_hash: SHA-256 of the uploaded file
+
+        Returns:
+            Dict with invoice, analysis and recommendations, or None if the file was never processed
+        """
+        row = self.database.connection.execute(
+            """SELECT invoice, analysis, recommendations FROM invoice_results
+               WHERE json_extract(invoice, '$.file_hash') = ? ORDER BY created_at DESC LIMIT 1""", (file_hash,)
+        ).fetchone()
+        return self._to_result(row) if row else None
+
+    def save_batch(self, batch: Dict[str, Any]) -> None:
+        """
+        Store the record of an uploaded bundle and its invoices
+
+        Args:
+            batch: Dict with the batch id, its file and one entry per invoice
+        """
+        row = (batch['id'], _dumps(batch), time.time())
+
+        def write(conn):
+            conn.execute(
+                """INSERT INTO invoice_batches (batch_id, batch, created_at, updated_at) VALUES (?, ?, ?, ?3)
+                   ON CONFLICT (batch_id) DO UPDATE SET batch = excluded.batch, updated_at = excluded.updated_at""",
+                row
+            )
+        self.committer.submit(write)
+
+    def get_batch(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        """Get the record of an uploaded bundle"""
+        row = self.database.connection.execute(
+            'SELECT batch FROM invoice_batches WHERE batch_id = ?', (batch_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_ocr_text(self, invoice_id: str) -> Optional[str]:
+        """Get the OCR text an invoice was extracted from"""
+        row = self.database.connection.execute(
+            'SELECT ocr_text FROM invoice_results WHERE invoice_id = ?', (invoice_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def all(self) -> List[Dict[str, Any]]:
+        """Get all full results, oldest first"""
+        rows = self.database.connection.execute(
+            'SELECT invoice, analysis, recommendations FROM invoice_results ORDER BY created_at, invoice_id'
+        )
+        return [self._to_result(row) for row in rows]
+
+    def all_json(self) -> str:
+        """Get all full results as a JSON array, assembled by SQLite without decoding each row"""
+        row = self.database.connection.execute(
+            """SELECT json_group_array(json_object(
+                   'invoice', json(invoice), 'analysis', json(analysis), 'recommendations', json(recommendations)))
+               FROM (SELECT * FROM invoice_results ORDER BY created_at, invoice_id)"""
+        ).fetchone()
+        return row[0]
+
+    def invoices(self) -> List[Dict[str, Any]]:
+        """Get the invoice data of all results, oldest first"""
+        rows = self.database.connection.execute(
+            'SELECT invoice FROM invoice_results ORDER BY created_at, invoice_id'
+        )
+        return [json.loads(row[0]) for row in rows]
+
+    def summaries(self) -> List[InvoiceSummary]:
+        """Get the summaries of all invoices, oldest first, extracted by SQLite without decoding each invoice"""
+        columns = ', '.join(f"json_extract(invoice, '$.{name}')" for name in InvoiceSummary.__slots__)
+        rows = self.database.connection.execute(
+            f'SELECT {columns} FROM invoice_results ORDER BY created_at, invoice_id'
+        )
+        return [InvoiceSummary(*row) for row in rows]
+
+    def recover(self, data_dir: str, full_results_dir: Optional[str] = None) -> int:
+        """
+        Import results written as JSON files by earlier versions
+
+        Full result files are preferred; otherwise an invoice is rebuilt from its
+        invoice_/analysis_/recommendations_ files. Files that are truncated or
+        corrupt (a crash mid-write) are renamed with a .corrupt suffix and skipped.
+
+        Args:
+            data_dir: Directory with the per-artifact files
+            full_results_dir: Directory with the {invoice_id}.json full results
+
+        Returns:
+            Number of imported results
+        """
+        known = {row[0] for row in self.database.connection.execute('SELECT invoice_id FROM invoice_results')}
+        results = {}
+
+        if full_results_dir and os.path.isdir(full_results_dir):
+            for filename in sorted(os.listdir(full_results_dir)):
+                invoice_id, extension = os.path.splitext(filename)
+                if extension != '.json' or invoice_id in known:
+                    continue
+                result = _load_json(os.path.join(full_results_dir, filename))
+                if isinstance(result, dict) and isinstance(result.get('invoice'), dict):
+                    result['invoice'].setdefault('id', invoice_id)
+                    results[result['invoice']['id']] = result
+
+        if os.path.isdir(data_dir):
+            for filename in sorted(os.listdir(data_dir)):
+                if not (filename.startswith('invoice_') and filename.endswith('.json')):
+                    continue
+                invoice_id = filename[len('invoice_'):-len('.json')]
+                if invoice_id in known or invoice_id in results:
+                    continue
+                invoice = _load_json(os.path.join(data_dir, filename))
+                if not isinstance(invoice, dict):
+                    continue
+                invoice.setdefault('id', invoice_id)
+                result = {'invoice': invoice}
+                for name in ('analysis', 'recommendations'):
+                    path = os.path.join(data_dir, f"{name}_{invoice_id}.json")
+                    result[name] = _load_json(path) if os.path.exists(path) else None
+                results[invoice['id']] = result
+
+        if not results:
+            return 0
+        now = time.time()
+        imported = 0
+        with self.database.transaction() as conn:
+            for invoice_id, result in results.items():
+                # Skipped if another worker stored it since: only inserted rows count in the KPIs
+                cursor = conn.execute(
+                    """INSERT OR IGNORE INTO invoice_results
+                           (invoice_id, invoice, analysis, recommendations, ocr_text, created_at, updated_at)
+                       VALUES (?, ?, ?, ?, ?, ?, ?6)""",
+                    (invoice_id, *(_dumps(result.get(name)) for name in ARTIFACTS), result.get('ocr_text'), now)
+                )
+                if cursor.rowcount == 1:
+                    self.kpis.apply(conn, None, result)
+                    imported += 1
+        logger.info(f"Recovered {imported} invoice results from JSON files")
+        return imported
+
+    @staticmethod
+    def _to_result(row) -> Dict[str, Any]:
+        return {name: json.loads(row[name]) if row[name] is not None else None for name in ARTIFACTS}
@@ -0,0 +1,190 @@
+import re
+import logging
+from typing import Any, Dict, List, Optional
+
+from models.invoice import Invoice
+from services.consistency_checker import PEAK_SHARE_THRESHOLD
+from services.document_splitter import find_invoice_number
+from utils.invoice_utils import classify_issue, classify_item, summarize_items, to_float
+
+logger = logging.getLogger(__name__)
+
+# Amount as printed on invoices ("13 818,99", "449.67", "28 617")
+AMOUNT = r"-?\d{1,3}(?:[ \u00a0]\d{3})*(?:[,.]\d+)?|-?\d+(?:[,.]\d+)?"
+_AMOUNT = re.compile(rf"^(?:{AMOUNT})$")
+
+PROVIDER = re.compile(r"\b(LYDEC|ONEE|REDAL|AMENDIS|RADEEMA|RADEEJ|RADEEF|RADEE)\b", re.IGNORECASE)
+PERIOD = re.compile(r"du\s+(\d{2}/\d{2}/\d{4})\s+au\s+(\d{2}/\d{2}/\d{4})", re.IGNORECASE)
+ISSUE_DATE = re.compile(r"(?:date\s+de\s+l'?\s*[ée]dition|date\s+d'[ée]mission)\s*:?\s*(\d{2}/\d{2}/\d{4})", re.IGNORECASE)
+DUE_DATE = re.compile(r"(?:date\s+limite(?:\s+de\s+paiement)?|payer\s+avant\s+le)\s*:?\s*(\d{2}/\d{2}/\d{4})", re.IGNORECASE)
+TOTAL_KWH = re.compile(rf"total\s+consommation\s+kwh\s*:?\s*({AMOUNT})", re.IGNORECASE)
+TOTAL_AMOUNT = re.compile(
+    rf"(?:montant\s+ttc|total\s+g[ée]n[ée]ral|net\s+[àa]\s+payer|total\s+ttc)\s*:?\s*({AMOUNT})", re.IGNORECASE
+)
+# VAT line as read from any text layer, whatever the column spacing
+VAT_ANCHOR = re.compile(rf"\bTVA\s+\d+(?:[,.]\d+)?\s*%\s*(?:{AMOUNT})", re.IGNORECASE)
+TAX_LINE = re.compile(rf"^\s*TVA\s+(\d+(?:[,.]\d+)?)\s*%\s{{2,}}({AMOUNT})\s*$", re.IGNORECASE)
+
+# Catalogue action for each issue type (see the RECOMMEND prompt)
+ACTIONS = {
+    'power_factor': "Installer des batteries de condensateurs pour ramener le cos φ au-dessus de 0,93 "
+                    "(idéalement 0,95-0,98) et supprimer les pénalités sur l'énergie réactive.",
+    'power_overrun': "Étaler les démarrages des équipements, gérer les appels de charge ou installer un "
+                     "dispositif de lissage (peak shaving) pour éviter les dépassements de puissance.",
+    'oversized_subscribed_power': "Analyser l'historique de charge et ramener la puissance souscrite "
+                                  "légèrement au-dessus de la puissance maximale réellement appelée.",
+    'peak_concentration': "Transférer la consommation des équipements non critiques vers les heures creuses "
+                          "ou normales en programmant leur fonctionnement sur ces périodes.",
+}
+
+# History flags confirming an issue type when the rules found none
+HISTORY_ISSUES = {
+    'recurrent_power_overrun': 'power_overrun',
+    'oversized_subscribed_power': 'oversized_subscribed_power',
+    'peak_concentration': 'peak_concentration',
+}
+
+SEVERITY_PENALTY = {'high': 15, 'medium': 8, 'low': 3}
+
+def completeness(text: str) -> float:
+    """
+    Score how completely an OCR text covers an invoice
+
+    Four anchors are looked for: the invoice header with its number, the totals
+    (amount due or VAT lines), at least two billed item lines (consumption bands,
+    power, penalties) and the consumption (billing period or total kWh).
+
+    Args:
+        text: OCR text
+
+    Returns:
+        Share of the anchors found, from 0 to 1
+    """
+    text = text or ''
+    lines = text.splitlines()
+    anchors = (
+        find_invoice_number(text) is not None,
+        TOTAL_AMOUNT.search(text) is not None or VAT_ANCHOR.search(text) is not None,
+        sum(1 for line in lines if classify_item(line) != 'other' and re.search(r"\d", line)) >= 2,
+        TOTAL_KWH.search(text) is not None or PERIOD.search(text) is not None,
+    )
+    return sum(anchors) / len(anchors)
+
+def _split_columns(line: str) -> List[str]:
+    return [column for column in re.split(r"\s{2,}", line.strip()) if column]
+
+def extract_invoice(ocr_text: str) -> Invoice:
+    """
+    Extract an invoice from its OCR text with regular expressions, without the LLM
+
+    Reads the provider, invoice number, dates and billing period, the item table
+    (description, quantity, unit price and amount columns separated by runs of
+    spaces), the VAT lines and the printed totals. Fields computable from the
+    items are left to the consistency check.
+
+    Args:
+        ocr_text: Raw text extracted from the invoice
+
+    Returns:
+        The invoice, with the fields found
+    """
+    text = ocr_text or ''
+    data: Dict[str, Any] = {'items': [], 'taxes': {}}
+    if match := PROVIDER.search(text):
+        data['provider'] = match.group(1).upper()
+    data['invoice_number'] = find_invoice_number(text)
+    if match := PERIOD.search(text):
+        data['period_start'], data['period_end'] = match.groups()
+    if match := ISSUE_DATE.search(text):
+        data['issue_date'] = match.group(1)
+    if match := DUE_DATE.search(text):
+        data['due_date'] = match.group(1)
+    if match := TOTAL_KWH.search(text):
+        data['total_kwh'] = to_float(match.group(1))
+    if match := TOTAL_AMOUNT.search(text):
+        data['total_amount'] = to_float(match.group(1))
+
+    for line in text.splitlines():
+        if match := TAX_LINE.match(line):
+            data['taxes'][f"{match.group(1).replace(',', '.')}%"] = to_float(match.group(2))
+            continue
+        columns = _split_columns(line)
+        if len(columns) == 4 and all(_AMOUNT.match(column) for column in columns[1:]) and \
+                not _AMOUNT.match(columns[0]):
+            quantity, unit_price, total = (to_float(column) for column in columns[1:])
+            data['items'].append({'description': columns[0], 'quantity': quantity,
+                                  'unit_price': unit_price, 'total': total})
+    return Invoice.model_validate(data)
+
+def analyze(invoice: Dict[str, Any], consistency: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Find the catalogue issues of an invoice from its line items and consistency report
+
+    Args:
+        invoice: Invoice data, with the derived fields filled in
+        consistency: Its consistency report
+
+    Returns:
+        Analysis with issue objects (description and severity), as returned by the LLM
+    """
+    items = summarize_items(invoice.get('items'))
+    issues = []
+    overrun = items.get('power_overrun', {}).get('total')
+    if overrun:
+        issues.append({'description': f"Pénalités de dépassement : la puissance appelée a dépassé la puissance "
+                                      f"souscrite ({overrun:.2f} facturés).", 'severity': 'high'})
+    reactive = items.get('reactive', {}).get('total')
+    if reactive:
+        issues.append({'description': f"Pénalités sur la puissance réactive : facteur de puissance (cos φ) "
+                                      f"inférieur à 0,93 ({reactive:.2f} facturés).", 'severity': 'high'})
+    peak, total = to_float(invoice.get('peak_kwh')), to_float(invoice.get('total_kwh'))
+    if peak and total and peak / total >= PEAK_SHARE_THRESHOLD:
+        issues.append({'description': f"Consommation concentrée durant les heures pleines (HP) : "
+                                      f"{100 * peak / total:.0f} % de la consommation.", 'severity': 'medium'})
+    if consistency and not consistency['consistent']:
+        fields = sorted(field for field, flag in consistency['flags'].items() if flag == 'mismatch')
+        issues.append({'description': f"Montants à vérifier : {', '.join(fields)} ne correspondent pas "
+                                      f"aux lignes de la facture.", 'severity': 'low'})
+    return {'issues': issues}
+
+def recommend(analysis: Dict[str, Any], simulation: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Recommend the catalogue actions of the issues of an analysis
+
+    History flags add the issues the invoice alone does not show, and the
+    simulation, when available, gives the optimal subscribed power and load shift.
+
+    Args:
+        analysis: Analysis with issues and, optionally, history findings
+        simulation: Tariff simulation of the invoice (see TariffSimulator.simulate)
+
+    Returns:
+        Recommendations, potential_savings (from the simulation, else None) and an
+        efficiency_score lowered by each issue according to its severity
+    """
+    issues = [issue for issue in analysis.get('issues') or [] if isinstance(issue, dict)]
+    issue_types = [classify_issue(issue.get('description')) for issue in issues]
+    for flag in (analysis.get('history') or {}).get('flags') or []:
+        if flag in HISTORY_ISSUES:
+            issue_types.append(HISTORY_ISSUES[flag])
+
+    recommendations = [ACTIONS[issue_type] for issue_type in dict.fromkeys(issue_types) if issue_type in ACTIONS]
+    if simulation:
+        current, optimum = simulation['current'], simulation['optimum']
+        if optimum['subscribed_power'] is not None and optimum['subscribed_power'] != current['subscribed_power']:
+            recommendations.append(f"Ajuster la puissance souscrite de {current['subscribed_power']:g} à "
+                                   f"{optimum['subscribed_power']:g} (économie simulée de "
+                                   f"{simulation['savings_breakdown']['subscribed_power']:.2f} par période).")
+        if optimum['load_shift']:
+            recommendations.append(f"Reporter {100 * optimum['load_shift']:.0f} % de la consommation des heures "
+                                   f"pleines vers les heures creuses (économie simulée de "
+                                   f"{simulation['savings_breakdown']['load_shift']:.2f} par période).")
+    if not recommendations:
+        recommendations.append("Aucun problème détecté : poursuivre le suivi mensuel de la consommation.")
+
+    score = 100 - sum(SEVERITY_PENALTY.get(str(issue.get('severity')).lower(), 0) for issue in issues)
+    return {
+        'recommendations': recommendations,
+        'potential_savings': simulation['potential_savings'] if simulation else None,
+        'efficiency_score': simulation['efficiency_score'] if simulation else float(max(score, 0)),
+    }
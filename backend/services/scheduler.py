@@ -0,0 +1,259 @@
+import time
+import logging
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional
+
+from utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Priority classes, served in this order
+PRIORITIES = ('interactive', 'bulk')
+
+# Credit given to a customer each time the round robin visits it (job costs are in the same unit)
+QUANTUM = 1.0
+MAX_COST = 20.0
+
+WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+QUEUE_WAIT = registry.histogram(
+    'aienergy_queue_wait_seconds', 'Time invoices wait in the processing queue', ['priority'], WAIT_BUCKETS)
+QUEUE_DEPTH = registry.gauge('aienergy_queue_depth', 'Invoices waiting in the processing queue', ['priority'])
+QUEUE_REJECTED = registry.counter(
+    'aienergy_queue_rejected_total', 'Uploads refused by admission control', ['priority'])
+
+class SchedulerFull(Exception):
+    """Job refused by admission control"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class TokenBucket:
+    """Rate budget refilled continuously (a rate of 0 means unlimited)"""
+
+    def __init__(self, rate_per_minute: float, burst: Optional[float] = None):
+        """
+        Initialize the bucket
+
+        Args:
+            rate_per_minute: Tokens added per minute
+            burst: Maximum tokens held (defaults to one minute of budget)
+        """
+        self.rate = rate_per_minute / 60.0
+        self.capacity = burst if burst is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float) -> float:
+        """Seconds until the amount is available (0 if it is now)"""
+        if not self.rate:
+            return 0.0
+        self._refill()
+        # Jobs larger than the bucket only need it full
+        missing = min(amount, self.capacity) - self.tokens
+        return max(missing, 0.0) / self.rate
+
+    def take(self, amount: float) -> None:
+        """Consume tokens (the balance may go negative for jobs larger than the bucket)"""
+        if self.rate:
+            self._refill()
+            self.tokens -= amount
+
+class _Job:
+    __slots__ = ('tenant', 'priority', 'cost', 'args', 'kwargs', 'future', 'enqueued')
+
+    def __init__(self, tenant: str, priority: str, cost: float, args: tuple, kwargs: dict):
+        self.tenant = tenant
+        self.priority = priority
+        self.cost = cost
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.enqueued = time.monotonic()
+
+class ProcessingScheduler:
+    """
+    Queue in front of invoice processing
+
+    Interactive jobs are served before bulk ones, and some workers are kept for
+    them so a bulk backlog never delays an interactive upload by more than one
+    job. Within a class customers share the workers through deficit round robin,
+    so a customer queuing hundreds of invoices only gets its turn like the others.
+    Jobs start only when the OCR and LLM rate budgets allow, and submissions are
+    refused when the budgets could not drain the queue within the maximum wait.
+    """
+
+    def __init__(self, process: Callable[..., Any], concurrency: int = 4, reserved_interactive: int = 1,
+                 ocr_per_minute: float = 0, llm_tokens_per_minute: float = 0, llm_tokens_per_job: float = 8000,
+                 max_wait: Optional[Dict[str, float]] = None, max_queue: int = 10000):
+        """
+        Initialize the scheduler
+
+        Args:
+            process: Function processing one job (InvoiceProcessor.process_invoice)
+            concurrency: Number of worker threads
+            reserved_interactive: Workers bulk jobs may not use
+            ocr_per_minute: OCR calls allowed per minute (0 for unlimited)
+            llm_tokens_per_minute: LLM tokens allowed per minute (0 for unlimited)
+            llm_tokens_per_job: Estimated LLM tokens used by one invoice
+            max_wait: Longest estimated queue wait accepted per priority, in seconds
+            max_queue: Maximum number of queued jobs per priority
+        """
+        self.process = process
+        self.concurrency = max(1, concurrency)
+        self.bulk_slots = max(1, self.concurrency - reserved_interactive)
+        self.ocr_budget = TokenBucket(ocr_per_minute)
+        self.llm_budget = TokenBucket(llm_tokens_per_minute)
+        self.llm_tokens_per_job = llm_tokens_per_job
+        self.max_wait = dict({'interactive': 300.0, 'bulk': 86400.0}, **(max_wait or {}))
+        self.max_queue = max_queue
+
+        self._queues: Dict[str, 'OrderedDict[str, deque[_Job]]'] = {p: OrderedDict() for p in PRIORITIES}
+        self._deficits: Dict[str, Dict[str, float]] = {p: {} for p in PRIORITIES}
+        self._queued = {p: 0 for p in PRIORITIES}
+        self._running = {p: 0 for p in PRIORITIES}
+        self._condition = threading.Condition()
+        self._workers: List[threading.Thread] = []
+        self._closed = False
+
+    def submit(self, tenant: str, priority: str, *args, cost: float = 1.0, **kwargs) -> Future:
+        """
+        Queue a job
+
+        Args:
+            tenant: Customer the job belongs to
+            priority: 'interactive' or 'bulk'
+            args: Positional arguments of the processing function
+            cost: Relative size of the job (e.g. in MB), for the fair share
+            kwargs: Keyword arguments of the processing function
+
+        Returns:
+            Future of the processing result
+
+        Raises:
+            ValueError: If the priority is unknown
+            SchedulerFull: If the job would wait longer than the class allows
+        """
+        if priority not in PRIORITIES:
+            raise ValueError(f"priority must be one of {', '.join(PRIORITIES)}")
+        with self._condition:
+            wait = self.estimated_wait(priority)
+            if self._queued[priority] >= self.max_queue or wait > self.max_wait[priority]:
+                QUEUE_REJECTED.inc(priority=priority)
+                raise SchedulerFull(f"The {priority} processing queue is full", retry_after=max(wait, 1.0))
+            job = _Job(str(tenant or ''), priority, min(max(cost, 0.0), MAX_COST), args, kwargs)
+            self._queues[priority].setdefault(job.tenant, deque()).append(job)
+            self._deficits[priority].setdefault(job.tenant, 0.0)
+            self._queued[priority] += 1
+            QUEUE_DEPTH.set(self._queued[priority], priority=priority)
+            self._ensure_started()
+            self._condition.notify()
+        return job.future
+
+    def run(self, tenant: str, priority: str, *args, cost: float = 1.0, **kwargs) -> Any:
+        """Queue a job and wait for its result (see submit)"""
+        return self.submit(tenant, priority, *args, cost=cost, **kwargs).result()
+
+    def estimated_wait(self, priority: str) -> float:
+        """
+        Estimate how long a new job would wait for the rate budgets
+
+        Args:
+            priority: Priority of the job
+
+        Returns:
+            Seconds (0 when the budgets are unlimited)
+        """
+        ahead = self._queued['interactive'] + (self._queued['bulk'] if priority == 'bulk' else 0)
+        rates = [bucket.rate for bucket in (self.ocr_budget,) if bucket.rate]
+        if self.llm_budget.rate:
+            rates.append(self.llm_budget.rate / self.llm_tokens_per_job)
+        return ahead / min(rates) if rates else 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        """Queued and running jobs per priority"""
+        with self._condition:
+            return {p: {'queued': self._queued[p], 'running': self._running[p],
+                        'customers': len(self._queues[p])} for p in PRIORITIES}
+
+    def close(self) -> None:
+        """Stop the workers once the queued jobs are done"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for worker in self._workers:
+            worker.join()
+
+    def _ensure_started(self) -> None:
+        if not self._workers:
+            for index in range(self.concurrency):
+                worker = threading.Thread(target=self._work, name=f'invoice-worker-{index}', daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def _next_job(self) -> Optional[_Job]:
+        """Pop the next job: first class with capacity, deficit round robin between its customers"""
+        for priority in PRIORITIES:
+            queues = self._queues[priority]
+            if not queues or (priority == 'bulk' and self._running['bulk'] >= self.bulk_slots):
+                continue
+            deficits = self._deficits[priority]
+            while True:
+                tenant, jobs = next(iter(queues.items()))
+                job = jobs[0]
+                if deficits[tenant] < job.cost:
+                    deficits[tenant] += QUANTUM
+                    queues.move_to_end(tenant)
+                    continue
+                jobs.popleft()
+                deficits[tenant] -= job.cost
+                if not jobs:
+                    # An idle customer does not keep credit
+                    del queues[tenant], deficits[tenant]
+                self._queued[priority] -= 1
+                QUEUE_DEPTH.set(self._queued[priority], priority=priority)
+                return job
+        return None
+
+    def _take(self) -> Optional[_Job]:
+        """Wait for a job allowed to start by the rate budgets (None once closed and drained)"""
+        with self._condition:
+            while True:
+                if not any(self._queued.values()):
+                    if self._closed:
+                        return None
+                    self._condition.wait()
+                    continue
+                delay = max(self.ocr_budget.delay(1), self.llm_budget.delay(self.llm_tokens_per_job))
+                job = self._next_job() if not delay else None
+                if job:
+                    self.ocr_budget.take(1)
+                    self.llm_budget.take(self.llm_tokens_per_job)
+                    self._running[job.priority] += 1
+                    return job
+                # Woken when a job finishes (freeing a bulk slot) or is queued
+                self._condition.wait(delay or None)
+
+    def _work(self) -> None:
+        while True:
+            job = self._take()
+            if job is None:
+                return
+            QUEUE_WAIT.observe(time.monotonic() - job.enqueued, priority=job.priority)
+            try:
+                if job.future.set_running_or_notify_cancel():
+                    job.future.set_result(self.process(*job.args, **job.kwargs))
+            except BaseException as e:
+                job.future.set_exception(e)
+            finally:
+                with self._condition:
+                    self._running[job.priority] -= 1
+                    self._condition.notify_all()
@@ -0,0 +1,269 @@
+import re
+import logging
+from typing import Any, Dict, List, Optional
+
+from utils.database import Database
+from utils.invoice_utils import ISSUE_PATTERNS, normalize_issues
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS search_documents (
+    doc_id INTEGER PRIMARY KEY,
+    invoice_id TEXT NOT NULL UNIQUE,
+    provider TEXT NOT NULL DEFAULT '',
+    issue_types INTEGER NOT NULL DEFAULT 0,
+    severities INTEGER NOT NULL DEFAULT 0
+);
+-- Covering index: facet counts are computed by grouping on it, without a sort
+CREATE INDEX IF NOT EXISTS idx_search_documents_facets ON search_documents (provider, issue_types, severities);
+CREATE VIRTUAL TABLE IF NOT EXISTS invoice_search USING fts5(
+    invoice_number,
+    provider,
+    customer,
+    items,
+    issues,
+    ocr_text,
+    tokenize = "unicode61 remove_diacritics 2",
+    prefix = '2 3 4'
+);
+"""
+
+FACETS = ('provider', 'issue_type', 'severity')
+SEARCH_FIELDS = ('invoice_number', 'provider', 'customer', 'items', 'issues', 'ocr_text')
+
+# Multi-valued facets are stored as bit masks on the document row
+ISSUE_TYPES = tuple(issue_type for issue_type, _ in ISSUE_PATTERNS) + ('other',)
+SEVERITIES = ('high', 'medium', 'low')
+MASK_FACETS = {
+    'issue_type': ('issue_types', ISSUE_TYPES),
+    'severity': ('severities', SEVERITIES),
+}
+
+# Above this many matches results are ordered by recency instead of BM25 rank,
+# since ranking has to score every matching document
+RANK_LIMIT = 5000
+
+# Quoted phrases or bare terms, a trailing * marking a prefix query
+_TOKEN_RE = re.compile(r'"([^"]*)"(\*?)|(\S+)')
+
+def build_match_query(query: str, field: Optional[str] = None) -> str:
+    """
+    Translate a user query into an FTS5 MATCH expression
+
+    Terms are ANDed, "quoted text" is a phrase and a trailing * makes a prefix
+    query. Every term is quoted so FTS5 operators in user input are inert.
+
+    Args:
+        query: User query (e.g. '"DEPASS. DE PUISSANCE" 2018*')
+        field: Optional column to restrict the search to
+
+    Returns:
+        The MATCH expression, or '' if the query has no terms
+    """
+    terms = []
+    for phrase, phrase_prefix, word in _TOKEN_RE.findall(query or ''):
+        text = phrase if phrase else word
+        prefix = phrase_prefix if phrase else ''
+        if not phrase and text.endswith('*'):
+            text, prefix = text.rstrip('*'), '*'
+        if not text.strip():
+            continue
+        terms.append('"' + text.replace('"', '""') + '"' + prefix)
+    if not terms:
+        return ''
+    expression = ' '.join(terms)
+    if field:
+        expression = f'{field} : ({expression})'
+    return expression
+
+def _mask(values: List[str], names: tuple) -> int:
+    return sum(1 << names.index(value) for value in set(values) if value in names)
+
+class SearchIndex:
+    """Full-text and faceted search over processed invoices, backed by SQLite FTS5"""
+
+    def __init__(self, database: Database):
+        """
+        Initialize the index, creating its tables if needed
+
+        Args:
+            database: Application database
+        """
+        self.database = database
+        self.database.executescript(SCHEMA)
+
+    def count(self) -> int:
+        """Get the number of indexed invoices"""
+        return self.database.connection.execute('SELECT COUNT(*) FROM search_documents').fetchone()[0]
+
+    def index_invoice(self, invoice: Dict[str, Any], analysis: Optional[Dict[str, Any]] = None,
+                      ocr_text: Optional[str] = None) -> None:
+        """
+        Add or replace an invoice in the index
+
+        Args:
+            invoice: Extracted invoice data (must contain its id)
+            analysis: Analysis with the identified issues
+            ocr_text: Raw OCR text of the invoice
+        """
+        with self.database.transaction() as conn:
+            self._index(conn, invoice, analysis, ocr_text)
+
+    def index_many(self, results: List[Dict[str, Any]]) -> None:
+        """
+        Index several full results ({"invoice", "analysis", ...}) in one transaction
+
+        Args:
+            results: Full invoice results
+        """
+        with self.database.transaction() as conn:
+            for result in results:
+                if result.get('invoice'):
+                    self._index(conn, result['invoice'], result.get('analysis'), result.get('ocr_text'))
+        logger.info(f"Indexed {len(results)} invoices for search")
+
+    def remove_invoice(self, invoice_id: str) -> None:
+        """Remove an invoice from the index"""
+        with self.database.transaction() as conn:
+            doc_id = self._delete(conn, invoice_id)
+            if doc_id is not None:
+                conn.execute('DELETE FROM search_documents WHERE doc_id = ?', (doc_id,))
+
+    def search(self, query: str = '', filters: Optional[Dict[str, str]] = None, field: Optional[str] = None,
+               limit: int = 20, offset: int = 0) -> Dict[str, Any]:
+        """
+        Search invoices
+
+        Args:
+            query: Terms, "phrases" and prefix* terms (see build_match_query)
+            filters: Facet values to restrict to (provider, issue_type, severity)
+            field: Optional field to search in (see SEARCH_FIELDS)
+            limit: Maximum number of results
+            offset: Number of results to skip
+
+        Returns:
+            Dict with the total number of matches, the requested page of results
+            (with a highlighted snippet) and the facet counts over all matches
+        """
+        if field and field not in SEARCH_FIELDS:
+            raise ValueError(f"Unsupported search field: {field}")
+
+        match = build_match_query(query, field)
+        conditions, params = [], []
+        for facet, value in (filters or {}).items():
+            if not value:
+                continue
+            if facet == 'provider':
+                conditions.append('d.provider = ?')
+                params.append(value)
+            elif facet in MASK_FACETS:
+                column, names = MASK_FACETS[facet]
+                if value not in names:
+                    return {'total': 0, 'results': [], 'facets': {f: {} for f in FACETS}}
+                conditions.append(f'(d.{column} & ?) != 0')
+                params.append(1 << names.index(value))
+
+        if match:
+            conditions.insert(0, 'd.doc_id IN (SELECT rowid FROM invoice_search WHERE invoice_search MATCH ?)')
+            params.insert(0, match)
+        where_sql = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+
+        # Facet counts: one row per distinct facet combination, bit masks expanded here
+        conn = self.database.connection
+        facet_rows = conn.execute(
+            'SELECT d.provider, d.issue_types, d.severities, COUNT(*) FROM search_documents d '
+            f'{where_sql} GROUP BY d.provider, d.issue_types, d.severities',
+            params
+        ).fetchall()
+
+        total = 0
+        facets = {facet: {} for facet in FACETS}
+        for provider, issue_types, severities, count in facet_rows:
+            total += count
+            if provider:
+                facets['provider'][provider] = facets['provider'].get(provider, 0) + count
+            for facet, mask in (('issue_type', issue_types), ('severity', severities)):
+                for i, name in enumerate(MASK_FACETS[facet][1]):
+                    if mask >> i & 1:
+                        facets[facet][name] = facets[facet].get(name, 0) + count
+        for facet in FACETS:
+            facets[facet] = dict(sorted(facets[facet].items(), key=lambda kv: -kv[1]))
+
+        if match:
+            # FTS drives the join, so recency ordering can stop after the first page
+            order = 'invoice_search.rank' if total <= RANK_LIMIT else 'invoice_search.rowid DESC'
+            rows = conn.execute(
+                'SELECT d.doc_id, d.invoice_id FROM invoice_search '
+                'JOIN search_documents d ON d.doc_id = invoice_search.rowid '
+                'WHERE invoice_search MATCH ?' + ''.join(f' AND {c}' for c in conditions[1:]) +
+                f' ORDER BY {order} LIMIT ? OFFSET ?',
+                params + [limit, offset]
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                f'SELECT d.doc_id, d.invoice_id FROM search_documents d {where_sql} '
+                'ORDER BY d.doc_id DESC LIMIT ? OFFSET ?',
+                params + [limit, offset]
+            ).fetchall()
+
+        results = []
+        for doc_id, invoice_id in rows:
+            snippet = "snippet(invoice_search, -1, '[', ']', '…', 12)" if match else "''"
+            document = conn.execute(
+                f'SELECT invoice_number, provider, customer, {snippet} AS snippet FROM invoice_search '
+                'WHERE rowid = ?' + (' AND invoice_search MATCH ?' if match else ''),
+                [doc_id] + ([match] if match else [])
+            ).fetchone()
+            results.append({
+                'invoice_id': invoice_id,
+                'invoice_number': document['invoice_number'] or None,
+                'provider': document['provider'] or None,
+                'customer': document['customer'] or None,
+                'snippet': document['snippet'] or None,
+            })
+        return {'total': total, 'results': results, 'facets': facets}
+
+    def _index(self, conn, invoice: Dict[str, Any], analysis: Optional[Dict[str, Any]],
+               ocr_text: Optional[str]) -> None:
+        invoice_id = str(invoice.get('id'))
+        provider = str(invoice.get('provider') or '')
+        issues = normalize_issues(analysis)
+        items = '\n'.join(
+            str(item.get('description') or '') for item in invoice.get('items') or [] if isinstance(item, dict)
+        )
+        issue_types = _mask([issue['type'] for issue in issues], ISSUE_TYPES)
+        severities = _mask([issue['severity'] for issue in issues], SEVERITIES)
+
+        doc_id = self._delete(conn, invoice_id)
+        if doc_id is None:
+            doc_id = conn.execute(
+                'INSERT INTO search_documents (invoice_id, provider, issue_types, severities) VALUES (?, ?, ?, ?)',
+                (invoice_id, provider, issue_types, severities)
+            ).lastrowid
+        else:
+            conn.execute(
+                'UPDATE search_documents SET provider = ?, issue_types = ?, severities = ? WHERE doc_id = ?',
+                (provider, issue_types, severities, doc_id)
+            )
+        conn.execute(
+            'INSERT INTO invoice_search (rowid, invoice_number, provider, customer, items, issues, ocr_text) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (
+                doc_id,
+                str(invoice.get('invoice_number') or ''),
+                provider,
+                ' '.join(str(v) for v in (invoice.get('customer_id'), invoice.get('customer_name')) if v),
+                items,
+                '\n'.join(issue['description'] or '' for issue in issues),
+                ocr_text or '',
+            )
+        )
+
+    def _delete(self, conn, invoice_id: str) -> Optional[int]:
+        """Delete the full-text content of an invoice, returning its document ID if it was indexed"""
+        row = conn.execute('SELECT doc_id FROM search_documents WHERE invoice_id = ?', (invoice_id,)).fetchone()
+        if row is None:
+            return None
+        conn.execute('DELETE FROM invoice_search WHERE rowid = ?', (row['doc_id'],))
+        return row['doc_id']
@@ -0,0 +1,172 @@
+import logging
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+from services.history_analyzer import METRICS, invoice_metrics
+from utils.invoice_utils import summarize_items
+
+logger = logging.getLogger(__name__)
+
+# Subscribed power candidates are searched in steps of this many kW (kVA on most invoices)
+POWER_STEP = 1.0
+
+# Candidates go up to this multiple of the highest power drawn over the history
+POWER_HEADROOM = 1.2
+
+# Share of the peak-hour kWh moved to off-peak hours, in steps of LOAD_SHIFT_STEP
+LOAD_SHIFT_STEP = 0.01
+
+# Number of points kept in each savings curve
+CURVE_POINTS = 20
+
+_IDX = {name: i for i, name in enumerate(METRICS)}
+
+def _price(entry: Optional[Dict[str, float]]) -> Optional[float]:
+    """Unit price of a line item category (total over quantity when the unit price is missing)"""
+    if not entry:
+        return None
+    if entry.get('unit_price'):
+        return entry['unit_price']
+    return entry['total'] / entry['quantity'] if entry.get('quantity') else None
+
+def tariff_prices(invoice: Dict[str, Any]) -> Dict[str, Optional[float]]:
+    """
+    Get the unit prices the simulation applies, from the line items of an invoice
+
+    Args:
+        invoice: Extracted invoice data
+
+    Returns:
+        Prices of the subscribed power, of power overruns (None when not billed) and of
+        peak and off-peak kWh (normal hours when no off-peak line)
+    """
+    items = summarize_items(invoice.get('items'))
+    return {
+        'power': _price(items.get('subscribed_power')),
+        'overrun': _price(items.get('power_overrun')),
+        'peak': _price(items.get('peak')),
+        'off_peak': _price(items.get('off_peak')) or _price(items.get('normal')),
+    }
+
+def _curve(grid: np.ndarray, savings: np.ndarray) -> list:
+    """Savings curve reduced to at most CURVE_POINTS [x, saving] pairs"""
+    keep = np.unique(np.linspace(0, len(grid) - 1, min(len(grid), CURVE_POINTS)).round().astype(int))
+    return [[round(float(grid[i]), 4), round(float(savings[i]), 2)] for i in keep]
+
+class TariffSimulator:
+    """
+    What-if simulation of the subscribed power and of peak to off-peak load shifts
+
+    The cost of every (subscribed power, load shift) pair over a customer's billed
+    periods is computed in one NumPy broadcast: subscribed power is billed on every
+    period, power drawn above it is billed as an overrun, and shifted kWh are billed
+    at the off-peak price. Without an overrun price on the invoice, only subscribed
+    powers covering the highest power drawn are considered. Power drawn in a period is the highest power recorded
+    (max_power_kw) or the subscribed power plus the billed overrun; periods with
+    neither are assumed to have drawn their whole subscribed power.
+    """
+
+    def __init__(self, max_load_shift: float = 0.2):
+        """
+        Initialize the simulator
+
+        Args:
+            max_load_shift: Largest share of the peak-hour kWh considered movable to off-peak hours
+        """
+        self.max_load_shift = max_load_shift
+
+    def simulate(self, invoice: Dict[str, Any], history: Optional[np.ndarray] = None) -> Optional[Dict[str, Any]]:
+        """
+        Find the subscribed power and load shift minimizing the bill over the history
+
+        Args:
+            invoice: Extracted invoice data, whose prices are applied to every period
+            history: Metrics of the customer's previous periods, one row per period
+                ordered as history_analyzer.METRICS
+
+        Returns:
+            Current and optimal settings with their mean cost per period, potential_savings
+            (per period), its breakdown, efficiency_score (optimal over current cost, 0-100)
+            and the savings curves; None if the invoice has neither power nor peak prices
+        """
+        prices = tariff_prices(invoice)
+        periods = invoice_metrics(invoice)[None, :]
+        if history is not None and len(history):
+            periods = np.vstack([np.asarray(history, dtype=np.float64), periods])
+
+        subscribed = periods[:, _IDX['subscribed_power']]
+        overrun = np.nan_to_num(periods[:, _IDX['power_overrun']])
+        max_power = periods[:, _IDX['max_power']]
+        drawn = np.where(overrun > 0, np.fmax(max_power, subscribed + overrun),
+                         np.where(np.isfinite(max_power), max_power, subscribed))
+        power_known = np.isfinite(subscribed) & np.isfinite(drawn)
+        # A power line without its quantity gives no subscribed power to simulate from
+        has_power = prices['power'] is not None and np.isfinite(subscribed[-1]) and subscribed[-1] > 0
+        powers = np.zeros(1)
+        if has_power:
+            # Grid from high to low, so that among equal costs argmin keeps the largest power (fewest overruns)
+            top = max(np.max(drawn[power_known]), subscribed[-1]) * POWER_HEADROOM
+            grid = np.arange(np.ceil(top / POWER_STEP) * POWER_STEP, 0, -POWER_STEP)
+            if prices['overrun'] is None:
+                grid = grid[grid >= np.max(drawn[power_known]) - 1e-9]
+            has_power = len(grid) > 0
+            if has_power:
+                powers = grid
+                overrun_price = prices['overrun'] or prices['power']
+
+        peak_kwh = np.nan_to_num(periods[:, _IDX['total_kwh']] * periods[:, _IDX['peak_share']])
+        has_shift = prices['peak'] is not None and prices['off_peak'] is not None and \
+            prices['peak'] > prices['off_peak'] and peak_kwh.any()
+        if not has_power and not has_shift:
+            return None
+
+        # Shifts from low to high, so that among equal costs argmin keeps the smallest
+        shifts = np.arange(0.0, self.max_load_shift + LOAD_SHIFT_STEP / 2, LOAD_SHIFT_STEP) if has_shift else np.zeros(1)
+
+        # Cost of every (power, shift, period) triple, summed over the periods
+        if has_power:
+            demand = np.where(power_known, drawn, 0.0)
+            power_cost = powers[:, None, None] * prices['power'] + \
+                np.maximum(demand - powers[:, None, None], 0.0) * overrun_price
+            power_cost = np.where(power_known, power_cost, 0.0)
+            current_power = np.where(power_known, subscribed * prices['power'] + overrun * overrun_price, 0.0).sum()
+        else:
+            power_cost = np.zeros((1, 1, len(periods)))
+            current_power = 0.0
+        if has_shift:
+            shift_cost = peak_kwh * (prices['peak'] - shifts[None, :, None] * (prices['peak'] - prices['off_peak']))
+        else:
+            shift_cost = np.zeros((1, 1, len(periods)))
+        total = (power_cost + shift_cost).sum(axis=2)
+
+        best_power, best_shift = np.unravel_index(np.argmin(total), total.shape)
+        current = current_power + peak_kwh.sum() * (prices['peak'] or 0.0)
+        best = float(total[best_power, best_shift])
+        count = len(periods)
+
+        # Periods billed with different subscribed powers can cost less than any single
+        # power: the current contract is then kept
+        best = min(best, current)
+        return {
+            'periods': count,
+            'current': {
+                'subscribed_power': float(subscribed[-1]) if has_power else None,
+                'cost': round(current / count, 2),
+            },
+            'optimum': {
+                'subscribed_power': float(powers[best_power]) if has_power else None,
+                'load_shift': round(float(shifts[best_shift]), 4),
+                'cost': round(best / count, 2),
+            },
+            'potential_savings': round((current - best) / count, 2),
+            'savings_breakdown': {
+                'subscribed_power': round(max(current_power - float(power_cost[best_power, 0].sum()), 0.0) / count, 2),
+                'load_shift': round(float(total[best_power, 0] - total[best_power, best_shift]) / count, 2),
+            },
+            'efficiency_score': round(100 * best / current, 1) if current > 0 else 100.0,
+            'curves': {
+                'subscribed_power': _curve(powers[::-1], (current - total[::-1, 0]) / count) if has_power else [],
+                'load_shift': _curve(shifts, (current - total[best_power, :]) / count) if has_shift else [],
+            },
+        }
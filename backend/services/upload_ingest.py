@@ -0,0 +1,235 @@
+import os
+import uuid
+import hashlib
+import logging
+import threading
+from typing import Any, BinaryIO, Dict, Optional
+
+import PyPDF2
+from PIL import Image
+from werkzeug.utils import secure_filename
+
+from services.blob_store import BlobStore
+from utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Uploads are copied in chunks of this size, so memory per upload stays constant
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Leading bytes of the accepted file types ('%PDF-' may follow a little leading junk)
+MAGIC_NUMBERS = (
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpg'),
+)
+PDF_MAGIC = b'%PDF-'
+PDF_MAGIC_WINDOW = 1024
+
+# Magika labels matching each detected type
+MAGIKA_LABELS = {'pdf': 'pdf', 'jpg': 'jpeg', 'png': 'png'}
+
+MAX_PDF_PAGES = 50
+MAX_IMAGE_PIXELS = 50_000_000
+
+UPLOADS_REJECTED = registry.counter('aienergy_uploads_rejected_total', 'Uploads rejected at ingest', ['reason'])
+
+class UploadError(ValueError):
+    """Upload rejected before processing"""
+
+    def __init__(self, message: str, status_code: int = 400, reason: str = 'invalid'):
+        super().__init__(message)
+        self.status_code = status_code
+        self.reason = reason
+
+def sniff_file_type(head: bytes) -> Optional[str]:
+    """
+    Detect the file type from its first bytes
+
+    Args:
+        head: First bytes of the file (at least PDF_MAGIC_WINDOW when available)
+
+    Returns:
+        'pdf', 'jpg' or 'png', or None if the type is not supported
+    """
+    for magic, file_type in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return file_type
+    if PDF_MAGIC in head[:PDF_MAGIC_WINDOW]:
+        return 'pdf'
+    return None
+
+def validate_pdf(path: str) -> int:
+    """
+    Check that a PDF can be parsed and has pages
+
+    Args:
+        path: Path to the PDF
+
+    Returns:
+        Number of pages
+    """
+    try:
+        reader = PyPDF2.PdfReader(path, strict=False)
+        if reader.is_encrypted and not reader.decrypt(''):
+            raise UploadError("Encrypted PDFs are not supported", reason='encrypted')
+        pages = len(reader.pages)
+    except UploadError:
+        raise
+    except Exception as e:
+        raise UploadError(f"Corrupt PDF: {str(e)}", reason='corrupt')
+    if pages == 0:
+        raise UploadError("PDF has no pages", reason='corrupt')
+    if pages > MAX_PDF_PAGES:
+        raise UploadError(f"PDF has {pages} pages (at most {MAX_PDF_PAGES} are accepted)", 413, 'too_many_pages')
+    return pages
+
+def validate_image(path: str, file_type: str) -> None:
+    """
+    Check that an image is intact without decoding it at full size
+
+    Args:
+        path: Path to the image
+        file_type: Type detected from the magic bytes ('jpg' or 'png')
+    """
+    try:
+        with Image.open(path) as image:
+            width, height = image.size
+            if width * height > MAX_IMAGE_PIXELS:
+                raise UploadError(f"Image is too large ({width}x{height})", 413, 'too_large')
+            # Checks the structure (and the PNG checksums) without decoding pixels
+            image.verify()
+        if file_type == 'jpg':
+            # Decoding at 1/8 scale catches truncated JPEGs for a fraction of the memory
+            with Image.open(path) as image:
+                image.draft('RGB', (max(1, width // 8), max(1, height // 8)))
+                image.load()
+    except UploadError:
+        raise
+    except Exception as e:
+        raise UploadError(f"Corrupt image: {str(e)}", reason='corrupt')
+
+_magika = None
+_magika_lock = threading.Lock()
+
+def _get_magika():
+    """Get the shared Magika model, or None if magika is not installed"""
+    global _magika
+    if _magika is None:
+        with _magika_lock:
+            if _magika is None:
+                try:
+                    from magika import Magika
+                    _magika = Magika()
+                except Exception as e:
+                    logger.warning(f"Magika unavailable, relying on magic bytes only: {str(e)}")
+                    _magika = False
+    return _magika or None
+
+class UploadIngestor:
+    """Streams uploads to disk while hashing them, and rejects unsupported or corrupt files"""
+
+    def __init__(self, upload_dir: str, max_bytes: Optional[int] = None, chunk_size: int = UPLOAD_CHUNK_SIZE,
+                 use_magika: Optional[bool] = None, blob_store: Optional[BlobStore] = None):
+        """
+        Initialize the ingestor
+
+        Args:
+            upload_dir: Directory uploads are spooled to (and stored in, without a blob store)
+            max_bytes: Maximum upload size (None for no limit)
+            chunk_size: Size of the chunks read from the request stream
+            use_magika: Confirm the detected type with magika (defaults to UPLOAD_MAGIKA, on)
+            blob_store: Content-addressed store accepted uploads are moved to
+        """
+        self.upload_dir = upload_dir
+        self.blob_store = blob_store
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        if use_magika is None:
+            use_magika = os.environ.get('UPLOAD_MAGIKA', '1') != '0'
+        self.use_magika = use_magika
+        os.makedirs(upload_dir, exist_ok=True)
+
+    def ingest(self, stream: BinaryIO, filename: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Copy an upload to the upload directory and validate it
+
+        The type is checked on the first chunk, before the rest of the body is read.
+
+        Args:
+            stream: Request or multipart file stream
+            filename: Client file name (only used to name the stored file)
+
+        Returns:
+            Dict with path, sha256, size and file_type of the stored file
+        """
+        try:
+            return self._ingest(stream, filename)
+        except UploadError as e:
+            UPLOADS_REJECTED.inc(reason=e.reason)
+            logger.info(f"Upload rejected ({e.reason}): {str(e)}")
+            raise
+
+    def _ingest(self, stream: BinaryIO, filename: Optional[str]) -> Dict[str, Any]:
+        head = self._read(stream, max(self.chunk_size, PDF_MAGIC_WINDOW))
+        if not head:
+            raise UploadError("Empty file", reason='empty')
+        file_type = sniff_file_type(head)
+        if file_type is None:
+            raise UploadError("Unsupported file type (expected a PDF, JPEG or PNG file)", 415, 'unsupported_type')
+
+        digest = hashlib.sha256()
+        size = 0
+        part_path = os.path.join(self.upload_dir, f".ingest-{uuid.uuid4().hex}.part")
+        try:
+            with open(part_path, 'wb') as f:
+                chunk = head
+                while chunk:
+                    size += len(chunk)
+                    if self.max_bytes is not None and size > self.max_bytes:
+                        raise UploadError(f"File exceeds the maximum size of {self.max_bytes} bytes", 413, 'too_large')
+                    digest.update(chunk)
+                    f.write(chunk)
+                    chunk = self._read(stream, self.chunk_size)
+
+            self._check_content(part_path, file_type)
+
+            if self.blob_store is not None:
+                path = self.blob_store.put(part_path, file_type, digest.hexdigest())['path']
+            else:
+                stem = os.path.splitext(secure_filename(filename or ''))[0] or 'invoice'
+                path = os.path.join(self.upload_dir, f"{uuid.uuid4()}_{stem}.{file_type}")
+                os.replace(part_path, path)
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+
+        return {'path': path, 'sha256': digest.hexdigest(), 'size': size, 'file_type': file_type}
+
+    def _check_content(self, path: str, file_type: str) -> None:
+        magika = _get_magika() if self.use_magika else None
+        if magika is not None:
+            from pathlib import Path
+            label = magika.identify_path(Path(path)).output.label
+            if label != MAGIKA_LABELS[file_type]:
+                raise UploadError(f"File content does not look like a {file_type.upper()} ({label})", 415,
+                                  'type_mismatch')
+        if file_type == 'pdf':
+            validate_pdf(path)
+        else:
+            validate_image(path, file_type)
+
+    @staticmethod
+    def _read(stream: BinaryIO, size: int) -> bytes:
+        """Read up to size bytes (streams may return short reads)"""
+        data = stream.read(size)
+        if not data or len(data) >= size:
+            return data or b''
+        chunks = [data]
+        remaining = size - len(data)
+        while remaining > 0:
+            chunk = stream.read(remaining)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return b''.join(chunks)
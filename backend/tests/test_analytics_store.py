@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.analytics_store import AnalyticsStore
+
+def make_invoice(invoice_id, provider="LYDEC", customer_id="C1", period_end="2018-04-01", peak=100, off_peak=200):
+    """Build extracted invoice data as returned by the LLM"""
+    return {
+        "id": invoice_id,
+        "provider": provider,
+        "invoice_number": f"N-{invoice_id}",
+        "customer_id": customer_id,
+        "period_start": "2018-03-01",
+        "period_end": period_end,
+        "total_amount": 500.0,
+        "total_kwh": peak + off_peak,
+        "items": [
+            {"description": "CONSO. H. DE POINTE", "quantity": peak, "unit_price": 1.2, "total": peak * 1.2},
+            {"description": "CONSO. H. CREUSES", "quantity": off_peak, "unit_price": 0.6, "total": off_peak * 0.6},
+            {"description": "RDV. DE PUISSANCE", "quantity": 5, "unit_price": 449.67, "total": 2248.35}
+        ],
+        "taxes": {"14%": 40.0, "20%": "10,5"}
+    }
+
+class TestAnalyticsStore(unittest.TestCase):
+    """Test cases for the AnalyticsStore service"""
+
+    def setUp(self):
+        """Set up a store in a temporary directory"""
+        self.store_dir = tempfile.mkdtemp()
+        self.store = AnalyticsStore(self.store_dir, max_segments=3)
+
+    def tearDown(self):
+        """Remove the temporary directory"""
+        shutil.rmtree(self.store_dir)
+
+    def test_aggregate_by_provider(self):
+        """Test aggregations over several invoices"""
+        self.store.add_invoice(make_invoice("a"))
+        self.store.add_invoice(make_invoice("b", period_end="2018-05-01"))
+        self.store.add_invoice(make_invoice("c", provider="ONEE"))
+
+        result = self.store.aggregate("provider")
+        groups = {g["key"]: g for g in result["groups"]}
+
+        self.assertEqual(result["invoice_count"], 3)
+        self.assertEqual(groups["LYDEC"]["invoice_count"], 2)
+        self.assertEqual(groups["LYDEC"]["total_kwh"], 600)
+        self.assertAlmostEqual(groups["LYDEC"]["peak_share"], 1 / 3, places=5)
+        self.assertAlmostEqual(groups["LYDEC"]["cost_per_kwh"], (120 + 120) / 300, places=5)
+        self.assertAlmostEqual(groups["LYDEC"]["tax_total"], 101.0)
+        self.assertEqual([m["period"] for m in groups["LYDEC"]["by_month"]], ["2018-04", "2018-05"])
+
+    def test_latest_write_wins_and_compaction(self):
+        """Test that rewriting an invoice replaces its row, across compactions"""
+        for i in range(5):
+            self.store.add_invoice(make_invoice("a", peak=100 + i))
+
+        self.assertEqual(len(self.store), 1)
+        self.assertLessEqual(len(os.listdir(self.store_dir)), 3)
+        self.assertEqual(self.store.columns()["peak_kwh"][0], 104)
+
+        reopened = AnalyticsStore(self.store_dir)
+        self.assertEqual(reopened.columns()["peak_kwh"][0], 104)
+
+    def test_filters(self):
+        """Test filtering by customer and period"""
+        self.store.add_invoice(make_invoice("a", customer_id="C1"))
+        self.store.add_invoice(make_invoice("b", customer_id="C2", period_end="2018-06-01"))
+
+        result = self.store.aggregate("customer", {"period_from": "2018-05"})
+
+        self.assertEqual([g["key"] for g in result["groups"]], ["C2"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import os
+import json
+import unittest
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import groq
+from unstract.llmwhisperer import LLMWhispererClientV2
+
+from benchmarks.mock_servers import MockBehavior, MockChatServer, MockWhisperServer
+from benchmarks.run import compare, summarize
+from benchmarks import validation
+
+class TestBenchmarks(unittest.TestCase):
+    """Test cases for the benchmark mock servers and report comparison"""
+
+    def test_mock_chat_server(self):
+        """Test that the mock answers the Groq client according to the system prompt"""
+        with MockChatServer() as server:
+            client = groq.Client(api_key='test', base_url=server.url)
+            response = client.chat.completions.create(
+                model='test',
+                messages=[{'role': 'system', 'content': 'You analyze energy invoices'}, {'role': 'user', 'content': 'x'}]
+            )
+
+        self.assertIn('issues', json.loads(response.choices[0].message.content))
+        self.assertGreater(response.usage.completion_tokens, 0)
+
+    def test_mock_whisper_server(self):
+        """Test the accept / status / retrieve flow of the LLMWhisperer client"""
+        with MockWhisperServer(ocr_text='CONSO. H. CREUSES') as server:
+            client = LLMWhispererClientV2(base_url=server.url, api_key='test', logging_level='ERROR')
+            result = client.whisper(stream=[b'%PDF-1.4'], wait_for_completion=True)
+
+        self.assertEqual(result['extraction']['result_text'], 'CONSO. H. CREUSES')
+
+    def test_mock_errors(self):
+        """Test that the error rate is applied"""
+        with MockChatServer(MockBehavior(error_rate=1.0)) as server:
+            client = groq.Client(api_key='test', base_url=server.url, max_retries=0)
+            with self.assertRaises(groq.InternalServerError):
+                client.chat.completions.create(model='test', messages=[{'role': 'user', 'content': 'x'}])
+
+    def test_compare(self):
+        """Test that slower p95 latency and lower throughput are reported as regressions"""
+        baseline = {'results': [summarize('process_invoice', 4, [0.1] * 10, 0, 1.0)]}
+        slower = {'results': [summarize('process_invoice', 4, [0.2] * 10, 0, 2.0)]}
+
+        self.assertEqual(compare(baseline, baseline), [])
+        self.assertEqual(len(compare(slower, baseline)), 2)
+
+    def test_validation_benchmark(self):
+        """Test that the parse benchmark covers every response model"""
+        report = validation.run(iterations=2, listing_size=100)
+
+        self.assertEqual(set(report['parse_us']), {'invoice', 'analysis', 'recommendations'})
+        self.assertLess(report['listing_kb']['slots'], report['listing_kb']['dicts'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import os
+import time
+import hashlib
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import services.blob_store
+from services.blob_store import LocalBlobStore, DAY
+from utils.database import Database
+
+class TestBlobStore(unittest.TestCase):
+    """Test cases for the LocalBlobStore service"""
+
+    def setUp(self):
+        """Create a store in a temporary directory"""
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.store = LocalBlobStore(
+            os.path.join(self.temp_dir.name, 'blobs'), Database(':memory:'), retention_days=30, archive_after_days=7
+        )
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write(self, data: bytes) -> str:
+        path = os.path.join(self.temp_dir.name, f'upload-{time.perf_counter_ns()}.pdf')
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_put_is_content_addressed(self):
+        """Test that identical uploads are stored once, under a sharded path"""
+        first = self.store.put(self.write(b'%PDF-1.4 same'), 'pdf')
+        second = self.store.put(self.write(b'%PDF-1.4 same'), 'pdf')
+
+        digest = hashlib.sha256(b'%PDF-1.4 same').hexdigest()
+        self.assertEqual(first['digest'], digest)
+        self.assertEqual(first['path'], second['path'])
+        self.assertTrue(first['path'].endswith(os.path.join(digest[:2], digest[2:4], f'{digest}.pdf')))
+        self.assertEqual(self.store.stats()['hot']['count'], 1)
+        self.assertEqual([f for f in os.listdir(self.temp_dir.name) if f.startswith('upload-')], [])
+
+    def test_retention_of_unreferenced_blobs(self):
+        """Test that only unreferenced blobs past retention are deleted"""
+        kept = self.store.put(self.write(b'kept'), 'pdf')
+        dropped = self.store.put(self.write(b'dropped'), 'pdf')
+        self.store.add_ref(kept['digest'], 'invoice-1')
+        self.store.add_ref(kept['digest'], 'invoice-1')
+
+        self.assertEqual(self.store.ref_count(kept['digest']), 1)
+        self.assertEqual(self.store.compact(time.time() + 29 * DAY)['deleted'], 0)
+        self.assertEqual(self.store.compact(time.time() + 31 * DAY)['deleted'], 1)
+        self.assertFalse(os.path.exists(dropped['path']))
+        self.assertIsNone(self.store.path(dropped['digest']))
+
+        # Released blobs get the full retention period from their release
+        self.store.release(kept['digest'], 'invoice-1')
+        self.assertEqual(self.store.compact(time.time() + DAY)['deleted'], 0)
+        self.assertEqual(self.store.compact(time.time() + 31 * DAY)['deleted'], 1)
+
+    def test_archive_and_restore(self):
+        """Test that cold blobs are compressed and restored on access"""
+        blob = self.store.put(self.write(b'%PDF-1.4 ' + b'cold ' * 1000), 'pdf')
+        self.store.add_ref(blob['digest'], 'invoice-1')
+
+        self.assertEqual(self.store.compact(time.time() + 8 * DAY)['archived'], 1)
+        self.assertFalse(os.path.exists(blob['path']))
+        self.assertEqual(self.store.stats()['archive']['count'], 1)
+
+        path = self.store.path(blob['digest'])
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'%PDF-1.4 ' + b'cold ' * 1000)
+        self.assertIn('hot', self.store.stats())
+
+    def test_put_from_another_filesystem(self):
+        """Test that a file on another filesystem is copied before the write lock is taken"""
+        replace, copyfile = os.replace, services.blob_store.shutil.copyfile
+        upload_dir = os.path.dirname(self.store.root)
+
+        def cross_device_replace(src, dst):
+            if os.path.dirname(src) == upload_dir:
+                raise OSError(18, 'Invalid cross-device link')
+            replace(src, dst)
+
+        def checked_copyfile(src, dst):
+            self.assertFalse(self.store.database.connection.in_transaction)
+            return copyfile(src, dst)
+
+        source = self.write(b'%PDF-1.4 elsewhere')
+        with patch('services.blob_store.os.replace', cross_device_replace), \
+             patch('services.blob_store.shutil.copyfile', checked_copyfile):
+            blob = self.store.put(source, 'pdf')
+
+        self.assertFalse(os.path.exists(source))
+        with open(blob['path'], 'rb') as f:
+            self.assertEqual(f.read(), b'%PDF-1.4 elsewhere')
+        self.assertEqual(os.listdir(self.store.tmp_dir), [])
+
+    def test_stale_temp_files_removed_on_startup(self):
+        """Test that temp files left by a crashed worker are removed"""
+        stale = os.path.join(self.store.tmp_dir, 'crashed.tmp')
+        fresh = os.path.join(self.store.tmp_dir, 'in-progress.tmp')
+        for path in (stale, fresh):
+            open(path, 'wb').close()
+        os.utime(stale, (time.time() - 2 * 3600, time.time() - 2 * 3600))
+
+        LocalBlobStore(self.store.root, self.store.database)
+
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(fresh))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import os
+import json
+import unittest
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.mock_servers import load_fixture
+from services.consistency_checker import (
+    analysis_payload, check_invoice, check_invoices, needs_analysis, summarize_reports
+)
+
+def make_invoice(**fields):
+    """Build a small consistent invoice"""
+    invoice = {
+        'id': 'a',
+        'total_amount': 220.0,
+        'total_kwh': 300,
+        'peak_kwh': 50,
+        'off_peak_kwh': 250,
+        'rate_per_kwh': None,
+        'items': [
+            {'description': 'CONSO. H. DE POINTE', 'quantity': 50, 'unit_price': 1.0, 'total': 50.0},
+            {'description': 'CONSO. H. CREUSES', 'quantity': 250, 'unit_price': 0.5, 'total': 125.0},
+            {'description': 'LOCATION COMPTAGE', 'quantity': 1, 'unit_price': 25.0, 'total': 25.0},
+        ],
+        'taxes': {'20%': 20.0},
+    }
+    invoice.update(fields)
+    return invoice
+
+class TestConsistencyChecker(unittest.TestCase):
+    """Test cases for the arithmetic consistency checks"""
+
+    def test_consistent_invoice(self):
+        """Test the flags of a consistent invoice and the derived rate per kWh"""
+        report = check_invoice(make_invoice())
+
+        self.assertTrue(report['consistent'])
+        self.assertEqual(report['flags']['total_amount'], 'verified')
+        self.assertEqual(report['flags']['rate_per_kwh'], 'derived')
+        # (50 + 125) / 300 kWh
+        self.assertAlmostEqual(report['derived']['rate_per_kwh'], 0.58333)
+
+    def test_fixture_total_amount_mismatch(self):
+        """Test that the misread total of the fixture extraction is caught"""
+        invoice = json.loads(load_fixture('llm_responses.json'))['invoice']
+        report = check_invoice(invoice)
+
+        self.assertFalse(report['consistent'])
+        self.assertEqual(report['flags']['total_amount'], 'mismatch')
+        self.assertEqual(report['expected']['total_amount'], 37108.35)
+        self.assertEqual(report['flags']['total_kwh'], 'verified')
+        self.assertEqual(report['flags']['items'], 'verified')
+
+    def test_item_mismatch_and_derived_totals(self):
+        """Test quantity * unit_price against item totals, and missing totals"""
+        invoice = make_invoice()
+        invoice['items'][0]['total'] = 60.0
+        invoice['items'][2]['total'] = None
+        report = check_invoice(invoice)
+
+        self.assertEqual(report['item_mismatches'], [0])
+        self.assertEqual(report['flags']['items'], 'mismatch')
+        self.assertEqual(report['item_totals'], {2: 25.0})
+
+    def test_bulk_check(self):
+        """Test that a corpus is checked in one pass, with missing fields left unverified"""
+        invoices = [make_invoice(), make_invoice(id='b', total_kwh=500), {'id': 'c'}]
+        reports = check_invoices(invoices)
+
+        self.assertEqual([r['consistent'] for r in reports], [True, False, True])
+        self.assertEqual(reports[1]['expected'], {'total_kwh': 300.0})
+        self.assertEqual(set(reports[2]['flags'].values()), {'unverified'})
+
+        summary = summarize_reports(invoices, reports)
+        self.assertEqual(summary['checked'], 3)
+        self.assertEqual(summary['consistent'], 2)
+        self.assertEqual(summary['flags']['total_kwh'], {'verified': 1, 'mismatch': 1, 'unverified': 1})
+        self.assertEqual([r['id'] for r in summary['inconsistent']], ['b'])
+
+    def test_bulk_item_checks_stay_with_their_invoice(self):
+        """Test that item mismatches and filled totals are reported on their own invoice"""
+        last = make_invoice(id='d')
+        last['items'][0]['total'] = 60.0
+        last['items'][2]['total'] = None
+        reports = check_invoices([make_invoice(), {'id': 'c'}, last])
+
+        self.assertEqual([r['item_mismatches'] for r in reports], [[], [], [0]])
+        self.assertEqual([r['item_totals'] for r in reports], [{}, {}, {2: 25.0}])
+        self.assertEqual(reports[1]['flags']['items'], 'unverified')
+
+    def test_needs_analysis(self):
+        """Test that only clean invoices without penalties or peak-heavy consumption skip the analysis"""
+        invoice = make_invoice()
+        self.assertFalse(needs_analysis(invoice, check_invoice(invoice)))
+
+        peak_heavy = make_invoice(peak_kwh=200)
+        self.assertTrue(needs_analysis(peak_heavy, check_invoice(peak_heavy)))
+
+        overrun = make_invoice(total_amount=250.0)
+        overrun['items'].append({'description': 'DEPASS. DE PUISSANCE', 'quantity': 1, 'unit_price': 30.0, 'total': 30.0})
+        self.assertTrue(needs_analysis(overrun, check_invoice(overrun)))
+
+    def test_analysis_payload(self):
+        """Test that the analysis payload sums items by category and lists unverified checks"""
+        invoice = make_invoice()
+        payload = analysis_payload(invoice, check_invoice(invoice))
+
+        self.assertNotIn('items', payload)
+        self.assertNotIn('id', payload)
+        self.assertEqual(payload['items_by_category']['peak']['total'], 50.0)
+        self.assertEqual(payload['taxes_total'], 20.0)
+        self.assertEqual(payload['checks'], {'rate_per_kwh': 'derived'})
+
+if __name__ == '__main__':
+    unittest.main()
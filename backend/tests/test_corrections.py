@@ -0,0 +1,61 @@
+import os
+import unittest
+
+from pydantic import ValidationError
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.corrections import apply_corrections, dirty_stages
+
+class TestCorrections(unittest.TestCase):
+    """Test cases for field corrections and the stages they make stale"""
+
+    def setUp(self):
+        """Set up a stored invoice whose total was derived by the consistency check"""
+        self.invoice = {
+            'id': '1',
+            'provider': 'LYDEC',
+            'customer_name': 'John Doe',
+            'period_start': '2025-04-01',
+            'total_kwh': 500,
+            'total_amount': 150.75,
+            'items': [{'description': 'Energy usage', 'quantity': 500, 'unit_price': 0.25, 'total': 125.0}],
+            'taxes': {'VAT': 25.75},
+        }
+        self.flags = {'total_amount': 'derived'}
+
+    def test_apply_corrections(self):
+        """Test that values are normalized like extracted ones and only real changes are reported"""
+        corrected, changed = apply_corrections(self.invoice, {'period_start': '01/05/2025', 'provider': 'LYDEC'})
+
+        self.assertEqual(corrected['period_start'], '2025-05-01')
+        self.assertEqual(changed, {'period_start': {'old': '2025-04-01', 'new': '2025-05-01'}})
+        self.assertEqual(self.invoice['period_start'], '2025-04-01')
+
+    def test_derived_fields_are_cleared(self):
+        """Test that fields derived from the amounts are cleared when an amount changes"""
+        corrected, changed = apply_corrections(self.invoice, {'taxes': {'VAT': 30.0}}, self.flags)
+
+        self.assertEqual(list(changed), ['taxes'])
+        self.assertIsNone(corrected['total_amount'])
+
+        corrected, _ = apply_corrections(self.invoice, {'customer_name': 'Jane Doe'}, self.flags)
+        self.assertEqual(corrected['total_amount'], 150.75)
+
+    def test_invalid_corrections(self):
+        """Test that pipeline fields and invalid values are refused"""
+        with self.assertRaises(ValueError):
+            apply_corrections(self.invoice, {'id': '2'})
+        with self.assertRaises(ValidationError):
+            apply_corrections(self.invoice, {'total_kwh': 'a lot'})
+
+    def test_dirty_stages(self):
+        """Test that each field maps to the stages reading it"""
+        self.assertEqual(dirty_stages({'invoice_number'}), [])
+        self.assertEqual(dirty_stages({'provider'}), ['analyze'])
+        self.assertEqual(dirty_stages({'customer_id'}), ['history', 'simulate'])
+        self.assertEqual(dirty_stages({'total_kwh'}), ['check', 'analyze', 'history', 'simulate'])
+
+if __name__ == '__main__':
+    unittest.main()
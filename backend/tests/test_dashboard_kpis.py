@@ -0,0 +1,118 @@
+import os
+import copy
+import json
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services import result_store
+from services.result_store import ResultStore
+from utils.database import Database
+
+def make_result(invoice_id: str, period: str = '2025-04-01', provider: str = 'LYDEC') -> dict:
+    return {
+        'invoice': {
+            'id': invoice_id, 'provider': provider, 'period_start': period,
+            'total_amount': 150.75, 'total_kwh': 500,
+            'items': [{'description': 'CONSO. H. POINTE', 'quantity': 300, 'total': 90.0},
+                      {'description': 'CONSO. H. CREUSES', 'quantity': 200, 'total': 50.0}],
+            'taxes': {'TVA 14%': 10.75},
+        },
+        'analysis': {'issues': [{'description': 'Dépassement de puissance', 'severity': 'high'},
+                                {'description': 'Consommation en heures pleines', 'severity': 'medium'}]},
+        'recommendations': {'recommendations': ['Réduire la puissance souscrite'],
+                            'potential_savings': 20.0, 'efficiency_score': 70},
+    }
+
+class TestDashboardKPIs(unittest.TestCase):
+    """Test cases for the dashboard KPIs maintained by the result store"""
+
+    def setUp(self):
+        """Create a store in a temporary directory"""
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.database = Database(os.path.join(self.temp_dir.name, 'test.db'))
+        self.store = ResultStore(self.database)
+
+    def tearDown(self):
+        self.store.committer.close()
+        self.temp_dir.cleanup()
+
+    def test_saved_results_are_counted(self):
+        """Test that each saved result adds to the totals, severities, periods and breakdowns"""
+        self.store.save(make_result('a'))
+        second = make_result('b', period='2025-05-01')
+        second['recommendations']['efficiency_score'] = None
+        self.store.save(second)
+
+        kpis = self.store.kpis.snapshot()
+
+        self.assertEqual(kpis['invoices'], 2)
+        self.assertEqual(kpis['total_amount'], 301.5)
+        self.assertEqual(kpis['total_kwh'], 1000)
+        self.assertEqual(kpis['potential_savings'], 40.0)
+        self.assertEqual(kpis['average_efficiency_score'], 70)
+        self.assertEqual(kpis['severity'], {'high': 2, 'medium': 2})
+        self.assertEqual([(p['period'], p['kwh']) for p in kpis['periods']], [('2025-04', 500), ('2025-05', 500)])
+        self.assertEqual(kpis['providers']['LYDEC']['invoices'], 2)
+        self.assertEqual(kpis['taxes'], {'TVA 14%': 21.5})
+        self.assertEqual(kpis['bands'], {'off_peak': 400, 'peak': 600})
+        # Line items are counted by category, not by their free-text description
+        self.assertEqual(kpis['items'], {'off_peak': 100.0, 'peak': 180.0})
+
+    def test_corrected_result_replaces_its_figures(self):
+        """Test that saving a result again moves its figures instead of counting it twice"""
+        self.store.save(make_result('a'))
+        self.store.save(make_result('b'))
+
+        corrected = copy.deepcopy(self.store.get('a'))
+        corrected['invoice'].update(period_start='2025-05-01', provider='ONEE', total_kwh=600)
+        corrected['analysis']['issues'] = []
+        self.store.save(corrected)
+
+        kpis = self.store.kpis.snapshot()
+        self.assertEqual(kpis['invoices'], 2)
+        self.assertEqual(kpis['total_kwh'], 1100)
+        self.assertEqual(kpis['severity'], {'high': 1, 'medium': 1})
+        self.assertEqual([(p['period'], p['invoices']) for p in kpis['periods']], [('2025-04', 1), ('2025-05', 1)])
+        self.assertEqual(sorted(kpis['providers']), ['LYDEC', 'ONEE'])
+
+        # Matches the figures recomputed from scratch
+        with self.database.transaction() as conn:
+            self.store.kpis.rebuild(conn, self.store.all())
+        self.assertEqual(self.store.kpis.snapshot(), kpis)
+
+    def test_existing_results_are_backfilled(self):
+        """Test that results stored before the KPI tables existed are counted at startup"""
+        self.store.save(make_result('a'))
+        with self.database.transaction() as conn:
+            conn.execute('DELETE FROM dashboard_kpis')
+
+        store = ResultStore(self.database, self.store.committer)
+
+        self.assertEqual(store.kpis.snapshot()['invoices'], 1)
+
+    def test_recovered_results_are_counted_once(self):
+        """Test that a legacy result saved by another worker during recovery is not counted again"""
+        full_results_dir = os.path.join(self.temp_dir.name, 'full_results')
+        os.makedirs(full_results_dir)
+        for invoice_id in ('a', 'b'):
+            with open(os.path.join(full_results_dir, f'{invoice_id}.json'), 'w', encoding='utf-8') as f:
+                json.dump(make_result(invoice_id), f)
+
+        load_json = result_store._load_json
+        def load_while_saving(path):
+            # 'a' is stored after the known results were read, before they are inserted
+            if path.endswith('a.json'):
+                self.store.save(make_result('a'))
+            return load_json(path)
+
+        with patch('services.result_store._load_json', side_effect=load_while_saving):
+            self.assertEqual(self.store.recover(self.temp_dir.name, full_results_dir), 1)
+
+        self.assertEqual(self.store.kpis.snapshot()['invoices'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
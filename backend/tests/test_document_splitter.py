@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+import PyPDF2
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.document_splitter import DocumentSplitter, find_invoice_number, segment_pages
+
+def make_bundle_pdf(path, pages):
+    """Write a PDF with one page per text (empty texts give pages without a text layer)"""
+    from fpdf import FPDF
+
+    pdf = FPDF()
+    pdf.set_font('Helvetica', size=10)
+    for text in pages:
+        pdf.add_page()
+        for line in text.splitlines():
+            pdf.cell(0, 6, line, ln=1)
+    pdf.output(path)
+    return path
+
+class TestDocumentSplitter(unittest.TestCase):
+    """Test cases for the multi-invoice document splitter"""
+
+    def setUp(self):
+        """Set up a temporary directory"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.splitter = DocumentSplitter(os.path.join(self.tmp_dir, 'segments'))
+
+    def tearDown(self):
+        """Remove the temporary directory"""
+        shutil.rmtree(self.tmp_dir)
+
+    def test_find_invoice_number(self):
+        """Test the invoice header formats"""
+        self.assertEqual(find_invoice_number('Détail de votre facture N° 10023456'), '10023456')
+        self.assertEqual(find_invoice_number('DETAIL DE VOTRE FACTURE NO : 2024-881'), '2024-881')
+        self.assertEqual(find_invoice_number('N° facture 55501'), '55501')
+        self.assertIsNone(find_invoice_number('CONSO. H. CREUSES 1200 kWh'))
+
+    def test_segment_pages(self):
+        """Test that a new number starts an invoice and other pages stay with the previous one"""
+        texts = [
+            'Détail de votre facture N° 1001',
+            'suite',
+            'Détail de votre facture N° 1001',
+            'Détail de votre facture N° 1002',
+            'conditions générales',
+        ]
+        self.assertEqual(segment_pages(texts), [(0, 2, '1001'), (3, 4, '1002')])
+        self.assertEqual(segment_pages(['page de garde', 'Détail de votre facture N° 1001']), [(0, 1, '1001')])
+
+    def test_split_bundle(self):
+        """Test that a bundle is written as one PDF per invoice"""
+        path = make_bundle_pdf(os.path.join(self.tmp_dir, 'bundle.pdf'), [
+            'Détail de votre facture N° 1001\nCONSO. H. CREUSES',
+            'Page 2 de la facture',
+            'Détail de votre facture N° 1002\nCONSO. H. PLEINES',
+        ])
+
+        parts = self.splitter.split(path)
+
+        self.assertEqual([part['pages'] for part in parts], [[1, 2], [3, 3]])
+        self.assertEqual([part['invoice_number'] for part in parts], ['1001', '1002'])
+        self.assertEqual(len(PyPDF2.PdfReader(parts[0]['path']).pages), 2)
+        self.assertNotEqual(parts[1]['path'], path)
+
+    def test_single_invoice_keeps_file(self):
+        """Test that a single invoice is not rewritten"""
+        path = make_bundle_pdf(os.path.join(self.tmp_dir, 'single.pdf'), [
+            'Détail de votre facture N° 1001', 'Page 2 de la facture'
+        ])
+
+        self.assertEqual(self.splitter.split(path), [{'pages': [1, 2], 'invoice_number': '1001', 'path': path}])
+
+    def test_ocr_pages_without_text_layer(self):
+        """Test that scanned pages are segmented from the cheap OCR pass"""
+        path = make_bundle_pdf(os.path.join(self.tmp_dir, 'scanned.pdf'), ['', '', ''])
+        ocr_pages = MagicMock(return_value=[
+            'Détail de votre facture N° 1001', 'suite', 'Détail de votre facture N° 1002'
+        ])
+        splitter = DocumentSplitter(os.path.join(self.tmp_dir, 'segments'), ocr_pages=ocr_pages)
+
+        parts = splitter.split(path)
+
+        ocr_pages.assert_called_once_with(path)
+        self.assertEqual([part['pages'] for part in parts], [[1, 2], [3, 3]])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.event_bus import EventBus, format_sse
+from utils.database import Database
+
+class TestEventBus(unittest.TestCase):
+    """Test cases for the event log backing the /api/events stream"""
+
+    def setUp(self):
+        """Set up an event bus on a temporary database"""
+        self.data_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.data_dir, 'events.db')
+        self.bus = EventBus(Database(self.path), poll_interval=0.05)
+
+    def tearDown(self):
+        """Remove the temporary directory"""
+        shutil.rmtree(self.data_dir)
+
+    def test_publish_and_since(self):
+        """Test that events are read back in order after a given ID"""
+        first = self.bus.publish('progress', stage='uploaded', invoice_id='a')
+        self.bus.publish('invoice', result={'invoice': {'id': 'a'}})
+
+        self.assertEqual(self.bus.latest_id(), first + 1)
+        events = self.bus.since(first)
+        self.assertEqual([e['type'] for e in events], ['invoice'])
+        self.assertEqual(events[0]['data'], {'result': {'invoice': {'id': 'a'}}})
+
+    def test_listen_wakes_on_publish(self):
+        """Test that a listener only receives new events, as soon as they are published"""
+        self.bus.publish('progress', stage='uploaded', invoice_id='old')
+        stop = threading.Event()
+        received = []
+        listener = self.bus.listen(heartbeat=60, stop=stop)
+
+        def consume():
+            for event in listener:
+                received.append((event, time.monotonic()))
+                stop.set()
+
+        thread = threading.Thread(target=consume)
+        thread.start()
+        time.sleep(0.1)
+        published = time.monotonic()
+        self.bus.publish('progress', stage='ocr_done', invoice_id='new')
+        thread.join(5)
+
+        self.assertEqual(len(received), 1)
+        self.assertEqual(received[0][0]['data']['invoice_id'], 'new')
+        self.assertLess(received[0][1] - published, 1)
+
+    def test_listen_across_workers(self):
+        """Test that events published by another worker's bus reach a listener, resuming after an ID"""
+        other = EventBus(Database(self.path), poll_interval=0.05)
+        last_id = other.publish('progress', stage='uploaded', invoice_id='a')
+        other.publish('progress', stage='ocr_done', invoice_id='a')
+
+        event = next(self.bus.listen(last_id))
+
+        self.assertEqual(event['data']['stage'], 'ocr_done')
+
+    def test_heartbeat(self):
+        """Test that an idle listener yields keep-alives"""
+        self.assertIsNone(next(self.bus.listen(heartbeat=0.1)))
+        self.assertEqual(format_sse(None), ': keep-alive\n\n')
+
+    def test_format_sse(self):
+        """Test the Server-Sent Events encoding"""
+        event_id = self.bus.publish('progress', stage='extracted', invoice_id='a')
+        message = format_sse(self.bus.since(event_id - 1)[0])
+
+        self.assertEqual(message, f'id: {event_id}\nevent: progress\n'
+                                  'data: {"stage": "extracted", "invoice_id": "a"}\n\n')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+import json
+import unittest
+from unittest.mock import MagicMock
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.mock_servers import load_fixture
+from models.invoice import Invoice
+from services.field_repair import FieldRepairer, find_inconsistent_fields, ocr_snippet
+
+class TestFieldRepair(unittest.TestCase):
+    """Test cases for the targeted re-extraction of invoice fields"""
+
+    def setUp(self):
+        """Load the fixture OCR text and extraction"""
+        self.ocr_text = load_fixture('ocr_text.txt')
+        self.invoice = Invoice.model_validate(json.loads(load_fixture('llm_responses.json'))['invoice'])
+        self.llm_service = MagicMock()
+        self.repairer = FieldRepairer(self.llm_service)
+
+    def test_find_inconsistent_fields(self):
+        """Test that totals contradicting the items are detected"""
+        data = self.invoice.model_dump()
+
+        # 37.11 instead of the ~37 108 of items and taxes
+        self.assertEqual(find_inconsistent_fields(data), ['total_amount'])
+        data['total_amount'] = 37108.35
+        data['total_kwh'] = 20000
+        self.assertEqual(find_inconsistent_fields(data), ['total_kwh'])
+
+    def test_ocr_snippet(self):
+        """Test that only the matching lines and their neighbours are kept"""
+        snippet = ocr_snippet(self.ocr_text, [r'total\s+consommation'])
+
+        self.assertIn('Total consommation kWh : 28 617', snippet)
+        self.assertIn('TVA 20 %', snippet)
+        self.assertNotIn('CONSO. H. NORMALES', snippet)
+        self.assertEqual(ocr_snippet(self.ocr_text, [r'introuvable']), '')
+
+    def test_plan_skips_fields_absent_from_text(self):
+        """Test that missing fields are only requested when the OCR text mentions them"""
+        fields, snippet = self.repairer.plan(self.invoice.model_dump(), self.ocr_text)
+
+        # rate_per_kwh is missing but computable from the energy items
+        self.assertEqual(fields, ['total_amount'])
+        self.assertNotIn('issue_date', fields)
+        self.assertLess(len(snippet), len(self.ocr_text))
+
+    def test_repair_merges_requested_fields(self):
+        """Test that only the requested, non-null fields are updated"""
+        self.llm_service.extract_fields.return_value = json.dumps({
+            'total_amount': '37 108,35', 'rate_per_kwh': None, 'provider': 'Autre'
+        })
+
+        repaired = self.repairer.repair(self.invoice, self.ocr_text)
+
+        self.assertEqual(repaired, ['total_amount'])
+        self.assertEqual(self.invoice.total_amount, 37108.35)
+        self.assertEqual(self.invoice.provider, 'LYDEC')
+        fields, snippet = self.llm_service.extract_fields.call_args[0]
+        self.assertEqual(list(fields), ['total_amount'])
+
+    def test_invalid_repair_is_ignored(self):
+        """Test that an invalid re-extraction leaves the invoice unchanged"""
+        self.llm_service.extract_fields.return_value = json.dumps({'total_amount': 'inconnu'})
+
+        self.assertEqual(self.repairer.repair(self.invoice, self.ocr_text), [])
+        self.assertEqual(self.invoice.total_amount, 37.11)
+
+    def test_nothing_to_repair(self):
+        """Test that a complete, consistent invoice makes no LLM call"""
+        self.invoice.total_amount = 37108.35
+
+        self.assertEqual(self.repairer.repair(self.invoice, self.ocr_text), [])
+        self.llm_service.extract_fields.assert_not_called()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.history_analyzer import HistoryAnalyzer, invoice_metrics
+from utils.database import Database
+
+def make_invoice(month, normal=15000, peak=6000, off_peak=7000, overrun=None, customer_id="C1", max_power=None):
+    """Build extracted invoice data for one billing month of 2018"""
+    items = [
+        {"description": "CONSO. H. NORMALES", "quantity": normal, "unit_price": 0.886, "total": normal * 0.886},
+        {"description": "CONSO. H. CREUSES", "quantity": off_peak, "unit_price": 0.649, "total": off_peak * 0.649},
+        {"description": "CONSO. H. DE POINTE", "quantity": peak, "unit_price": 1.242, "total": peak * 1.242},
+        {"description": "RDV. DE PUISSANCE", "quantity": 5, "unit_price": 449.67, "total": 2248.35}
+    ]
+    if overrun:
+        items.append({"description": "DEPASS. DE PUISSANCE", "quantity": overrun, "unit_price": 449.67,
+                      "total": overrun * 449.67})
+    return {
+        "id": f"inv-{month}",
+        "customer_id": customer_id,
+        "period_end": f"2018-{month:02d}-01",
+        "total_kwh": normal + peak + off_peak,
+        "items": items,
+        "max_power_kw": max_power
+    }
+
+class TestHistoryAnalyzer(unittest.TestCase):
+    """Test cases for the HistoryAnalyzer service"""
+
+    def setUp(self):
+        """Set up an analyzer in a temporary directory"""
+        self.history_dir = tempfile.mkdtemp()
+        self.analyzer = HistoryAnalyzer(Database(os.path.join(self.history_dir, 'test.db')))
+
+    def tearDown(self):
+        """Remove the temporary directory"""
+        shutil.rmtree(self.history_dir)
+
+    def process(self, invoice):
+        """Evaluate an invoice, then record it, as the pipeline does once the result is saved"""
+        findings = self.analyzer.evaluate(invoice)
+        self.analyzer.record(invoice)
+        return findings
+
+    def test_invoice_metrics(self):
+        """Test metrics derived from line items"""
+        metrics = invoice_metrics(make_invoice(1, overrun=7.5))
+
+        self.assertEqual(metrics[0], 28000)
+        self.assertAlmostEqual(metrics[1], 6000 / 28000)
+        self.assertEqual(metrics[3], 5)
+        self.assertEqual(metrics[4], 7.5)
+
+    def test_spike_and_peak_concentration(self):
+        """Test that deviations from the history are flagged"""
+        for month, normal in zip(range(1, 7), [15000, 15500, 14800, 15200, 14900, 15100]):
+            self.process(make_invoice(month, normal=normal))
+
+        findings = self.process(make_invoice(7, normal=30000, peak=15000))
+
+        self.assertEqual(findings["history_count"], 6)
+        self.assertIn("consumption_spike", findings["flags"])
+        self.assertIn("peak_concentration", findings["flags"])
+        self.assertGreater(findings["metrics"]["total_kwh"]["zscore"], 2)
+
+    def test_reprocessing_a_period_replaces_it(self):
+        """Test that running statistics stay correct when a period is processed again"""
+        self.process(make_invoice(1, normal=10000))
+        self.process(make_invoice(2, normal=20000))
+        self.process(make_invoice(2, normal=12000))
+
+        state = self.analyzer._load(self.analyzer.database.connection, "C1")
+        kwh = [10000 + 13000, 12000 + 13000]
+
+        self.assertEqual(len(state["periods"]), 2)
+        self.assertAlmostEqual(state["stats"]["mean"][0], np.mean(kwh))
+        self.assertAlmostEqual(state["stats"]["m2"][0], np.var(kwh) * 2)
+
+    def test_oversized_power_needs_drawn_power(self):
+        """Test that subscribed power is only called oversized from the power actually drawn"""
+        for month in range(1, 7):
+            findings = self.process(make_invoice(month))
+        self.assertNotIn("oversized_subscribed_power", findings["flags"])
+
+        for month in range(7, 12):
+            findings = self.process(make_invoice(month, max_power=3))
+        self.assertIn("oversized_subscribed_power", findings["flags"])
+
+        findings = self.process(make_invoice(12, max_power=4.8))
+        self.assertNotIn("oversized_subscribed_power", findings["flags"])
+
+    def test_evaluate_does_not_record(self):
+        """Test that only recorded invoices join the history"""
+        self.process(make_invoice(1))
+        self.analyzer.evaluate(make_invoice(2))
+
+        findings = self.analyzer.evaluate(make_invoice(3))
+
+        self.assertEqual(findings["history_count"], 1)
+
+    def test_history_values(self):
+        """Test that the previous periods are returned oldest first, without the invoice's own"""
+        for month in (3, 1, 2):
+            self.analyzer.record(make_invoice(month, max_power=month))
+
+        values = self.analyzer.history_values(make_invoice(3))
+
+        self.assertEqual(values.shape, (2, 6))
+        self.assertEqual(values[:, 5].tolist(), [1.0, 2.0])
+        self.assertIsNone(self.analyzer.history_values(make_invoice(1, customer_id=None)))
+
+    def test_corrected_invoice_replaces_its_period(self):
+        """Test that a corrected invoice is judged without its recorded version, which it replaces once recorded"""
+        for month in (1, 2, 3):
+            self.analyzer.record(make_invoice(month))
+        recorded = make_invoice(3)
+        corrected = dict(make_invoice(4), id=recorded["id"])
+
+        self.assertEqual(len(self.analyzer.history_values(corrected, exclude=recorded)), 2)
+        self.assertEqual(self.analyzer.evaluate(corrected, exclude=recorded)["history_count"], 2)
+        self.assertEqual(len(self.analyzer.history_values(corrected)), 3)
+
+        self.analyzer.record(corrected, previous=recorded)
+        periods = lambda customer: sorted(self.analyzer._load(self.analyzer.database.connection, customer)["periods"])
+        self.assertEqual(periods("C1"), ["2018-01", "2018-02", "2018-04"])
+
+        # A corrected customer moves the invoice to the other customer's history
+        self.analyzer.record(dict(corrected, customer_id="C2"), previous=corrected)
+        self.assertEqual(periods("C1"), ["2018-01", "2018-02"])
+        self.assertEqual(periods("C2"), ["2018-04"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from concurrent.futures import Future
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.idempotency import CLAIMED, CONFLICT, DONE, IN_FLIGHT, IdempotencyStore
+from utils.database import Database
+
+class TestIdempotencyStore(unittest.TestCase):
+    """Test cases for the single-flight table of upload requests"""
+
+    def setUp(self):
+        """Set up a temporary database"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.database = Database(os.path.join(self.tmp_dir, 'test.db'))
+        self.store = IdempotencyStore(self.database, poll_interval=0.01)
+
+    def tearDown(self):
+        """Remove the temporary directory"""
+        shutil.rmtree(self.tmp_dir)
+
+    def test_claim_then_replay(self):
+        """Test that the first request claims a key and retries get its stored response"""
+        self.assertEqual(self.store.claim('t:key', 'abc'), (CLAIMED, None))
+        self.assertEqual(self.store.claim('t:key', 'abc')[0], IN_FLIGHT)
+        self.assertEqual(self.store.claim('t:key', 'other')[0], CONFLICT)
+
+        self.store.complete('t:key', 200, {'invoice': {'id': '1'}})
+        outcome, record = self.store.claim('t:key', 'abc')
+
+        self.assertEqual(outcome, DONE)
+        self.assertEqual(record['status_code'], 200)
+        self.assertEqual(record['response'], {'invoice': {'id': '1'}})
+
+    def test_identical_request_joins_job(self):
+        """Test that a request identical to one in flight waits for its job instead of running"""
+        self.store.claim('t:key', 'abc')
+        job = Future()
+        self.store.track('t:key', job, lambda result: (200, result))
+        threading.Timer(0.05, job.set_result, args=({'invoice': {'id': '1'}},)).start()
+
+        outcome, record = self.store.wait('t:key', 'abc', timeout=5)
+
+        self.assertEqual(outcome, DONE)
+        self.assertEqual(record['response'], {'invoice': {'id': '1'}})
+
+    def test_failed_job_releases_key(self):
+        """Test that a failed job lets the next retry run again"""
+        self.store.claim('t:key', 'abc')
+        job = Future()
+        self.store.track('t:key', job, lambda result: (200, result))
+        job.set_exception(RuntimeError('OCR failed'))
+
+        self.assertEqual(self.store.claim('t:key', 'abc'), (CLAIMED, None))
+
+    def test_other_worker(self):
+        """Test that a request running in another worker is followed through the shared table"""
+        other = IdempotencyStore(self.database)
+        other.claim('t:key', 'abc')
+        threading.Timer(0.05, other.complete, args=('t:key', 200, {'ok': True})).start()
+
+        outcome, record = self.store.wait('t:key', 'abc', timeout=5)
+
+        self.assertEqual(outcome, DONE)
+        self.assertEqual(record['response'], {'ok': True})
+
+    def test_claims_expire(self):
+        """Test that a claim left by a crashed worker expires after the lock TTL"""
+        store = IdempotencyStore(self.database, lock_ttl=0.05, poll_interval=0.01)
+        store.claim('t:key', 'abc')
+
+        self.assertEqual(store.wait('t:key', 'abc', timeout=0.01)[0], IN_FLIGHT)
+        time.sleep(0.06)
+        self.assertEqual(store.claim('t:key', 'abc'), (CLAIMED, None))
+
+if __name__ == '__main__':
+    unittest.main()
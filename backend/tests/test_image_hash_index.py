@@ -0,0 +1,87 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from PIL import Image, ImageDraw
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.image_hash_index import ImageHashIndex, dhash, hamming, number_in_text
+from utils.database import Database
+
+def make_photo(path, lines, size=(600, 800), scale=1.0, quality=90):
+    """Draw a bill-like page (text rows and a table) and save it as a JPEG"""
+    image = Image.new('L', size, 235)
+    draw = ImageDraw.Draw(image)
+    for row, width in enumerate(lines):
+        draw.rectangle((40, 60 + row * 45, 40 + width, 80 + row * 45), fill=40)
+    if scale != 1.0:
+        image = image.resize((int(size[0] * scale), int(size[1] * scale)))
+    image.save(path, 'JPEG', quality=quality)
+    return path
+
+class TestImageHashIndex(unittest.TestCase):
+    """Test cases for the perceptual-hash duplicate index"""
+
+    def setUp(self):
+        """Set up an index in a temporary directory"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.database = Database(os.path.join(self.tmp_dir, 'test.db'))
+        self.index = ImageHashIndex(self.database, threshold=10)
+
+    def tearDown(self):
+        """Remove the temporary directory"""
+        shutil.rmtree(self.tmp_dir)
+
+    def test_dhash_survives_rescaling(self):
+        """Test that a rescaled, recompressed copy stays close and another layout does not"""
+        lines = [500, 320, 410, 200, 480, 150, 380, 260, 450, 300, 350, 220, 400, 280, 500, 180]
+        original = dhash(make_photo(os.path.join(self.tmp_dir, 'a.jpg'), lines))
+        copy = dhash(make_photo(os.path.join(self.tmp_dir, 'b.jpg'), lines, scale=0.5, quality=40))
+        other = dhash(make_photo(os.path.join(self.tmp_dir, 'c.jpg'), lines[::-1]))
+
+        self.assertLessEqual(hamming(original, copy), 4)
+        self.assertGreater(hamming(original, other), 10)
+
+    def test_lookup_matches_brute_force(self):
+        """Test that the multi-index lookup finds exactly the hashes within the threshold"""
+        rng = random.Random(1)
+        hashes = [rng.getrandbits(64) for _ in range(2000)]
+        # Near copies of the first hash, up to 12 bits away
+        for flips in range(1, 13):
+            value = hashes[0]
+            for bit in rng.sample(range(64), flips):
+                value ^= 1 << bit
+            hashes.append(value)
+        for i, value in enumerate(hashes):
+            self.index.add(value, f'inv-{i}')
+
+        for query in hashes[:1] + hashes[-3:]:
+            expected = sorted(f'inv-{i}' for i, value in enumerate(hashes) if hamming(query, value) <= 10)
+            found = self.index.lookup(query)
+            self.assertEqual(sorted(match['invoice_id'] for match in found), expected)
+            self.assertEqual(found[0]['distance'], 0)
+
+    def test_shared_between_workers(self):
+        """Test that hashes added by another worker are found, and removed hashes are not"""
+        other_worker = ImageHashIndex(self.database)
+        other_worker.add(0xA0828E8E8A9E9A32, 'inv-1', '201850448855', 'abc')
+
+        match, = self.index.lookup(0xA0828E8E8A9E9A33)
+        self.assertEqual((match['invoice_number'], match['file_hash'], match['distance']), ('201850448855', 'abc', 1))
+
+        self.index.remove('inv-1')
+        self.assertEqual(self.index.lookup(0xA0828E8E8A9E9A32), [])
+
+    def test_number_in_text(self):
+        """Test the invoice number confirmation"""
+        self.assertTrue(number_in_text('201850448855', 'Détail de votre facture N° 2018 5044 8855'))
+        self.assertTrue(number_in_text('INV-12345', 'facture inv 12345'))
+        self.assertFalse(number_in_text('201850448855', 'Détail de votre facture N° 201743204409'))
+        self.assertFalse(number_in_text(None, 'facture'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,20 @@
 import os
+import time
+import shutil
 import unittest
 import json
 from unittest.mock import patch, MagicMock
 
+from pydantic import ValidationError
+
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+from services.blob_store import DAY
 from services.invoice_processor import InvoiceProcessor
 from services.ocr_service import OCRService
 from services.llm_service import LLMService
+from utils.resilience import CircuitBreaker, DependencyUnavailable
 
 class TestInvoiceProcessor(unittest.TestCase):
     """Test cases for the InvoiceProcessor service"""
@@ -62,18 +68,14 @@ class TestInvoiceProcessor(unittest.TestCase):
         
         # Create the invoice processor with mocked services
         with patch('services.invoice_processor.OCRService', return_value=self.mock_ocr), \
-             patch('services.invoice_processor.LLMService', return_value=self.mock_llm):
-            #  patch.object(InvoiceProcessor, 'data_dir', self.test_data_dir):
+             patch('services.invoice_processor.LLMService', return_value=self.mock_llm), \
+             patch.dict(os.environ, {'DATA_DIR': self.test_data_dir}):
             self.processor = InvoiceProcessor()
     
     def tearDown(self):
         """Clean up test fixtures"""
-        # Remove test files
-        for filename in os.listdir(self.test_data_dir):
-            os.remove(os.path.join(self.test_data_dir, filename))
-        
-        # Remove test directory
-        os.rmdir(self.test_data_dir)
+        # Remove the test directory (database, blobs and analytics segments)
+        shutil.rmtree(self.test_data_dir)
     
     def test_process_invoice(self):
         """Test processing an invoice"""
@@ -98,14 +100,10 @@ class TestInvoiceProcessor(unittest.TestCase):
         self.assertEqual(result["invoice"]["provider"], "Energy Co")
         self.assertEqual(result["invoice"]["total_amount"], 150.75)
         
-        # Check that the invoice was saved
+        # Check that the invoice, analysis and recommendations were saved together
         invoice_id = result["invoice"]["id"]
-        invoice_file = os.path.join(self.test_data_dir, f"invoice_{invoice_id}.json")
-        self.assertTrue(os.path.exists(invoice_file))
-        
-        # Check that the recommendations were saved
-        recommendations_file = os.path.join(self.test_data_dir, f"recommendations_{invoice_id}.json")
-        self.assertTrue(os.path.exists(recommendations_file))
+        self.assertEqual(self.processor.get_full_result_by_id(invoice_id), result)
+        self.assertEqual(self.processor.result_store.get_ocr_text(invoice_id), "Sample OCR text from an energy invoice")
     
     def test_get_invoice(self):
         """Test retrieving an invoice"""
@@ -136,5 +134,280 @@ class TestInvoiceProcessor(unittest.TestCase):
         self.assertEqual(recommendations["potential_savings"], 45.25)
         self.assertEqual(recommendations["efficiency_score"], 70)
 
+    def test_get_invoice_file(self):
+        """Test that an uploaded file is resolved through its hash, even once archived"""
+        upload_path = os.path.join(self.test_data_dir, "upload.pdf")
+        with open(upload_path, "wb") as f:
+            f.write(b"%PDF-1.4 invoice")
+        blob = self.processor.blob_store.put(upload_path, "pdf")
+        result = self.processor.process_invoice(blob["path"], file_hash=blob["digest"])
+        invoice_id = result["invoice"]["id"]
+
+        self.assertNotIn("file_path", result["invoice"])
+        self.processor.blob_store.compact(now=time.time() + 8 * DAY)
+        with open(self.processor.get_invoice_file(invoice_id), "rb") as f:
+            self.assertEqual(f.read(), b"%PDF-1.4 invoice")
+        self.assertIsNone(self.processor.get_invoice_file("missing"))
+
+    def test_invalid_extraction_is_corrected(self):
+        """Test that invalid fields get one targeted correction request"""
+        invalid = dict(self.mock_llm.extract_invoice_data.return_value, total_amount="unknown")
+        self.mock_llm.extract_invoice_data.return_value = invalid
+        self.mock_llm.correct_json.return_value = json.dumps(dict(invalid, total_amount="150,75"))
+
+        result = self.processor.process_invoice("test_invoice.pdf")
+
+        stage_name, _, errors = self.mock_llm.correct_json.call_args[0]
+        self.assertEqual(stage_name, "extract")
+        self.assertEqual(errors, ["total_amount: expected a number, got 'unknown'"])
+        self.assertEqual(result["invoice"]["total_amount"], 150.75)
+
+    def test_invalid_extraction_is_not_stored(self):
+        """Test that an extraction still invalid after correction fails before anything is stored"""
+        self.mock_llm.extract_invoice_data.return_value = '{"total_amount": "unknown"'
+        self.mock_llm.correct_json.return_value = '{"total_amount": "still unknown"}'
+
+        with self.assertRaises(ValidationError):
+            self.processor.process_invoice("test_invoice.pdf")
+        self.mock_llm.analyze_invoice.assert_not_called()
+        self.assertEqual(self.processor.result_store.count(), 0)
+
+    def test_clean_invoice_skips_analysis(self):
+        """Test that a consistent invoice without penalties or peak-heavy consumption is not sent for analysis"""
+        clean = dict(self.mock_llm.extract_invoice_data.return_value, peak_kwh=100, off_peak_kwh=400, rate_per_kwh=None)
+        clean["items"] = [{"description": "CONSO. H. CREUSES", "quantity": 400, "unit_price": 0.25, "total": None},
+                          {"description": "CONSO. H. NORMALES", "quantity": 100, "unit_price": 0.25, "total": 25.00},
+                          {"description": "Service fee", "quantity": 1, "unit_price": 15.00, "total": 15.00}]
+        self.mock_llm.extract_invoice_data.return_value = clean
+
+        result = self.processor.process_invoice("test_invoice.pdf")
+
+        self.mock_llm.analyze_invoice.assert_not_called()
+        self.assertEqual(result["analysis"]["issues"], [])
+        self.assertTrue(result["analysis"]["consistency"]["consistent"])
+        # Derived from the energy items
+        self.assertEqual(result["invoice"]["items"][0]["total"], 100.0)
+        self.assertEqual(result["invoice"]["rate_per_kwh"], 0.25)
+
+    def test_progress_events(self):
+        """Test that each stage and the new result are published with the upload ID"""
+        last_id = self.processor.event_bus.latest_id()
+
+        result = self.processor.process_invoice("test_invoice.pdf", upload_id="upload-1")
+
+        events = self.processor.event_bus.since(last_id)
+        progress = [e['data'] for e in events if e['type'] == 'progress']
+        self.assertEqual([e['stage'] for e in progress],
+                         ['uploaded', 'ocr_done', 'extracted', 'analyzed', 'recommended'])
+        self.assertTrue(all(e['invoice_id'] == result['invoice']['id'] and e['upload_id'] == 'upload-1'
+                            for e in progress))
+        self.assertEqual(events[-1]['type'], 'invoice')
+        self.assertEqual(events[-1]['data']['result'], result)
+
+    def test_missing_fields_are_repaired(self):
+        """Test that a field left empty by the extraction is re-extracted from the OCR text"""
+        self.mock_ocr.process_file.return_value = "Facture LYDEC\nDate de l'édition : 02/05/2025\nMontant TTC : 150,75"
+        self.mock_llm.extract_invoice_data.return_value = dict(self.mock_llm.extract_invoice_data.return_value, issue_date=None)
+        self.mock_llm.extract_fields.return_value = '{"issue_date": "02/05/2025"}'
+        # The LLM service can be swapped after construction (as the benchmarks do)
+        self.processor.llm_service = replacement = MagicMock(wraps=self.mock_llm)
+
+        result = self.processor.process_invoice("test_invoice.pdf")
+
+        fields, snippet = replacement.extract_fields.call_args[0]
+        self.assertEqual(list(fields), ["issue_date"])
+        self.assertIn("Date de l'édition", snippet)
+        self.assertEqual(result["invoice"]["issue_date"], "2025-05-02")
+
+    def test_fused_pipeline(self):
+        """Test that the single-call mode replaces the three staged calls"""
+        self.mock_llm.process_invoice_fused.return_value = json.dumps({
+            "invoice": self.mock_llm.extract_invoice_data.return_value,
+            "analysis": {"issues": [{"description": "Dépassement de puissance", "severity": "high"}]},
+            "recommendations": self.mock_llm.generate_recommendations.return_value,
+        })
+        self.processor.fused_pipeline = True
+
+        result = self.processor.process_invoice("test_invoice.pdf")
+
+        self.mock_llm.extract_invoice_data.assert_not_called()
+        self.mock_llm.analyze_invoice.assert_not_called()
+        self.mock_llm.generate_recommendations.assert_not_called()
+        self.assertEqual(result["analysis"]["issues"][0]["severity"], "high")
+        self.assertIn("consistency", result["analysis"])
+        self.assertEqual(result["recommendations"]["invoice_id"], result["invoice"]["id"])
+
+    def test_fused_pipeline_falls_back(self):
+        """Test that an invalid single-call result falls back to the staged calls"""
+        self.mock_llm.process_invoice_fused.return_value = '{"invoice": {}, "analysis": {"issues": []}}'
+        self.processor.fused_pipeline = True
+
+        result = self.processor.process_invoice("test_invoice.pdf")
+
+        self.mock_llm.extract_invoice_data.assert_called_once()
+        self.mock_llm.generate_recommendations.assert_called_once()
+        self.mock_llm.correct_json.assert_not_called()
+        self.assertEqual(result["invoice"]["invoice_number"], "INV-12345")
+
+    def test_simulated_savings(self):
+        """Test that the simulated savings replace the LLM's estimates in the recommendations"""
+        invoice = dict(self.mock_llm.extract_invoice_data.return_value, max_power_kw=3, items=[
+            {"description": "CONSO. H. DE POINTE", "quantity": 300, "unit_price": 1.2, "total": 360},
+            {"description": "CONSO. H. CREUSES", "quantity": 200, "unit_price": 0.6, "total": 120},
+            {"description": "RDV. DE PUISSANCE", "quantity": 5, "unit_price": 10, "total": 50}
+        ])
+        self.mock_llm.extract_invoice_data.return_value = invoice
+        
+        result = self.processor.process_invoice("test_invoice.pdf")
+        
+        simulation = result["analysis"]["simulation"]
+        self.assertEqual(simulation["optimum"]["subscribed_power"], 3.0)
+        self.assertNotIn("curves", simulation)
+        # Sent to the LLM with the analysis
+        self.assertIn("simulation", self.mock_llm.generate_recommendations.call_args[0][1])
+        recommendations = result["recommendations"]
+        self.assertEqual(recommendations["potential_savings"], simulation["potential_savings"])
+        self.assertEqual(recommendations["efficiency_score"], simulation["efficiency_score"])
+        self.assertTrue(recommendations["savings_curves"]["subscribed_power"])
+
+    def test_failed_correction_keeps_history(self):
+        """Test that a correction failing before it is saved leaves the customer history and result unchanged"""
+        result = self.processor.process_invoice("test_invoice.pdf")
+        invoice_id = result["invoice"]["id"]
+        read_history = lambda: self.processor.database.connection.execute(
+            'SELECT customer, state FROM customer_history ORDER BY customer').fetchall()
+        history = [tuple(row) for row in read_history()]
+        
+        self.mock_llm.analyze_invoice.return_value = {"issues": ["Consumption doubled"], "severity": ["high"]}
+        with patch.object(self.processor, '_recommend', side_effect=RuntimeError('LLM failed')):
+            with self.assertRaises(RuntimeError):
+                self.processor.correct_invoice(invoice_id, {"period_end": "2025-05-31", "total_kwh": 1000})
+        
+        self.assertEqual([tuple(row) for row in read_history()], history)
+        self.assertEqual(self.processor.get_full_result_by_id(invoice_id), result)
+        
+        # Once saved, the corrected period replaces the recorded one
+        corrected = self.processor.correct_invoice(invoice_id, {"period_end": "2025-05-31", "total_kwh": 1000})
+        self.assertEqual(corrected["analysis"]["history"]["history_count"], 0)
+        state = json.loads(read_history()[0]['state'])
+        self.assertEqual(list(state['periods']), ['2025-05'])
+    
+    def test_failed_simulation_is_skipped(self):
+        """Test that an error of the tariff simulation leaves the invoice processed without simulation"""
+        with patch.object(self.processor.tariff_simulator, 'simulate', side_effect=ValueError('empty power grid')):
+            result = self.processor.process_invoice("test_invoice.pdf")
+        
+        self.assertNotIn("simulation", result["analysis"])
+        self.assertEqual(self.processor.get_full_result_by_id(result["invoice"]["id"]), result)
+    
+    def test_rephotographed_invoice_is_reused(self):
+        """Test that a new photo of a processed invoice reuses its result once the number is confirmed"""
+        from tests.test_image_hash_index import make_photo
+        
+        lines = [500, 320, 410, 200, 480, 150, 380, 260, 450, 300, 350, 220]
+        first = make_photo(os.path.join(self.test_data_dir, 'first.jpg'), lines)
+        second = make_photo(os.path.join(self.test_data_dir, 'second.jpg'), lines, scale=0.7, quality=50)
+        self.mock_ocr.process_file.return_value = "Facture N° INV 12345 - Energy Co"
+        
+        original = self.processor.process_invoice(first, file_hash='aaa')
+        duplicate = self.processor.process_invoice(second, file_hash='bbb')
+        
+        self.assertEqual(duplicate["invoice"]["id"], original["invoice"]["id"])
+        self.assertEqual(duplicate["duplicate_of"]["confirmation"], "confirmed")
+        self.assertEqual(self.mock_llm.extract_invoice_data.call_count, 1)
+        
+        # The same file again is reused without OCR
+        self.processor.process_invoice(first, file_hash='aaa')
+        self.assertEqual(self.mock_ocr.process_file.call_count, 2)
+        
+        # Another invoice with the same layout is processed
+        self.mock_ocr.process_file.return_value = "Facture N° INV 99999 - Energy Co"
+        other = self.processor.process_invoice(second, file_hash='ccc')
+        self.assertNotIn("duplicate_of", other)
+        self.assertEqual(self.mock_llm.extract_invoice_data.call_count, 2)
+
+    def test_submit_bundle(self):
+        """Test that each invoice of a split bundle is processed and recorded in the batch"""
+        segments = []
+        for pages in ([1, 2], [3, 3]):
+            path = os.path.join(self.test_data_dir, f"segment_p{pages[0]}-{pages[1]}.pdf")
+            with open(path, 'wb') as f:
+                f.write(b'%PDF-1.4')
+            segments.append({'pages': pages, 'invoice_number': None, 'path': path})
+        
+        done = self.processor.submit_bundle('tenant', 'interactive', 'bundle.pdf', segments, file_hash='abc')
+        result = done.result(timeout=30)
+        
+        batch = result["batch"]
+        self.assertEqual(batch["status"], "done")
+        self.assertEqual(len(result["results"]), 2)
+        self.assertTrue(all(r["invoice"]["batch_id"] == batch["id"] for r in result["results"]))
+        self.assertEqual(self.processor.get_batch(batch["id"])["invoices"][1]["pages"], [3, 3])
+        self.assertFalse(any(os.path.exists(segment['path']) for segment in segments))
+
+    def test_degraded_when_llm_unavailable(self):
+        """Test that the local rules take over while the LLM breaker is open, and stored files are served from cache"""
+        fixture = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'benchmarks', 'fixtures', 'ocr_text.txt')
+        with open(fixture, encoding='utf-8') as f:
+            self.mock_ocr.process_file.return_value = f.read()
+        unavailable = DependencyUnavailable('llm', 'open', retry_after=30)
+        for method in ('extract_invoice_data', 'analyze_invoice', 'generate_recommendations'):
+            getattr(self.mock_llm, method).side_effect = unavailable
+        
+        result = self.processor.process_invoice("test_invoice.pdf", file_hash='abc')
+        
+        self.assertEqual(result["analysis"]["degraded"], ['extract', 'analyze', 'recommend'])
+        self.assertEqual(result["invoice"]["invoice_number"], "201850448855")
+        self.assertEqual(result["invoice"]["total_amount"], 37108.35)
+        self.assertIn("dépassement", result["analysis"]["issues"][0]["description"])
+        self.assertTrue(result["recommendations"]["recommendations"])
+        
+        # With the breaker open, the same file is answered from its stored result without OCR
+        breaker = CircuitBreaker('llm', failure_threshold=1, recovery_time=60)
+        with self.assertRaises(ConnectionError):
+            breaker.call(MagicMock(side_effect=ConnectionError('refused')))
+        with patch('services.invoice_processor.get_breaker', return_value=breaker):
+            cached = self.processor.process_invoice("test_invoice.pdf", file_hash='abc')
+        self.assertTrue(cached["cached"])
+        self.assertEqual(cached["invoice"]["id"], result["invoice"]["id"])
+        self.assertEqual(self.mock_ocr.process_file.call_count, 1)
+    
+    def test_correct_invoice(self):
+        """Test that a correction recomputes only the stages reading the corrected fields"""
+        result = self.processor.process_invoice("test_invoice.pdf")
+        invoice_id = result["invoice"]["id"]
+        analyze_calls = self.mock_llm.analyze_invoice.call_count
+        
+        # The customer name only places the invoice in a history: the LLM analysis is kept
+        corrected = self.processor.correct_invoice(invoice_id, {"customer_name": "Jane Doe"})
+        
+        self.assertEqual(corrected["recomputed"], ['history', 'simulate'])
+        self.assertEqual(corrected["analysis"]["issues"], result["analysis"]["issues"])
+        self.assertEqual(self.mock_llm.analyze_invoice.call_count, analyze_calls)
+        self.mock_llm.generate_recommendations.assert_called_once()
+        self.assertEqual(self.processor.get_invoice(invoice_id)["customer_name"], "Jane Doe")
+        
+        # A corrected amount is checked and analyzed again
+        self.mock_llm.analyze_invoice.return_value = {"issues": ["Invoice total does not match its items"],
+                                                      "severity": ["high"]}
+        corrected = self.processor.correct_invoice(invoice_id, {"total_amount": 180.75, "peak_kwh": "450"})
+        
+        self.assertEqual(corrected["recomputed"], ['check', 'analyze', 'recommend'])
+        self.assertFalse(corrected["analysis"]["consistency"]["consistent"])
+        self.assertEqual(corrected["invoice"]["peak_kwh"], 450)
+        self.assertEqual(self.mock_llm.analyze_invoice.call_count, analyze_calls + 1)
+        self.assertEqual(self.mock_llm.generate_recommendations.call_count, 2)
+        self.assertEqual(self.processor.get_full_result_by_id(invoice_id)["analysis"], corrected["analysis"])
+        self.assertEqual([c["field"] for c in self.processor.get_corrections(invoice_id)],
+                         ['customer_name', 'total_amount', 'peak_kwh'])
+        
+        # Unchanged values recompute nothing; unknown fields and invalid values are refused
+        self.assertEqual(self.processor.correct_invoice(invoice_id, {"total_amount": 180.75})["recomputed"], [])
+        with self.assertRaises(ValueError):
+            self.processor.correct_invoice(invoice_id, {"file_hash": "abc"})
+        with self.assertRaises(ValidationError):
+            self.processor.correct_invoice(invoice_id, {"total_kwh": "a lot"})
+        self.assertIsNone(self.processor.correct_invoice("missing", {"customer_name": "Jane Doe"}))
+
 if __name__ == '__main__':
     unittest.main()
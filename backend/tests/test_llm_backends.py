@@ -0,0 +1,143 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.mock_servers import MockChatServer
+from services.llm_backends import (
+    BackendRouter, Completion, LLMBackend, OpenAICompatibleBackend, ReplayBackend, Usage, parse_stage_routes
+)
+from models.invoice import FusedInvoiceResult
+from services.llm_service import FUSED_RESPONSE_FORMAT, LLMService
+from services.ocr_service import OCRService
+from utils.replay import ReplayMiss, ReplayStore
+from utils.resilience import DependencyUnavailable
+
+MESSAGES = [{'role': 'system', 'content': 'You analyze energy invoices'}, {'role': 'user', 'content': 'x'}]
+
+class FakeBackend(LLMBackend):
+    """Backend answering with a fixed text, or failing"""
+
+    def __init__(self, name, content='{}', error=None):
+        super().__init__('fake')
+        self.name = name
+        self.content = content
+        self.error = error
+        self.calls = 0
+
+    def complete(self, messages, temperature=0.0, max_tokens=None, stage=None, response_format=None):
+        self.calls += 1
+        if self.error:
+            raise self.error
+        return Completion(self.content, Usage(10, 5), self.name, self.model)
+
+class TestLLMBackends(unittest.TestCase):
+    """Test cases for the LLM backends, stage routing and record/replay"""
+
+    def setUp(self):
+        """Set up a temporary recordings directory"""
+        self.replay_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Remove the temporary directory"""
+        shutil.rmtree(self.replay_dir)
+
+    def test_record_then_replay(self):
+        """Test that a recorded completion is replayed without calling the backend"""
+        inner = FakeBackend('groq', '{"issues": []}')
+        recorder = ReplayBackend(ReplayStore(self.replay_dir, 'record'), inner)
+        recorder.complete(MESSAGES, temperature=0.2, stage='analyze')
+
+        player = ReplayBackend(ReplayStore(self.replay_dir, 'replay'), inner)
+        completion = player.complete(MESSAGES, temperature=0.2, stage='analyze')
+
+        self.assertEqual(inner.calls, 1)
+        self.assertEqual(completion.content, '{"issues": []}')
+        self.assertEqual(completion.usage.prompt_tokens, 10)
+
+    def test_replay_miss(self):
+        """Test that an unrecorded request fails in replay mode instead of reaching the network"""
+        inner = FakeBackend('groq')
+        player = ReplayBackend(ReplayStore(self.replay_dir, 'replay'), inner)
+
+        with self.assertRaises(ReplayMiss):
+            player.complete(MESSAGES, temperature=0.7, stage='analyze')
+        self.assertEqual(inner.calls, 0)
+
+    def test_router_prefers_fastest(self):
+        """Test that unmeasured backends are tried first, then the fastest one"""
+        fast, slow = FakeBackend('local'), FakeBackend('groq')
+        router = BackendRouter([slow, fast])
+        router._latency[('extract', 'groq')] = 2.0
+        router._latency[('extract', 'local')] = 0.5
+
+        self.assertEqual([b.name for b in router.candidates('extract')], ['local', 'groq'])
+        self.assertEqual([b.name for b in router.candidates('analyze')], ['groq', 'local'])
+
+    def test_router_fallback(self):
+        """Test that a failing backend falls back to the next one and is skipped while cooling down"""
+        broken = FakeBackend('local', error=ConnectionError('refused'))
+        groq = FakeBackend('groq', '{"ok": true}')
+        router = BackendRouter([broken, groq], stages={'extract': ['local', 'groq']}, cooldown=60)
+
+        self.assertEqual(router.complete(MESSAGES, stage='extract').backend, 'groq')
+        router.complete(MESSAGES, stage='extract')
+        self.assertEqual(broken.calls, 1)
+        self.assertEqual(groq.calls, 2)
+
+    def test_router_stage_without_configured_backend(self):
+        """Test that a stage routed only to unconfigured backends is reported unavailable"""
+        router = BackendRouter([FakeBackend('groq', '{"ok": true}')], stages={'extract': ['local']})
+
+        with self.assertRaises(DependencyUnavailable):
+            router.complete(MESSAGES, stage='extract')
+        self.assertEqual(router.complete(MESSAGES, stage='analyze').backend, 'groq')
+
+    def test_parse_stage_routes(self):
+        """Test the LLM_STAGE_BACKENDS format"""
+        self.assertEqual(parse_stage_routes('extract=local, groq; analyze=groq;'),
+                         {'extract': ['local', 'groq'], 'analyze': ['groq']})
+        self.assertEqual(parse_stage_routes(None), {})
+
+    def test_openai_compatible_backend(self):
+        """Test a local OpenAI-compatible server through the LLM service"""
+        with MockChatServer() as server:
+            service = LLMService(api_key='test', backend=OpenAICompatibleBackend(server.url + '/v1', 'local-model'))
+            analysis = json.loads(service.analyze_invoice({'invoice_number': 'A-1'}))
+
+        self.assertIn('issues', analysis)
+
+    def test_fused_structured_output(self):
+        """Test that the single-call mode sends its JSON schema and validates into the fused model"""
+        with MockChatServer() as server:
+            service = LLMService(api_key='test', backend=OpenAICompatibleBackend(server.url + '/v1', 'local-model'))
+            result = FusedInvoiceResult.model_validate_json(service.process_invoice_fused('CONSO. H. CREUSES'))
+
+        schema = FUSED_RESPONSE_FORMAT['json_schema']['schema']
+        self.assertNotIn('file_path', schema['$defs']['Invoice']['properties'])
+        self.assertTrue(result.recommendations.recommendations)
+
+    def test_ocr_replay(self):
+        """Test that OCR results are recorded by file content and replayed"""
+        file_path = os.path.join(self.replay_dir, 'invoice.pdf')
+        with open(file_path, 'wb') as f:
+            f.write(b'%PDF-1.4')
+
+        with patch.dict(os.environ, {'REPLAY_MODE': 'record', 'REPLAY_DIR': self.replay_dir}):
+            recorder = OCRService(api_key='test')
+        recorder.process_pdf = MagicMock(return_value='CONSO. H. CREUSES')
+        recorder.process_file(file_path)
+
+        with patch.dict(os.environ, {'REPLAY_MODE': 'replay', 'REPLAY_DIR': self.replay_dir}):
+            player = OCRService(api_key='test')
+        player.process_pdf = MagicMock(side_effect=AssertionError('OCR called'))
+
+        self.assertEqual(player.process_file(file_path), 'CONSO. H. CREUSES')
+
+if __name__ == '__main__':
+    unittest.main()
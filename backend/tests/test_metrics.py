@@ -0,0 +1,67 @@
+import os
+import unittest
+from types import SimpleNamespace
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.metrics import MetricsRegistry, STAGE_DURATION, LLM_TOKENS, cached_prompt_tokens, record_llm_usage, stage, start_trace, get_trace_id
+
+class TestMetrics(unittest.TestCase):
+    """Test cases for the metrics registry and stage instrumentation"""
+
+    def test_histogram_rendering(self):
+        """Test that histograms render cumulative buckets, sum and count"""
+        registry = MetricsRegistry()
+        histogram = registry.histogram('test_seconds', 'Test histogram', ['stage'], buckets=(0.1, 1))
+        histogram.observe(0.05, stage='a')
+        histogram.observe(0.5, stage='a')
+        histogram.observe(5, stage='a')
+        registry.counter('test_total', 'Test counter').inc(2)
+
+        text = registry.render()
+
+        self.assertIn('# TYPE test_seconds histogram', text)
+        self.assertIn('test_seconds_bucket{stage="a",le="0.1"} 1', text)
+        self.assertIn('test_seconds_bucket{stage="a",le="1"} 2', text)
+        self.assertIn('test_seconds_bucket{stage="a",le="+Inf"} 3', text)
+        self.assertIn('test_seconds_count{stage="a"} 3', text)
+        self.assertIn('test_total 2', text)
+
+    def test_stage_records_errors(self):
+        """Test that a failing stage is recorded with an error status and re-raised"""
+        with self.assertRaises(RuntimeError):
+            with stage('test_failing'):
+                raise RuntimeError('boom')
+
+        self.assertIn('aienergy_stage_duration_seconds_count{stage="test_failing",status="error"} 1',
+                      '\n'.join(STAGE_DURATION.render()))
+
+    def test_llm_usage(self):
+        """Test that token usage is read from the completion usage"""
+        usage = record_llm_usage('test_stage', SimpleNamespace(prompt_tokens=1200, completion_tokens=300))
+
+        self.assertEqual(usage, {'prompt_tokens': 1200, 'completion_tokens': 300})
+        self.assertIn('aienergy_llm_tokens_sum{stage="test_stage",kind="prompt"} 1200',
+                      '\n'.join(LLM_TOKENS.render()))
+        self.assertEqual(record_llm_usage('test_stage', None), {'prompt_tokens': 0, 'completion_tokens': 0})
+
+    def test_cached_prompt_tokens(self):
+        """Test that prefix cache hits are read from the usage details"""
+        usage = SimpleNamespace(prompt_tokens=1200, completion_tokens=300,
+                                prompt_tokens_details=SimpleNamespace(cached_tokens=1000))
+        record_llm_usage('cached_stage', usage)
+
+        self.assertEqual(cached_prompt_tokens(usage), 1000)
+        self.assertEqual(cached_prompt_tokens({'prompt_tokens': 10}), 0)
+        self.assertIn('aienergy_llm_tokens_sum{stage="cached_stage",kind="cached"} 1000',
+                      '\n'.join(LLM_TOKENS.render()))
+
+    def test_trace_id(self):
+        """Test that a given request ID is reused as trace ID"""
+        self.assertEqual(start_trace('abc'), 'abc')
+        self.assertEqual(get_trace_id(), 'abc')
+        self.assertEqual(len(start_trace()), 32)
+
+if __name__ == '__main__':
+    unittest.main()
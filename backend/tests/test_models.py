@@ -0,0 +1,64 @@
+import os
+import unittest
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pydantic import ValidationError
+
+from models.invoice import Invoice, InvoiceAnalysis, InvoiceRecommendation, InvoiceSummary, describe_errors
+
+class TestModels(unittest.TestCase):
+    """Test cases for the invoice models used to validate LLM responses"""
+
+    def test_invoice_from_json(self):
+        """Test that numbers, dates and invoice numbers are normalized"""
+        invoice = Invoice.model_validate_json(
+            '{"provider": "LYDEC", "invoice_number": 201850448855, "issue_date": "15/04/2018",'
+            ' "total_amount": "13 818,99", "total_kwh": null, "unknown_key": 1,'
+            ' "items": [{"description": "CONSO. H. CREUSES", "quantity": 6898, "unit_price": "0,64895", "total": 4476.46}],'
+            ' "taxes": {"14%": "4 412,82"}}'
+        )
+
+        self.assertEqual(invoice.invoice_number, '201850448855')
+        self.assertEqual(invoice.issue_date, '2018-04-15')
+        self.assertEqual(invoice.total_amount, 13818.99)
+        self.assertEqual(invoice.items[0].unit_price, 0.64895)
+        self.assertEqual(invoice.taxes, {'14%': 4412.82})
+        self.assertNotIn('unknown_key', invoice.model_dump())
+
+    def test_field_level_errors(self):
+        """Test that invalid fields are reported with their location"""
+        with self.assertRaises(ValidationError) as context:
+            Invoice.model_validate_json('{"issue_date": "soon", "items": [{"total": "n/a"}]}')
+
+        self.assertEqual(describe_errors(context.exception), [
+            "issue_date: expected a date in YYYY-MM-DD format, got 'soon'",
+            "items.0.total: expected a number, got 'n/a'",
+        ])
+        with self.assertRaises(ValidationError):
+            Invoice.model_validate_json('{"provider": "LYDEC"')
+
+    def test_analysis_and_recommendations(self):
+        """Test both issue layouts and the efficiency score range"""
+        analysis = InvoiceAnalysis.model_validate_json(
+            '{"issues": [{"description": "Pénalités de dépassement", "severity": "high"}, "Heures pleines"],'
+            ' "severity": ["high", "medium"]}'
+        )
+        self.assertEqual(analysis.issues[0].severity, 'high')
+        self.assertEqual(analysis.issues[1], 'Heures pleines')
+
+        recommendation = InvoiceRecommendation.model_validate({"recommendations": ["x"], "efficiency_score": "70"})
+        self.assertEqual(recommendation.efficiency_score, 70)
+        with self.assertRaises(ValidationError):
+            InvoiceRecommendation.model_validate({"recommendations": ["x"], "efficiency_score": 140})
+
+    def test_summary(self):
+        """Test that summaries are slots-based"""
+        summary = InvoiceSummary('a', 'LYDEC')
+
+        self.assertFalse(hasattr(summary, '__dict__'))
+        self.assertEqual(summary.to_dict()['provider'], 'LYDEC')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.ocr_service import OCRService
+from tests.test_document_splitter import make_bundle_pdf
+from utils.resilience import CircuitBreaker, DependencyUnavailable
+
+def load_fixture(name):
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks', 'fixtures', name)
+    with open(path, encoding='utf-8') as f:
+        return f.read()
+
+class TestOCRService(unittest.TestCase):
+    """Test cases for the hedged PDF extraction"""
+
+    def setUp(self):
+        """Set up a hedged OCR service with a mock LLMWhisperer client"""
+        self.tmp_dir = tempfile.mkdtemp()
+        with patch.dict(os.environ, {'HEDGED_OCR': '1'}):
+            self.service = OCRService(api_key='test')
+        self.service.poll_interval = 0.01
+        self.service.breaker = CircuitBreaker('llmwhisperer')
+        self.service.client = MagicMock()
+        self.service.client.whisper.return_value = {'status_code': 202, 'whisper_hash': 'abc'}
+        self.service.client.whisper_status.return_value = {'status_code': 200, 'status': 'processing'}
+
+    def tearDown(self):
+        """Remove the temporary directory"""
+        shutil.rmtree(self.tmp_dir)
+
+    def test_complete_text_layer_wins(self):
+        """Test that a text layer covering the invoice is used and LLMWhisperer is no longer awaited"""
+        path = make_bundle_pdf(os.path.join(self.tmp_dir, 'invoice.pdf'), [load_fixture('ocr_text.txt')])
+
+        text = self.service.process_pdf(path)
+
+        self.assertIn('201850448855', text)
+        self.service.client.whisper_retrieve.assert_not_called()
+
+    def test_incomplete_text_layer_waits_for_remote(self):
+        """Test that LLMWhisperer's text is used when the text layer misses the invoice anchors"""
+        path = make_bundle_pdf(os.path.join(self.tmp_dir, 'scan.pdf'), ['Page scannee'])
+        self.service.client.whisper_status.return_value = {'status_code': 200, 'status': 'processed'}
+        self.service.client.whisper_retrieve.return_value = {'status_code': 200,
+                                                             'extraction': {'result_text': 'Remote text'}}
+
+        self.assertEqual(self.service.process_pdf(path), 'Remote text')
+
+    def test_remote_failure_falls_back_to_text_layer(self):
+        """Test that the text layer is used when LLMWhisperer fails, unless it is blank and the service unavailable"""
+        path = make_bundle_pdf(os.path.join(self.tmp_dir, 'partial.pdf'), ['CONSO. H. CREUSES 6 898'])
+        self.service.client.whisper_status.return_value = {'status_code': 500, 'status': 'error', 'message': 'down'}
+
+        self.assertIn('CREUSES', self.service.process_pdf(path))
+
+        self.service.breaker = CircuitBreaker('llmwhisperer', failure_threshold=1, recovery_time=60)
+        with self.assertRaises(RuntimeError):
+            self.service.breaker.call(MagicMock(side_effect=RuntimeError('down')))
+        blank = make_bundle_pdf(os.path.join(self.tmp_dir, 'blank.pdf'), [''])
+        with self.assertRaises(DependencyUnavailable):
+            self.service.process_pdf(blank)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import os
+import unittest
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.mock_servers import MockChatServer
+from benchmarks.prompt_cache import run
+from services.llm_backends import OpenAICompatibleBackend
+from services.prompts import ANALYZE, PROMPTS, RECOMMEND, get_prompt, prompt_versions
+
+class TestPrompts(unittest.TestCase):
+    """Test cases for the prompt registry"""
+
+    def test_static_system_prefix(self):
+        """Test that the system message does not depend on the invoice and the data comes last"""
+        first = ANALYZE.render(invoice_data={'invoice_number': 'A-1', 'total_kwh': 1000})
+        second = ANALYZE.render(invoice_data={'invoice_number': 'B-2', 'total_kwh': 2000})
+
+        self.assertEqual(first[0], second[0])
+        self.assertIn('Essentiel pour l\'optimisation des redevances électriques', first[0]['content'])
+        self.assertTrue(first[1]['content'].endswith('{"invoice_number":"A-1","total_kwh":1000}'))
+
+    def test_registry(self):
+        """Test that every prompt is registered with a version and renders all its placeholders"""
+        self.assertIs(get_prompt('recommend'), RECOMMEND)
+        self.assertEqual(RECOMMEND.id, 'recommend@v3')
+        self.assertEqual(set(prompt_versions()), set(PROMPTS))
+        with self.assertRaises(KeyError):
+            RECOMMEND.render(invoice_data={})
+        messages = RECOMMEND.render(invoice_data={}, analysis={'issues': []})
+        self.assertNotIn('$', messages[1]['content'])
+
+    def test_cached_prefix(self):
+        """Test that a second invoice reuses the cached system prefix of a local server"""
+        with MockChatServer(prefix_cache=True) as server:
+            backend = OpenAICompatibleBackend(server.url + '/v1', 'local-model')
+            backend.complete(ANALYZE.render(invoice_data={'invoice_number': 'A-1'}))
+            usage = backend.complete(ANALYZE.render(invoice_data={'invoice_number': 'B-2'})).usage
+
+        self.assertGreater(usage.cached_tokens, len(ANALYZE.system) // 4)
+        self.assertLess(usage.cached_tokens, usage.prompt_tokens)
+
+    def test_cache_benchmark(self):
+        """Test that the registry layout gets a higher cached share than the inline one"""
+        report = run(invoices=3, prefill_latency=0.0)
+
+        for stage_name in ('extract', 'analyze', 'recommend'):
+            self.assertGreater(report['registry'][stage_name]['cached_share'],
+                               report['inline'][stage_name]['cached_share'])
+
+if __name__ == '__main__':
+    unittest.main()
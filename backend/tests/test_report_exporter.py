@@ -0,0 +1,133 @@
+import io
+import os
+import csv
+import shutil
+import zipfile
+import tempfile
+import unittest
+from unittest.mock import patch
+from xml.etree import ElementTree
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+
+from services.analytics_store import AnalyticsStore
+from services.report_exporter import REPORT_COLUMNS, export_report
+from tests.test_analytics_store import make_invoice
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+HEADERS = [header for header, _ in REPORT_COLUMNS]
+SHEET_NS = {'s': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'}
+
+def read_xlsx(data: bytes) -> list:
+    """Read the rows of the exported worksheet (cell text, None for empty cells)"""
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        root = ElementTree.fromstring(archive.read('xl/worksheets/sheet1.xml'))
+    rows = []
+    for row in root.iterfind('.//s:row', SHEET_NS):
+        rows.append([cell.findtext('.//s:t', namespaces=SHEET_NS) or cell.findtext('s:v', namespaces=SHEET_NS)
+                     for cell in row.iterfind('s:c', SHEET_NS)])
+    return rows
+
+class TestReportExporter(unittest.TestCase):
+    """Test cases for the streaming report exporter and the export endpoint"""
+
+    def setUp(self):
+        """Set up an analytics store with three invoices"""
+        self.store_dir = tempfile.mkdtemp()
+        self.store = AnalyticsStore(self.store_dir)
+        self.store.add_invoice(make_invoice('a'))
+        self.store.add_invoice(make_invoice('b', provider='ONEE'))
+        self.store.add_invoice(make_invoice('c', period_end='2018-06-01'))
+
+    def tearDown(self):
+        """Remove the temporary directory"""
+        shutil.rmtree(self.store_dir)
+
+    def export(self, export_format, filters=None, chunk_size=1000) -> bytes:
+        return b''.join(export_report(self.store.select(filters), export_format, chunk_size))
+
+    def test_csv(self):
+        """Test the CSV header and rows, with filters applied"""
+        rows = list(csv.reader(io.StringIO(self.export('csv', {'provider': 'LYDEC'}).decode('utf-8'))))
+
+        self.assertEqual(rows[0], HEADERS)
+        self.assertEqual(sorted(row[0] for row in rows[1:]), ['a', 'c'])
+        self.assertEqual(rows[1][6], '500.0')
+
+    def test_xlsx(self):
+        """Test that the streamed workbook holds the header and every row"""
+        rows = read_xlsx(self.export('xlsx', chunk_size=2))
+
+        self.assertEqual(rows[0], HEADERS)
+        self.assertEqual(sorted(row[0] for row in rows[1:]), ['a', 'b', 'c'])
+        # Missing values are empty cells
+        self.assertIsNone(rows[1][HEADERS.index('due_date')])
+
+    @unittest.skipIf(openpyxl is None, 'openpyxl is not installed')
+    def test_xlsx_opens_in_openpyxl(self):
+        """Test that the workbook is readable by a spreadsheet library"""
+        workbook = openpyxl.load_workbook(io.BytesIO(self.export('xlsx', chunk_size=1)), read_only=True)
+        rows = list(workbook.active.iter_rows(values_only=True))
+
+        self.assertEqual(list(rows[0]), HEADERS)
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[1][HEADERS.index('total_amount')], 500)
+
+    def test_empty_exports(self):
+        """Test that an empty selection still produces a header"""
+        filters = {'provider': 'NONE'}
+
+        self.assertEqual(self.export('csv', filters).decode('utf-8').strip(), ','.join(HEADERS))
+        self.assertEqual(read_xlsx(self.export('xlsx', filters)), [HEADERS])
+        if pq is not None:
+            table = pq.read_table(io.BytesIO(self.export('parquet', filters)))
+            self.assertEqual(table.column_names, HEADERS)
+            self.assertEqual(table.num_rows, 0)
+
+    @unittest.skipIf(pq is None, 'pyarrow is not installed')
+    def test_parquet_row_groups(self):
+        """Test that each chunk is written as one row group"""
+        data = self.export('parquet', {'period_to': '2018-05'}, chunk_size=1)
+        parquet_file = pq.ParquetFile(io.BytesIO(data))
+
+        self.assertEqual(parquet_file.metadata.num_row_groups, 2)
+        table = parquet_file.read()
+        self.assertEqual(table.column_names, HEADERS)
+        self.assertEqual(sorted(table.column('id').to_pylist()), ['a', 'b'])
+        self.assertEqual(table.column('total_amount').to_pylist(), [500.0, 500.0])
+
+    def test_endpoint_errors(self):
+        """Test the 400 answers for an unknown format and for Parquet without pyarrow"""
+        from api.routes import api_bp
+        app = Flask(__name__)
+        app.register_blueprint(api_bp, url_prefix='/api')
+        client = app.test_client()
+
+        with patch('api.routes.invoice_processor') as processor:
+            processor.export_report.side_effect = lambda export_format, filters: export_report(
+                self.store.select(filters), export_format)
+
+            self.assertEqual(client.get('/api/reports/export?format=pdf').status_code, 400)
+            response = client.get('/api/reports/export?format=csv&provider=ONEE')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.data.decode('utf-8').strip().splitlines()), 2)
+
+            with patch.dict(sys.modules, {'pyarrow': None, 'pyarrow.parquet': None}):
+                response = client.get('/api/reports/export?format=parquet')
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('pyarrow', response.get_json()['error'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import os
+import time
+import threading
+import unittest
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.resilience import (
+    CircuitBreaker, Deadline, DeadlineExceeded, DependencyUnavailable, call_timeout, deadline_scope
+)
+
+def fail():
+    raise ConnectionError('refused')
+
+class TestResilience(unittest.TestCase):
+    """Test cases for the circuit breakers and request deadlines"""
+
+    def test_breaker_opens_and_sheds(self):
+        """Test that consecutive failures open the breaker and later calls are refused without the call"""
+        breaker = CircuitBreaker('test', failure_threshold=2, recovery_time=60)
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                breaker.call(fail)
+
+        calls = []
+        with self.assertRaises(DependencyUnavailable) as raised:
+            breaker.call(calls.append, 1)
+        self.assertEqual(calls, [])
+        self.assertEqual(raised.exception.reason, 'open')
+        self.assertGreater(raised.exception.retry_after, 50)
+        self.assertFalse(breaker.available())
+        self.assertEqual(breaker.snapshot()['state'], 'open')
+        self.assertEqual(breaker.snapshot()['shed'], 1)
+
+    def test_half_open_probe(self):
+        """Test that after the recovery time one probe is let through and its success closes the breaker"""
+        breaker = CircuitBreaker('test', failure_threshold=1, recovery_time=0.05)
+        with self.assertRaises(ConnectionError):
+            breaker.call(fail)
+        time.sleep(0.06)
+
+        self.assertTrue(breaker.available())
+        self.assertEqual(breaker.call(lambda: 'ok'), 'ok')
+        self.assertEqual(breaker.state, 'closed')
+
+        # A failed probe reopens it at once
+        with self.assertRaises(ConnectionError):
+            breaker.call(fail)
+        time.sleep(0.06)
+        with self.assertRaises(ConnectionError):
+            breaker.call(fail)
+        self.assertEqual(breaker.state, 'open')
+
+    def test_slow_calls_count_as_failures(self):
+        """Test that successful calls slower than the limit open the breaker"""
+        breaker = CircuitBreaker('test', failure_threshold=1, recovery_time=60, slow_call=0.01)
+        self.assertEqual(breaker.call(lambda: time.sleep(0.02) or 'late'), 'late')
+        self.assertEqual(breaker.state, 'open')
+        self.assertIn('slow call', breaker.snapshot()['last_error'])
+
+    def test_concurrency_limit(self):
+        """Test that calls beyond the concurrency limit are refused while the others run"""
+        breaker = CircuitBreaker('test', max_concurrent=1)
+        started, release = threading.Event(), threading.Event()
+
+        def slow():
+            started.set()
+            release.wait(5)
+
+        worker = threading.Thread(target=breaker.call, args=(slow,))
+        worker.start()
+        started.wait(5)
+        try:
+            with self.assertRaises(DependencyUnavailable) as raised:
+                breaker.call(lambda: None)
+            self.assertEqual(raised.exception.reason, 'busy')
+        finally:
+            release.set()
+            worker.join()
+        self.assertEqual(breaker.state, 'closed')
+        self.assertIsNone(breaker.call(lambda: None))
+
+    def test_call_timeout(self):
+        """Test that call timeouts are shortened to the current deadline and fail once it has passed"""
+        self.assertEqual(call_timeout(200), 200)
+        with deadline_scope(Deadline(5)):
+            self.assertLessEqual(call_timeout(200), 5)
+            self.assertEqual(call_timeout(1), 1)
+        with deadline_scope(Deadline(0)):
+            with self.assertRaises(DeadlineExceeded):
+                call_timeout(200, 'extract')
+        self.assertEqual(call_timeout(200), 200)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import os
+import json
+import tempfile
+import threading
+import unittest
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.result_store import ResultStore
+from utils.database import COMMIT_BATCH_SIZE, Database, GroupCommitter
+
+def make_result(invoice_id: str) -> dict:
+    return {
+        'invoice': {'id': invoice_id, 'provider': 'ONEE', 'total_amount': 12.5},
+        'analysis': {'issues': [], 'severity': []},
+        'recommendations': {'invoice_id': invoice_id, 'recommendations': ['Réduire la puissance souscrite']},
+    }
+
+class TestResultStore(unittest.TestCase):
+    """Test cases for the ResultStore service and the group committer"""
+
+    def setUp(self):
+        """Create a store in a temporary directory"""
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.database = Database(os.path.join(self.temp_dir.name, 'test.db'))
+        self.store = ResultStore(self.database)
+
+    def tearDown(self):
+        self.store.committer.close()
+        self.temp_dir.cleanup()
+
+    def test_save_and_get(self):
+        """Test that all artifacts of an invoice are stored and read back"""
+        self.store.save(make_result('a'), 'OCR text')
+        self.store.save(make_result('b'))
+
+        self.assertEqual(self.store.get('a'), make_result('a'))
+        self.assertIsNone(self.store.get('missing'))
+        self.assertEqual(self.store.get_ocr_text('a'), 'OCR text')
+        self.assertEqual([invoice['id'] for invoice in self.store.invoices()], ['a', 'b'])
+        self.assertEqual(json.loads(self.store.all_json()), self.store.all())
+
+    def test_concurrent_saves_are_batched(self):
+        """Test that writes queued during a commit share the next transaction"""
+        committer = self.store.committer
+        started, release = threading.Event(), threading.Event()
+        blocker = threading.Thread(target=committer.submit, args=(lambda conn: started.set() or release.wait(),))
+        blocker.start()
+        started.wait()
+        before = COMMIT_BATCH_SIZE._series.get((), {}).get('count', 0)
+
+        errors = []
+        def save(index):
+            try:
+                if index:
+                    self.store.save(make_result(str(index)))
+                else:
+                    committer.submit(lambda conn: conn.execute('INSERT INTO invoice_results (invoice_id) VALUES (0)'))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=save, args=(i,)) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        while committer._queue.qsize() < len(threads):
+            pass
+        release.set()
+        for thread in threads + [blocker]:
+            thread.join()
+
+        # The blocking operation's transaction, then one for all ten saves
+        self.assertEqual(COMMIT_BATCH_SIZE._series[()]['count'] - before, 2)
+        # The invalid write fails alone
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(self.store.count(), 9)
+
+    def test_committer_rolls_back_failed_operation(self):
+        """Test that a failing operation's statements are rolled back"""
+        committer = GroupCommitter(self.database)
+        self.database.executescript('CREATE TABLE t (x INTEGER)')
+
+        def failing(conn):
+            conn.execute('INSERT INTO t VALUES (1)')
+            raise RuntimeError('boom')
+
+        with self.assertRaises(RuntimeError):
+            committer.submit(failing)
+        committer.submit(lambda conn: conn.execute('INSERT INTO t VALUES (2)'))
+        committer.close()
+
+        rows = self.database.connection.execute('SELECT x FROM t').fetchall()
+        self.assertEqual([row[0] for row in rows], [2])
+
+    def test_recover(self):
+        """Test importing legacy JSON files, setting aside truncated ones"""
+        data_dir = os.path.join(self.temp_dir.name, 'data')
+        full_results_dir = os.path.join(data_dir, 'full_results')
+        os.makedirs(full_results_dir)
+        with open(os.path.join(full_results_dir, 'a.json'), 'w') as f:
+            json.dump(make_result('a'), f)
+        with open(os.path.join(full_results_dir, 'b.json'), 'w') as f:
+            f.write(json.dumps(make_result('b'))[:40])
+        result = make_result('c')
+        for name in ('invoice', 'analysis', 'recommendations'):
+            with open(os.path.join(data_dir, f'{name}_c.json'), 'w') as f:
+                json.dump(result[name], f)
+
+        self.assertEqual(self.store.recover(data_dir, full_results_dir), 2)
+        self.assertEqual(self.store.get('a'), make_result('a'))
+        self.assertEqual(self.store.get('c'), result)
+        self.assertIsNone(self.store.get('b'))
+        self.assertTrue(os.path.exists(os.path.join(full_results_dir, 'b.json.corrupt')))
+        # Already imported results are not read again
+        self.assertEqual(self.store.recover(data_dir, full_results_dir), 0)
+
+if __name__ == '__main__':
+    unittest.main()
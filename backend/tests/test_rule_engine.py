@@ -0,0 +1,69 @@
+import os
+import unittest
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.consistency_checker import check_invoice
+from services.rule_engine import analyze, extract_invoice, recommend
+from utils.invoice_utils import classify_issue
+
+def load_fixture(name):
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks', 'fixtures', name)
+    with open(path, encoding='utf-8') as f:
+        return f.read()
+
+class TestRuleEngine(unittest.TestCase):
+    """Test cases for the local extraction, analysis and recommendations"""
+
+    def setUp(self):
+        """Extract the fixture invoice"""
+        self.invoice = extract_invoice(load_fixture('ocr_text.txt')).model_dump()
+
+    def test_extract_invoice(self):
+        """Test that the header fields, item table and VAT lines are read from the OCR text"""
+        self.assertEqual(self.invoice['provider'], 'LYDEC')
+        self.assertEqual(self.invoice['invoice_number'], '201850448855')
+        self.assertEqual(self.invoice['period_start'], '2018-03-01')
+        self.assertEqual(self.invoice['total_kwh'], 28617)
+        self.assertEqual(len(self.invoice['items']), 7)
+        self.assertEqual(self.invoice['items'][0],
+                         {'description': 'CONSO. H. NORMALES', 'quantity': 15596, 'unit_price': 0.88606, 'total': 13818.99})
+        self.assertEqual(self.invoice['taxes'], {'7%': 31.52, '14%': 4412.82, '20%': 115.59})
+
+        # The items are consistent, so the checker derives the missing totals
+        report = check_invoice(self.invoice)
+        self.assertTrue(report['consistent'])
+        self.assertEqual(report['derived']['total_amount'], 37108.35)
+
+    def test_analyze_and_recommend(self):
+        """Test that penalty items and history flags lead to the catalogue actions"""
+        analysis = analyze(self.invoice, check_invoice(self.invoice))
+
+        self.assertEqual([classify_issue(issue['description']) for issue in analysis['issues']], ['power_overrun'])
+
+        analysis['history'] = {'flags': ['oversized_subscribed_power']}
+        recommendations = recommend(analysis)
+        self.assertEqual(len(recommendations['recommendations']), 2)
+        self.assertIn('peak shaving', recommendations['recommendations'][0])
+        self.assertIsNone(recommendations['potential_savings'])
+        self.assertEqual(recommendations['efficiency_score'], 85)
+
+    def test_recommend_with_simulation(self):
+        """Test that the simulated optimum is quoted with its savings"""
+        simulation = {
+            'current': {'subscribed_power': 5.0, 'cost': 100.0},
+            'optimum': {'subscribed_power': 8.0, 'load_shift': 0.1, 'cost': 80.0},
+            'potential_savings': 20.0,
+            'savings_breakdown': {'subscribed_power': 15.0, 'load_shift': 5.0},
+            'efficiency_score': 80.0,
+        }
+        recommendations = recommend({'issues': []}, simulation)
+
+        self.assertEqual(len(recommendations['recommendations']), 2)
+        self.assertIn('de 5 à 8', recommendations['recommendations'][0])
+        self.assertIn('10 %', recommendations['recommendations'][1])
+        self.assertEqual(recommendations['potential_savings'], 20.0)
+
+if __name__ == '__main__':
+    unittest.main()
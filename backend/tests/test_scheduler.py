@@ -0,0 +1,120 @@
+import os
+import threading
+import unittest
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.scheduler import QUEUE_WAIT, ProcessingScheduler, SchedulerFull, TokenBucket
+
+class TestProcessingScheduler(unittest.TestCase):
+    """Test cases for the priority and fair-share processing queue"""
+
+    def setUp(self):
+        """Set up a processing function recording the order jobs run in"""
+        self.order = []
+        self.release = threading.Event()
+        self.started = threading.Event()
+
+        def process(name):
+            if name == 'blocker':
+                self.started.set()
+                self.release.wait(5)
+            self.order.append(name)
+            return name
+
+        self.process = process
+
+    def run_queued(self, scheduler, jobs):
+        """Queue jobs behind a blocking one, then release it and wait for all of them"""
+        futures = [scheduler.submit('blocker', 'interactive', 'blocker')]
+        self.assertTrue(self.started.wait(5))
+        futures += [scheduler.submit(tenant, priority, name) for tenant, priority, name in jobs]
+        self.release.set()
+        for future in futures:
+            future.result(5)
+        scheduler.close()
+        return self.order[1:]
+
+    def test_interactive_before_bulk(self):
+        """Test that interactive jobs overtake queued bulk jobs"""
+        scheduler = ProcessingScheduler(self.process, concurrency=1)
+        order = self.run_queued(scheduler, [
+            ('a', 'bulk', 'bulk-1'), ('a', 'bulk', 'bulk-2'), ('b', 'interactive', 'interactive-1'),
+        ])
+
+        self.assertEqual(order, ['interactive-1', 'bulk-1', 'bulk-2'])
+
+    def test_fair_share_between_customers(self):
+        """Test that a customer with many queued jobs does not delay the others"""
+        scheduler = ProcessingScheduler(self.process, concurrency=1)
+        jobs = [('big', 'bulk', f'big-{i}') for i in range(4)] + [('small', 'bulk', 'small-0'),
+                                                                 ('small', 'bulk', 'small-1')]
+        order = self.run_queued(scheduler, jobs)
+
+        self.assertEqual(order, ['big-0', 'small-0', 'big-1', 'small-1', 'big-2', 'big-3'])
+
+    def test_cost_weighted_share(self):
+        """Test that larger jobs use up a customer's share faster"""
+        scheduler = ProcessingScheduler(self.process, concurrency=1)
+        futures = [scheduler.submit('blocker', 'interactive', 'blocker')]
+        self.assertTrue(self.started.wait(5))
+        futures += [scheduler.submit('large', 'bulk', f'large-{i}', cost=3) for i in range(2)]
+        futures += [scheduler.submit('small', 'bulk', f'small-{i}') for i in range(4)]
+        self.release.set()
+        for future in futures:
+            future.result(5)
+        scheduler.close()
+
+        self.assertLess(self.order.index('small-2'), self.order.index('large-1'))
+
+    def test_bulk_leaves_reserved_workers(self):
+        """Test that bulk jobs cannot occupy the workers kept for interactive uploads"""
+        scheduler = ProcessingScheduler(self.process, concurrency=2, reserved_interactive=1)
+        bulk = scheduler.submit('a', 'bulk', 'blocker')
+        self.assertTrue(self.started.wait(5))
+        queued = scheduler.submit('a', 'bulk', 'bulk-2')
+        # The second worker is free but reserved: the interactive job runs while the blocker holds the first
+        self.assertEqual(scheduler.run('b', 'interactive', 'interactive-1'), 'interactive-1')
+        self.assertFalse(queued.done())
+        self.release.set()
+        bulk.result(5)
+        queued.result(5)
+        scheduler.close()
+
+        self.assertEqual(self.order, ['interactive-1', 'blocker', 'bulk-2'])
+
+    def test_admission_control(self):
+        """Test that jobs the rate budget cannot start in time are refused"""
+        # One OCR call per minute: the second queued interactive job would wait about two minutes
+        scheduler = ProcessingScheduler(self.process, concurrency=1, ocr_per_minute=1,
+                                        max_wait={'interactive': 90})
+        scheduler.submit('a', 'interactive', 'first').result(5)
+        scheduler.submit('a', 'interactive', 'second')
+        with self.assertRaises(SchedulerFull) as error:
+            for _ in range(3):
+                scheduler.submit('b', 'interactive', 'third')
+        self.assertGreater(error.exception.retry_after, 90)
+        self.assertEqual(scheduler.stats()['interactive']['queued'], 2)
+        with self.assertRaises(ValueError):
+            scheduler.submit('a', 'urgent', 'job')
+
+    def test_queue_wait_metric(self):
+        """Test that the queue wait of each class is recorded"""
+        before = QUEUE_WAIT.render()
+        scheduler = ProcessingScheduler(self.process, concurrency=1)
+        scheduler.run('a', 'bulk', 'job')
+        scheduler.close()
+
+        self.assertNotEqual(QUEUE_WAIT.render(), before)
+        self.assertIn('priority="bulk"', '\n'.join(QUEUE_WAIT.render()))
+
+    def test_token_bucket(self):
+        """Test the refill arithmetic of the rate budget"""
+        bucket = TokenBucket(60)
+        bucket.take(60)
+        self.assertAlmostEqual(bucket.delay(1), 1.0, places=1)
+        self.assertEqual(TokenBucket(0).delay(1000), 0.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import os
+import threading
+import unittest
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.search_index import SearchIndex, build_match_query
+from utils.database import Database
+
+class TestSearchIndex(unittest.TestCase):
+    """Test cases for the SearchIndex service"""
+
+    def setUp(self):
+        """Index two invoices in an in-memory database"""
+        self.index = SearchIndex(Database(':memory:'))
+        self.index.index_invoice(
+            {
+                "id": "a",
+                "provider": "LYDEC",
+                "invoice_number": "201850448855",
+                "items": [{"description": "CONSO. H. CREUSES"}, {"description": "DEPASS. DE PUISSANCE"}]
+            },
+            {"issues": [{"description": "Pénalités de dépassement appliquées", "severity": "high"}]},
+            "Détail de votre facture N° 201850448855 Montant TTC"
+        )
+        self.index.index_invoice(
+            {"id": "b", "provider": "ONEE", "invoice_number": "778899", "items": [{"description": "RDV. DE PUISSANCE"}]},
+            {"issues": ["Consommation concentrée durant les heures pleines"], "severity": ["medium"]}
+        )
+
+    def test_build_match_query(self):
+        """Test that user input is quoted and prefixes are kept"""
+        self.assertEqual(build_match_query('"DEPASS. DE" puis* OR'), '"DEPASS. DE" "puis"* "OR"')
+        self.assertEqual(build_match_query('x', 'items'), 'items : ("x")')
+        self.assertEqual(build_match_query('  '), '')
+
+    def test_phrase_and_prefix_queries(self):
+        """Test phrase, prefix and accent-insensitive queries"""
+        self.assertEqual([r["invoice_id"] for r in self.index.search('"DEPASS. DE PUISSANCE"')["results"]], ["a"])
+        self.assertEqual(self.index.search("2018504*")["total"], 1)
+        self.assertEqual(self.index.search("puissance")["total"], 2)
+        self.assertEqual(self.index.search("detail", field="ocr_text")["total"], 1)
+
+    def test_facets(self):
+        """Test facet filters and counts"""
+        result = self.index.search("puissance", {"severity": "medium"})
+
+        self.assertEqual([r["invoice_id"] for r in result["results"]], ["b"])
+        self.assertEqual(result["facets"]["issue_type"], {"peak_concentration": 1})
+
+        all_facets = self.index.search()["facets"]
+        self.assertEqual(all_facets["provider"], {"LYDEC": 1, "ONEE": 1})
+        self.assertEqual(all_facets["issue_type"], {"power_overrun": 1, "peak_concentration": 1})
+
+    def test_reindex_replaces_document(self):
+        """Test that indexing an invoice again replaces its content"""
+        self.index.index_invoice({"id": "b", "provider": "REDAL", "invoice_number": "1"})
+
+        self.assertEqual(self.index.count(), 2)
+        self.assertEqual(self.index.search("778899")["total"], 0)
+        self.assertEqual(self.index.search(filters={"provider": "REDAL"})["total"], 1)
+
+    def test_in_memory_database_is_shared_across_threads(self):
+        """Test that request threads see the schema and data of an in-memory database"""
+        results = []
+        thread = threading.Thread(target=lambda: results.append(self.index.search("LYDEC")["total"]))
+        thread.start()
+        thread.join()
+
+        self.assertEqual(results, [1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import os
+import unittest
+
+import numpy as np
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.history_analyzer import invoice_metrics
+from services.tariff_simulator import TariffSimulator, tariff_prices
+
+def make_invoice(month, subscribed=40, max_power=None, overrun=None, peak=6000):
+    """Build extracted invoice data for one billing month of 2018"""
+    items = [
+        {"description": "CONSO. H. NORMALES", "quantity": 15000, "unit_price": 0.886, "total": 15000 * 0.886},
+        {"description": "CONSO. H. CREUSES", "quantity": 7000, "unit_price": 0.649, "total": 7000 * 0.649},
+        {"description": "CONSO. H. DE POINTE", "quantity": peak, "unit_price": 1.242, "total": peak * 1.242},
+        {"description": "RDV. DE PUISSANCE", "quantity": subscribed, "unit_price": 100.0, "total": subscribed * 100.0}
+    ]
+    if overrun:
+        items.append({"description": "DEPASS. DE PUISSANCE", "quantity": overrun, "unit_price": 300.0,
+                      "total": overrun * 300.0})
+    return {
+        "customer_id": "C1",
+        "period_end": f"2018-{month:02d}-01",
+        "total_kwh": 22000 + peak,
+        "items": items,
+        "max_power_kw": max_power
+    }
+
+class TestTariffSimulator(unittest.TestCase):
+    """Test cases for the TariffSimulator service"""
+
+    def setUp(self):
+        """Set up a simulator without load shifting"""
+        self.simulator = TariffSimulator(max_load_shift=0.0)
+
+    def test_prices(self):
+        """Test that the prices come from the line items"""
+        prices = tariff_prices(make_invoice(1))
+        self.assertEqual(prices, {'power': 100.0, 'overrun': None, 'peak': 1.242, 'off_peak': 0.649})
+        self.assertEqual(tariff_prices(make_invoice(1, overrun=2))['overrun'], 300.0)
+
+    def test_oversized_subscribed_power(self):
+        """Test that without billed overruns the optimum covers the highest power drawn"""
+        history = np.array([invoice_metrics(make_invoice(month, max_power=20 + month)) for month in range(1, 12)])
+
+        result = self.simulator.simulate(make_invoice(12, max_power=25, overrun=None), history)
+
+        self.assertEqual(result['periods'], 12)
+        self.assertEqual(result['optimum']['subscribed_power'], 31.0)
+        # 40 - 31 kW saved each month at 100 per kW
+        self.assertAlmostEqual(result['potential_savings'], 900.0)
+        self.assertAlmostEqual(result['savings_breakdown']['subscribed_power'], 900.0)
+        self.assertLess(result['efficiency_score'], 100)
+
+    def test_recurrent_overruns(self):
+        """Test that recurrent overruns raise the optimal subscribed power"""
+        history = np.array([invoice_metrics(make_invoice(month, subscribed=20, overrun=5)) for month in range(1, 12)])
+
+        result = self.simulator.simulate(make_invoice(12, subscribed=20, overrun=5), history)
+
+        self.assertEqual(result['optimum']['subscribed_power'], 25.0)
+        # 5 kW of overrun at 300 replaced by 5 kW subscribed at 100
+        self.assertAlmostEqual(result['potential_savings'], 1000.0)
+
+    def test_load_shift(self):
+        """Test the savings of moving peak consumption to off-peak hours"""
+        result = TariffSimulator(max_load_shift=0.1).simulate(make_invoice(1, max_power=40))
+
+        self.assertEqual(result['optimum']['load_shift'], 0.1)
+        self.assertAlmostEqual(result['savings_breakdown']['load_shift'], 600 * (1.242 - 0.649), places=1)
+        self.assertEqual(result['curves']['load_shift'][0], [0.0, 0.0])
+        self.assertLessEqual(len(result['curves']['subscribed_power']), 20)
+
+    def test_without_prices(self):
+        """Test that invoices without power or energy prices are not simulated"""
+        self.assertIsNone(self.simulator.simulate({"items": [{"description": "ENTRETIEN COMPTAGE", "total": 577.93}]}))
+
+    def test_power_line_without_quantity(self):
+        """Test that a subscribed power line without its quantity is not simulated instead of failing"""
+        invoice = make_invoice(1)
+        del invoice['items'][3]['quantity']
+
+        result = self.simulator.simulate(invoice)
+
+        self.assertIsNone(result['optimum']['subscribed_power'])
+        self.assertEqual(result['curves']['subscribed_power'], [])
+
+        invoice['items'] = invoice['items'][3:]
+        self.assertIsNone(self.simulator.simulate(invoice))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import io
+import os
+import hashlib
+import tempfile
+import unittest
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fpdf import FPDF
+from PIL import Image
+
+from services.upload_ingest import UploadError, UploadIngestor, sniff_file_type
+
+def make_pdf() -> bytes:
+    pdf = FPDF()
+    pdf.add_page()
+    pdf.set_font('Arial', size=10)
+    pdf.cell(0, 5, 'CONSO. H. CREUSES 6 898')
+    return pdf.output(dest='S').encode('latin-1')
+
+def make_image(image_format: str) -> bytes:
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 48), 'white').save(buffer, format=image_format)
+    return buffer.getvalue()
+
+class TestUploadIngest(unittest.TestCase):
+    """Test cases for the UploadIngestor service"""
+
+    def setUp(self):
+        """Create a temporary upload directory"""
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.ingestor = UploadIngestor(self.temp_dir.name, max_bytes=1024 * 1024, chunk_size=1024, use_magika=False)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def assertRejected(self, data: bytes, status_code: int, ingestor: UploadIngestor = None):
+        with self.assertRaises(UploadError) as context:
+            (ingestor or self.ingestor).ingest(io.BytesIO(data), 'invoice.pdf')
+        self.assertEqual(context.exception.status_code, status_code)
+        # Nothing is left behind
+        self.assertEqual(os.listdir(self.temp_dir.name), [])
+
+    def test_sniff_file_type(self):
+        """Test detection of the accepted types from magic bytes"""
+        self.assertEqual(sniff_file_type(b'%PDF-1.7\n'), 'pdf')
+        self.assertEqual(sniff_file_type(b'\r\n%PDF-1.4'), 'pdf')
+        self.assertEqual(sniff_file_type(make_image('PNG')), 'png')
+        self.assertEqual(sniff_file_type(make_image('JPEG')), 'jpg')
+        self.assertIsNone(sniff_file_type(b'PK\x03\x04'))
+
+    def test_ingest_pdf(self):
+        """Test that a valid PDF is stored under its detected type with its hash"""
+        data = make_pdf()
+        upload = self.ingestor.ingest(io.BytesIO(data), 'Facture mars.PNG')
+
+        self.assertEqual(upload['file_type'], 'pdf')
+        self.assertEqual(upload['size'], len(data))
+        self.assertEqual(upload['sha256'], hashlib.sha256(data).hexdigest())
+        self.assertTrue(upload['path'].endswith('_Facture_mars.pdf'))
+        with open(upload['path'], 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_ingest_images(self):
+        """Test that valid images are accepted"""
+        for image_format, file_type in (('PNG', 'png'), ('JPEG', 'jpg')):
+            upload = self.ingestor.ingest(io.BytesIO(make_image(image_format)), 'scan')
+            self.assertEqual(upload['file_type'], file_type)
+
+    def test_rejections(self):
+        """Test that empty, unsupported, oversized and corrupt files are rejected"""
+        self.assertRejected(b'', 400)
+        self.assertRejected(b'PK\x03\x04' + b'\x00' * 100, 415)
+        self.assertRejected(b'%PDF-1.4\n' + b'x' * (2 * 1024 * 1024), 413)
+        self.assertRejected(b'%PDF-1.4\nnot really a pdf', 400)
+        self.assertRejected(make_image('PNG')[:-30], 400)
+        self.assertRejected(make_image('JPEG')[:200], 400)
+
+    def test_magika_type_mismatch(self):
+        """Test that magika rejects a text file starting with a PDF header"""
+        ingestor = UploadIngestor(self.temp_dir.name, use_magika=True)
+        self.assertRejected(b'%PDF-1.4\n' + b'just some text ' * 50, 415, ingestor)
+        self.assertEqual(ingestor.ingest(io.BytesIO(make_pdf()), 'a.pdf')['file_type'], 'pdf')
+
+if __name__ == '__main__':
+    unittest.main()
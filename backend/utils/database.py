@@ -0,0 +1,210 @@
+import os
+import uuid
+import queue
+import sqlite3
+import logging
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, List, Optional, Tuple
+
+from utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+COMMIT_BATCH_SIZE = registry.histogram(
+    'aienergy_group_commit_batch_size', 'Operations committed per transaction by the group committer', [],
+    (1, 2, 4, 8, 16, 32, 64, 128)
+)
+
+SQLITE_PREFIX = 'sqlite:///'
+
+def get_database_path(database_uri: Optional[str] = None, base_dir: Optional[str] = None) -> str:
+    """
+    Resolve the SQLite database file from a database URI
+
+    Args:
+        database_uri: URI such as 'sqlite:///energy_invoices.db' (defaults to DATABASE_URI)
+        base_dir: Directory relative paths are resolved against
+
+    Returns:
+        Path to the database file
+    """
+    database_uri = database_uri or os.environ.get('DATABASE_URI', 'sqlite:///energy_invoices.db')
+    if not database_uri.startswith(SQLITE_PREFIX):
+        raise ValueError(f"Unsupported database URI: {database_uri} (only sqlite:/// is supported)")
+
+    path = database_uri[len(SQLITE_PREFIX):]
+    if path != ':memory:' and not os.path.isabs(path) and base_dir:
+        path = os.path.join(base_dir, path)
+    return path
+
+class Database:
+    """Thread-local connections to the application's SQLite database"""
+
+    def __init__(self, path: str):
+        """
+        Initialize the database
+
+        Args:
+            path: Path to the SQLite database file
+        """
+        self.path = path
+        self._local = threading.local()
+        if path == ':memory:':
+            # Connections are per thread, so they share one named in-memory database (the
+            # memdb VFS, which unlike shared cache honours the busy timeout), kept alive by a
+            # connection held for the lifetime of this object
+            self._uri = f'file:/aienergy-{uuid.uuid4().hex}?vfs=memdb'
+            self._keepalive = sqlite3.connect(self._uri, uri=True, check_same_thread=False)
+        else:
+            self._uri = None
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """Get the connection of the current thread, opening it if needed"""
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            if self._uri:
+                conn = sqlite3.connect(self._uri, uri=True, timeout=30, isolation_level=None)
+            else:
+                conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            # WAL lets readers run concurrently with the single writer, across workers
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = conn
+        return conn
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """
+        Run statements in a write transaction, committed on success and rolled back on error
+
+        Yields:
+            The connection of the current thread
+        """
+        conn = self.connection
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def executescript(self, script: str) -> None:
+        """Run a schema script"""
+        self.connection.executescript(script)
+
+Operation = Callable[[sqlite3.Connection], Any]
+
+class GroupCommitter:
+    """
+    Runs write operations from many threads in shared transactions
+
+    A single writer thread commits every operation queued while the previous
+    commit was in progress in one transaction, so concurrent writers share one
+    fsync (the writer connection uses synchronous=FULL, so a returned
+    operation is durable). Each operation runs in its own savepoint: a failing
+    operation is rolled back without affecting the rest of its batch.
+    """
+
+    def __init__(self, database: Database, max_batch: int = 64, max_delay: float = 0.0):
+        """
+        Initialize the committer
+
+        Args:
+            database: Database to write to
+            max_batch: Maximum number of operations per transaction
+            max_delay: Seconds to wait for more operations before committing a batch
+                (0 only batches operations that are already queued)
+        """
+        self.database = database
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue: "queue.Queue[Optional[Tuple[Operation, Future]]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def submit(self, operation: Operation) -> Any:
+        """
+        Run an operation in a write transaction and wait until it is committed
+
+        Args:
+            operation: Callable receiving the connection
+
+        Returns:
+            The value returned by the operation (its exception is raised instead)
+        """
+        future: Future = Future()
+        self._ensure_started()
+        self._queue.put((operation, future))
+        return future.result()
+
+    def close(self) -> None:
+        """Commit the queued operations and stop the writer thread"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _ensure_started(self) -> None:
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='group-commit', daemon=True)
+                    self._thread.start()
+
+    def _run(self) -> None:
+        self.database.connection.execute('PRAGMA synchronous=FULL')
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            stop = False
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=self.max_delay) if self.max_delay else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            self._commit(batch)
+            if stop:
+                return
+
+    def _commit(self, batch: List[Tuple[Operation, Future]]) -> None:
+        conn = self.database.connection
+        results = []
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for operation, _ in batch:
+                conn.execute('SAVEPOINT operation')
+                try:
+                    results.append((operation(conn), None))
+                    conn.execute('RELEASE operation')
+                except Exception as e:
+                    conn.execute('ROLLBACK TO operation')
+                    conn.execute('RELEASE operation')
+                    results.append((None, e))
+            conn.execute('COMMIT')
+        except Exception as e:
+            logger.error(f"Group commit of {len(batch)} operations failed: {str(e)}")
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        COMMIT_BATCH_SIZE.observe(len(batch))
+        for (_, future), (result, error) in zip(batch, results):
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
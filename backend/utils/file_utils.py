@@ -1,9 +1,13 @@
 import os
+import time
 import logging
 from typing import List, Set
 
 logger = logging.getLogger(__name__)
 
+# Temporary files older than this are left over by crashed workers
+TEMP_MAX_AGE = 3600
+
 def get_allowed_extensions() -> Set[str]:
     """Get the set of allowed file extensions"""
     return {'pdf', 'jpg', 'jpeg', 'png'}
@@ -71,6 +75,33 @@ def list_files_in_directory(directory_path: str, extensions: List[str] = None) -
     
     return files
 
+def remove_stale_files(directory: str, max_age: float = TEMP_MAX_AGE, prefix: str = '') -> int:
+    """
+    Remove files older than max_age seconds from a temporary directory
+
+    Args:
+        directory: Directory to clean
+        max_age: Minimum age of the removed files, so files in use by other workers are kept
+        prefix: Only remove files whose name starts with this prefix
+
+    Returns:
+        Number of files removed
+    """
+    if not os.path.isdir(directory):
+        return 0
+    cutoff = time.time() - max_age
+    removed = 0
+    for entry in os.scandir(directory):
+        try:
+            if entry.is_file() and entry.name.startswith(prefix) and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                removed += 1
+        except OSError:
+            continue
+    if removed:
+        logger.info(f"Removed {removed} stale temporary files from {directory}")
+    return removed
+
 
 
 
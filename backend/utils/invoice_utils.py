@@ -0,0 +1,170 @@
+import re
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Line item categories, matched against the upper-cased item description
+# (e.g. "CONSO. H. NORMALES", "RDV. DE PUISSANCE", "DEPASS. DE PUISSANCE")
+ITEM_PATTERNS = [
+    ('peak', re.compile(r"CONSO.*(POINTE|PLEINES|\bHP\b)")),
+    ('off_peak', re.compile(r"CONSO.*(CREUSES|\bHC\b)")),
+    ('normal', re.compile(r"CONSO.*(NORMALES|\bHN\b)")),
+    ('power_overrun', re.compile(r"DEPASS")),
+    ('subscribed_power', re.compile(r"(RDV|REDEVANCE).*PUISSANCE")),
+    ('reactive', re.compile(r"REACTIVE|COS")),
+]
+
+ENERGY_CATEGORIES = ('peak', 'off_peak', 'normal')
+
+def to_float(value: Any) -> Optional[float]:
+    """
+    Convert an extracted value to a float
+
+    Args:
+        value: Number or string as returned by the LLM (e.g. "13 818,99")
+
+    Returns:
+        The float value, or None if the value is missing or not numeric
+    """
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = re.sub(r"[^\d,.\-]", "", str(value))
+    if ',' in text and '.' in text:
+        # Whichever separator comes last is the decimal one
+        if text.rfind(',') > text.rfind('.'):
+            text = text.replace('.', '').replace(',', '.')
+        else:
+            text = text.replace(',', '')
+    elif ',' in text:
+        text = text.replace(',', '.')
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+def classify_item(description: Optional[str]) -> str:
+    """
+    Classify an invoice line item from its description
+
+    Args:
+        description: Line item description
+
+    Returns:
+        One of 'peak', 'off_peak', 'normal', 'power_overrun', 'subscribed_power',
+        'reactive' or 'other'
+    """
+    text = (description or '').upper()
+    for category, pattern in ITEM_PATTERNS:
+        if pattern.search(text):
+            return category
+    return 'other'
+
+def parse_date(value: Any) -> Optional[datetime]:
+    """Parse an extracted date (YYYY-MM-DD or DD/MM/YYYY), returning None on failure"""
+    if not value or not isinstance(value, str):
+        return None
+    for fmt in ('%Y-%m-%d', '%d/%m/%Y', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.strptime(value[:19], fmt)
+        except ValueError:
+            continue
+    return None
+
+def billing_period(invoice: Dict[str, Any]) -> str:
+    """
+    Get the billing month of an invoice
+
+    Args:
+        invoice: Extracted invoice data
+
+    Returns:
+        Month as 'YYYY-MM' (from period_end, period_start or issue_date), or '' if unknown
+    """
+    for key in ('period_end', 'period_start', 'issue_date'):
+        date = parse_date(invoice.get(key))
+        if date:
+            return date.strftime('%Y-%m')
+    return ''
+
+def customer_key(invoice: Dict[str, Any]) -> str:
+    """Get the key identifying the customer of an invoice ('' if unknown)"""
+    return str(invoice.get('customer_id') or invoice.get('customer_name') or '')
+
+def summarize_items(items: Optional[List[Dict[str, Any]]]) -> Dict[str, Dict[str, float]]:
+    """
+    Sum line item quantities and totals by category
+
+    Args:
+        items: Extracted line items
+
+    Returns:
+        Dict mapping category to {'quantity': ..., 'total': ..., 'unit_price': ...}
+    """
+    summary = {}
+    for item in items or []:
+        if not isinstance(item, dict):
+            continue
+        category = classify_item(item.get('description'))
+        entry = summary.setdefault(category, {'quantity': 0.0, 'total': 0.0, 'unit_price': None})
+        entry['quantity'] += to_float(item.get('quantity')) or 0.0
+        entry['total'] += to_float(item.get('total')) or 0.0
+        if entry['unit_price'] is None:
+            entry['unit_price'] = to_float(item.get('unit_price'))
+    return summary
+
+# Issue types of the "Essentiel pour l'optimisation des redevances électriques" catalogue,
+# matched against the lower-cased issue description returned by the analysis
+ISSUE_PATTERNS = [
+    ('power_factor', re.compile(r"cos\s*φ|cos\s*phi|facteur de puissance|réactive|reactive")),
+    ('oversized_subscribed_power', re.compile(r"souscrite trop élevée|surcoût mensuel|surdimensionn")),
+    ('power_overrun', re.compile(r"dépassement|depassement|110\s*%")),
+    ('peak_concentration', re.compile(r"heures pleines|heures de pointe|\bhp\b|concentr")),
+]
+
+def classify_issue(description: Optional[str]) -> str:
+    """
+    Classify an analysis issue from its description
+
+    Args:
+        description: Issue description (in French)
+
+    Returns:
+        One of 'power_factor', 'oversized_subscribed_power', 'power_overrun',
+        'peak_concentration' or 'other'
+    """
+    text = (description or '').lower()
+    for issue_type, pattern in ISSUE_PATTERNS:
+        if pattern.search(text):
+            return issue_type
+    return 'other'
+
+def normalize_issues(analysis: Optional[Dict[str, Any]]) -> List[Dict[str, Optional[str]]]:
+    """
+    Get the issues of an analysis as dicts with description, severity and type
+
+    Accepts both issue objects ({"description", "severity"}) and the older
+    layout of parallel "issues" and "severity" string arrays.
+
+    Args:
+        analysis: Analysis returned by the LLM
+
+    Returns:
+        List of {'description': ..., 'severity': ..., 'type': ...}
+    """
+    if not isinstance(analysis, dict):
+        return []
+    severities = analysis.get('severity') if isinstance(analysis.get('severity'), list) else []
+    issues = []
+    for i, issue in enumerate(analysis.get('issues') or []):
+        if isinstance(issue, dict):
+            description, severity = issue.get('description'), issue.get('severity')
+        else:
+            description = str(issue)
+            severity = severities[i] if i < len(severities) else None
+        severity = str(severity).lower() if severity else None
+        issues.append({'description': description, 'severity': severity, 'type': classify_issue(description)})
+    return issues
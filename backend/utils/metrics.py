@@ -0,0 +1,318 @@
+import os
+import json
+import time
+import uuid
+import queue
+import random
+import logging
+import threading
+import logging.handlers
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Structured, one-JSON-object-per-line event log (see configure_structured_logging)
+event_logger = logging.getLogger('aienergy.events')
+
+trace_id_var: ContextVar[Optional[str]] = ContextVar('trace_id', default=None)
+payload_sampled_var: ContextVar[bool] = ContextVar('payload_sampled', default=False)
+
+# Longest string value written to the event log
+MAX_FIELD_LENGTH = 200
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+TOKEN_BUCKETS = (50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+BYTE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+LabelValues = Tuple[str, ...]
+
+class _Metric:
+    """Base class of metrics holding one series per combination of label values"""
+
+    type_name = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._series: Dict[LabelValues, Any] = {}
+
+    def _key(self, labels: Dict[str, Any]) -> LabelValues:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def _format_labels(self, key: LabelValues, extra: Optional[Dict[str, str]] = None) -> str:
+        pairs = list(zip(self.labelnames, key)) + list((extra or {}).items())
+        if not pairs:
+            return ''
+        escaped = (f'{k}="{v}"'.replace('\\', '\\\\').replace('\n', '\\n') for k, v in pairs)
+        return '{' + ','.join(escaped) + '}'
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type_name}']
+        with self._lock:
+            series = dict(self._series)
+        for key, value in sorted(series.items()):
+            lines.extend(self._render_series(key, value))
+        return lines
+
+    def _render_series(self, key: LabelValues, value: Any) -> List[str]:
+        return [f'{self.name}{self._format_labels(key)} {value}']
+
+class Counter(_Metric):
+    """Monotonically increasing counter"""
+
+    type_name = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+class Gauge(_Metric):
+    """Value that can go up and down"""
+
+    type_name = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._series[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+class Histogram(_Metric):
+    """Cumulative histogram with fixed buckets"""
+
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+            series['counts'][index] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def _render_series(self, key: LabelValues, value: Dict[str, Any]) -> List[str]:
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), value['counts']):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else f'{bound:g}'
+            lines.append(f'{self.name}_bucket{self._format_labels(key, {"le": le})} {cumulative}')
+        lines.append(f'{self.name}_sum{self._format_labels(key)} {value["sum"]}')
+        lines.append(f'{self.name}_count{self._format_labels(key)} {value["count"]}')
+        return lines
+
+class MetricsRegistry:
+    """Collection of metrics rendered together in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """Render every metric in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+registry = MetricsRegistry()
+
+STAGE_DURATION = registry.histogram(
+    'aienergy_stage_duration_seconds', 'Duration of invoice pipeline stages', ['stage', 'status'])
+STAGE_BYTES = registry.histogram(
+    'aienergy_stage_bytes', 'Size of the payload produced by a pipeline stage', ['stage'], BYTE_BUCKETS)
+LLM_TOKENS = registry.histogram(
+    'aienergy_llm_tokens', 'Tokens used per LLM call', ['stage', 'kind'], TOKEN_BUCKETS)
+HTTP_DURATION = registry.histogram(
+    'aienergy_http_request_duration_seconds', 'Duration of HTTP requests', ['method', 'route', 'status'])
+LLM_COST = registry.counter(
+    'aienergy_llm_cost_dollars_total', 'Estimated LLM spend from token usage', ['stage'])
+
+# Estimated LLM prices in dollars per million tokens
+PROMPT_PRICE_PER_MTOK = float(os.environ.get('LLM_PROMPT_PRICE_PER_MTOK', '0.59'))
+COMPLETION_PRICE_PER_MTOK = float(os.environ.get('LLM_COMPLETION_PRICE_PER_MTOK', '0.79'))
+
+def get_trace_id() -> str:
+    """Get the trace ID of the current request, creating one if needed"""
+    trace_id = trace_id_var.get()
+    if trace_id is None:
+        trace_id = start_trace()
+    return trace_id
+
+def start_trace(trace_id: Optional[str] = None) -> str:
+    """
+    Start a new trace in the current context
+
+    Args:
+        trace_id: Trace ID to reuse (e.g. from an X-Request-ID header)
+
+    Returns:
+        The trace ID
+    """
+    trace_id = (trace_id or '')[:64] or uuid.uuid4().hex
+    trace_id_var.set(trace_id)
+    rate = float(os.environ.get('DEBUG_PAYLOAD_SAMPLE_RATE', '0'))
+    payload_sampled_var.set(rate > 0 and random.random() < rate)
+    return trace_id
+
+def _bounded(value: Any) -> Any:
+    if isinstance(value, str) and len(value) > MAX_FIELD_LENGTH:
+        return value[:MAX_FIELD_LENGTH] + f'…(+{len(value) - MAX_FIELD_LENGTH})'
+    if isinstance(value, (int, float, bool)) or value is None:
+        return value
+    if isinstance(value, str):
+        return value
+    return _bounded(str(value))
+
+def log_event(event: str, **fields) -> None:
+    """
+    Write one structured event, tagged with the trace ID
+
+    String values are truncated to MAX_FIELD_LENGTH so the cost of an event is bounded.
+    """
+    if not event_logger.isEnabledFor(logging.INFO):
+        return
+    record = {'ts': round(time.time(), 3), 'event': event, 'trace_id': get_trace_id()}
+    record.update({key: _bounded(value) for key, value in fields.items()})
+    event_logger.info(json.dumps(record, ensure_ascii=False))
+
+def log_payload(name: str, payload: Any) -> None:
+    """
+    Log a full payload (OCR text, LLM output) for debugging
+
+    Only traces sampled with DEBUG_PAYLOAD_SAMPLE_RATE log payloads, so they
+    never cost anything on the hot path by default.
+    """
+    if payload_sampled_var.get():
+        logger.debug(f"[{get_trace_id()}] {name}: {payload}")
+        event_logger.info(json.dumps(
+            {'event': 'payload', 'trace_id': get_trace_id(), 'name': name, 'payload': str(payload)},
+            ensure_ascii=False
+        ))
+
+@contextmanager
+def stage(name: str, **fields) -> Iterator[Dict[str, Any]]:
+    """
+    Time a pipeline stage and record it in the metrics and the event log
+
+    Yields a dict the caller can fill with extra fields; a 'bytes' entry is
+    also recorded in the stage payload size histogram.
+
+    Args:
+        name: Stage name (e.g. 'whisper', 'extract')
+        fields: Extra fields for the event log
+    """
+    info: Dict[str, Any] = dict(fields)
+    status = 'ok'
+    start = time.perf_counter()
+    try:
+        yield info
+    except Exception as e:
+        status = 'error'
+        info['error'] = str(e)
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        STAGE_DURATION.observe(duration, stage=name, status=status)
+        if isinstance(info.get('bytes'), (int, float)):
+            STAGE_BYTES.observe(info['bytes'], stage=name)
+        log_event('stage', stage=name, status=status, duration_ms=round(duration * 1000, 1), **info)
+
+def cached_prompt_tokens(usage: Any) -> int:
+    """Prompt tokens served from the prefix cache (OpenAI-style prompt_tokens_details.cached_tokens)"""
+    details = getattr(usage, 'prompt_tokens_details', None)
+    if isinstance(details, dict):
+        return int(details.get('cached_tokens') or 0)
+    if details is not None:
+        return int(getattr(details, 'cached_tokens', 0) or 0)
+    return int(getattr(usage, 'cached_tokens', 0) or 0)
+
+def record_llm_usage(stage_name: str, usage: Any) -> Dict[str, int]:
+    """
+    Record token usage and estimated cost of an LLM call
+
+    Args:
+        stage_name: Pipeline stage of the call
+        usage: Usage object of the chat completion response (may be None)
+
+    Returns:
+        Dict with prompt_tokens and completion_tokens
+    """
+    prompt_tokens = int(getattr(usage, 'prompt_tokens', 0) or 0)
+    completion_tokens = int(getattr(usage, 'completion_tokens', 0) or 0)
+    if usage is not None:
+        LLM_TOKENS.observe(prompt_tokens, stage=stage_name, kind='prompt')
+        LLM_TOKENS.observe(completion_tokens, stage=stage_name, kind='completion')
+        LLM_TOKENS.observe(cached_prompt_tokens(usage), stage=stage_name, kind='cached')
+        LLM_COST.inc(
+            (prompt_tokens * PROMPT_PRICE_PER_MTOK + completion_tokens * COMPLETION_PRICE_PER_MTOK) / 1e6,
+            stage=stage_name
+        )
+    return {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+def configure_structured_logging() -> None:
+    """
+    Send the event log through a queue so the hot path never blocks on log I/O
+
+    Events are written as JSON lines to stderr by a background thread.
+    """
+    global _listener
+    if _listener is not None:
+        return
+    log_queue: queue.Queue = queue.Queue(maxsize=10000)
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    _listener = logging.handlers.QueueListener(log_queue, handler)
+    _listener.start()
+
+    event_logger.addHandler(_DroppingQueueHandler(log_queue))
+    event_logger.setLevel(logging.INFO)
+    event_logger.propagate = False
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that drops events instead of blocking when the queue is full"""
+
+    dropped = registry.counter('aienergy_log_events_dropped_total', 'Structured log events dropped on overflow')
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped.inc()
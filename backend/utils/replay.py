@@ -0,0 +1,90 @@
+import os
+import json
+import hashlib
+import logging
+import tempfile
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+REPLAY_MODES = ('record', 'replay')
+
+class ReplayMiss(LookupError):
+    """No recording for a request in replay mode"""
+
+def request_key(request: Any) -> str:
+    """SHA-256 of a JSON-serializable request"""
+    text = json.dumps(request, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+class ReplayStore:
+    """
+    Recordings of external calls on disk, keyed by a hash of the request
+
+    In 'replay' mode a missing recording is an error, so runs are deterministic and
+    never reach the network; in 'record' mode missing recordings are made by the caller.
+    """
+
+    def __init__(self, directory: str, mode: str = 'replay'):
+        """
+        Initialize the store
+
+        Args:
+            directory: Directory of the recordings
+            mode: 'record' or 'replay'
+        """
+        if mode not in REPLAY_MODES:
+            raise ValueError(f"mode must be one of {', '.join(REPLAY_MODES)}")
+        self.directory = directory
+        self.mode = mode
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f'{key}.json')
+
+    def get(self, key: str, what: str = 'request') -> Optional[Dict[str, Any]]:
+        """
+        Load a recording
+
+        Args:
+            key: Request key
+            what: Description of the request, for the error message
+
+        Returns:
+            The recording, or None in record mode when there is none
+
+        Raises:
+            ReplayMiss: In replay mode when there is no recording
+        """
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            if self.mode == 'replay':
+                raise ReplayMiss(f"No recorded response for {what} {key[:12]}")
+            return None
+
+    def put(self, key: str, recording: Dict[str, Any]) -> None:
+        """Save a recording (written then renamed, so concurrent recorders never leave a partial file)"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(recording, f, ensure_ascii=False, indent=1)
+        os.replace(temp_path, path)
+
+def replay_store_from_env(name: str) -> Optional[ReplayStore]:
+    """
+    Get the replay store of a service from REPLAY_MODE and REPLAY_DIR
+
+    Args:
+        name: Subdirectory of the service ('llm', 'ocr')
+
+    Returns:
+        The store, or None when replay is off
+    """
+    mode = os.environ.get('REPLAY_MODE', '').lower()
+    if mode not in REPLAY_MODES:
+        return None
+    directory = os.environ.get('REPLAY_DIR') or os.path.join(tempfile.gettempdir(), 'aienergy_replay')
+    return ReplayStore(os.path.join(directory, name), mode)
@@ -0,0 +1,285 @@
+import os
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+BREAKER_STATE = registry.gauge(
+    'aienergy_breaker_state', 'Circuit breaker state per dependency (0 closed, 1 half-open, 2 open)', ['dependency']
+)
+BREAKER_SHED = registry.counter(
+    'aienergy_breaker_shed_total', 'Calls refused without reaching a dependency', ['dependency', 'reason']
+)
+
+class DependencyUnavailable(Exception):
+    """Call refused because its dependency's breaker is open or its concurrency limit is reached"""
+
+    def __init__(self, dependency: str, reason: str, retry_after: float = 1.0):
+        super().__init__(f"{dependency} is unavailable ({reason})")
+        self.dependency = dependency
+        self.reason = reason
+        self.retry_after = retry_after
+
+class DeadlineExceeded(Exception):
+    """The processing deadline of a request has passed"""
+
+class Deadline:
+    """Time budget of one request, shared by every stage of its pipeline"""
+
+    def __init__(self, seconds: float):
+        """
+        Start the budget
+
+        Args:
+            seconds: Budget in seconds from now
+        """
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        """Seconds left (negative once expired)"""
+        return self.expires_at - time.monotonic()
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def check(self, stage_name: str) -> None:
+        """
+        Fail if the deadline has passed
+
+        Args:
+            stage_name: Stage about to start, for the error message
+
+        Raises:
+            DeadlineExceeded: If no time is left
+        """
+        if self.expired():
+            raise DeadlineExceeded(f"Processing deadline of {self.seconds:g}s exceeded before {stage_name}")
+
+_current_deadline: contextvars.ContextVar = contextvars.ContextVar('deadline', default=None)
+
+@contextmanager
+def deadline_scope(deadline: Optional[Deadline]) -> Iterator[Optional[Deadline]]:
+    """Make a deadline the current one for the calls made in this context"""
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+def current_deadline() -> Optional[Deadline]:
+    """Deadline of the request being processed by this thread, if any"""
+    return _current_deadline.get()
+
+def call_timeout(default: float, stage_name: str = 'the call') -> float:
+    """
+    Timeout of an outgoing call: its default, shortened to the time left before the deadline
+
+    Args:
+        default: Timeout without a deadline, in seconds
+        stage_name: Stage making the call, for the error message
+
+    Returns:
+        Timeout in seconds
+
+    Raises:
+        DeadlineExceeded: If the current deadline has passed
+    """
+    deadline = current_deadline()
+    if deadline is None:
+        return default
+    deadline.check(stage_name)
+    return max(min(default, deadline.remaining()), 0.1)
+
+class CircuitBreaker:
+    """
+    Health tracking and fail-fast for one upstream dependency
+
+    After failure_threshold consecutive failures (errors, or calls slower than
+    slow_call seconds) the breaker opens and calls are refused at once for
+    recovery_time seconds; then one probe call is let through (half-open) and
+    its outcome closes or reopens the breaker. At most max_concurrent calls run
+    at a time, so one slow dependency cannot hold every worker.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_time: float = 30.0,
+                 slow_call: Optional[float] = None, max_concurrent: Optional[int] = None):
+        """
+        Initialize the breaker (closed)
+
+        Args:
+            name: Dependency name, used in metrics and errors
+            failure_threshold: Consecutive failures opening the breaker
+            recovery_time: Seconds the breaker stays open before a probe
+            slow_call: Duration in seconds above which a successful call counts as a failure
+            max_concurrent: Calls allowed in flight at once (unlimited if None or 0)
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.slow_call = slow_call
+        self.max_concurrent = max_concurrent or None
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._in_flight = 0
+        self._stats = {'calls': 0, 'failures': 0, 'shed': 0}
+        self._latency: Optional[float] = None
+        self._last_error: Optional[str] = None
+        self._lock = threading.Lock()
+        BREAKER_STATE.set(0, dependency=name)
+
+    def available(self) -> bool:
+        """Whether a call would currently be let through"""
+        with self._lock:
+            if self.state == OPEN:
+                return time.monotonic() - self._opened_at >= self.recovery_time
+            if self.state == HALF_OPEN:
+                return not self._probing
+            return self.max_concurrent is None or self._in_flight < self.max_concurrent
+
+    def retry_after(self) -> float:
+        """Seconds until the breaker lets a probe through (0 if not open)"""
+        with self._lock:
+            if self.state != OPEN:
+                return 0.0
+            return max(self.recovery_time - (time.monotonic() - self._opened_at), 0.0)
+
+    def call(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """
+        Call the dependency through the breaker
+
+        Args:
+            fn: Function calling the dependency
+            args: Positional arguments of fn
+            kwargs: Keyword arguments of fn
+
+        Returns:
+            The result of fn
+
+        Raises:
+            DependencyUnavailable: If the breaker is open or the concurrency limit is reached
+        """
+        probe = self._acquire()
+        start = time.monotonic()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            self._release(probe, time.monotonic() - start, str(e) or type(e).__name__)
+            raise
+        duration = time.monotonic() - start
+        slow = self.slow_call is not None and duration > self.slow_call
+        self._release(probe, duration, f"slow call ({duration:.1f}s)" if slow else None)
+        return result
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Current state and health of the dependency"""
+        with self._lock:
+            state = self.state
+            if state == OPEN and time.monotonic() - self._opened_at >= self.recovery_time:
+                state = HALF_OPEN
+            return {
+                'state': state,
+                'consecutive_failures': self._failures,
+                'in_flight': self._in_flight,
+                'latency_ms': round(self._latency * 1000, 1) if self._latency is not None else None,
+                'last_error': self._last_error,
+                **self._stats,
+            }
+
+    def _acquire(self) -> bool:
+        """Reserve a call slot, returning whether the call is the half-open probe"""
+        with self._lock:
+            probe = False
+            if self.state == OPEN:
+                if time.monotonic() - self._opened_at < self.recovery_time:
+                    self._shed('open', self.recovery_time - (time.monotonic() - self._opened_at))
+                self._set_state(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self._probing:
+                    self._shed('open', 1.0)
+                self._probing = probe = True
+            elif self.max_concurrent is not None and self._in_flight >= self.max_concurrent:
+                self._shed('busy', 1.0)
+            self._in_flight += 1
+            self._stats['calls'] += 1
+            return probe
+
+    def _shed(self, reason: str, retry_after: float) -> None:
+        """Refuse a call (called with the lock held)"""
+        self._stats['shed'] += 1
+        BREAKER_SHED.inc(dependency=self.name, reason=reason)
+        raise DependencyUnavailable(self.name, reason, retry_after=max(retry_after, 1.0))
+
+    def _release(self, probe: bool, duration: float, error: Optional[str]) -> None:
+        """Record the outcome of a call and free its slot"""
+        with self._lock:
+            self._in_flight -= 1
+            if probe:
+                self._probing = False
+            self._latency = duration if self._latency is None else self._latency + 0.2 * (duration - self._latency)
+            if error is None:
+                self._failures = 0
+                if self.state != CLOSED:
+                    self._set_state(CLOSED)
+                return
+            self._stats['failures'] += 1
+            self._failures += 1
+            self._last_error = error
+            if probe or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                if self.state != OPEN:
+                    logger.warning(f"Circuit breaker for {self.name} opened: {error}")
+                self._set_state(OPEN)
+
+    def _set_state(self, state: str) -> None:
+        if state == CLOSED and self.state != CLOSED:
+            logger.info(f"Circuit breaker for {self.name} closed")
+        self.state = state
+        BREAKER_STATE.set(_STATE_VALUES[state], dependency=self.name)
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+def get_breaker(name: str) -> CircuitBreaker:
+    """
+    Get the breaker of a dependency, creating it from the environment on first use
+
+    BREAKER_FAILURES, BREAKER_RECOVERY_SECONDS and BREAKER_SLOW_CALL_SECONDS apply to
+    every dependency; <NAME>_MAX_CONCURRENT (e.g. LLMWHISPERER_MAX_CONCURRENT) limits
+    the calls in flight to one of them.
+
+    Args:
+        name: Dependency name ('llmwhisperer', 'llm')
+
+    Returns:
+        The shared breaker
+    """
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            slow_call = float(os.environ.get('BREAKER_SLOW_CALL_SECONDS', 0))
+            breaker = _breakers[name] = CircuitBreaker(
+                name,
+                failure_threshold=int(os.environ.get('BREAKER_FAILURES', 5)),
+                recovery_time=float(os.environ.get('BREAKER_RECOVERY_SECONDS', 30)),
+                slow_call=slow_call or None,
+                max_concurrent=int(os.environ.get(f'{name.upper()}_MAX_CONCURRENT', 0)),
+            )
+        return breaker
+
+def breaker_states() -> Dict[str, Dict[str, Any]]:
+    """Snapshot of every dependency's breaker"""
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.name: breaker.snapshot() for breaker in breakers}